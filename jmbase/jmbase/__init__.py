@@ -4,6 +4,6 @@ from builtins import *
 
 from .support import (get_log, chunks, debug_silence, debug_dump_object,
                       joinmarket_alert, core_alert, get_password,
-                      set_logging_level)
+                      set_logging_level, get_approx_size)
 from .commands import *
 
@@ -68,13 +68,22 @@ class JMMsgSignatureVerify(JMCommand):
                  (b'fullmsg', Unicode()),
                  (b'hostid', Unicode())]
 
+class JMRequestMemoryReport(JMCommand):
+    """Request a report of the memory used by
+    the daemon's state (see JMMemoryReport).
+    """
+    arguments = []
+
 """TAKER specific commands
 """
 
 class JMRequestOffers(JMCommand):
-    """Get orderbook from daemon
+    """Get orderbook from daemon; version is that
+    of the last orderbook received by the client (if any),
+    which allows the daemon to reply with only the changes
+    since then (JMOffersDelta).
     """
-    arguments = []
+    arguments = [(b'version', Integer(optional=True))]
 
 class JMFill(JMCommand):
     """Fill an offer/order
@@ -178,14 +187,38 @@ class JMRequestMsgSigVerify(JMCommand):
                  (b'max_encoded', Integer()),
                  (b'hostid', Unicode())]
 
+class JMMemoryReport(JMCommand):
+    """The number of entries and approximate size in
+    bytes of each of the daemon's state structures, as a
+    json-ified dict.
+    """
+    arguments = [(b'report', BigUnicode())]
+
 """ TAKER-specific commands
 """
 
 class JMOffers(JMCommand):
     """Return the entire contents of the
-    orderbook to TAKER, as a json-ified dict.
+    orderbook to TAKER, as a json-ified dict,
+    along with the number of counterparties known
+    from the daemon's orderbook cache (previous runs),
+    and the version number of this snapshot.
+    """
+    arguments = [(b'orderbook', BigUnicode()),
+                 (b'cached_counterparties', Integer(optional=True)),
+                 (b'version', Integer(optional=True))]
+
+class JMOffersDelta(JMCommand):
+    """Return the changes to the orderbook since
+    the version base_version already held by the TAKER:
+    updated is a json-ified list of offers added or changed,
+    removed a json-ified list of [counterparty, oid] pairs.
     """
-    arguments = [(b'orderbook', BigUnicode())]
+    arguments = [(b'base_version', Integer()),
+                 (b'version', Integer()),
+                 (b'updated', BigUnicode()),
+                 (b'removed', BigUnicode()),
+                 (b'cached_counterparties', Integer(optional=True))]
 
 class JMFillResponse(JMCommand):
     """Returns ioauth data from MAKER if successful.
@@ -0,0 +1,298 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import * # noqa: F401
+"""Lightweight instrumentation of the hot paths of makers, takers and
+the daemon: counters, gauges and histograms (of durations, mostly),
+kept in process and exported in the Prometheus text format by an
+optional local HTTP endpoint, and/or summarized in the log.
+Metrics are defined once, at module level, where they are used:
+
+    RPC_SECONDS = metrics.histogram('jm_rpc_seconds',
+        'Bitcoin Core RPC call duration', labelnames=('method',))
+    ...
+    with RPC_SECONDS.time(method=method):
+        ...
+
+Nothing is recorded until enable() is called; until then, every
+recording call returns after checking one module level flag.
+"""
+
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from twisted.internet import reactor, task
+from twisted.web import resource, server
+
+from .support import get_log
+
+log = get_log()
+
+#upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, float('inf'))
+
+_enabled = [False]
+#{name: metric}, in order of definition
+_registry = OrderedDict()
+
+
+def enable(on=True):
+    _enabled[0] = on
+
+
+def is_enabled():
+    return _enabled[0]
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_null_timer = _NullTimer()
+
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+        return False
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        #{tuple of label values: value}
+        self.values = {}
+
+    def key(self, labels):
+        return tuple([str(labels.get(n, '')) for n in self.labelnames])
+
+    def reset(self):
+        self.values = {}
+
+    def format_labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(['{}="{}"'.format(n, v.replace('\\', '\\\\')
+                                                .replace('"', '\\"'))
+                               for n, v in pairs]) + '}'
+
+    def render(self):
+        """Returns the lines of the text exposition format for
+        this metric.
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.doc),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for key in sorted(self.values.keys()):
+            lines.append('{}{} {}'.format(self.name, self.format_labels(key),
+                                          repr(float(self.get(key)))))
+        return lines
+
+    def get(self, key):
+        return self.values[key]
+
+    def summarize(self, key):
+        return '{}'.format(self.get(key))
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not _enabled[0]:
+            return
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        if not _enabled[0]:
+            return
+        self.values[self.key(labels)] = value
+
+    def set_function(self, f, **labels):
+        """The value is f(), evaluated when read (e.g. the length
+        of a queue); replaces any previous value.
+        """
+        self.values[self.key(labels)] = f
+
+    def remove(self, **labels):
+        self.values.pop(self.key(labels), None)
+
+    def get(self, key):
+        value = self.values[key]
+        return value() if callable(value) else value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, doc, labelnames)
+        self.buckets = tuple(buckets)
+        #every observation must fall in a bucket, for _count
+        if self.buckets[-1] != float('inf'):
+            self.buckets += (float('inf'),)
+
+    def observe(self, value, **labels):
+        if not _enabled[0]:
+            return
+        key = self.key(labels)
+        #[bucket counts, sum, max]
+        v = self.values.get(key)
+        if v is None:
+            v = self.values[key] = [[0] * len(self.buckets), 0.0, 0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                v[0][i] += 1
+                break
+        v[1] += value
+        v[2] = max(v[2], value)
+
+    def time(self, **labels):
+        """A context manager observing the duration of its block.
+        """
+        if not _enabled[0]:
+            return _null_timer
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.doc),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for key in sorted(self.values.keys()):
+            counts, total, vmax = self.values[key]
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, self.format_labels(key, ('le', le)),
+                    cumulative))
+            lines.append('{}_sum{} {}'.format(self.name,
+                                              self.format_labels(key),
+                                              repr(total)))
+            lines.append('{}_count{} {}'.format(self.name,
+                                                self.format_labels(key),
+                                                cumulative))
+        return lines
+
+    def summarize(self, key):
+        counts, total, vmax = self.values[key]
+        n = sum(counts)
+        return 'count={} mean={:.4f}s max={:.4f}s'.format(
+            n, total / n if n else 0.0, vmax)
+
+
+def _get_metric(cls, name, doc, labelnames, **kwargs):
+    metric = _registry.get(name)
+    if metric is None:
+        metric = _registry[name] = cls(name, doc, labelnames, **kwargs)
+    assert isinstance(metric, cls), "metric redefined: " + name
+    return metric
+
+
+def counter(name, doc, labelnames=()):
+    return _get_metric(Counter, name, doc, labelnames)
+
+
+def gauge(name, doc, labelnames=()):
+    return _get_metric(Gauge, name, doc, labelnames)
+
+
+def histogram(name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return _get_metric(Histogram, name, doc, labelnames, buckets=buckets)
+
+
+def timed(histogram):
+    """Decorator observing the duration of each call of the
+    decorated function in histogram.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not _enabled[0]:
+                return f(*args, **kwargs)
+            start = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                histogram.observe(time.time() - start)
+        return wrapper
+    return decorator
+
+
+def reset():
+    """Forgets all recorded values (but not the metrics).
+    """
+    for metric in _registry.values():
+        metric.reset()
+
+
+def render_text():
+    """Returns all metrics with recorded values, in the
+    Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _registry.values():
+        if metric.values:
+            lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def log_summary():
+    for metric in _registry.values():
+        for key in sorted(metric.values.keys()):
+            log.info("{}{}: {}".format(metric.name, metric.format_labels(key),
+                                       metric.summarize(key)))
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type',
+                          b'text/plain; version=0.0.4; charset=utf-8')
+        return render_text().encode('utf-8')
+
+
+def start_metrics_server(port, host='localhost'):
+    """Enables the metrics, and serves them over HTTP (at any path)
+    on host:port; returns the listening port.
+    """
+    enable()
+    listener = reactor.listenTCP(port, server.Site(MetricsResource()),
+                                 interface=host)
+    log.info("Serving metrics on http://{}:{}/metrics".format(
+        host, listener.getHost().port))
+    return listener
+
+
+def start_metrics_summary(interval):
+    """Enables the metrics, and logs a summary of them every
+    interval seconds; returns the LoopingCall.
+    """
+    enable()
+    loop = task.LoopingCall(log_summary)
+    loop.start(interval, now=False)
+    return loop
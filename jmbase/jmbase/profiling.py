@@ -0,0 +1,273 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import * # noqa: F401
+"""Profiling of a running process (a yield generator or joinmarketd)
+on demand, without restarting it. Everything that matters runs on the
+reactor thread, so that is what is profiled:
+
+* with cProfile (deterministic, but slows the process down while
+  active), dumped as a pstats file, or
+* by sampling the reactor thread's stack from another thread, dumped
+  as "folded" stacks (one line per stack, with its sample count; the
+  input format of flamegraph.pl),
+
+for a given number of seconds, to a timestamped file. Separately, a
+watchdog can log the stack of the reactor thread whenever a callback
+has been running for longer than a threshold.
+These are driven by a ProfilingControl, which can be commanded by a
+signal (see install_profiling_signal) and/or by lines of text on a
+local control socket (see start_profiling_control and COMMANDS).
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+from twisted.internet import protocol, reactor, task
+from twisted.protocols.basic import LineReceiver
+
+from .support import get_log
+
+log = get_log()
+
+#seconds between stack samples in sampling mode
+SAMPLE_INTERVAL = 0.005
+#most expensive functions logged at the end of a cProfile run
+LOG_TOP_FUNCTIONS = 15
+
+COMMANDS = """profile start [seconds] [cprofile|sample]
+profile stop
+slow start <milliseconds>
+slow stop
+status"""
+
+
+class ProfilingControl(object):
+
+    def __init__(self, profile_dir='.', default_duration=60.0,
+                 default_mode='cprofile'):
+        """
+        args:
+            profile_dir: directory in which the profiles are written
+            default_duration: seconds a profile runs for if not given
+            default_mode: 'cprofile' or 'sample'
+        """
+        self.profile_dir = profile_dir
+        self.default_duration = default_duration
+        self.default_mode = default_mode
+        self.mode = None
+        self.profile = None
+        self.samples = None
+        self.sampler = None
+        self.stop_call = None
+        self.watchdog = None
+        self.heartbeat = None
+        self.last_beat = None
+        self.slow_threshold = None
+        self.reactor_thread = None
+
+    #Methods below must be called on the reactor thread.
+
+    def start_profile(self, duration=None, mode=None):
+        """Returns a message describing the outcome.
+        """
+        if self.mode:
+            return "Already profiling"
+        mode = mode or self.default_mode
+        if mode not in ('cprofile', 'sample'):
+            return "Unknown profiling mode: " + mode
+        duration = duration or self.default_duration
+        self.mode = mode
+        if mode == 'cprofile':
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.samples = Counter()
+            self.sampler = threading.Thread(
+                target=self.sample, args=(threading.current_thread().ident,))
+            self.sampler.daemon = True
+            self.sampler.start()
+        self.stop_call = reactor.callLater(duration, self.stop_profile)
+        msg = "Profiling the reactor thread ({}) for {} seconds".format(
+            mode, duration)
+        log.info(msg)
+        return msg
+
+    def stop_profile(self):
+        """Stops profiling and writes the profile; returns a message
+        with its file name.
+        """
+        if not self.mode:
+            return "Not profiling"
+        if self.stop_call.active():
+            self.stop_call.cancel()
+        mode, self.mode = self.mode, None
+        path = os.path.join(self.profile_dir, "profile-{}-{}.{}".format(
+            time.strftime("%Y%m%d-%H%M%S"), os.getpid(),
+            "prof" if mode == 'cprofile' else "folded"))
+        if mode == 'cprofile':
+            self.profile.disable()
+            self.profile.dump_stats(path)
+            self.log_top_functions()
+            self.profile = None
+        else:
+            #the sampler stops on seeing mode reset
+            self.sampler.join()
+            self.sampler = None
+            with open(path, 'w') as f:
+                for stack, count in self.samples.most_common():
+                    f.write("{} {}\n".format(stack, count))
+            self.samples = None
+        msg = "Profile written to: " + path
+        log.info(msg)
+        return msg
+
+    def toggle_profile(self):
+        if self.mode:
+            self.stop_profile()
+        else:
+            self.start_profile()
+
+    def log_top_functions(self):
+        out = io.StringIO() if sys.version_info >= (3,) else io.BytesIO()
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats('cumulative').print_stats(LOG_TOP_FUNCTIONS)
+        log.info(out.getvalue())
+
+    def start_slow_trace(self, threshold):
+        """Logs the reactor thread's stack whenever a callback has
+        run for more than threshold seconds.
+        """
+        self.stop_slow_trace()
+        self.slow_threshold = threshold
+        self.reactor_thread = threading.current_thread().ident
+        self.beat()
+        self.heartbeat = task.LoopingCall(self.beat)
+        self.heartbeat.start(threshold / 4, now=False)
+        self.watchdog = threading.Thread(target=self.watch,
+                                         args=(self.heartbeat,))
+        self.watchdog.daemon = True
+        self.watchdog.start()
+        msg = "Tracing reactor callbacks slower than {:.0f}ms".format(
+            threshold * 1000)
+        log.info(msg)
+        return msg
+
+    def stop_slow_trace(self):
+        if not self.heartbeat:
+            return "Not tracing slow callbacks"
+        #the watchdog stops on seeing its heartbeat replaced
+        self.heartbeat.stop()
+        self.heartbeat = None
+        self.watchdog = None
+        return "Stopped tracing slow callbacks"
+
+    def beat(self):
+        self.last_beat = time.time()
+
+    def status(self):
+        status = ["profiling: " + (self.mode if self.mode else "off")]
+        if self.heartbeat:
+            status.append("slow callback threshold: {:.0f}ms".format(
+                self.slow_threshold * 1000))
+        else:
+            status.append("slow callback tracing: off")
+        return ", ".join(status)
+
+    def handle_command(self, line):
+        """Runs a command (see COMMANDS); returns the response.
+        """
+        args = line.split()
+        try:
+            if args[:2] == ['profile', 'start'] and len(args) <= 4:
+                return self.start_profile(
+                    float(args[2]) if len(args) > 2 else None,
+                    args[3] if len(args) > 3 else None)
+            elif args == ['profile', 'stop']:
+                return self.stop_profile()
+            elif args[:2] == ['slow', 'start'] and len(args) == 3:
+                return self.start_slow_trace(float(args[2]) / 1000)
+            elif args == ['slow', 'stop']:
+                return self.stop_slow_trace()
+            elif args == ['status']:
+                return self.status()
+        except ValueError:
+            pass
+        return "Commands are:\n" + COMMANDS
+
+    #Methods below run in their own threads.
+
+    def sample(self, thread_id):
+        while self.mode == 'sample':
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{}:{}".format(
+                    os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            #the last of the samples may be taken after mode was reset
+            samples = self.samples
+            if stack and samples is not None:
+                samples[";".join(reversed(stack))] += 1
+            time.sleep(SAMPLE_INTERVAL)
+
+    def watch(self, heartbeat):
+        reported = None
+        while self.heartbeat is heartbeat:
+            time.sleep(self.slow_threshold / 4)
+            last_beat = self.last_beat
+            blocked = time.time() - last_beat
+            if blocked > self.slow_threshold and reported != last_beat:
+                reported = last_beat
+                frame = sys._current_frames().get(self.reactor_thread)
+                log.warn("Reactor callback running for over {:.0f}ms, "
+                         "in:\n{}".format(blocked * 1000, "".join(
+                             traceback.format_stack(frame))))
+
+
+class ProfilingControlProtocol(LineReceiver):
+    delimiter = b'\n'
+
+    def lineReceived(self, line):
+        response = self.factory.control.handle_command(
+            line.decode('utf-8', 'replace'))
+        self.sendLine(response.encode('utf-8'))
+
+
+class ProfilingControlFactory(protocol.ServerFactory):
+    protocol = ProfilingControlProtocol
+
+    def __init__(self, control):
+        self.control = control
+
+
+def start_profiling_control(control, socket_path):
+    """Accepts commands (one per line, see COMMANDS) for control
+    on the unix socket socket_path, e.g. with:
+    socat - UNIX-CONNECT:socket_path
+    Returns the listening port.
+    """
+    listener = reactor.listenUNIX(socket_path,
+                                  ProfilingControlFactory(control),
+                                  mode=0o600, wantPID=True)
+    log.info("Profiling control socket listening at: " + socket_path)
+    return listener
+
+
+def install_profiling_signal(control, signum=getattr(signal, 'SIGUSR2',
+                                                     None)):
+    """On signal signum (by default, SIGUSR2), start profiling for
+    control's default duration, or stop profiling if running.
+    """
+    if signum is None:
+        return
+    signal.signal(signum, lambda signum, frame:
+                  reactor.callFromThread(control.toggle_profile))
@@ -53,6 +53,25 @@ def set_logging_level(level):
 def chunks(d, n):
     return [d[x:x + n] for x in range(0, len(d), n)]
 
+def get_approx_size(obj, _seen=None):
+    """Approximate memory usage, in bytes, of obj and of the
+    containers (dict, list, set, tuple) and their items, which it
+    holds, counting shared objects once.
+    """
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in iteritems(obj):
+            size += get_approx_size(k, _seen) + get_approx_size(v, _seen)
+    elif isinstance(obj, (list, set, tuple, frozenset)):
+        for x in obj:
+            size += get_approx_size(x, _seen)
+    return size
+
 def get_password(msg): #pragma: no cover
     password = getpass(msg)
     if not isinstance(password, bytes):
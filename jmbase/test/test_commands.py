@@ -73,12 +73,13 @@ class JMTestServerProtocol(JMBaseProtocol):
         return {'accepted': True}
 
     @JMRequestOffers.responder
-    def on_JM_REQUEST_OFFERS(self):
-        show_receipt("JMREQUESTOFFERS")
+    def on_JM_REQUEST_OFFERS(self, version):
+        show_receipt("JMREQUESTOFFERS", version)
         #build a huge orderbook to test BigString Argument
         orderbook = ["aaaa" for _ in range(2**15)]
         d = self.callRemote(JMOffers,
-                        orderbook=json.dumps(orderbook))
+                        orderbook=json.dumps(orderbook),
+                        cached_counterparties=0)
         self.defaultCallbacks(d)
         return {'accepted': True}
 
@@ -178,8 +179,8 @@ class JMTestClientProtocol(JMBaseProtocol):
         return {'accepted': True}
 
     @JMOffers.responder
-    def on_JM_OFFERS(self, orderbook):
-        show_receipt("JMOFFERS", orderbook)
+    def on_JM_OFFERS(self, orderbook, cached_counterparties, version):
+        show_receipt("JMOFFERS", orderbook, cached_counterparties, version)
         d = self.callRemote(JMFill,
                             amount=100,
                             commitment="dummycommitment",
@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import * # noqa: F401
+'''Tests of the instrumentation layer and its HTTP endpoint.'''
+
+import time
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web.client import Agent, readBody
+
+from jmbase import metrics
+
+CALLS = metrics.counter('test_calls_total', 'Calls', labelnames=('kind',))
+QUEUE = metrics.gauge('test_queue_lines', 'Queue length')
+SECONDS = metrics.histogram('test_seconds', 'Durations',
+                            buckets=(0.01, 1.0, float('inf')))
+
+
+@metrics.timed(SECONDS)
+def slow(t):
+    time.sleep(t)
+    return t
+
+
+class MetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.enable(False)
+        metrics.reset()
+
+    def test_disabled(self):
+        CALLS.inc(kind="a")
+        with SECONDS.time():
+            pass
+        assert slow(0) == 0
+        assert metrics.render_text() == '\n'
+
+    def test_render(self):
+        metrics.enable()
+        CALLS.inc(kind="a")
+        CALLS.inc(2, kind='b"')
+        queue = [1, 2, 3]
+        QUEUE.set_function(lambda: len(queue))
+        slow(0.02)
+        with SECONDS.time():
+            pass
+        SECONDS.observe(2.0)
+        lines = metrics.render_text().splitlines()
+        assert '# TYPE test_calls_total counter' in lines
+        assert 'test_calls_total{kind="a"} 1.0' in lines
+        assert 'test_calls_total{kind="b\\""} 2.0' in lines
+        queue.append(4)
+        assert 'test_queue_lines 4.0' in \
+            metrics.render_text().splitlines()
+        #cumulative buckets
+        assert 'test_seconds_bucket{le="0.01"} 1' in lines
+        assert 'test_seconds_bucket{le="1.0"} 2' in lines
+        assert 'test_seconds_bucket{le="+Inf"} 3' in lines
+        assert 'test_seconds_count 3' in lines
+        total = [l for l in lines if l.startswith('test_seconds_sum')][0]
+        assert 2.02 <= float(total.split()[1]) < 3.0
+        #the same metric is returned for the same name
+        assert metrics.counter('test_calls_total', 'Calls') is CALLS
+
+    def test_histogram_buckets(self):
+        metrics.enable()
+        #a +Inf bucket is added if not given, so nothing goes uncounted
+        hist = metrics.Histogram('test_bounded_seconds', 'Durations',
+                                 buckets=(0.1, 1.0))
+        assert hist.buckets == (0.1, 1.0, float('inf'))
+        hist.observe(0.05)
+        hist.observe(5.0)
+        lines = hist.render()
+        assert 'test_bounded_seconds_bucket{le="1.0"} 1' in lines
+        assert 'test_bounded_seconds_bucket{le="+Inf"} 2' in lines
+        assert 'test_bounded_seconds_count 2' in lines
+
+    @defer.inlineCallbacks
+    def test_server(self):
+        listener = metrics.start_metrics_server(0)
+        self.addCleanup(listener.stopListening)
+        CALLS.inc(kind="c")
+        url = 'http://localhost:{}/metrics'.format(listener.getHost().port)
+        response = yield Agent(reactor).request(b'GET', url.encode('ascii'))
+        body = yield readBody(response)
+        assert response.headers.getRawHeaders(b'content-type')[0].startswith(
+            b'text/plain')
+        assert b'test_calls_total{kind="c"} 1.0' in body.splitlines()
@@ -0,0 +1,124 @@
+#! /usr/bin/env python
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import * # noqa: F401
+'''Tests of on-demand profiling of the reactor thread.'''
+
+import logging
+import os
+import pstats
+import shutil
+import tempfile
+import time
+
+from twisted.internet import defer, protocol, reactor, task
+from twisted.protocols.basic import LineReceiver
+from twisted.trial import unittest
+
+from jmbase import get_log
+from jmbase.profiling import ProfilingControl, start_profiling_control
+
+
+def busy(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class ControlClient(LineReceiver):
+    delimiter = b'\n'
+
+    def connectionMade(self):
+        self.responses = defer.DeferredQueue()
+
+    def lineReceived(self, line):
+        self.responses.put(line.decode('utf-8'))
+
+    def command(self, line):
+        self.sendLine(line.encode('utf-8'))
+        return self.responses.get()
+
+
+class ProfilingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.control = ProfilingControl(self.tmpdir, default_duration=0.3)
+        self.handler = RecordingHandler()
+        get_log().addHandler(self.handler)
+
+    def tearDown(self):
+        get_log().removeHandler(self.handler)
+        self.control.stop_slow_trace()
+        self.control.stop_profile()
+        shutil.rmtree(self.tmpdir)
+
+    def profiles(self):
+        return [os.path.join(self.tmpdir, f) for f in os.listdir(self.tmpdir)
+                if f.startswith('profile-')]
+
+    @defer.inlineCallbacks
+    def test_cprofile(self):
+        self.control.start_profile()
+        assert self.control.start_profile() == "Already profiling"
+        yield task.deferLater(reactor, 0.0, busy, 0.05)
+        #stops itself after default_duration
+        yield task.deferLater(reactor, 0.5, lambda: None)
+        assert not self.control.mode
+        profiles = self.profiles()
+        assert len(profiles) == 1 and profiles[0].endswith('.prof')
+        stats = pstats.Stats(profiles[0])
+        assert any([f[2] == 'busy' for f in stats.stats.keys()])
+
+    @defer.inlineCallbacks
+    def test_sample(self):
+        self.control.start_profile(10, 'sample')
+        yield task.deferLater(reactor, 0.0, busy, 0.2)
+        msg = self.control.stop_profile()
+        assert msg.endswith('.folded')
+        with open(self.profiles()[0]) as f:
+            lines = f.read().splitlines()
+        #a frame name may contain spaces, a line ends with " <count>"
+        stacks = [l.rsplit(' ', 1) for l in lines]
+        busy_samples = sum([int(count) for stack, count in stacks
+                            if stack.endswith('test_profiling.py:busy')])
+        assert busy_samples > 5
+
+    @defer.inlineCallbacks
+    def test_slow_trace(self):
+        self.control.start_slow_trace(0.1)
+        yield task.deferLater(reactor, 0.2, lambda: None)
+        assert not [m for m in self.handler.messages if 'running for' in m]
+        yield task.deferLater(reactor, 0.0, busy, 0.3)
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        slow = [m for m in self.handler.messages if 'running for' in m]
+        assert len(slow) == 1 and 'in busy' in slow[0]
+
+    @defer.inlineCallbacks
+    def test_control_socket(self):
+        path = os.path.join(self.tmpdir, 'control.sock')
+        listener = start_profiling_control(self.control, path)
+        self.addCleanup(listener.stopListening)
+        client = yield protocol.ClientCreator(
+            reactor, ControlClient).connectUNIX(path)
+        self.addCleanup(client.transport.loseConnection)
+        response = yield client.command("status")
+        assert response == "profiling: off, slow callback tracing: off"
+        response = yield client.command("profile start 5 sample")
+        assert response.startswith("Profiling the reactor thread (sample)")
+        response = yield client.command("slow start 500")
+        response = yield client.command("status")
+        assert response == "profiling: sample, slow callback threshold: 500ms"
+        response = yield client.command("profile stop")
+        assert response.startswith("Profile written to: ")
+        response = yield client.command("bogus")
+        assert response == "Commands are:"
@@ -647,6 +647,17 @@ def mk_multisig_script(pubs, k):
 
 # Signing and verifying
 
+#The inputs of a transaction are usually verified one after the other;
+#the last transaction deserialized for a segwit verification is kept
+#(segwit_signature_form does not modify it), as (serialization, txobj).
+_last_verified_tx = (None, None)
+
+def _deserialize_for_verify(tx):
+    global _last_verified_tx
+    if _last_verified_tx[0] != tx:
+        _last_verified_tx = (tx, deserialize(tx))
+    return _last_verified_tx[1]
+
 def verify_tx_input(tx, i, script, sig, pub, scriptCode=None, amount=None):
     """ Given a hex-serialized transaction tx, an integer index i,
     a script (see more on this below), signature and pubkey, and optionally
@@ -686,7 +697,7 @@ def verify_tx_input(tx, i, script, sig, pub, scriptCode=None, amount=None):
     hashcode = binascii.unhexlify(sig[-2:])
 
     if amount:
-        modtx = segwit_signature_form(deserialize(tx), i,
+        modtx = segwit_signature_form(_deserialize_for_verify(tx), i,
                     scriptCode, amount, hashcode, decoder_func=lambda x: x)
     else:
         modtx = signature_form(tx, i, script, hashcode)
@@ -8,7 +8,8 @@ from .support import (calc_cj_fee, choose_sweep_orders, choose_orders,
                       cheapest_order_choose, weighted_order_choose,
                       rand_norm_array, rand_pow_array, rand_exp_array, select,
                       select_gradual, select_greedy, select_greediest,
-                      get_random_bytes, random_under_max_order_choose)
+                      get_random_bytes, random_under_max_order_choose,
+                      count_suitable_counterparties)
 from .jsonrpc import JsonRpcError, JsonRpcConnectionError, JsonRpc
 from .old_mnemonic import mn_decode, mn_encode
 from .taker import Taker
@@ -26,6 +27,7 @@ from .configure import (
 from .blockchaininterface import (BlockchainInterface, sync_wallet,
                                   RegtestBitcoinCoreInterface, BitcoinCoreInterface)
 from .electruminterface import ElectrumInterface
+from .simulatedinterface import SimulatedBlockchainInterface
 from .client_protocol import (JMTakerClientProtocol, JMClientProtocolFactory,
                               start_reactor)
 from .podle import (set_commitment_file, get_commitment_file,
@@ -41,12 +43,15 @@ from .commitment_utils import get_utxo_info, validate_utxo_data, quit
 from .taker_utils import (tumbler_taker_finished_update, restart_waiter,
                              restart_wait, get_tumble_log, direct_send,
                              tumbler_filter_orders_callback)
+from .tx_cache import TxCache, get_tx_cache
 from .wallet_utils import (
     wallet_tool_main, wallet_generate_recover_bip39, open_wallet,
     open_test_wallet_maybe, create_wallet, get_wallet_cls, get_wallet_path,
     wallet_display)
 from .maker import Maker
-from .yieldgenerator import YieldGenerator, YieldGeneratorBasic, ygmain
+from .address_pool import AddressImportPool, get_address_pool
+from .yieldgenerator import YieldGenerator, YieldGeneratorBasic, \
+    YieldGeneratorMultiOffer, ygmain
 # Set default logging handler to avoid "No handler found" warnings.
 
 try:
@@ -0,0 +1,140 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import * # noqa: F401
+"""With Bitcoin Core, each new address that a coinjoin pays to must be
+imported into Core's wallet, so that the coinjoin's transaction is
+seen. Importing it when it is chosen costs an RPC call in the middle
+of the coinjoin; instead, the next addresses of each internal branch
+(those of coinjoin outputs and change) are imported ahead of use, in
+the background, and the index up to which they are imported is kept
+in the wallet, so that it survives restarts (and is checked against
+the addresses imported into Core's wallet on each sync).
+"""
+
+from twisted.internet import defer, reactor
+
+from jmbase.support import get_log
+from .configure import jm_single
+
+log = get_log()
+
+#seconds after an address is taken before the pool is refilled, so that
+#the refill happens after the message using the address is sent
+REFILL_DELAY = 1.0
+
+
+class AddressImportPool(object):
+
+    def __init__(self, wallet, size):
+        """
+        args:
+            wallet: the wallet whose addresses are imported
+            size: number of addresses of each internal branch imported
+                ahead of the next unused index
+        """
+        self.wallet = wallet
+        self.size = size
+        self.refill_call = None
+        #set while a refill's import is in progress
+        self.refill_deferred = None
+
+    def import_new_addresses(self, addr_list):
+        """Makes sure that the addresses (of the wallet) are imported;
+        only those which are not in the pool are imported now.
+        """
+        bci = jm_single().bc_interface
+        if not hasattr(bci, 'import_addresses'):
+            return
+        assert hasattr(bci, 'get_wallet_name')
+        to_import = [a for a in addr_list if not self.is_imported(a)]
+        if to_import:
+            bci.import_addresses(to_import, bci.get_wallet_name(self.wallet))
+        self.schedule_refill()
+
+    def is_imported(self, addr):
+        if not self.wallet.is_known_addr(addr):
+            return False
+        md, internal, index = self.wallet.get_details(
+            self.wallet.addr_to_path(addr))
+        if internal not in (0, 1):
+            return False
+        return index < self.wallet.get_import_horizon(md, internal)
+
+    def schedule_refill(self):
+        if not self.size:
+            return
+        if self.refill_call and self.refill_call.active():
+            return
+        if self.refill_deferred:
+            return
+        self.refill_call = reactor.callLater(REFILL_DELAY, self.refill)
+
+    def refill(self):
+        """Imports the addresses of each internal branch up to size
+        ahead of its next unused index (in one call); returns the
+        number of addresses being imported.
+        With Bitcoin Core, the import runs in a thread, as the reactor
+        may be serving other coinjoins meanwhile; the addresses only
+        count as imported once it has finished (if one of them is used
+        before, it is just imported again, at once).
+        """
+        bci = jm_single().bc_interface
+        if not hasattr(bci, 'import_addresses') or self.refill_deferred:
+            return 0
+        addresses = []
+        horizons = {}
+        for md in range(self.wallet.mixdepth + 1):
+            next_index = self.wallet.get_next_unused_index(md, True)
+            horizon = max(self.wallet.get_import_horizon(md, True),
+                          next_index)
+            target = next_index + self.size
+            if horizon >= target:
+                continue
+            #as in sync, the new addresses are derived (and so become known
+            #to the wallet) without moving the next unused index
+            self.wallet.set_next_index(md, True, horizon, force=True)
+            addresses.extend([self.wallet.get_new_addr(md, True)
+                              for index in range(horizon, target)])
+            self.wallet.set_next_index(md, True, next_index)
+            horizons[md] = target
+        if not addresses:
+            return 0
+        log.debug("Importing {} addresses into the pool".format(
+            len(addresses)))
+        wallet_name = bci.get_wallet_name(self.wallet)
+        if hasattr(bci, 'import_addresses_in_thread'):
+            d = bci.import_addresses_in_thread(addresses, wallet_name)
+        else:
+            d = defer.maybeDeferred(bci.import_addresses, addresses,
+                                    wallet_name)
+        self.refill_deferred = d
+        d.addCallbacks(self.on_refilled, self.on_refill_failed,
+                       callbackArgs=(horizons,))
+        return len(addresses)
+
+    def on_refilled(self, result, horizons):
+        self.refill_deferred = None
+        for md, target in horizons.items():
+            self.wallet.set_import_horizon(md, True, target)
+        self.wallet.save()
+
+    def on_refill_failed(self, failure):
+        self.refill_deferred = None
+        log.warn("Failed to import addresses into the pool: " +
+                 failure.getErrorMessage())
+
+
+def get_address_pool(wallet):
+    """Returns the wallet's pool, of the size in the config; it is
+    kept on the wallet, so that it goes with it.
+    """
+    pool = getattr(wallet, 'address_pool', None)
+    if pool is None:
+        pool = wallet.address_pool = AddressImportPool(
+            wallet, jm_single().config.getint("BLOCKCHAIN",
+                                              "address_pool_size"))
+    return pool
+
+
+def import_new_addresses(wallet, addr_list):
+    get_address_pool(wallet).import_new_addresses(addr_list)
@@ -6,34 +6,62 @@ import abc
 import ast
 import random
 import sys
+import threading
 import time
 import binascii
-from copy import deepcopy
+from copy import copy, deepcopy
 from decimal import Decimal
-from twisted.internet import reactor, task
+from twisted.internet import defer, reactor, task, threads
 
 import jmbitcoin as btc
 
 from jmclient.jsonrpc import JsonRpcConnectionError, JsonRpcError
 from jmclient.configure import get_p2pk_vbyte, jm_single
 from jmbase.support import get_log
+from jmbase import metrics
 
 log = get_log()
 
-
-def sync_wallet(wallet, fast=False):
-    """Wrapper function to choose fast syncing where it's
+RPC_SECONDS = metrics.histogram('jm_rpc_seconds',
+                                'Duration of Bitcoin Core RPC calls',
+                                labelnames=('method',))
+
+#block times may be this far (in seconds) out of order; rescans start
+#this long before the wallet birthday, as Bitcoin Core does for keys
+TIMESTAMP_WINDOW = 7200
+#seconds between progress reports of a blockchain rescan
+RESCAN_PROGRESS_INTERVAL = 10.0
+#number of addresses per branch looked up in each scan of the
+#UTXO set in a recovery sync
+RECOVERY_SCAN_RANGE = 1000
+#the address sync checkpoint is a block with this many confirmations;
+#a reorg deeper than this after a sync is not noticed by the next one
+SYNC_CHECKPOINT_DEPTH = 6
+
+
+def sync_wallet(wallet, fast=False, recover=False):
+    """Wrapper function to choose fast (or recovery) syncing where it's
     both possible and requested.
     """
-    if fast and (
+    if (fast or recover) and (
         isinstance(jm_single().bc_interface, BitcoinCoreInterface) or isinstance(
                 jm_single().bc_interface, RegtestBitcoinCoreInterface)):
-        jm_single().bc_interface.sync_wallet(wallet, fast=True)
+        jm_single().bc_interface.sync_wallet(wallet, fast=fast,
+                                             recover=recover)
     else:
         jm_single().bc_interface.sync_wallet(wallet)
 
 class BlockchainInterface(object):
     __metaclass__ = abc.ABCMeta
+    #seconds between calls of the watcher set up by add_tx_notify, or
+    #None if the interface calls it itself when there is news
+    tx_watcher_poll_interval = 5.0
+    #seconds between polls of the chain tip height by the block watcher,
+    #or None if the interface keeps current_height up to date itself
+    block_watcher_poll_interval = 30.0
+    #height of the chain tip, as last seen
+    current_height = None
+    block_watcher_loop = None
 
     def __init__(self):
         pass
@@ -78,6 +106,7 @@ class BlockchainInterface(object):
         really usable in a segwit context, and only on fully formed transactions),
         else we create a watcher loop on the output set of the transaction (taken
         from the outs field of the txd).
+        Returns the key of the watcher loop in self.tx_watcher_loops.
         """
         if not vb:
             vb = get_p2pk_vbyte()
@@ -128,8 +157,8 @@ class BlockchainInterface(object):
             log.debug("Created watcher loop for txid: " + txid)
             loopkey = txid
         self.tx_watcher_loops[loopkey] = [loop, False, False, False]
-        #Hardcoded polling interval, but in any case it can be very short.
-        loop.start(5.0)
+        if self.tx_watcher_poll_interval:
+            loop.start(self.tx_watcher_poll_interval)
         #Give up on un-broadcast transactions and broadcast but not confirmed
         #transactions as per settings in the config.
         reactor.callLater(float(jm_single().config.get("TIMEOUT",
@@ -137,6 +166,7 @@ class BlockchainInterface(object):
         confirm_timeout_sec = int(jm_single().config.get(
             "TIMEOUT", "confirm_timeout_hours")) * 3600
         reactor.callLater(confirm_timeout_sec, self.tx_timeout, txd, loopkey, timeoutfun)
+        return loopkey
 
     def tx_network_timeout(self, loopkey):
         """If unconfirm has not been called by the time this
@@ -196,13 +226,138 @@ class BlockchainInterface(object):
         """
         # address and output script contain the same information btw
 
-    @abc.abstractmethod
+    def query_utxo_set_with_wallet(self, txouts, wallet):
+        """As query_utxo_set(txouts, includeconf=True), but the utxos
+        of wallet whose confirmation height was recorded at sync are
+        answered from the wallet, with their confirmations counted
+        from the chain tip seen by the block watcher; only the others
+        are queried.
+        """
+        if not isinstance(txouts, list):
+            txouts = [txouts]
+        tip = self.get_current_height()
+        result = [None] * len(txouts)
+        to_query = []
+        for i, txo in enumerate(txouts):
+            utxo = None
+            if tip is not None and len(txo) >= 66:
+                try:
+                    utxo = wallet.get_utxo_(binascii.unhexlify(txo[:64]),
+                                            int(txo[65:]))
+                except (TypeError, ValueError):
+                    pass
+            if utxo is None or utxo['height'] is None:
+                to_query.append(i)
+                continue
+            result[i] = {'value': utxo['value'],
+                         'address': wallet.get_addr_path(utxo['path']),
+                         'script': binascii.hexlify(
+                             utxo['script']).decode('ascii'),
+                         #+1 because if current height = tx height,
+                         #that's 1 conf
+                         'confirms': max(tip - utxo['height'] + 1, 1)}
+        if to_query:
+            queried = self.query_utxo_set([txouts[i] for i in to_query],
+                                          includeconf=True)
+            for i, r in zip(to_query, queried):
+                result[i] = r
+        return result
+
+    def get_current_height(self):
+        """Returns the height of the chain tip (None if the interface
+        can't tell). Once the reactor is running, a single block watcher
+        loop keeps it up to date; before that it is fetched on each call.
+        """
+        if self.block_watcher_poll_interval is None:
+            return self.current_height
+        if self.block_watcher_loop is None:
+            self.update_current_height()
+            if reactor.running:
+                self.block_watcher_loop = task.LoopingCall(
+                    self.update_current_height)
+                self.block_watcher_loop.start(
+                    self.block_watcher_poll_interval, now=False)
+        return self.current_height
+
+    def update_current_height(self):
+        try:
+            self.current_height = self.fetch_current_height()
+        except Exception as e:
+            #the last seen height is used until the next poll
+            log.warn("Failed to fetch the chain tip height: " + repr(e))
+
+    def fetch_current_height(self):
+        """Returns the height of the chain tip, from the blockchain
+        source; None if not supported by the interface.
+        """
+        return None
+
     def estimate_fee_per_kb(self, N):
+        """Returns the fee per kB to use for inclusion in the next N
+        blocks: if N is higher than 144, N itself (randomized by 20%),
+        else the estimate of the blockchain interface, answered from
+        a cache of estimates which are refreshed in the background
+        (see get_fee_estimate).
+        """
+        if self.fee_per_kb_has_been_manually_set(N):
+            return int(random.uniform(N * float(0.8), N * float(1.2)))
+        return self.get_fee_estimate(N)
+
+    @abc.abstractmethod
+    def fetch_fee_per_kb(self, N):
         '''Use the blockchain interface to 
         get an estimate of the transaction fee per kb
         required for inclusion in the next N blocks.
 	'''
 
+    def fetch_fee_per_kb_async(self, N):
+        """As fetch_fee_per_kb, without blocking the reactor; returns
+        a Deferred firing with the estimate. By default the fetch is
+        run in a thread.
+        """
+        return threads.deferToThread(self.fetch_fee_per_kb, N)
+
+    def get_fee_estimate(self, N):
+        """Returns fetch_fee_per_kb(N), cached for fee_estimate_ttl_sec.
+        Once the reactor is running, all the targets asked for are
+        refreshed at half that interval, with fetch_fee_per_kb_async,
+        so that callers are answered from the cache without waiting
+        for the blockchain source.
+        """
+        if not hasattr(self, "fee_estimates"):
+            #{N: (fee per kB, time fetched)}
+            self.fee_estimates = {}
+            self.fee_refresh_loop = None
+        ttl = jm_single().config.getint("POLICY", "fee_estimate_ttl_sec")
+        if N not in self.fee_estimates or \
+           time.time() - self.fee_estimates[N][1] >= ttl:
+            self.fee_estimates[N] = (self.fetch_fee_per_kb(N), time.time())
+        if self.fee_refresh_loop is None and reactor.running and ttl > 0:
+            self.fee_refresh_loop = task.LoopingCall(
+                self.refresh_fee_estimates)
+            self.fee_refresh_loop.start(ttl / 2.0, now=False)
+        return self.fee_estimates[N][0]
+
+    def refresh_fee_estimates(self):
+        """Fetches the cached targets anew; returns a Deferred firing
+        once they are all updated (so that the refresh loop waits for
+        it before the next refresh).
+        """
+        def update(fee, N):
+            self.fee_estimates[N] = (fee, time.time())
+
+        def failed(failure):
+            #the cached estimate is used until it expires
+            log.warn("Failed to refresh fee estimate: " +
+                     failure.getErrorMessage())
+
+        deferreds = []
+        for N in list(self.fee_estimates.keys()):
+            d = self.fetch_fee_per_kb_async(N)
+            d.addCallbacks(update, failed, callbackArgs=(N,))
+            deferreds.append(d)
+        return defer.DeferredList(deferreds)
+
     def fee_per_kb_has_been_manually_set(self, N):
         '''if the 'block' target is higher than 144, interpret it
         as manually set fee/Kb.
@@ -268,7 +423,7 @@ class ElectrumWalletInterface(BlockchainInterface): #pragma: no cover
         a result list containing at least one "None" which the
         caller can use as a flag for failure.
 	"""
-        self.current_height = self.wallet.network.blockchain.local_height
+        self.current_height = self.fetch_current_height()
         if not isinstance(txout, list):
             txout = [txout]
         utxos = [[t[:64], int(t[65:])] for t in txout]
@@ -304,9 +459,10 @@ class ElectrumWalletInterface(BlockchainInterface): #pragma: no cover
             result.append(r)
         return result
 
-    def estimate_fee_per_kb(self, N):
-        if super(ElectrumWalletInterface, self).fee_per_kb_has_been_manually_set(N):
-            return int(random.uniform(N * float(0.8), N * float(1.2)))
+    def fetch_current_height(self):
+        return self.wallet.network.blockchain.local_height
+
+    def fetch_fee_per_kb(self, N):
         fee = self.wallet.network.synchronous_get(('blockchain.estimatefee', [N]
                                                   ))
         log.debug("Got fee: " + str(fee))
@@ -328,6 +484,8 @@ class BitcoinCoreInterface(BlockchainInterface):
 
         self.txnotify_fun = []
         self.wallet_synced = False
+        #see add_watchonly_addresses
+        self.rescan_deferred = None
         #task.LoopingCall objects that track transactions, keyed by txids.
         #Format: {"txid": (loop, unconfirmed true/false, confirmed true/false,
         #spent true/false), ..}
@@ -346,41 +504,169 @@ class BitcoinCoreInterface(BlockchainInterface):
         if method not in ['importaddress', 'walletpassphrase', 'getaccount',
                           'gettransaction', 'getrawtransaction', 'gettxout']:
             log.debug('rpc: ' + method + " " + str(args))
-        res = self.jsonRpc.call(method, args)
+        with RPC_SECONDS.time(method=method):
+            res = self.jsonRpc.call(method, args)
         return res
 
-    def import_addresses(self, addr_list, wallet_name):
-        """Imports addresses in a batch during initial sync.
+    def rpc_batch(self, method, args_list):
+        """Calls method once for each of args_list, in a single
+        request; returns the list of results.
+        """
+        with RPC_SECONDS.time(method=method + '_batch'):
+            res = self.jsonRpc.call_batch([(method, args)
+                                           for args in args_list])
+        return res
+
+    def import_addresses(self, addr_list, wallet_name, timestamp="now"):
+        """Imports addresses in a batch during initial sync, with a
+        single importmulti call (without rescanning); timestamp is the
+        earliest time (unix) at which they may have been used, for
+        Bitcoin Core's records.
         Refuses to proceed if keys are found to be under control
         of another account/label (see console output), and quits.
         Do NOT use for in-run imports, use rpc('importaddress',..) instead.
         """
+        addr_list = list(addr_list)
         log.debug('importing ' + str(len(addr_list)) +
                   ' addresses with label ' + wallet_name)
-        for addr in addr_list:
-            try:
-                self.rpc('importaddress', [addr, wallet_name, False])
-            except JsonRpcError as e:
-                if e.code == -4 and e.message == "The wallet already " + \
-                   "contains the private key for this address or script":
-                    log.warn("Fatal sync error: import of address: " + addr +
-                             " failed, since it's already owned by this Bitcoin Core "
-                             "wallet in another account. To prevent coin or privacy "
-                             "loss, Joinmarket will not load a wallet in this conflicted "
-                             "state. To fix: use a new Bitcoin Core wallet to sync this "
-                             "Joinmarket wallet, or use a new Joinmarket wallet.")
-                    sys.exit(1)
+        requests = [{"scriptPubKey": {"address": addr},
+                     "timestamp": timestamp,
+                     "label": wallet_name,
+                     "watchonly": True} for addr in addr_list]
+        try:
+            results = self.rpc('importmulti', [requests, {"rescan": False}])
+        except JsonRpcError as e:
+            if e.code != -32601:
                 raise
+            #no importmulti (before Bitcoin Core 0.14)
+            results = []
+            for addr in addr_list:
+                try:
+                    self.rpc('importaddress', [addr, wallet_name, False])
+                    results.append({"success": True})
+                except JsonRpcError as e:
+                    results.append({"success": False,
+                                    "error": {"code": e.code,
+                                              "message": e.message}})
+        for addr, result in zip(addr_list, results):
+            if result["success"]:
+                continue
+            e = JsonRpcError(result["error"])
+            if e.code == -4 and e.message == "The wallet already " + \
+               "contains the private key for this address or script":
+                log.warn("Fatal sync error: import of address: " + addr +
+                         " failed, since it's already owned by this Bitcoin Core "
+                         "wallet in another account. To prevent coin or privacy "
+                         "loss, Joinmarket will not load a wallet in this conflicted "
+                         "state. To fix: use a new Bitcoin Core wallet to sync this "
+                         "Joinmarket wallet, or use a new Joinmarket wallet.")
+                sys.exit(1)
+            raise e
+
+    def import_addresses_in_thread(self, addr_list, wallet_name):
+        """As import_addresses, but in a thread (over its own RPC
+        connection), so that the reactor is not blocked meanwhile;
+        returns a Deferred.
+        """
+        bci = copy(self)
+        bci.jsonRpc = self.jsonRpc.new_connection()
+        return threads.deferToThread(bci.import_addresses, addr_list,
+                                     wallet_name)
+
+    def get_height_at_time(self, timestamp):
+        """Returns the height of the first block with a time not
+        more than TIMESTAMP_WINDOW before timestamp (unix), found by
+        bisection; the chain height + 1 if there is none.
+        """
+        timestamp -= TIMESTAMP_WINDOW
+        low, high = 0, self.rpc('getblockcount', []) + 1
+        while low < high:
+            mid = (low + high) // 2
+            header = self.rpc('getblockheader',
+                              [self.rpc('getblockhash', [mid])])
+            if header['time'] < timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def rescan_from_time(self, timestamp):
+        """Rescans the blockchain for transactions of the imported
+        addresses, from the first block which may contain transactions
+        after timestamp (unix), logging progress. Returns False if
+        Bitcoin Core can't do it (before 0.16, or the blocks are
+        pruned); then it must be restarted with -rescan.
+        """
+        return self.rescan_from_height(self.get_height_at_time(timestamp))
+
+    def rescan_from_time_in_thread(self, timestamp):
+        """As rescan_from_time, but in a thread (over its own RPC
+        connection), so that the reactor is not blocked meanwhile;
+        returns a Deferred firing with its result.
+        """
+        bci = copy(self)
+        bci.jsonRpc = self.jsonRpc.new_connection()
+        return threads.deferToThread(bci.rescan_from_time, timestamp)
+
+    def rescan_from_height(self, start_height):
+        """As rescan_from_time, from block start_height.
+        """
+        log.info("Rescanning blockchain from block " + str(start_height) +
+                 ", this may take a while ...")
+        stop = threading.Event()
+        reporter = threading.Thread(target=self._report_rescan_progress,
+                                    args=(stop,))
+        reporter.daemon = True
+        reporter.start()
+        st = time.time()
+        try:
+            res = self.rpc('rescanblockchain', [start_height])
+        except JsonRpcError as e:
+            log.warn("Unable to rescan the blockchain: " + e.message)
+            return False
+        finally:
+            stop.set()
+        log.info("Rescanned blocks {} to {} in {:.0f}s".format(
+            res['start_height'], res['stop_height'], time.time() - st))
+        return True
 
-    def add_watchonly_addresses(self, addr_list, wallet_name, restart_cb=None):
+    def _report_rescan_progress(self, stop):
+        rpc = self.jsonRpc.new_connection()
+        while not stop.wait(RESCAN_PROGRESS_INTERVAL):
+            try:
+                scanning = rpc.call('getwalletinfo', []).get('scanning')
+            except (JsonRpcError, JsonRpcConnectionError):
+                return
+            if scanning:
+                log.info("Rescan progress: {:.1f}%".format(
+                    float(scanning['progress']) * 100))
+
+    def add_watchonly_addresses(self, addr_list, wallet_name, restart_cb=None,
+                                birthday=None):
         """For backwards compatibility, this fn name is preserved
-        as the case where we quit the program if a rescan is required;
-        but in some cases a rescan is not required (if the address is known
-        to be new/unused). For that case use import_addresses instead.
+        as the case where a rescan is required; but in some cases a rescan
+        is not required (if the address is known to be new/unused). For
+        that case use import_addresses instead.
+        If the wallet's birthday (unix time) is given, the blockchain is
+        rescanned from then, in-process; otherwise, or if that isn't
+        possible, we quit the program, for a restart with -rescan.
+        If the reactor is running (as in the GUI), the rescan is only
+        started, in a thread, and rescan_deferred fires with whether it
+        was done; the wallet must be synced again after that.
+        Returns True if a rescan was done, started or asked for (never
+        on regtest).
         """
-        self.import_addresses(addr_list, wallet_name)
+        self.import_addresses(addr_list, wallet_name,
+                              timestamp=birthday or "now")
         if jm_single().config.get("BLOCKCHAIN",
                                   "blockchain_source") != 'regtest': #pragma: no cover
+            if birthday is not None:
+                if reactor.running:
+                    self.rescan_deferred = self.rescan_from_time_in_thread(
+                        birthday)
+                    return True
+                if self.rescan_from_time(birthday):
+                    return True
             #Exit conditions cannot be included in tests
             restart_msg = ("restart Bitcoin Core with -rescan if you're "
                            "recovering an existing wallet from backup seed\n"
@@ -390,8 +676,13 @@ class BitcoinCoreInterface(BlockchainInterface):
             else:
                 print(restart_msg)
                 sys.exit(0)
+            return True
+        return False
 
-    def sync_wallet(self, wallet, fast=False, restart_cb=None):
+    def sync_wallet(self, wallet, fast=False, restart_cb=None, recover=False):
+        if recover:
+            self.sync_wallet_recover(wallet, restart_cb=restart_cb)
+            return
         #trigger fast sync if the index_cache is available
         #(and not specifically disabled).
         if fast:
@@ -405,11 +696,100 @@ class BitcoinCoreInterface(BlockchainInterface):
         """Exploits the fact that given an index_cache,
         all addresses necessary should be imported, so we
         can just list all used addresses to find the right
-        index values.
+        index values. If the wallet has a sync checkpoint, the
+        (incremental) normal address sync is as fast, and safer.
         """
-        self.get_address_usages(wallet)
+        if wallet.get_sync_checkpoint():
+            self.sync_addresses(wallet)
+            if not self.wallet_synced:
+                return
+        else:
+            self.get_address_usages(wallet)
         self.sync_unspent(wallet)
 
+    def sync_wallet_recover(self, wallet, restart_cb=None):
+        """For restoring a wallet from its seed: finds the wallet's
+        coins in the UTXO set with scantxoutset (which needs no imports
+        or rescans), RECOVERY_SCAN_RANGE addresses per branch at a time,
+        until the last gap limit addresses scanned of each branch are
+        unused. The index of each branch is set to after its last address
+        holding coins (addresses whose coins are all spent can't be
+        found). Then the addresses up to the gap limit from there are
+        imported, and the blockchain is rescanned from the block of the
+        oldest coin, so that Bitcoin Core tracks them from now on.
+        """
+        st = time.time()
+        wallet_name = self.get_wallet_name(wallet)
+        branches = [(md, internal) for md in range(wallet.max_mixdepth + 1)
+                    for internal in (0, 1)]
+        scanned = dict([(b, 0) for b in branches])
+        used = dict([(b, 0) for b in branches])
+        #scripts of the imported keys, scanned once
+        scripts = dict([(wallet.get_script_path(path), None)
+                        for md in range(wallet.max_mixdepth + 1)
+                        for path in wallet.yield_imported_paths(md)])
+        unspents = []
+        to_scan = branches
+        while to_scan or scripts:
+            for md, internal in to_scan:
+                start = scanned[(md, internal)]
+                wallet.set_next_index(md, internal, start, force=True)
+                for index in range(start, start + RECOVERY_SCAN_RANGE):
+                    scripts[wallet.get_new_script(md, internal)] = (
+                        (md, internal), index)
+            log.info("Scanning the UTXO set for {} scripts, this may take a "
+                     "few minutes ...".format(len(scripts)))
+            try:
+                res = self.rpc('scantxoutset', ['start', [
+                    'addr(' + wallet.script_to_addr(s) + ')' for s in scripts]])
+            except JsonRpcError as e:
+                if e.code != -32601:
+                    raise
+                log.warn("Bitcoin Core can't scan the UTXO set (it needs "
+                         "0.17 or later), syncing normally instead.")
+                for md, internal in branches:
+                    wallet.set_next_index(md, internal, 0, force=True)
+                self.sync_wallet(wallet, restart_cb=restart_cb)
+                return
+            for u in res['unspents']:
+                script = binascii.unhexlify(u['scriptPubKey'])
+                if script not in scripts:
+                    continue
+                unspents.append(u)
+                if scripts[script] is not None:
+                    branch, index = scripts[script]
+                    used[branch] = max(used[branch], index + 1)
+            for b in to_scan:
+                scanned[b] += RECOVERY_SCAN_RANGE
+            to_scan = [b for b in to_scan
+                       if used[b] > scanned[b] - wallet.gap_limit]
+            scripts = {}
+        log.debug("UTXO set scans took {:.1f}s, found {} coins".format(
+            time.time() - st, len(unspents)))
+
+        wallet.reset_utxos()
+        wallet.set_sync_checkpoint(None)
+        for md, internal in branches:
+            wallet.set_next_index(md, internal, used[(md, internal)],
+                                  force=True)
+        for u in unspents:
+            wallet.add_utxo(binascii.unhexlify(u['txid']), int(u['vout']),
+                            binascii.unhexlify(u['scriptPubKey']),
+                            int(Decimal(str(u['amount'])) * Decimal('1e8')),
+                            height=int(u['height']))
+
+        st = time.time()
+        addresses, saved_indices = self._collect_addresses_init(wallet)
+        self.import_addresses(addresses, wallet_name,
+                              timestamp=wallet.get_creation_time() or "now")
+        if unspents and not self.rescan_from_height(
+                min([int(u['height']) for u in unspents])):
+            log.warn("Bitcoin Core does not know about the recovered coins; "
+                     "restart it with -rescan before the next sync.")
+        log.debug("Importing addresses and rescanning took {:.1f}s".format(
+            time.time() - st))
+        self.wallet_synced = True
+
     def get_address_usages(self, wallet):
         """Use rpc `listaddressgroupings` to locate all used
         addresses in the account (whether spent or unspent outputs).
@@ -493,10 +873,43 @@ class BitcoinCoreInterface(BlockchainInterface):
         self._rewind_wallet_indices(wallet, used_indices, saved_indices)
         self.wallet_synced = True
 
+    def get_sync_start(self, wallet):
+        """Returns (blockhash, used_indices), the wallet's sync
+        checkpoint, if it is valid: its block is in the main chain,
+        and its indices are not beyond the wallet's; else None.
+        """
+        checkpoint = wallet.get_sync_checkpoint()
+        if checkpoint is None:
+            return None
+        blockhash, used_indices = checkpoint
+        try:
+            header = self.rpc('getblockheader', [blockhash])
+        except JsonRpcError:
+            header = None
+        if not header or header['confirmations'] < 0:
+            log.info("Sync checkpoint block is not in the chain, scanning "
+                     "the whole wallet history.")
+            return None
+        for md in used_indices:
+            for internal in (0, 1):
+                if md > wallet.max_mixdepth or used_indices[md][internal] > \
+                   wallet.get_next_unused_index(md, internal):
+                    log.info("Sync checkpoint doesn't match the wallet, "
+                             "scanning the whole wallet history.")
+                    return None
+        return checkpoint
+
     def sync_addresses(self, wallet, restart_cb=None):
+        """Finds the used addresses of the wallet from the transactions of
+        its imported addresses, importing more if needed. After a complete
+        sync, a checkpoint (a block SYNC_CHECKPOINT_DEPTH deep, and the
+        used indices as of then) is kept in the wallet, so that the next
+        sync only lists the transactions since then (with listsinceblock).
+        """
         log.debug("requesting detailed wallet history")
         wallet_name = self.get_wallet_name(wallet)
 
+        st = time.time()
         addresses, saved_indices = self._collect_addresses_init(wallet)
         try:
             imported_addresses = set(self.rpc('getaddressesbyaccount',
@@ -508,16 +921,41 @@ class BitcoinCoreInterface(BlockchainInterface):
             else:
                 imported_addresses = set()
 
+        log.debug("Collecting and listing imported addresses took "
+                  "{:.2f}s".format(time.time() - st))
         if not addresses.issubset(imported_addresses):
-            self.add_watchonly_addresses(addresses - imported_addresses,
-                                         wallet_name, restart_cb)
+            if self.add_watchonly_addresses(
+                    addresses - imported_addresses, wallet_name, restart_cb,
+                    birthday=wallet.get_creation_time()):
+                #the rescan may find transactions before the checkpoint
+                wallet.set_sync_checkpoint(None)
+            #sync again, with the imported addresses
+            self.wallet_synced = False
             return
 
-        used_addresses_gen = (tx['address']
-                              for tx in self._yield_transactions(wallet_name)
+        st = time.time()
+        sync_start = self.get_sync_start(wallet)
+        if sync_start:
+            res = self.rpc('listsinceblock', [sync_start[0],
+                                              SYNC_CHECKPOINT_DEPTH, True])
+            transactions = res['transactions']
+            checkpoint_block = res['lastblock']
+        else:
+            #the checkpoint is taken before listing, so nothing is missed
+            checkpoint_block = self.rpc('getblockhash', [max(
+                0, self.rpc('getblockcount', []) - SYNC_CHECKPOINT_DEPTH + 1)])
+            transactions = self._yield_transactions(wallet_name)
+        used_addresses_gen = (tx['address'] for tx in transactions
                               if tx['category'] == 'receive')
 
         used_indices = self._get_used_indices(wallet, used_addresses_gen)
+        if sync_start:
+            for md in sync_start[1]:
+                for internal in (0, 1):
+                    used_indices[md][internal] = max(
+                        used_indices[md][internal], sync_start[1][md][internal])
+        log.debug("Listing {} transactions took {:.2f}s".format(
+            "new" if sync_start else "all", time.time() - st))
         log.debug("got used indices: {}".format(used_indices))
         gap_limit_used = not self._check_gap_indices(wallet, used_indices)
         self._rewind_wallet_indices(wallet, used_indices, saved_indices)
@@ -525,8 +963,10 @@ class BitcoinCoreInterface(BlockchainInterface):
         new_addresses = self._collect_addresses_gap(wallet)
         if not new_addresses.issubset(imported_addresses):
             log.debug("Syncing iteration finished, additional step required")
-            self.add_watchonly_addresses(new_addresses - imported_addresses,
-                                         wallet_name, restart_cb)
+            if self.add_watchonly_addresses(
+                    new_addresses - imported_addresses, wallet_name,
+                    restart_cb, birthday=wallet.get_creation_time()):
+                wallet.set_sync_checkpoint(None)
             self.wallet_synced = False
         elif gap_limit_used:
             log.debug("Syncing iteration finished, additional step required")
@@ -534,6 +974,8 @@ class BitcoinCoreInterface(BlockchainInterface):
         else:
             log.debug("Wallet successfully synced")
             self._rewind_wallet_indices(wallet, used_indices, saved_indices)
+            wallet.set_sync_checkpoint(checkpoint_block, used_indices)
+            self._check_import_horizons(wallet, imported_addresses)
             self.wallet_synced = True
 
     @staticmethod
@@ -589,6 +1031,29 @@ class BitcoinCoreInterface(BlockchainInterface):
 
         return addresses, saved_indices
 
+    @staticmethod
+    def _check_import_horizons(wallet, imported_addresses):
+        """The import horizons kept in the wallet (see AddressImportPool)
+        only hold for the Core wallet the addresses were imported into:
+        each is lowered to the index of its first address beyond the
+        synced ones which isn't imported (after a change of Core wallet
+        or node), so that it is imported when used.
+        """
+        for md in range(wallet.max_mixdepth + 1):
+            for internal in (0, 1):
+                next_unused = wallet.get_next_unused_index(md, internal)
+                horizon = wallet.get_import_horizon(md, internal)
+                for index in range(next_unused, horizon):
+                    if wallet.get_new_addr(md, internal) not in \
+                            imported_addresses:
+                        log.warn("The addresses of mixdepth {} from index "
+                                 "{} are not imported into Bitcoin Core's "
+                                 "wallet, importing them again.".format(
+                                     md, index))
+                        wallet.set_import_horizon(md, internal, index)
+                        break
+                wallet.set_next_index(md, internal, next_unused)
+
     @staticmethod
     def _collect_addresses_gap(wallet, gap_limit=None):
         gap_limit = gap_limit or wallet.gap_limit
@@ -634,28 +1099,36 @@ class BitcoinCoreInterface(BlockchainInterface):
                 'POLICY', 'listunspent_args'))
 
         unspent_list = self.rpc('listunspent', listunspent_args)
+        #fetched after listunspent, so that if a block arrives in between
+        #the utxo heights found are too high (too young), not too low
+        self.current_height = self.fetch_current_height()
         for u in unspent_list:
             if not wallet.is_known_addr(u['address']):
                 continue
-            self._add_unspent_utxo(wallet, u)
+            self._add_unspent_utxo(wallet, u, self.current_height)
         et = time.time()
         log.debug('bitcoind sync_unspent took ' + str((et - st)) + 'sec')
         self.wallet_synced = True
 
     @staticmethod
-    def _add_unspent_utxo(wallet, utxo):
+    def _add_unspent_utxo(wallet, utxo, tip=None):
         """
         Add a UTXO as returned by rpc's listunspent call to the wallet.
 
         params:
             wallet: wallet
             utxo: single utxo dict as returned by listunspent
+            tip: chain tip height, to record the height of confirmed
+                utxos at
         """
         txid = binascii.unhexlify(utxo['txid'])
         script = binascii.unhexlify(utxo['scriptPubKey'])
         value = int(Decimal(str(utxo['amount'])) * Decimal('1e8'))
+        height = None
+        if tip is not None and int(utxo['confirmations']) > 0:
+            height = tip - int(utxo['confirmations']) + 1
 
-        wallet.add_utxo(txid, int(utxo['vout']), script, value)
+        wallet.add_utxo(txid, int(utxo['vout']), script, value, height=height)
 
     def get_deser_from_gettransaction(self, rpcretval):
         """Get full transaction deserialization from a call
@@ -842,18 +1315,24 @@ class BitcoinCoreInterface(BlockchainInterface):
         """
         if not isinstance(txout, list):
             txout = [txout]
-        result = []
+        #the outpoints are looked up together, in one batch request
+        args_list = []
         for txo in txout:
             if len(txo) < 66:
-                result.append(None)
+                args_list.append(None)
                 continue
             try:
                 txo_idx = int(txo[65:])
             except ValueError:
                 log.warn("Invalid utxo format, ignoring: {}".format(txo))
-                result.append(None)
+                args_list.append(None)
                 continue
-            ret = self.rpc('gettxout', [txo[:64], txo_idx, includeunconf])
+            args_list.append([txo[:64], txo_idx, includeunconf])
+        rets = iter(self.rpc_batch('gettxout',
+                                   [a for a in args_list if a is not None]))
+        result = []
+        for args in args_list:
+            ret = next(rets) if args is not None else None
             if ret is None:
                 result.append(None)
             else:
@@ -870,10 +1349,10 @@ class BitcoinCoreInterface(BlockchainInterface):
                 result.append(result_dict)
         return result
 
-    def estimate_fee_per_kb(self, N):
-        if super(BitcoinCoreInterface, self).fee_per_kb_has_been_manually_set(N):
-            return int(random.uniform(N * float(0.8), N * float(1.2)))
+    def fetch_current_height(self):
+        return self.rpc('getblockcount', [])
 
+    def fetch_fee_per_kb(self, N):
         # Special bitcoin core case: sometimes the highest priority
         # cannot be estimated in that case the 2nd highest priority
         # should be used instead of falling back to hardcoded values
@@ -889,6 +1368,13 @@ class BitcoinCoreInterface(BlockchainInterface):
             return 10000
         return int(Decimal(1e8) * Decimal(estimate))
 
+    def fetch_fee_per_kb_async(self, N):
+        """As fetch_fee_per_kb, in a thread over its own RPC connection.
+        """
+        bci = copy(self)
+        bci.jsonRpc = self.jsonRpc.new_connection()
+        return threads.deferToThread(bci.fetch_fee_per_kb, N)
+
 
 # class for regtest chain access
 # running on local daemon. Only
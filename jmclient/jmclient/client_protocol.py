@@ -16,8 +16,10 @@ from jmbase import commands
 import json
 import hashlib
 import os
+import signal
 import sys
-from jmbase import get_log
+import time
+from jmbase import get_log, metrics, profiling
 from jmclient import (jm_single, get_irc_mchannels, get_p2sh_vbyte,
                       RegtestBitcoinCoreInterface)
 from .output import fmt_tx_data
@@ -25,6 +27,12 @@ import jmbitcoin as btc
 
 jlog = get_log()
 
+SIGN_SECONDS = metrics.histogram('jm_msg_sign_seconds',
+                                 'Duration of message channel message signing')
+VERIFY_SECONDS = metrics.histogram(
+    'jm_msg_verify_seconds',
+    'Duration of message channel signature and nick verification')
+
 class JMProtocolError(Exception):
     pass
 
@@ -61,6 +69,12 @@ class JMClientProtocol(amp.AMP):
         self.factory.setClient(self)
         self.clientStart()
 
+    def connectionLost(self, reason):
+        #don't leave a stale client for getClient() callers
+        if self.factory.getClient() is self:
+            self.factory.setClient(None)
+        amp.AMP.connectionLost(self, reason)
+
     def set_nick(self):
         self.nick_pubkey = btc.privtopub(self.nick_priv)
         self.nick_pkh_raw = btc.bin_sha256(self.nick_pubkey)[
@@ -92,7 +106,8 @@ class JMClientProtocol(amp.AMP):
 
     @commands.JMRequestMsgSig.responder
     def on_JM_REQUEST_MSGSIG(self, nick, cmd, msg, msg_to_be_signed, hostid):
-        sig = btc.ecdsa_sign(str(msg_to_be_signed), self.nick_priv)
+        with SIGN_SECONDS.time():
+            sig = btc.ecdsa_sign(str(msg_to_be_signed), self.nick_priv)
         msg_to_return = str(msg) + " " + self.nick_pubkey + " " + sig
         d = self.callRemote(commands.JMMsgSignature,
                             nick=nick,
@@ -106,18 +121,20 @@ class JMClientProtocol(amp.AMP):
     def on_JM_REQUEST_MSGSIG_VERIFY(self, msg, fullmsg, sig, pubkey, nick,
                                     hashlen, max_encoded, hostid):
         verif_result = True
-        if not btc.ecdsa_verify(str(msg), sig, pubkey):
-            jlog.debug("nick signature verification failed, ignoring.")
-            verif_result = False
-        #check that nick matches hash of pubkey
-        nick_pkh_raw = btc.bin_sha256(pubkey)[:hashlen]
-        nick_stripped = nick[2:2 + max_encoded]
-        #strip right padding
-        nick_unpadded = ''.join([x for x in nick_stripped if x != 'O'])
-        if not nick_unpadded == btc.b58encode(nick_pkh_raw):
-            jlog.debug("Nick hash check failed, expected: " + str(nick_unpadded)
-                       + ", got: " + str(btc.b58encode(nick_pkh_raw)))
-            verif_result = False
+        with VERIFY_SECONDS.time():
+            if not btc.ecdsa_verify(str(msg), sig, pubkey):
+                jlog.debug("nick signature verification failed, ignoring.")
+                verif_result = False
+            #check that nick matches hash of pubkey
+            nick_pkh_raw = btc.bin_sha256(pubkey)[:hashlen]
+            nick_stripped = nick[2:2 + max_encoded]
+            #strip right padding
+            nick_unpadded = ''.join([x for x in nick_stripped if x != 'O'])
+            if not nick_unpadded == btc.b58encode(nick_pkh_raw):
+                jlog.debug("Nick hash check failed, expected: " +
+                           str(nick_unpadded) + ", got: " +
+                           str(btc.b58encode(nick_pkh_raw)))
+                verif_result = False
         d = self.callRemote(commands.JMMsgSignatureVerify,
                             verif_result=verif_result,
                             nick=nick,
@@ -126,6 +143,19 @@ class JMClientProtocol(amp.AMP):
         self.defaultCallbacks(d)
         return {'accepted': True}
 
+    def request_memory_report(self):
+        d = self.callRemote(commands.JMRequestMemoryReport)
+        self.defaultCallbacks(d)
+
+    @commands.JMMemoryReport.responder
+    def on_JM_MEMORY_REPORT(self, report):
+        report = json.loads(report)
+        jlog.info("Daemon memory usage (entries, approx. bytes):")
+        for name in sorted(report.keys()):
+            jlog.info("{}: {}, {}".format(name, report[name]["count"],
+                                          report[name]["bytes"]))
+        return {'accepted': True}
+
 class JMMakerClientProtocol(JMClientProtocol):
     def __init__(self, factory, maker, nick_priv=None):
         self.factory = factory
@@ -241,6 +271,7 @@ class JMMakerClientProtocol(JMClientProtocol):
         if not offerinfo:
             jlog.info("Failed to find notified unconfirmed transaction: " + txid)
             return
+        self.client.release_utxos(offerinfo["utxos"].keys())
         removed_utxos = self.client.wallet.remove_old_utxos(txd)
         jlog.info('saw tx on network, removed_utxos=\n{}'.format('\n'.join(
             '{} - {}'.format(u, fmt_tx_data(tx_data, self.client.wallet))
@@ -265,6 +296,7 @@ class JMMakerClientProtocol(JMClientProtocol):
         if not offerinfo:
             jlog.info("Failed to find notified unconfirmed transaction: " + txid)
             return
+        self.client.release_utxos(offerinfo["utxos"].keys())
         jm_single().bc_interface.wallet_synced = False
         jm_single().bc_interface.sync_unspent(self.client.wallet)
         jlog.info('tx in a block: ' + txid)
@@ -289,6 +321,14 @@ class JMTakerClientProtocol(JMClientProtocol):
 
     def __init__(self, factory, client, nick_priv=None):
         self.orderbook = None
+        #client-side copy of the daemon's orderbook, keyed by
+        #(counterparty, oid), kept current by JMOffersDelta
+        self.offers_mirror = {}
+        self.offers_version = None
+        self.early_fill_loop = None
+        self.offers_timeout = None
+        self.offers_received = False
+        self.offers_requested_time = time.time()
         JMClientProtocol.__init__(self, factory, client, nick_priv)
 
     def clientStart(self):
@@ -365,7 +405,16 @@ class JMTakerClientProtocol(JMClientProtocol):
         #The daemon is ready and has requested the orderbook
         #from the pit; we can request the entire orderbook
         #and filter it as we choose.
-        reactor.callLater(jm_single().maker_timeout_sec, self.get_offers)
+        self.offers_requested_time = time.time()
+        self.offers_received = False
+        self.offers_timeout = reactor.callLater(jm_single().maker_timeout_sec,
+                                                self.get_final_offers)
+        #In early fill mode, we poll the orderbook and proceed as
+        #soon as it is sufficient (see Taker.early_fill_ready), rather
+        #than always waiting for the timeout.
+        if jm_single().config.get("POLICY", "early_fill") == "true":
+            self.early_fill_loop = task.LoopingCall(self.get_offers)
+            self.early_fill_loop.start(1.0, now=False)
         return {'accepted': True}
 
     @commands.JMFillResponse.responder
@@ -400,10 +449,50 @@ class JMTakerClientProtocol(JMClientProtocol):
                 return {'accepted': True}
 
     @commands.JMOffers.responder
-    def on_JM_OFFERS(self, orderbook):
-        self.orderbook = json.loads(orderbook)
+    def on_JM_OFFERS(self, orderbook, cached_counterparties, version):
+        orderbook = json.loads(orderbook)
+        self.offers_mirror = dict([((o['counterparty'], o['oid']), o)
+                                   for o in orderbook])
+        self.offers_version = version
+        self.process_offers(orderbook, cached_counterparties)
+        return {'accepted': True}
+
+    @commands.JMOffersDelta.responder
+    def on_JM_OFFERS_DELTA(self, base_version, version, updated, removed,
+                           cached_counterparties):
+        if base_version != self.offers_version:
+            #we do not hold the orderbook this delta applies
+            #to; ask again for the full orderbook.
+            jlog.debug("Orderbook delta against unknown version, "
+                       "requesting full orderbook")
+            self.offers_version = None
+            self.get_offers()
+            return {'accepted': True}
+        for o in json.loads(updated):
+            self.offers_mirror[(o['counterparty'], o['oid'])] = o
+        for cp, oid in json.loads(removed):
+            self.offers_mirror.pop((cp, oid), None)
+        self.offers_version = version
+        self.process_offers(list(self.offers_mirror.values()),
+                            cached_counterparties)
+        return {'accepted': True}
+
+    def process_offers(self, orderbook, cached_counterparties):
+        if self.offers_received:
+            #an early fill poll response which arrived after we proceeded
+            return
+        if self.early_fill_loop and self.early_fill_loop.running:
+            if not self.client.early_fill_ready(orderbook,
+                                                cached_counterparties):
+                return
+            self.early_fill_loop.stop()
+            self.offers_timeout.cancel()
+        self.offers_received = True
+        self.orderbook = orderbook
         #Removed for now, as judged too large, even for DEBUG:
         #jlog.debug("Got the orderbook: " + str(self.orderbook))
+        jlog.info("Time to fill: {:.1f} seconds, orderbook size: {}".format(
+            time.time() - self.offers_requested_time, len(self.orderbook)))
         retval = self.client.initialize(self.orderbook)
         #format of retval is:
         #True, self.cjamount, commitment, revelation, self.filtered_orderbook)
@@ -414,12 +503,12 @@ class JMTakerClientProtocol(JMClientProtocol):
                 #This could be an optional feature also for multi-entry schedules,
                 #but is not the functionality desired in general (tumbler).
                 self.client.on_finished_callback(False, False, 0.0)
-            return {'accepted': True}
+            return
         elif retval[0] == "commitment-failure":
             #This case occurs if we cannot find any utxos for reasons
             #other than age, which is a permanent failure
             self.client.on_finished_callback(False, False, 0.0)
-            return {'accepted': True}
+            return
         amt, cmt, rev, foffers = retval[1:]
         d = self.callRemote(commands.JMFill,
                             amount=amt,
@@ -427,7 +516,6 @@ class JMTakerClientProtocol(JMClientProtocol):
                             revelation=str(rev),
                             filled_offers=json.dumps(foffers))
         self.defaultCallbacks(d)
-        return {'accepted': True}
 
     @commands.JMSigReceived.responder
     def on_JM_SIG_RECEIVED(self, nick, sig):
@@ -438,9 +526,18 @@ class JMTakerClientProtocol(JMClientProtocol):
         return {'accepted': True}
 
     def get_offers(self):
-        d = self.callRemote(commands.JMRequestOffers)
+        d = self.callRemote(commands.JMRequestOffers,
+                            version=self.offers_version)
         self.defaultCallbacks(d)
 
+    def get_final_offers(self):
+        """Request the orderbook after the full wait; in early
+        fill mode, stop polling and accept whatever we have.
+        """
+        if self.early_fill_loop and self.early_fill_loop.running:
+            self.early_fill_loop.stop()
+        self.get_offers()
+
     def make_tx(self, nick_list, txhex):
         d = self.callRemote(commands.JMMakeTx,
                             nick_list= json.dumps(nick_list),
@@ -470,6 +567,54 @@ class JMClientProtocolFactory(protocol.ClientFactory):
     def buildProtocol(self, addr):
         return self.protocol(self, self.client)
 
+def request_memory_report(factory):
+    client = factory.getClient()
+    if client is None:
+        jlog.info("Not connected to the daemon, no memory report available.")
+        return
+    client.request_memory_report()
+
+#the GUI calls start_reactor once per coinjoin, but the metrics are
+#served and summarized, and profiling controlled, once per process
+_metrics_started = [False]
+
+def start_metrics():
+    """Serves and/or periodically logs the metrics, as configured;
+    does nothing after the first call.
+    """
+    if _metrics_started[0]:
+        return
+    _metrics_started[0] = True
+    metrics_port = jm_single().config.getint("LOGGING", "metrics_port")
+    if metrics_port:
+        metrics.start_metrics_server(metrics_port, jm_single().config.get(
+            "LOGGING", "metrics_host"))
+    metrics_interval = jm_single().config.getint("LOGGING",
+                                                 "metrics_summary_interval")
+    if metrics_interval:
+        metrics.start_metrics_summary(metrics_interval)
+
+#as for the metrics, there is one profiling control per process
+_profiling_control = [None]
+
+def start_profiling_control():
+    """Creates the process's ProfilingControl, commanded by SIGUSR2
+    and the configured control socket, if any; returns it. Later
+    calls return the same control.
+    """
+    if _profiling_control[0] is not None:
+        return _profiling_control[0]
+    control = _profiling_control[0] = profiling.ProfilingControl(
+        os.path.join(os.path.dirname(jm_single().config_location), "logs"),
+        jm_single().config.getfloat("LOGGING", "profile_duration"),
+        jm_single().config.get("LOGGING", "profile_mode"))
+    profiling.install_profiling_signal(control)
+    control_socket = jm_single().config.get("LOGGING",
+                                            "profile_control_socket")
+    if control_socket:
+        profiling.start_profiling_control(control, control_socket)
+    return control
+
 def start_reactor(host, port, factory, ish=True, daemon=False, rs=True, gui=False): #pragma: no cover
     #(Cannot start the reactor in tests)
     #Not used in prod (twisted logging):
@@ -484,7 +629,15 @@ def start_reactor(host, port, factory, ish=True, daemon=False, rs=True, gui=Fals
                        "to run the daemon separately, edit the DAEMON "
                        "section of the config. Quitting.")
             return
-        dfactory = JMDaemonServerProtocolFactory()
+        orderbook_cache = jm_single().config.get("DAEMON", "orderbook_cache")
+        expiry = dict([(k, jm_single().config.getint("DAEMON", k)) for k in
+                       ["nick_expiry", "max_nicks", "partial_message_expiry",
+                        "active_order_expiry", "offer_expiry"]])
+        dfactory = JMDaemonServerProtocolFactory(
+            orderbook_cache=orderbook_cache if orderbook_cache else None,
+            orderbook_cache_max_age=jm_single().config.getint(
+                "DAEMON", "orderbook_cache_max_age"),
+            expiry=expiry)
         orgport = port
         while True:
             try:
@@ -498,6 +651,13 @@ def start_reactor(host, port, factory, ish=True, daemon=False, rs=True, gui=Fals
                     jlog.error("Tried 100 ports but cannot listen on any of them. Quitting.")
                     sys.exit(1)
                 port += 1
+    start_metrics()
+    start_profiling_control()
+    #On SIGUSR1, log the daemon's memory usage (see JMMemoryReport);
+    #not for the GUI, which calls this once per coinjoin.
+    if hasattr(signal, "SIGUSR1") and not gui:
+        signal.signal(signal.SIGUSR1, lambda signum, frame:
+                      reactor.callFromThread(request_memory_report, factory))
     if usessl:
         ctx = ClientContextFactory()
         reactor.connectSSL(host, port, factory, ctx)
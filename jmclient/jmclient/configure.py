@@ -104,9 +104,30 @@ daemon_host = localhost
 #by default the client-daemon connection is plaintext, set to 'true' to use TLS;
 #for this, you need to have a valid (self-signed) certificate installed
 use_ssl = false
+#file (relative to the scripts directory) in which the daemon keeps the
+#offers it has seen between runs, so that a restarted taker knows which
+#counterparties to expect (see early_fill); leave empty to disable.
+#only used if no_daemon = 1; see joinmarketd.py otherwise.
+orderbook_cache = orderbookcache.json
+#cached offers not seen for this many seconds are discarded on startup
+orderbook_cache_max_age = 3600
+#the daemon forgets state about counterparties which have gone quiet,
+#so that its memory use stays bounded when running for months (send
+#SIGUSR1 to the joinmarket process to log the daemon's memory usage);
+#all times are in seconds. Nicks not heard from are forgotten after:
+nick_expiry = 86400
+#and at most this many nicks are remembered:
+max_nicks = 5000
+#incomplete multi-part messages are dropped after:
+partial_message_expiry = 60
+#the state of unfinished coinjoins with a counterparty is dropped after:
+active_order_expiry = 3600
+#offers which are not re-announced are dropped from the orderbook after:
+offer_expiry = 86400
 
 [BLOCKCHAIN]
 #options: bitcoin-rpc, regtest, electrum-server
+# (and simulated: an in-memory chain, for tests and benchmarks only)
 # for instructions on bitcoin-rpc read
 # https://github.com/chris-belcher/joinmarket/wiki/Running-JoinMarket-with-Bitcoin-Core-full-node
 blockchain_source = bitcoin-rpc
@@ -116,6 +137,11 @@ rpc_port = 8332
 rpc_user = bitcoin
 rpc_password = password
 rpc_wallet_file =
+#with bitcoin-rpc, the coinjoin and change addresses of a coinjoin must be
+#imported into Bitcoin Core; this many of the next such addresses of each
+#mixdepth are imported ahead of use, in the background, so that coinjoins
+#don't wait for the imports. 0 imports each address when it is used.
+address_pool_size = 20
 
 [MESSAGING:server1]
 host = irc.cyberguerrilla.org
@@ -148,12 +174,45 @@ socks5_port = 9050
 #usessl = false
 #socks5 = true
 
+#for private or test deployments, a joinmarket hub (see
+#scripts/joinmarket-hub.py) can be used instead of, or as well as, IRC;
+#it has no message rate or size limits:
+#[MESSAGING:server3]
+#type = hub
+#host = localhost
+#port = 27184
+#channel = joinmarket-pit
+#or, instead of host and port, a unix socket:
+#socket = /path/to/hub.sock
+
 [LOGGING]
 # Set the log level for the output to the terminal/console
 # Possible choices: DEBUG / INFO / WARNING / ERROR
 # Log level for the files in the logs-folder will always be DEBUG
 console_log_level = INFO
 
+# Timings of RPC calls, message signing and verification, wallet saves
+# and so on can be recorded, and served on a local HTTP endpoint in the
+# Prometheus text format (at http://metrics_host:metrics_port/metrics);
+# 0 disables the endpoint.
+metrics_port = 0
+metrics_host = localhost
+# If non-zero, a summary of the same metrics is logged every
+# this many seconds.
+metrics_summary_interval = 0
+# A running bot can be profiled without a restart: the signal SIGUSR2
+# starts profiling of its event loop for profile_duration seconds (or
+# stops it early), and the profile is written to a timestamped file in
+# the logs directory. profile_mode is cprofile (a pstats file), or
+# sample (stack samples, in the input format of flamegraph.pl).
+profile_duration = 60
+profile_mode = cprofile
+# If set, profiling, and logging of event loop callbacks which run for
+# too long, are also controlled by commands on this unix socket, e.g.
+# with: echo "slow start 200" | socat - UNIX-CONNECT:<path>
+# (send 'help' for the list of commands).
+profile_control_socket =
+
 [TIMEOUT]
 maker_timeout_sec = 60
 unconfirm_timeout_sec = 180
@@ -182,6 +241,11 @@ merge_algorithm = default
 # 8000 and 12000 for your transactions.
 tx_fees = 3
 
+# Fee estimates from the blockchain source are reused for this many
+# seconds; while a Joinmarket application is running, they are
+# refreshed in the background before they expire.
+fee_estimate_ttl_sec = 300
+
 # For users getting transaction fee estimates over an API,
 # place a sanity check limit on the satoshis-per-kB to be paid.
 # This limit is also applied to users using Core, even though
@@ -224,6 +288,15 @@ absurd_fee_per_kb = 350000
 tx_broadcast = self
 minimum_makers = 2
 
+#Takers normally wait maker_timeout_sec for offers to arrive before choosing
+#from them. Set early_fill to true to choose as soon as enough offers meeting
+#the amount and fee constraints have arrived; if the daemon has an orderbook
+#cache from previous runs (see the DAEMON section), also wait until at least
+#early_fill_fraction of the counterparties in it have re-announced their
+#offers, so that the choice is not just among the fastest responders.
+early_fill = false
+early_fill_fraction = 0.8
+
 ##############################
 #THE FOLLOWING SETTINGS ARE REQUIRED TO DEFEND AGAINST SNOOPERS.
 #DON'T ALTER THEM UNLESS YOU UNDERSTAND THE IMPLICATIONS.
@@ -286,14 +359,32 @@ def get_irc_mchannels():
     configs = []
     for section in irc_sections:
         server_data = {}
-        for option, otype in fields:
-            val = jm_single().config.get(section, option)
-            server_data[option] = otype(val)
+        if jm_single().config.has_option(section, "type") and \
+           jm_single().config.get(section, "type") == "hub":
+            server_data = _get_hub_mchannel(section)
+        else:
+            for option, otype in fields:
+                val = jm_single().config.get(section, option)
+                server_data[option] = otype(val)
         server_data['btcnet'] = get_network()
         configs.append(server_data)
     return configs
 
 
+def _get_hub_mchannel(section):
+    """A joinmarket hub (see jmdaemon/hub.py) is reached either
+    at host and port, or at a unix socket path.
+    """
+    server_data = {"type": "hub",
+                   "channel": jm_single().config.get(section, "channel")}
+    if jm_single().config.has_option(section, "socket"):
+        server_data["socket"] = jm_single().config.get(section, "socket")
+    else:
+        server_data["host"] = jm_single().config.get(section, "host")
+        server_data["port"] = jm_single().config.getint(section, "port")
+    return server_data
+
+
 def _get_irc_mchannels_old():
     fields = [("host", str), ("port", int), ("channel", str), ("usessl", str),
               ("socks5", str), ("socks5_host", str), ("socks5_port", str)]
@@ -478,6 +569,7 @@ def get_blockchain_interface_instance(_config):
     from jmclient.blockchaininterface import BitcoinCoreInterface, \
         RegtestBitcoinCoreInterface, ElectrumWalletInterface
     from jmclient.electruminterface import ElectrumInterface
+    from jmclient.simulatedinterface import SimulatedBlockchainInterface
     source = _config.get("BLOCKCHAIN", "blockchain_source")
     network = get_network()
     testnet = network == 'testnet'
@@ -496,6 +588,8 @@ def get_blockchain_interface_instance(_config):
         bc_interface = ElectrumWalletInterface(testnet)
     elif source == 'electrum-server':
         bc_interface = ElectrumInterface(testnet) #can specify server, config, TODO
+    elif source == 'simulated':
+        bc_interface = SimulatedBlockchainInterface()
     else:
         raise ValueError("Invalid blockchain source")
     return bc_interface
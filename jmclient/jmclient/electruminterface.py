@@ -6,10 +6,10 @@ import jmbitcoin as btc
 import json
 import queue as Queue
 import os
-import pprint
 import random
 import socket
 import threading
+import time
 import ssl
 import binascii
 from twisted.internet.protocol import ClientFactory
@@ -18,26 +18,57 @@ from twisted.protocols.basic import LineReceiver
 from twisted.internet import reactor, task, defer
 from .blockchaininterface import BlockchainInterface
 from .configure import get_p2sh_vbyte
+from .tx_cache import get_tx_cache
 from jmbase import get_log
 from .electrum_data import get_default_servers, set_electrum_testnet,\
     DEFAULT_PROTO
 
 log = get_log()
 
+#Electrum protocol versions supported (min, max), as sent to the server
+#in server.version; scripthash methods need 1.1.
+PROTOCOL_VERSION = ["1.1", "1.4"]
+
 class ElectrumConnectionError(Exception):
     pass
 
+
+def script_to_scripthash(script):
+    """Returns the Electrum script hash (hex) of an output
+    script (hex): its sha256, reversed.
+    """
+    return binascii.hexlify(btc.bin_sha256(binascii.unhexlify(
+        script))[::-1]).decode('ascii')
+
+
+def address_to_scripthash(addr):
+    return script_to_scripthash(btc.address_to_script(addr))
+
+
+def get_header_height(header):
+    """Returns the block height from a blockchain.headers.subscribe
+    result or notification (its key depends on protocol version).
+    """
+    return header.get('height', header.get('block_height'))
+
+
 class TxElectrumClientProtocol(LineReceiver):
-    #map deferreds to msgids to correctly link response with request
-    deferreds = {}
     delimiter = b"\n"
+    #responses to batches of requests can be large
+    MAX_LENGTH = 2**26
 
     def __init__(self, factory):
         self.factory = factory
+        #map deferreds to msgids to correctly link response with request
+        self.deferreds = {}
+        self.pingloop = None
 
     def connectionMade(self):
         log.debug('connection to Electrum succesful')
         self.msg_id = 0
+        #must be the first request
+        self.call_server_method('server.version',
+                                ['joinmarket', PROTOCOL_VERSION])
         if self.factory.bci.wallet:
             #Use connectionMade as a trigger to start wallet sync,
             #if the reactor start happened after the call to wallet sync
@@ -46,42 +77,79 @@ class TxElectrumClientProtocol(LineReceiver):
             self.factory.bci.sync_addresses(self.factory.bci.wallet)
         #these server calls must always be done to keep the connection open
         self.start_ping()
-        self.call_server_method('blockchain.numblocks.subscribe')
+        d = self.call_server_method('blockchain.headers.subscribe')
+        d.addCallback(self.factory.bci.on_headers_response)
+        #subscriptions don't survive the connection
+        for scripthash in self.factory.bci.scripthash_watchers:
+            self.factory.bci.subscribe_scripthash(scripthash)
+
+    def connectionLost(self, reason):
+        if self.pingloop and self.pingloop.running:
+            self.pingloop.stop()
+        #requests in flight will not be answered
+        self.deferreds = {}
 
     def start_ping(self):
-        pingloop = task.LoopingCall(self.ping)
-        pingloop.start(60.0)
+        self.pingloop = task.LoopingCall(self.ping)
+        self.pingloop.start(60.0)
 
     def ping(self):
         #We dont bother tracking response to this;
         #just for keeping connection active
-        self.call_server_method('server.version')
+        self.call_server_method('server.ping')
 
     def send_json(self, json_data):
         data = json.dumps(json_data).encode()
         self.sendLine(data)
 
-    def call_server_method(self, method, params=[]):
+    def make_request(self, method, params):
+        """Returns a request object with a new id, and the
+        Deferred that will fire with the response to it.
+        """
         self.msg_id = self.msg_id + 1
-        current_id = self.msg_id
-        self.deferreds[current_id] = defer.Deferred()
-        method_dict = {
-            'id': current_id,
-            'method': method,
-            'params': params
-        }
-        self.send_json(method_dict)
-        return self.deferreds[current_id]
+        d = defer.Deferred()
+        self.deferreds[self.msg_id] = d
+        return {'id': self.msg_id, 'method': method, 'params': params}, d
+
+    def call_server_method(self, method, params=[]):
+        request, d = self.make_request(method, params)
+        self.send_json(request)
+        return d
+
+    def call_server_batch(self, calls):
+        """Send a list of (method, params) as a single JSON-RPC batch
+        request; returns a Deferred firing with the list of responses,
+        in the same order. Any number of requests and batches can be in
+        flight at once; responses are matched to requests by id.
+        """
+        requests, deferreds = zip(*[self.make_request(method, params)
+                                    for method, params in calls])
+        self.send_json(list(requests))
+        return defer.gatherResults(list(deferreds))
 
     def lineReceived(self, line):
         try:
             parsed = json.loads(line.decode())
-            msgid = parsed['id']
-            linked_deferred = self.deferreds[msgid]
-        except:
-            log.debug("Ignored response from Electrum server: " + str(line))
+        except ValueError:
+            log.debug("Ignored invalid data from Electrum server: " +
+                      str(line))
             return
-        linked_deferred.callback(parsed)
+        #a batch request is answered with an array
+        if not isinstance(parsed, list):
+            parsed = [parsed]
+        for response in parsed:
+            try:
+                if response.get('id') is None and 'method' in response:
+                    #a subscription notification
+                    self.factory.bci.on_notification(response['method'],
+                                                     response['params'])
+                    continue
+                linked_deferred = self.deferreds.pop(response['id'])
+            except (KeyError, TypeError, AttributeError):
+                log.debug("Ignored response from Electrum server: " +
+                          str(response))
+                continue
+            linked_deferred.callback(response)
 
 class TxElectrumClientProtocolFactory(ClientFactory):
 
@@ -124,27 +192,40 @@ class ElectrumConn(threading.Thread):
         except Exception as e:
             log.error("Error connecting to electrum server; trying again.")
             raise ElectrumConnectionError
+        #must be the first request
+        self.send_json({'id': 0, 'method': 'server.version',
+                        'params': ['joinmarket', PROTOCOL_VERSION]})
         self.ping()
 
     def run(self):
+        buf = bytearray()
         while True:
-            all_data = None
+            data = self.s.recv(65536)
+            if not data:
+                log.debug("Electrum connection closed")
+                return
+            buf.extend(data)
+            #a read may hold part of a message, or several
             while True:
-                data = self.s.recv(1024)
-                if data is None:
-                    continue
-                if all_data is None:
-                    all_data = data
-                else:
-                    all_data = all_data + data
-                if b'\n' in all_data:
+                end = buf.find(b'\n')
+                if end < 0:
                     break
-            data_json = json.loads(all_data[:-1].decode())
-            self.RetQueue.put(data_json)
+                line = bytes(buf[:end])
+                del buf[:end + 1]
+                try:
+                    data_json = json.loads(line.decode())
+                except ValueError:
+                    log.debug("Ignored invalid data from Electrum server")
+                    continue
+                #a batch request is answered with an array
+                if not isinstance(data_json, list):
+                    data_json = [data_json]
+                for response in data_json:
+                    self.RetQueue.put(response)
 
     def ping(self):
         log.debug('Sending Electrum server ping')
-        self.send_json({'id':0,'method':'server.version','params':[]})
+        self.send_json({'id':0,'method':'server.ping','params':[]})
         t = threading.Timer(60, self.ping)
         t.daemon = True
         t.start()
@@ -169,12 +250,48 @@ class ElectrumConn(threading.Thread):
             else:
                 log.debug(json.dumps(ret_data))
 
+    def call_server_batch(self, calls):
+        """Send a list of (method, params) as a single JSON-RPC batch
+        request, and wait for all the responses; they are returned
+        in the same order.
+        """
+        batch = []
+        for method, params in calls:
+            self.msg_id = self.msg_id + 1
+            batch.append({'id': self.msg_id, 'method': method,
+                          'params': params})
+        self.send_json(batch)
+        ids = set([b['id'] for b in batch])
+        responses = {}
+        while len(responses) < len(batch):
+            ret_data = self.RetQueue.get()
+            if ret_data.get('id', None) in ids:
+                responses[ret_data['id']] = ret_data
+            else:
+                log.debug(json.dumps(ret_data))
+        return [responses[b['id']] for b in batch]
+
 class ElectrumInterface(BlockchainInterface):
+    #Number of addresses whose history is requested in one batch, per
+    #branch, when syncing: it starts at BATCH_SIZE (or the gap limit,
+    #if larger), doubles for every further batch needed on the branch up
+    #to MAX_BATCH_SIZE, and is halved if the server rejects a batch.
+    #listunspent requests are sent in batches of MAX_BATCH_SIZE.
     BATCH_SIZE = 8
+    MAX_BATCH_SIZE = 512
+    #watchers are run on scripthash subscription notifications
+    tx_watcher_poll_interval = None
+    #the tip height is notified by the headers subscription
+    block_watcher_poll_interval = None
+
     def __init__(self, testnet=False, electrum_server=None):
+        """electrum_server: a server name from the default list, or
+        host:port; if None, a random default server is used.
+        """
         self.synctype = "sync-only"
         if testnet:
             set_electrum_testnet()
+        self.electrum_server = electrum_server
         self.start_electrum_proto()
         self.electrum_conn = None
         self.start_connection_thread()
@@ -182,11 +299,17 @@ class ElectrumInterface(BlockchainInterface):
         #Format: {"txid": (loop, unconfirmed true/false, confirmed true/false,
         #spent true/false), ..}
         self.tx_watcher_loops = {}
+        #keys of the watchers in tx_watcher_loops to run on a change
+        #of status of a script hash, by script hash
+        self.scripthash_watchers = {}
+        self.current_height = None
+        self.tx_cache = None
         self.wallet = None
         self.wallet_synced = False
 
     def start_electrum_proto(self, electrum_server=None):
-        self.server, self.port = self.get_server(electrum_server)
+        self.server, self.port = self.get_server(
+            electrum_server or self.electrum_server)
         self.factory = TxElectrumClientProtocolFactory(self)
         if DEFAULT_PROTO == 's':
             ctx = ClientContextFactory()
@@ -205,14 +328,15 @@ class ElectrumInterface(BlockchainInterface):
         is asynchronous).
         """
         try:
-            s, p = self.get_server(None)
+            s, p = self.get_server(self.electrum_server)
             self.electrum_conn = ElectrumConn(s, p, DEFAULT_PROTO)
         except ElectrumConnectionError:
             reactor.callLater(1.0, self.start_connection_thread)
             return
         self.electrum_conn.start()
         #used to hold open server conn
-        self.electrum_conn.call_server_method('blockchain.numblocks.subscribe')
+        self.on_headers_response(self.electrum_conn.call_server_method(
+            'blockchain.headers.subscribe'))
 
     def sync_wallet(self, wallet, fast=False, restart_cb=False):
         """This triggers the start of syncing, wiping temporary state
@@ -223,6 +347,12 @@ class ElectrumInterface(BlockchainInterface):
         self.wallet = wallet
         #wipe the temporary cache of address histories
         self.temp_addr_history = {}
+        #status hashes of the wallet's script hashes, by script hash,
+        #as returned by subscribing during this sync
+        self.scripthash_status = {}
+        if self.tx_cache:
+            self.tx_cache.close()
+        self.tx_cache = get_tx_cache(wallet)
         #mark as not currently synced
         self.wallet_synced = False
         if self.synctype == "sync-only":
@@ -235,8 +365,12 @@ class ElectrumInterface(BlockchainInterface):
                 electrum_server = random.choice(list(get_default_servers().keys()))
                 if DEFAULT_PROTO in get_default_servers()[electrum_server]:
                     break
-        s = electrum_server
-        p = int(get_default_servers()[electrum_server][DEFAULT_PROTO])
+        if electrum_server in get_default_servers():
+            s = electrum_server
+            p = int(get_default_servers()[electrum_server][DEFAULT_PROTO])
+        else:
+            s, p = electrum_server.rsplit(':', 1)
+            p = int(p)
         log.debug('Trying to connect to Electrum server: ' + str(electrum_server))
         return (s, p)
 
@@ -247,19 +381,49 @@ class ElectrumInterface(BlockchainInterface):
         else:
             return self.factory.client.call_server_method(method, params)
 
+    def get_from_electrum_batch(self, method, params_list, blocking=False):
+        """As get_from_electrum, for a list of params for the same method,
+        sent as one batch request; returns (or, if not blocking, returns
+        a Deferred firing with) the list of responses.
+        """
+        calls = [(method, [p] if type(p) is not list else p)
+                 for p in params_list]
+        if blocking:
+            return self.electrum_conn.call_server_batch(calls)
+        else:
+            return self.factory.client.call_server_batch(calls)
+
+    def on_headers_response(self, response):
+        if isinstance(response.get('result'), dict):
+            self.current_height = get_header_height(response['result'])
+
+    def on_notification(self, method, params):
+        """Called for a notification from the (asynchronous)
+        server connection, of a new tip or a changed script hash
+        status; the watchers of the script hash are run.
+        """
+        if method == 'blockchain.headers.subscribe':
+            self.current_height = get_header_height(params[0])
+        elif method == 'blockchain.scripthash.subscribe':
+            self.run_watchers(params[0])
+        else:
+            log.debug("Ignored notification from Electrum server: " + method)
+
     def sync_addresses(self, wallet, restart_cb=None):
-        if not self.electrum_conn:
+        if not self.electrum_conn or not getattr(self.factory, 'client', None):
             #wait until we have some connection up before starting
             reactor.callLater(0.2, self.sync_addresses, wallet, restart_cb)
             return
         log.debug("downloading wallet history from Electrum server ...")
+        self.sync_start_time = time.time()
         for mixdepth in range(wallet.max_mixdepth + 1):
             for forchange in [0, 1]:
                 #start from a clean index
                 wallet.set_next_index(mixdepth, forchange, 0)
                 self.synchronize_batch(wallet, mixdepth, forchange, 0)
 
-    def synchronize_batch(self, wallet, mixdepth, forchange, start_index):
+    def synchronize_batch(self, wallet, mixdepth, forchange, start_index,
+                          batch_size=None):
         #for debugging only:
         #log.debug("Syncing address batch, m, fc, i: " + ",".join(
         #    [str(x) for x in [mixdepth, forchange, start_index]]))
@@ -267,72 +431,87 @@ class ElectrumInterface(BlockchainInterface):
             self.temp_addr_history[mixdepth] = {}
         if forchange not in self.temp_addr_history[mixdepth]:
             self.temp_addr_history[mixdepth][forchange] = {"finished": False}
-        for i in range(start_index, start_index + self.BATCH_SIZE):
-            #get_new_addr is OK here, as guaranteed to be sequential *on this branch*
-            a = wallet.get_new_addr(mixdepth, forchange)
-            d = self.get_from_electrum('blockchain.address.get_history', a)
+        tah = self.temp_addr_history[mixdepth][forchange]
+        #the end of the branch is found when a batch ends with gap_limit
+        #unused addresses, so a batch must be at least that long.
+        batch_size = max(batch_size or self.BATCH_SIZE, wallet.gap_limit)
+        scripthashes = []
+        for i in range(start_index, start_index + batch_size):
             #makes sure entries in temporary address history are ready
-            #to be accessed.
-            if i not in self.temp_addr_history[mixdepth][forchange]:
-                self.temp_addr_history[mixdepth][forchange][i] = {'synced': False,
-                                                          'addr': a,
-                                                          'used': False}
-            d.addCallback(self.process_address_history, wallet,
-                          mixdepth, forchange, i, a, start_index)
-
-    def process_address_history(self, history, wallet, mixdepth, forchange, i,
-                                addr, start_index):
-        """Given the history data for an address from Electrum, update the current view
-        of the wallet's usage at mixdepth mixdepth and account forchange, address addr at
-        index i. Once all addresses from index start_index to start_index + self.BATCH_SIZE
-        have been thus updated, trigger either continuation to the next batch, or, if
-        conditions are fulfilled, end syncing for this (mixdepth, forchange) branch, and
-        if all such branches are finished, proceed to the sync_unspent step.
+            #to be accessed (they may be, if this batch is a retry).
+            if i not in tah:
+                #get_new_addr is OK here, as guaranteed to be sequential
+                #*on this branch*
+                addr = wallet.get_new_addr(mixdepth, forchange)
+                tah[i] = {'synced': False,
+                          'addr': addr,
+                          'scripthash': address_to_scripthash(addr),
+                          'used': False}
+            scripthashes.append(tah[i]['scripthash'])
+        d = self.get_from_electrum_batch('blockchain.scripthash.subscribe',
+                                         scripthashes)
+        d.addCallback(self.process_address_statuses, wallet,
+                      mixdepth, forchange, start_index, batch_size)
+
+    def process_address_statuses(self, statuses, wallet, mixdepth, forchange,
+                                 start_index, batch_size):
+        """Given the status hashes from Electrum for the batch_size addresses
+        from index start_index of branch (mixdepth, forchange) (None for an
+        address with no history), update the
+        current view of the wallet's usage of them, then trigger either
+        continuation to the next (larger) batch, or, if the last gap_limit
+        addresses are unused, end syncing for this branch; if all branches
+        are finished, proceed to the sync_unspent step.
         """
+        if any([h.get('error') for h in statuses]):
+            #likely too large for this server, retry smaller
+            retry_size = batch_size // 2
+            delay = 0.0
+            if retry_size < wallet.gap_limit:
+                log.warn("Electrum server rejected address status request, "
+                         "retrying: " + str([h.get('error') for h in
+                                             statuses if h.get('error')][0]))
+                delay = 5.0
+            reactor.callLater(delay, self.synchronize_batch, wallet, mixdepth,
+                              forchange, start_index, retry_size)
+            return
         tah = self.temp_addr_history[mixdepth][forchange]
-        if len(history['result']) > 0:
-            tah[i]['used'] = True
-        tah[i]['synced'] = True
-        #Having updated this specific record, check if the entire batch from start_index
-        #has been synchronized
-        if all([tah[j]['synced'] for j in range(start_index, start_index + self.BATCH_SIZE)]):
-            #check if unused goes back as much as gaplimit *and* we are ahead of any
-            #existing index_cache from the wallet file; if both true, end, else, continue
-            #to next batch
-            if all([tah[j]['used'] is False for j in range(
-                start_index + self.BATCH_SIZE - wallet.gap_limit,
-                start_index + self.BATCH_SIZE)]):
-                last_used_addr = None
-                #to find last used, note that it may be in the *previous* batch;
-                #may as well just search from the start, since it takes no time.
-                for j in range(start_index + self.BATCH_SIZE):
-                    if tah[j]['used']:
-                        last_used_addr = tah[j]['addr']
-                if last_used_addr:
-                    wallet.set_next_index(
-                        mixdepth, forchange,
-                        wallet.get_next_unused_index(mixdepth, forchange))
-                else:
-                    wallet.set_next_index(mixdepth, forchange, 0)
-                tah["finished"] = True
-                #check if all branches are finished to trigger next stage of sync.
-                addr_sync_complete = True
-                for m in range(wallet.max_mix_depth):
-                    for fc in [0, 1]:
-                        if not self.temp_addr_history[m][fc]["finished"]:
-                            addr_sync_complete = False
-                if addr_sync_complete:
-                    self.sync_unspent(wallet)
-            else:
-                #continue search forwards on this branch
-                self.synchronize_batch(wallet, mixdepth, forchange, start_index + self.BATCH_SIZE)
+        for i, status in enumerate(statuses):
+            entry = tah[start_index + i]
+            self.scripthash_status[entry['scripthash']] = status['result']
+            if status['result'] is not None:
+                entry['used'] = True
+            entry['synced'] = True
+        end_index = start_index + batch_size
+        if any([tah[j]['used'] for j in range(end_index - wallet.gap_limit,
+                                               end_index)]):
+            #continue search forwards on this branch
+            self.synchronize_batch(wallet, mixdepth, forchange, end_index,
+                                   min(batch_size * 2, self.MAX_BATCH_SIZE))
+            return
+        #the next index is after the last used address; it may be in an
+        #earlier batch, so search from the start, since it takes no time.
+        next_index = 0
+        for j in range(end_index):
+            if tah[j]['used']:
+                next_index = j + 1
+        wallet.set_next_index(mixdepth, forchange, next_index)
+        tah["finished"] = True
+        #check if all branches are finished to trigger next stage of sync.
+        for m in range(wallet.max_mixdepth + 1):
+            for fc in [0, 1]:
+                if not self.temp_addr_history[m][fc]["finished"]:
+                    return
+        log.debug("Electrum address history sync took: {:.2f}s".format(
+            time.time() - self.sync_start_time))
+        self.sync_unspent(wallet)
 
     def sync_unspent(self, wallet):
         # finds utxos in the wallet
         wallet.reset_utxos()
         #Prepare list of all used addresses
         addrs = set()
-        for m in range(wallet.max_mixdepth):
+        for m in range(wallet.max_mixdepth + 1):
             for fc in [0, 1]:
                 branch_list = []
                 for k, v in iteritems(self.temp_addr_history[m][fc]):
@@ -349,31 +528,87 @@ class ElectrumInterface(BlockchainInterface):
             return
         #make sure to add any addresses during the run (a subset of those
         #added to the address cache)
-        for md in range(wallet.max_mixdepth):
+        for md in range(wallet.max_mixdepth + 1):
             for internal in (True, False):
                 for index in range(wallet.get_next_unused_index(md, internal)):
                     addrs.add(wallet.get_addr(md, internal, index))
             for path in wallet.yield_imported_paths(md):
                 addrs.add(wallet.get_addr_path(path))
 
-        self.listunspent_calls = len(addrs)
-        for a in addrs:
-            # FIXME: update to protocol version 1.1 and use scripthash instead
-            script = wallet.addr_to_script(a)
-            d = self.get_from_electrum('blockchain.address.listunspent', a)
-            d.addCallback(self.process_listunspent_data, wallet, script)
-
-    def process_listunspent_data(self, unspent_info, wallet, script):
-        res = unspent_info['result']
-        for u in res:
-            txid = binascii.unhexlify(u['tx_hash'])
-            wallet.add_utxo(txid, int(u['tx_pos']), script, int(u['value']))
+        #the unspent outputs of an address are only requested if its
+        #status has changed since they were last fetched (or is not known)
+        to_request = []
+        for addr in addrs:
+            scripthash = address_to_scripthash(addr)
+            if scripthash not in self.scripthash_status:
+                to_request.append(addr)
+                continue
+            status = self.scripthash_status[scripthash]
+            if status is None:
+                continue
+            cached = self.tx_cache.get_scripthash_status(scripthash)
+            if cached is None or cached[0] != status:
+                to_request.append(addr)
+                continue
+            script = wallet.addr_to_script(addr)
+            for u in cached[1]:
+                #caches written before heights were recorded lack them
+                wallet.add_utxo(binascii.unhexlify(u[0]), u[1], script, u[2],
+                                height=u[3] if len(u) > 3 else None)
+        log.debug("Requesting unspent outputs of {} of {} addresses".format(
+            len(to_request), len(addrs)))
+        self.listunspent_calls = 0
+        for i in range(0, len(to_request), self.MAX_BATCH_SIZE):
+            self.request_listunspent(wallet,
+                                     to_request[i:i + self.MAX_BATCH_SIZE])
+        if self.listunspent_calls == 0:
+            self.finish_sync()
+
+    def request_listunspent(self, wallet, addrs):
+        self.listunspent_calls += 1
+        d = self.get_from_electrum_batch('blockchain.scripthash.listunspent',
+                                         [address_to_scripthash(a)
+                                          for a in addrs])
+        d.addCallback(self.process_listunspent_data, wallet, addrs)
+
+    def process_listunspent_data(self, unspent_infos, wallet, addrs):
+        if len(addrs) > 1 and any([u.get('error') for u in unspent_infos]):
+            #likely too large for this server, retry as two batches
+            half = len(addrs) // 2
+            self.request_listunspent(wallet, addrs[:half])
+            self.request_listunspent(wallet, addrs[half:])
+        else:
+            for addr, unspent_info in zip(addrs, unspent_infos):
+                if unspent_info.get('error'):
+                    log.error("Failed to get unspent outputs of " + addr +
+                              ": " + str(unspent_info['error']))
+                    continue
+                script = wallet.addr_to_script(addr)
+                #heights of 0 and -1 mean unconfirmed
+                unspent = [[str(u['tx_hash']), int(u['tx_pos']),
+                            int(u['value']),
+                            int(u['height']) if int(u['height']) > 0 else None]
+                           for u in unspent_info['result']]
+                for tx_hash, tx_pos, value, height in unspent:
+                    wallet.add_utxo(binascii.unhexlify(tx_hash), tx_pos,
+                                    script, value, height=height)
+                scripthash = address_to_scripthash(addr)
+                if self.scripthash_status.get(scripthash) is not None:
+                    self.tx_cache.set_scripthash_status(
+                        scripthash, self.scripthash_status[scripthash],
+                        unspent)
 
         self.listunspent_calls -= 1
         if self.listunspent_calls == 0:
-            self.wallet_synced = True
-            if self.synctype == "sync-only":
-                reactor.stop()
+            self.finish_sync()
+
+    def finish_sync(self):
+        self.tx_cache.save()
+        log.debug("Electrum wallet sync took: {:.2f}s".format(
+            time.time() - self.sync_start_time))
+        self.wallet_synced = True
+        if self.synctype == "sync-only":
+            reactor.stop()
 
     def pushtx(self, txhex):
         brcst_res = self.get_from_electrum('blockchain.transaction.broadcast',
@@ -385,28 +620,42 @@ class ElectrumInterface(BlockchainInterface):
         return (False, None)
 
     def query_utxo_set(self, txout, includeconf=False):
-        self.current_height = self.get_from_electrum(
-            "blockchain.numblocks.subscribe", blocking=True)['result']
+        """Behaves as for Core. The outpoints are looked up in batches
+        of MAX_BATCH_SIZE requests: each transaction referenced is
+        fetched once, then the unspent outputs of each distinct output
+        script. The tip height is the one last notified by the server.
+        """
+        if self.current_height is None:
+            self.on_headers_response(self.get_from_electrum(
+                "blockchain.headers.subscribe", blocking=True))
         if not isinstance(txout, list):
             txout = [txout]
-        utxos = [[t[:64],int(t[65:])] for t in txout]
+        utxos = [(t[:64], int(t[65:])) for t in txout]
+        #output script of each outpoint, or None if the transaction
+        #or output doesn't exist
+        txouts = self.get_tx_outs(set([u[0] for u in utxos]))
+        scripts = {}
+        for txid, n in utxos:
+            outs = txouts.get(txid)
+            scripts[(txid, n)] = outs[n] if outs and n < len(outs) else None
+        unspent = self.get_scripthash_unspent(set(
+            [script_to_scripthash(s['script']) for s in scripts.values()
+             if s is not None]))
         result = []
         for ut in utxos:
-            address = self.get_from_electrum("blockchain.utxo.get_address",
-                                             ut, blocking=True)['result']
-            utxo_info = self.get_from_electrum("blockchain.address.listunspent",
-                                               address, blocking=True)['result']
+            out = scripts[ut]
             utxo = None
-            for u in utxo_info:
-                if u['tx_hash'] == ut[0] and u['tx_pos'] == ut[1]:
-                    utxo = u
+            if out is not None:
+                utxo = unspent.get(script_to_scripthash(
+                    out['script']), {}).get(ut)
             if utxo is None:
                 result.append(None)
             else:
                 r = {
                     'value': utxo['value'],
-                    'address': address,
-                    'script': btc.address_to_script(address)
+                    'address': btc.script_to_address(out['script'],
+                                                     get_p2sh_vbyte()),
+                    'script': out['script']
                 }
                 if includeconf:
                     if int(utxo['height']) in [0, -1]:
@@ -419,15 +668,125 @@ class ElectrumInterface(BlockchainInterface):
                 result.append(r)
         return result
 
-    def estimate_fee_per_kb(self, N):
-        if super(ElectrumInterface, self).fee_per_kb_has_been_manually_set(N):
-            return int(random.uniform(N * float(0.8), N * float(1.2)))
+    def get_batch_results(self, method, params_list):
+        """Blocking batched calls of method for each of params_list;
+        returns {params: result}, without the calls that failed.
+        """
+        params_list = list(params_list)
+        results = {}
+        for i in range(0, len(params_list), self.MAX_BATCH_SIZE):
+            chunk = params_list[i:i + self.MAX_BATCH_SIZE]
+            responses = self.get_from_electrum_batch(method, chunk,
+                                                     blocking=True)
+            for params, response in zip(chunk, responses):
+                if response.get('error') or response.get('result') is None:
+                    log.debug("Electrum " + method + " failed for: " +
+                              str(params) + ": " + str(response.get('error')))
+                    continue
+                results[params] = response['result']
+        return results
+
+    def get_tx_outs(self, txids):
+        """Returns {txid: list of outputs (deserialized)} for the
+        transactions of txids which the server has.
+        """
+        return dict([(txid, btc.deserialize(str(txhex))['outs'])
+                     for txid, txhex in iteritems(self.get_batch_results(
+                         'blockchain.transaction.get', txids))])
+
+    def get_scripthash_unspent(self, scripthashes):
+        """Returns {scripthash: {(txid, n): unspent output}}.
+        """
+        return dict([(sh, dict([((u['tx_hash'], u['tx_pos']), u)
+                                for u in unspent]))
+                     for sh, unspent in iteritems(self.get_batch_results(
+                         'blockchain.scripthash.listunspent', scripthashes))])
+
+    def fetch_fee_per_kb(self, N):
         fee_info = self.get_from_electrum('blockchain.estimatefee', N, blocking=True)
-        print('got fee info result: ' + str(fee_info))
+        return self.on_fee_response(fee_info)
+
+    def fetch_fee_per_kb_async(self, N):
+        """As fetch_fee_per_kb, over the asynchronous connection.
+        """
+        d = defer.maybeDeferred(self.get_from_electrum,
+                                'blockchain.estimatefee', N)
+        d.addCallback(self.on_fee_response)
+        return d
+
+    def on_fee_response(self, fee_info):
+        log.debug('got fee info result: ' + str(fee_info))
         fee = fee_info.get('result')
         fee_per_kb_sat = int(float(fee) * 100000000)
         return fee_per_kb_sat
 
+    def add_tx_notify(self, txd, unconfirmfun, confirmfun, notifyaddr,
+                      wallet_name=None, timeoutfun=None, spentfun=None,
+                      txid_flag=True, n=0, c=1, vb=None):
+        """As for BlockchainInterface, but instead of polling, the
+        watcher is run whenever the status of the script hash of the
+        address it queries changes, as notified by the server.
+        """
+        loopkey = super(ElectrumInterface, self).add_tx_notify(
+            txd, unconfirmfun, confirmfun, notifyaddr, wallet_name=wallet_name,
+            timeoutfun=timeoutfun, spentfun=spentfun, txid_flag=txid_flag,
+            n=n, c=c, vb=vb)
+        addr = self.get_watch_address(txd) if txid_flag else notifyaddr
+        if not addr:
+            return loopkey
+        scripthash = address_to_scripthash(addr)
+        if scripthash not in self.scripthash_watchers:
+            self.scripthash_watchers[scripthash] = []
+            if getattr(self.factory, 'client', None):
+                self.subscribe_scripthash(scripthash)
+        self.scripthash_watchers[scripthash].append(loopkey)
+        return loopkey
+
+    def subscribe_scripthash(self, scripthash):
+        d = self.factory.client.call_server_method(
+            'blockchain.scripthash.subscribe', [scripthash])
+        #the status may already have changed
+        d.addCallback(lambda response: self.run_watchers(scripthash))
+
+    def run_watchers(self, scripthash):
+        for loopkey in list(self.scripthash_watchers.get(scripthash, [])):
+            loop = self.tx_watcher_loops[loopkey][0]
+            try:
+                loop.f(*loop.a, **loop.kw)
+            except Exception as e:
+                log.error("Failure in transaction watcher for: " +
+                          str(loopkey) + ": " + repr(e))
+
+    def remove_watcher(self, loopkey):
+        """The watcher is no longer run on notifications (it
+        is not unsubscribed, since 1.1 servers don't support that).
+        """
+        for scripthash, loopkeys in list(self.scripthash_watchers.items()):
+            if loopkey in loopkeys:
+                loopkeys.remove(loopkey)
+            if len(loopkeys) == 0:
+                del self.scripthash_watchers[scripthash]
+
+    def tx_network_timeout(self, loopkey):
+        if not self.tx_watcher_loops[loopkey][1]:
+            self.remove_watcher(loopkey)
+        super(ElectrumInterface, self).tx_network_timeout(loopkey)
+
+    def tx_timeout(self, txd, loopkey, timeoutfun):
+        if loopkey in self.tx_watcher_loops and \
+           not self.tx_watcher_loops[loopkey][2]:
+            self.remove_watcher(loopkey)
+        super(ElectrumInterface, self).tx_timeout(txd, loopkey, timeoutfun)
+
+    def get_scripthash_history(self, addr):
+        """Returns {txid: height} for the transactions of addr;
+        height is 0 or -1 for unconfirmed transactions.
+        """
+        history = self.get_from_electrum('blockchain.scripthash.get_history',
+                                         address_to_scripthash(addr),
+                                         blocking=True).get('result')
+        return dict([(str(t['tx_hash']), t['height']) for t in history])
+
     def outputs_watcher(self, wallet_name, notifyaddr, tx_output_set,
                         unconfirmfun, confirmfun, timeoutfun):
         """Given a key for the watcher loop (notifyaddr), a wallet name (account),
@@ -437,103 +796,63 @@ class ElectrumInterface(BlockchainInterface):
         End the loop when the confirmation has been seen (no spent monitoring here).
         """
         wl = self.tx_watcher_loops[notifyaddr]
-        print('txoutset=' + pprint.pformat(tx_output_set))
-        unconftx = self.get_from_electrum('blockchain.address.get_mempool',
-                                          notifyaddr, blocking=True).get('result')
-        unconftxs = set([str(t['tx_hash']) for t in unconftx])
-        if len(unconftxs):
-            txdatas = []
-            for txid in unconftxs:
-                txdatas.append({'id': txid,
-                                'hex':str(self.get_from_electrum(
-                                    'blockchain.transaction.get',txid,
-                                    blocking=True).get('result'))})
-            unconfirmed_txid = None
-            for txdata in txdatas:
-                txhex = txdata['hex']
-                outs = set([(sv['script'], sv['value']) for sv in btc.deserialize(
-                    txhex)['outs']])
-                print('unconfirm query outs = ' + str(outs))
-                if outs == tx_output_set:
-                    unconfirmed_txid = txdata['id']
-                    unconfirmed_txhex = txhex
-                    break
-            #call unconf callback if it was found in the mempool
-            if unconfirmed_txid and not wl[1]:
-                print("Tx: " + str(unconfirmed_txid) + " seen on network.")
-                unconfirmfun(btc.deserialize(unconfirmed_txhex), unconfirmed_txid)
+        for txid, height in iteritems(self.get_scripthash_history(notifyaddr)):
+            txhex = str(self.get_from_electrum('blockchain.transaction.get',
+                                               txid, blocking=True).get(
+                                                   'result'))
+            outs = set([(sv['script'], sv['value']) for sv in btc.deserialize(
+                txhex)['outs']])
+            if outs != tx_output_set:
+                continue
+            if not wl[1]:
+                log.info("Tx: " + str(txid) + " seen on network.")
+                unconfirmfun(btc.deserialize(txhex), txid)
                 wl[1] = True
-                return
-
-        conftx = self.get_from_electrum('blockchain.address.listunspent',
-                                        notifyaddr, blocking=True).get('result')
-        conftxs = set([str(t['tx_hash']) for t in conftx])
-        if len(conftxs):
-            txdatas = []
-            for txid in conftxs:
-                txdata = str(self.get_from_electrum('blockchain.transaction.get',
-                                                    txid, blocking=True).get('result'))
-                txdatas.append({'hex':txdata,'id':txid})
-            confirmed_txid = None
-            for txdata in txdatas:
-                txhex = txdata['hex']
-                outs = set([(sv['script'], sv['value']) for sv in btc.deserialize(
-                    txhex)['outs']])
-                print('confirm query outs = ' + str(outs))
-                if outs == tx_output_set:
-                    confirmed_txid = txdata['id']
-                    confirmed_txhex = txhex
-                    break
-            if confirmed_txid and not wl[2]:
-                confirmfun(btc.deserialize(confirmed_txhex), confirmed_txid, 1)
+            if not wl[2] and height > 0:
+                confirmfun(btc.deserialize(txhex), txid, 1)
                 wl[2] = True
-                wl[0].stop()
-                return
+                self.remove_watcher(notifyaddr)
+            return
+
+    def get_watch_address(self, txd):
+        """Choose an output address of txd to query for it. Filter
+        out p2pkh addresses, assume p2sh (thus would fail to find tx on
+        some nonstandard script type).
+        """
+        for i in range(len(txd['outs'])):
+            if not btc.is_p2pkh_script(txd['outs'][i]['script']):
+                return btc.script_to_address(txd['outs'][i]['script'],
+                                             get_p2sh_vbyte())
+        return None
 
     def tx_watcher(self, txd, unconfirmfun, confirmfun, spentfun, c, n):
-        """Called at a polling interval, checks if the given deserialized
-        transaction (which must be fully signed) is (a) broadcast, (b) confirmed
-        and (c) spent from. (c, n ignored in electrum version, just supports
-        registering first confirmation).
+        """Called on a change of status of an output script of the given
+        deserialized transaction (which must be fully signed), checks if
+        it is (a) broadcast, (b) confirmed and (c) spent from. (c, n ignored
+        in electrum version, just supports registering first confirmation).
         TODO: There is no handling of conflicts here.
         """
         txid = btc.txhash(btc.serialize(txd))
         wl = self.tx_watcher_loops[txid]
-        #first check if in mempool (unconfirmed)
-        #choose an output address for the query. Filter out
-        #p2pkh addresses, assume p2sh (thus would fail to find tx on
-        #some nonstandard script type)
-        addr = None
-        for i in range(len(txd['outs'])):
-            if not btc.is_p2pkh_script(txd['outs'][i]['script']):
-                addr = btc.script_to_address(txd['outs'][i]['script'], get_p2sh_vbyte())
-                break
+        addr = self.get_watch_address(txd)
         if not addr:
             log.error("Failed to find any p2sh output, cannot be a standard "
                       "joinmarket transaction, fatal error!")
             reactor.stop()
             return
-        unconftxs_res = self.get_from_electrum('blockchain.address.get_mempool',
-                                              addr, blocking=True).get('result')
-        unconftxs = [str(t['tx_hash']) for t in unconftxs_res]
-
-        if not wl[1] and txid in unconftxs:
-            print("Tx: " + str(txid) + " seen on network.")
+        history = self.get_scripthash_history(addr)
+        if txid not in history:
+            return
+        if not wl[1]:
+            log.info("Tx: " + str(txid) + " seen on network.")
             unconfirmfun(txd, txid)
             wl[1] = True
-            return
-        conftx = self.get_from_electrum('blockchain.address.listunspent',
-                                        addr, blocking=True).get('result')
-        conftxs = [str(t['tx_hash']) for t in conftx]
-        if not wl[2] and len(conftxs) and txid in conftxs:
-            print("Tx: " + str(txid) + " is confirmed.")
+        if not wl[2] and history[txid] > 0:
+            log.info("Tx: " + str(txid) + " is confirmed.")
             confirmfun(txd, txid, 1)
             wl[2] = True
-            #Note we do not stop the monitoring loop when
+            #Note we do not stop monitoring when
             #confirmations occur, since we are also monitoring for spending.
-            return
-        if not spentfun or wl[3]:
-            return
 
     def rpc(self, method, args):
         # FIXME: this is very poorly written code
@@ -25,6 +25,7 @@ from builtins import * # noqa: F401
 import errno
 import socket
 import base64
+import copy
 import http.client
 import json
 from decimal import Decimal
@@ -68,6 +69,15 @@ class JsonRpc(object):
             self.url = ""
         self.queryId = 1
 
+    def new_connection(self):
+        """
+    Returns a copy of this client with its own HTTP connection,
+    for concurrent use from another thread.
+    """
+        rpc = copy.copy(self)
+        rpc.conn = http.client.HTTPConnection(self.host, self.port)
+        return rpc
+
     def queryHTTP(self, obj):
         """
     Send an appropriate HTTP query to the server.  The JSON-RPC
@@ -134,23 +144,55 @@ class JsonRpc(object):
         self.queryId += 1
 
         request = {"method": method, "params": params, "id": currentId}
+        response = self.query(request)
+        if response["id"] != currentId:
+            raise JsonRpcConnectionError("invalid id returned by query")
+
+        if response["error"] is not None:
+            raise JsonRpcError(response["error"])
+        return response["result"]
+
+    def call_batch(self, calls):
+        """
+    Call several methods over JSON-RPC in one HTTP request (a JSON-RPC
+    batch); calls is a list of (method, params).  Returns the list of
+    their results, in order; raises JsonRpcError if any of them failed.
+    """
+
+        if not calls:
+            return []
+        firstId = self.queryId
+        self.queryId += len(calls)
+
+        request = [{"method": method, "params": params, "id": firstId + i}
+                   for i, (method, params) in enumerate(calls)]
+        response = self.query(request)
+        #the responses may come in any order
+        if not isinstance(response, list):
+            raise JsonRpcConnectionError("invalid batch response")
+        results = {}
+        for r in response:
+            if r.get("error") is not None:
+                raise JsonRpcError(r["error"])
+            results[r.get("id")] = r.get("result")
+        try:
+            return [results[firstId + i] for i in range(len(calls))]
+        except KeyError:
+            raise JsonRpcConnectionError("invalid id returned by query")
+
+    def query(self, request):
+        """
+    Sends the request, reconnecting if needed; returns the response.
+    """
+
         #query can fail from keepalive timeout; keep retrying if it does, up
         #to a reasonable limit, then raise (failure to access blockchain
         #is a critical failure). Note that a real failure to connect (e.g.
         #wrong port) is raised in queryHTTP directly.
-        response_received = False
         for i in range(100):
             response = self.queryHTTP(request)
             if response != "CONNFAILURE":
-                response_received = True
-                break
+                return response
             #Failure means keepalive timed out, just make a new one
             self.conn = http.client.HTTPConnection(self.host, self.port)
-        if not response_received:
-            raise JsonRpcConnectionError("Unable to connect over RPC")
-        if response["id"] != currentId:
-            raise JsonRpcConnectionError("invalid id returned by query")
-
-        if response["error"] is not None:
-            raise JsonRpcError(response["error"])
-        return response["result"]
+        raise JsonRpcConnectionError("Unable to connect over RPC")
@@ -2,28 +2,38 @@
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 from builtins import * # noqa: F401
+from future.utils import iteritems
 
 import base64
 import pprint
 import sys
 import abc
-from binascii import unhexlify
+from binascii import hexlify, unhexlify
 
 
 from jmbitcoin import SerializationError, SerializationTruncationError
 import jmbitcoin as btc
 from jmclient.configure import jm_single
 from jmbase.support import get_log
+from jmbase import metrics
 from jmclient.support import (calc_cj_fee)
 from jmclient.podle import verify_podle, PoDLE, PoDLEError
-from twisted.internet import task
+from jmclient.address_pool import get_address_pool, import_new_addresses
+from twisted.internet import reactor, task
 from .cryptoengine import EngineError
 
 jlog = get_log()
 
+AUTH_SECONDS = metrics.histogram('jm_maker_auth_seconds',
+                                 'Duration of the checks of a taker commitment '
+                                 'and the choice of utxos (!auth)')
+
 class Maker(object):
     def __init__(self, wallet):
         self.active_orders = {}
+        #{utxo: delayed call expiring its reservation}, for utxos promised
+        #to takers in coinjoins which are in progress (see reserve_utxos)
+        self.utxo_reservations = {}
         self.wallet = wallet
         self.nextoid = -1
         self.offerlist = None
@@ -42,10 +52,13 @@ class Maker(object):
             return
         self.offerlist = self.create_my_orders()
         self.sync_wait_loop.stop()
+        #import the addresses of the first coinjoins before they start
+        get_address_pool(self.wallet).schedule_refill()
         if not self.offerlist:
             jlog.info("Failed to create offers, giving up.")
             sys.exit(0)
 
+    @metrics.timed(AUTH_SECONDS)
     def on_auth_received(self, nick, offer, commitment, cr, amount, kphex):
         """Receives data on proposed transaction offer from daemon, verifies
         commitment, returns necessary data to send ioauth message (utxos etc)
@@ -99,6 +112,9 @@ class Maker(object):
         if not utxos:
             #could not find funds
             return (False,)
+        #the taker sends the transaction within its two waits
+        #(for our !ioauth, then for our !sig) of maker_timeout_sec
+        self.reserve_utxos(utxos.keys(), 2 * jm_single().maker_timeout_sec)
         self.wallet.update_cache_index()
         # Construct data for auth request back to taker.
         # Need to choose an input utxo pubkey to sign with
@@ -124,8 +140,13 @@ class Maker(object):
         goodtx, errmsg = self.verify_unsigned_tx(tx, offerinfo)
         if not goodtx:
             jlog.info('not a good tx, reason=' + errmsg)
+            self.release_utxos(offerinfo["utxos"].keys())
             return (False, errmsg)
         jlog.info('goodtx')
+        #held until the transaction is seen on the network, or until
+        #its watcher gives up on it being broadcast
+        self.reserve_utxos(offerinfo["utxos"].keys(), float(
+            jm_single().config.get("TIMEOUT", "unconfirm_timeout_sec")))
         sigs = []
         utxos = offerinfo["utxos"]
 
@@ -229,6 +250,53 @@ class Maker(object):
             return (False, (fmt(times_seen_cj_addr, times_seen_change_addr)))
         return (True, None)
 
+    def reserve_utxos(self, utxos, seconds):
+        """Excludes utxos (of the form 'txid:n') from those chosen to fill
+        further orders (see reserved_utxos), for the next seconds, or until
+        released, so that concurrent coinjoins do not choose the same utxos.
+        A utxo already reserved has its reservation extended (or shortened).
+        """
+        for utxo in utxos:
+            expiry = self.utxo_reservations.get(utxo)
+            if expiry and expiry.active():
+                expiry.reset(seconds)
+            else:
+                self.utxo_reservations[utxo] = reactor.callLater(
+                    seconds, self.expire_reservation, utxo)
+
+    def expire_reservation(self, utxo):
+        expiry = self.utxo_reservations.get(utxo)
+        #a DelayedCall is no longer active while it runs, so an active
+        #one is a newer reservation of the same utxo, which is kept
+        if expiry is not None and not expiry.active():
+            del self.utxo_reservations[utxo]
+
+    def release_utxos(self, utxos):
+        for utxo in utxos:
+            expiry = self.utxo_reservations.pop(utxo, None)
+            if expiry and expiry.active():
+                expiry.cancel()
+
+    def reserved_utxos(self):
+        """Returns the list of utxos ('txid:n') promised to takers in
+        coinjoins in progress, which oid_to_order must not choose.
+        """
+        return list(self.utxo_reservations.keys())
+
+    def get_available_balance_by_mixdepth(self):
+        """As wallet.get_balance_by_mixdepth, but excluding the reserved
+        utxos.
+        """
+        mix_balance = self.wallet.get_balance_by_mixdepth()
+        if not self.utxo_reservations:
+            return mix_balance
+        for md, utxos in iteritems(self.wallet.get_utxos_by_mixdepth_()):
+            for (txid, index), data in iteritems(utxos):
+                utxo = hexlify(txid).decode('ascii') + ':' + str(index)
+                if utxo in self.utxo_reservations and md in mix_balance:
+                    mix_balance[md] -= data['value']
+        return mix_balance
+
     def modify_orders(self, to_cancel, to_announce):
         """This code is called on unconfirm and confirm callbacks,
         and replaces existing orders with new ones, or just cancels
@@ -241,6 +309,7 @@ class Maker(object):
             if len(order) == 0:
                 fmt = 'didnt cancel order which doesnt exist, oid={}'.format
                 jlog.info(fmt(oid))
+                continue
             self.offerlist.remove(order[0])
         if len(to_announce) > 0:
             for ann in to_announce:
@@ -251,12 +320,7 @@ class Maker(object):
             self.offerlist += to_announce
 
     def import_new_addresses(self, addr_list):
-        # FIXME: same code as in taker.py
-        bci = jm_single().bc_interface
-        if not hasattr(bci, 'import_addresses'):
-            return
-        assert hasattr(bci, 'get_wallet_name')
-        bci.import_addresses(addr_list, bci.get_wallet_name(self.wallet))
+        import_new_addresses(self.wallet, addr_list)
 
     @abc.abstractmethod
     def create_my_orders(self):
@@ -0,0 +1,403 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import * # noqa: F401
+"""An in-process blockchain for tests and benchmarks: a UTXO set,
+mempool and block producer held in memory, shared by all the wallets
+(takers and makers) of one process, so that full coinjoin rounds can
+be run without bitcoind.
+Transactions are checked for spending existing, unspent outputs and
+for not creating money, but scripts and signatures are not verified.
+Every call which would be an RPC on a real node is counted in
+calls, and can be given an artificial latency, so that the cost of
+the blockchain interface in a round can be profiled.
+"""
+
+import ast
+import binascii
+import collections
+import time
+from decimal import Decimal
+from twisted.internet import reactor, task
+
+import jmbitcoin as btc
+
+from jmclient.blockchaininterface import (BlockchainInterface,
+                                          BitcoinCoreInterface)
+from jmclient.configure import get_p2sh_vbyte, jm_single
+from jmbase.support import get_log
+
+log = get_log()
+
+#the fee per kB returned by the fee estimation, in satoshis
+DEFAULT_SIMULATED_FEE_PER_KB = 10000
+
+
+class SimulatedBlockchainInterface(BlockchainInterface):
+    #watchers are run when a transaction is pushed or a block mined
+    tx_watcher_poll_interval = None
+    #current_height is kept by the block producer
+    block_watcher_poll_interval = None
+
+    def __init__(self, latency=0.0, fee_per_kb=DEFAULT_SIMULATED_FEE_PER_KB):
+        """
+        args:
+            latency: seconds each simulated RPC call blocks for
+            fee_per_kb: the fee estimate, for any target
+        """
+        super(SimulatedBlockchainInterface, self).__init__()
+        self.latency = latency
+        self.fee_per_kb = fee_per_kb
+        #number of simulated RPC calls made, by method name
+        self.calls = collections.Counter()
+        self.current_height = 0
+        #{txid: {'txd': dict, 'height': int or None}}, in order of arrival
+        self.txs = collections.OrderedDict()
+        #{(txid, n): {'script': bytes, 'value': int, 'height': int or None}}
+        self.utxos = {}
+        #{(txid, n): spending txid}
+        self.spent_by = {}
+        #txids of unconfirmed transactions
+        self.mempool = []
+        #output scripts that have ever been paid to
+        self.used_scripts = set()
+        #{frozenset of (script, value) outputs: txid}, for outputs_watcher
+        self.output_sets = {}
+        #fake coinbase inputs made by grab_coins
+        self.coinbase_count = 0
+        self.wallet_synced = False
+        #task.LoopingCall objects that track transactions, keyed by txids.
+        #Format: {"txid": (loop, unconfirmed true/false, confirmed true/false,
+        #spent true/false), ..}
+        self.tx_watcher_loops = {}
+        #keys of the watchers in tx_watcher_loops still to be run
+        self.watching = set()
+        #as for RegtestBitcoinCoreInterface
+        self.tick_forward_chain_interval = -1
+        self.absurd_fees = False
+        self.simulating = False
+        self.shutdown_signal = False
+
+    def simulate_call(self, method, count=1):
+        """Accounts for count calls to the blockchain source, made in
+        one request.
+        """
+        self.calls[method] += count
+        if self.latency:
+            time.sleep(self.latency)
+
+    """Chain state
+    """
+
+    def add_tx(self, txd, check_inputs=True):
+        """Adds deserialized transaction txd to the mempool, spending
+        its inputs. Returns its txid, or None if it is invalid.
+        """
+        txhex = btc.serialize(txd)
+        txid = btc.txhash(txhex)
+        if txid in self.txs:
+            log.debug("Simulated blockchain: transaction already known: " +
+                      txid)
+            return None
+        outpoints = [(i['outpoint']['hash'], i['outpoint']['index'])
+                     for i in txd['ins']]
+        if check_inputs:
+            if len(set(outpoints)) != len(outpoints) or \
+               any([o not in self.utxos for o in outpoints]):
+                log.debug("Simulated blockchain: missing or spent inputs "
+                          "in: " + txid)
+                return None
+            if sum([self.utxos[o]['value'] for o in outpoints]) < \
+               sum([o['value'] for o in txd['outs']]):
+                log.debug("Simulated blockchain: outputs exceed inputs "
+                          "in: " + txid)
+                return None
+            for o in outpoints:
+                del self.utxos[o]
+                self.spent_by[o] = txid
+        for n, out in enumerate(txd['outs']):
+            script = binascii.unhexlify(out['script'])
+            self.utxos[(txid, n)] = {'script': script, 'value': out['value'],
+                                     'height': None}
+            self.used_scripts.add(script)
+        self.txs[txid] = {'txd': txd, 'height': None}
+        self.output_sets[frozenset([(o['script'], o['value'])
+                                    for o in txd['outs']])] = txid
+        self.mempool.append(txid)
+        return txid
+
+    def get_confirmations(self, txid):
+        """Returns the number of confirmations of txid (0 if
+        unconfirmed), or None if it is not known.
+        """
+        if txid not in self.txs:
+            return None
+        height = self.txs[txid]['height']
+        if height is None:
+            return 0
+        return self.current_height - height + 1
+
+    def tick_forward_chain(self, n):
+        """Mines n blocks, the first with all the transactions
+        of the mempool.
+        """
+        for i in range(n):
+            self.current_height += 1
+            for txid in self.mempool:
+                self.txs[txid]['height'] = self.current_height
+                for index in range(len(self.txs[txid]['txd']['outs'])):
+                    if (txid, index) in self.utxos:
+                        self.utxos[(txid, index)]['height'] = \
+                            self.current_height
+            self.mempool = []
+        self.notify_watchers()
+
+    def tickchain(self):
+        if self.tick_forward_chain_interval < 0:
+            log.debug('not ticking forward chain')
+            self.tickchainloop.stop()
+            return
+        if self.shutdown_signal:
+            self.tickchainloop.stop()
+            return
+        self.tick_forward_chain(1)
+
+    def simulate_blocks(self):
+        self.tickchainloop = task.LoopingCall(self.tickchain)
+        self.tickchainloop.start(self.tick_forward_chain_interval)
+        self.simulating = True
+
+    def grab_coins(self, receiving_addr, amt=50):
+        """
+        NOTE! amt is passed in Coins, not Satoshis!
+        Pays amt to receiving_addr from nowhere, in a
+        transaction which is then mined. Returns the txid.
+        """
+        self.coinbase_count += 1
+        txd = {'version': 1, 'locktime': 0,
+               'ins': [{'outpoint': {'hash': '00' * 32,
+                                     'index': self.coinbase_count},
+                        'script': '', 'sequence': 4294967295}],
+               'outs': [{'script': btc.address_to_script(receiving_addr),
+                         'value': int(Decimal(str(amt)) * Decimal('1e8'))}]}
+        txid = self.add_tx(txd, check_inputs=False)
+        self.tick_forward_chain(1)
+        return txid
+
+    """Wallet sync
+    """
+
+    def sync_addresses(self, wallet, restart_cb=None):
+        """Sets the wallet's indices past its used addresses, as the
+        address sync for Bitcoin Core does; all scripts are watched,
+        so no import (nor restart) is ever needed.
+        """
+        self.simulate_call('listtransactions')
+        addresses, saved_indices = \
+            BitcoinCoreInterface._collect_addresses_init(wallet)
+        while True:
+            used_addresses_gen = (wallet.script_to_addr(s)
+                                  for s in self.used_scripts
+                                  if wallet.is_known_script(s))
+            used_indices = BitcoinCoreInterface._get_used_indices(
+                wallet, used_addresses_gen)
+            gap_limit_used = not BitcoinCoreInterface._check_gap_indices(
+                wallet, used_indices)
+            BitcoinCoreInterface._rewind_wallet_indices(wallet, used_indices,
+                                                        saved_indices)
+            if not gap_limit_used:
+                break
+            #the scripts beyond the newly used ones become known
+            BitcoinCoreInterface._collect_addresses_gap(wallet)
+        self.wallet_synced = True
+
+    def sync_unspent(self, wallet):
+        self.simulate_call('listunspent')
+        wallet.reset_utxos()
+        #as for Bitcoin Core, listunspent's minconf is 1 unless set
+        minconf = 1
+        if 'listunspent_args' in jm_single().config.options('POLICY'):
+            listunspent_args = ast.literal_eval(jm_single().config.get(
+                'POLICY', 'listunspent_args'))
+            if len(listunspent_args) > 0:
+                minconf = listunspent_args[0]
+        for (txid, n), u in self.utxos.items():
+            if not wallet.is_known_script(u['script']):
+                continue
+            confs = 0 if u['height'] is None else \
+                self.current_height - u['height'] + 1
+            if confs < minconf:
+                continue
+            wallet.add_utxo(binascii.unhexlify(txid), n, u['script'],
+                            u['value'], height=u['height'])
+        self.wallet_synced = True
+
+    """Transactions
+    """
+
+    def pushtx(self, txhex):
+        self.simulate_call('sendrawtransaction')
+        try:
+            txd = btc.deserialize(txhex)
+        except Exception as e:
+            log.debug('error pushing = ' + repr(e))
+            return False
+        if self.add_tx(txd) is None:
+            return False
+        if not self.simulating and self.tick_forward_chain_interval > 0:
+            reactor.callLater(self.tick_forward_chain_interval,
+                              self.tick_forward_chain, 1)
+        self.notify_watchers()
+        return True
+
+    def query_utxo_set(self, txout, includeconf=False, includeunconf=False):
+        """As for Bitcoin Core: outputs spent in the mempool are
+        returned (as None), unconfirmed outputs only if includeunconf.
+        """
+        if not isinstance(txout, list):
+            txout = [txout]
+        #as for Core, the outpoints are looked up in one batch request
+        if txout:
+            self.simulate_call('gettxout', len(txout))
+        result = []
+        for txo in txout:
+            try:
+                outpoint = (txo[:64], int(txo[65:]))
+            except ValueError:
+                log.warn("Invalid utxo format, ignoring: {}".format(txo))
+                result.append(None)
+                continue
+            u = self.utxos.get(outpoint)
+            if u is None or (u['height'] is None and not includeunconf):
+                result.append(None)
+                continue
+            script = binascii.hexlify(u['script']).decode('ascii')
+            try:
+                address = btc.script_to_address(script, get_p2sh_vbyte())
+            except Exception:
+                #non-standard script
+                address = None
+            result_dict = {'value': u['value'], 'address': address,
+                           'script': script}
+            if includeconf:
+                result_dict['confirms'] = self.get_confirmations(txo[:64])
+            result.append(result_dict)
+        return result
+
+    def fetch_current_height(self):
+        self.simulate_call('getblockcount')
+        return self.current_height
+
+    def estimate_fee_per_kb(self, N):
+        if not self.absurd_fees:
+            return super(SimulatedBlockchainInterface,
+                         self).estimate_fee_per_kb(N)
+        else:
+            return jm_single().config.getint("POLICY",
+                                             "absurd_fee_per_kb") + 100
+
+    def fetch_fee_per_kb(self, N):
+        self.simulate_call('estimatesmartfee')
+        return self.fee_per_kb
+
+    """Watchers
+    """
+
+    def add_tx_notify(self, txd, unconfirmfun, confirmfun, notifyaddr,
+                      wallet_name=None, timeoutfun=None, spentfun=None,
+                      txid_flag=True, n=0, c=1, vb=None):
+        """As for BlockchainInterface, but instead of polling, the
+        watchers are run whenever a transaction is pushed or a block
+        is mined (and once now).
+        """
+        loopkey = super(SimulatedBlockchainInterface, self).add_tx_notify(
+            txd, unconfirmfun, confirmfun, notifyaddr, wallet_name=wallet_name,
+            timeoutfun=timeoutfun, spentfun=spentfun, txid_flag=txid_flag,
+            n=n, c=c, vb=vb)
+        self.watching.add(loopkey)
+        self.run_watchers()
+        return loopkey
+
+    def notify_watchers(self):
+        #as watchers are polled on the reactor by the other interfaces,
+        #they aren't run in the middle of the caller's code
+        if reactor.running:
+            reactor.callLater(0.0, self.run_watchers)
+        else:
+            self.run_watchers()
+
+    def run_watchers(self):
+        for loopkey in list(self.watching):
+            if loopkey not in self.watching:
+                continue
+            loop = self.tx_watcher_loops[loopkey][0]
+            try:
+                loop.f(*loop.a, **loop.kw)
+            except Exception as e:
+                log.error("Failure in transaction watcher for: " +
+                          str(loopkey) + ": " + repr(e))
+
+    def tx_network_timeout(self, loopkey):
+        if not self.tx_watcher_loops[loopkey][1]:
+            self.watching.discard(loopkey)
+        super(SimulatedBlockchainInterface, self).tx_network_timeout(loopkey)
+
+    def tx_timeout(self, txd, loopkey, timeoutfun):
+        if loopkey in self.tx_watcher_loops and \
+           not self.tx_watcher_loops[loopkey][2]:
+            self.watching.discard(loopkey)
+        super(SimulatedBlockchainInterface, self).tx_timeout(txd, loopkey,
+                                                             timeoutfun)
+
+    def outputs_watcher(self, wallet_name, notifyaddr, tx_output_set,
+                        unconfirmfun, confirmfun, timeoutfun):
+        wl = self.tx_watcher_loops[notifyaddr]
+        self.simulate_call('listtransactions')
+        txid = self.output_sets.get(frozenset(tx_output_set))
+        if txid is None:
+            return
+        self.simulate_call('gettransaction')
+        txd = self.txs[txid]['txd']
+        confirmations = self.get_confirmations(txid)
+        if not wl[1] and confirmations == 0:
+            log.debug("Tx: " + str(txid) + " seen on network.")
+            unconfirmfun(txd, txid)
+            wl[1] = True
+            return
+        if not wl[2] and confirmations > 0:
+            log.debug("Tx: " + str(txid) + " has " + str(
+                confirmations) + " confirmations.")
+            confirmfun(txd, txid, confirmations)
+            wl[2] = True
+            self.watching.discard(notifyaddr)
+
+    def tx_watcher(self, txd, unconfirmfun, confirmfun, spentfun, c, n):
+        txid = btc.txhash(btc.serialize(txd))
+        wl = self.tx_watcher_loops[txid]
+        self.simulate_call('gettransaction')
+        confirmations = self.get_confirmations(txid)
+        if confirmations is None:
+            return
+        if not wl[1] and confirmations == 0:
+            log.debug("Tx: " + str(txid) + " seen on network.")
+            unconfirmfun(txd, txid)
+            wl[1] = True
+            return
+        if not wl[2] and confirmations > 0:
+            log.debug("Tx: " + str(txid) + " has " + str(
+                confirmations) + " confirmations.")
+            confirmfun(txd, txid, confirmations)
+            if c <= confirmations:
+                wl[2] = True
+                if not spentfun:
+                    self.watching.discard(txid)
+            return
+        if not spentfun or wl[3]:
+            return
+        self.simulate_call('listunspent')
+        spending_txid = self.spent_by.get((txid, n))
+        if spending_txid is None:
+            return
+        log.info("We found a spending transaction: " + spending_txid)
+        spentfun(self.txs[spending_txid]['txd'], txid)
+        wl[3] = True
+        self.watching.discard(txid)
@@ -11,6 +11,10 @@ import pyaes
 from hashlib import sha256
 from argon2 import low_level
 from .support import get_random_bytes
+from jmbase import metrics
+
+SAVE_SECONDS = metrics.histogram('jm_wallet_save_seconds',
+                                 'Duration of wallet file saves')
 
 
 class Argon2Hash(object):
@@ -107,6 +111,12 @@ class Storage(object):
     def is_encrypted(self):
         return self._hash is not None
 
+    def get_location(self):
+        """
+        return the file path of the storage, or None if it has none
+        """
+        return self.path
+
     def is_locked(self):
         return self._lock_file and os.path.exists(self._lock_file)
 
@@ -122,6 +132,7 @@ class Storage(object):
         self._set_hash(password)
         self._save_file()
 
+    @metrics.timed(SAVE_SECONDS)
     def save(self):
         """
         Write file to disk if data was modified
@@ -322,6 +333,9 @@ class VolatileStorage(Storage):
             self.file_data = data
             self._load_file(password)
 
+    def get_location(self):
+        return None
+
     def _create_lock(self):
         pass
 
@@ -225,9 +225,11 @@ def _get_is_within_max_limits(max_fee_rel, max_fee_abs, cjvalue):
     return check_max_fee
 
 
-def choose_orders(offers, cj_amount, n, chooseOrdersBy, ignored_makers=None,
-                  pick=False, allowed_types=["swreloffer", "swabsoffer"],
-                  max_cj_fee=(1, float('inf'))):
+def _get_suitable_orders_fees(offers, cj_amount, ignored_makers,
+                              allowed_types, max_cj_fee):
+    """Returns a list of (offer, fee) tuples for those offers which
+    can be used for a coinjoin of size cj_amount, within the fee limits.
+    """
     is_within_max_limits = _get_is_within_max_limits(
         max_cj_fee[0], max_cj_fee[1], cj_amount)
     if ignored_makers is None:
@@ -244,6 +246,25 @@ def choose_orders(offers, cj_amount, n, chooseOrdersBy, ignored_makers=None,
         fee = calc_cj_fee(o['ordertype'], o['cjfee'], cj_amount) - o['txfee']
         if is_within_max_limits(fee):
             orders_fees.append((o, fee))
+    return orders_fees
+
+
+def count_suitable_counterparties(offers, cj_amount, ignored_makers=None,
+                                  allowed_types=["swreloffer", "swabsoffer"],
+                                  max_cj_fee=(1, float('inf'))):
+    """Returns the number of distinct counterparties with at least
+    one offer that choose_orders would consider, without choosing any
+    (and so without logging liquidity errors).
+    """
+    return len(set(o['counterparty'] for o, f in _get_suitable_orders_fees(
+        offers, cj_amount, ignored_makers, allowed_types, max_cj_fee)))
+
+
+def choose_orders(offers, cj_amount, n, chooseOrdersBy, ignored_makers=None,
+                  pick=False, allowed_types=["swreloffer", "swabsoffer"],
+                  max_cj_fee=(1, float('inf'))):
+    orders_fees = _get_suitable_orders_fees(offers, cj_amount, ignored_makers,
+                                            allowed_types, max_cj_fee)
 
     counterparties = set(o['counterparty'] for o, f in orders_fees)
     if n > len(counterparties):
@@ -13,9 +13,10 @@ import jmbitcoin as btc
 from jmclient.configure import get_p2sh_vbyte, jm_single, validate_address
 from jmbase.support import get_log
 from jmclient.support import (calc_cj_fee, weighted_order_choose, choose_orders,
-                              choose_sweep_orders)
+                              choose_sweep_orders, count_suitable_counterparties)
 from jmclient.wallet import estimate_tx_fee
 from jmclient.podle import generate_podle, get_podle_commitments, PoDLE
+from jmclient.address_pool import import_new_addresses
 from .output import generate_podle_error_string
 from .cryptoengine import EngineError
 
@@ -105,6 +106,10 @@ class Taker(object):
         self.txid = None
         self.schedule_index = -1
         self.utxos = {}
+        #The transaction of the round in progress, as serialized before
+        #the counterparties' signatures, and the utxo data of its inputs,
+        #for the checks of those signatures (see get_unsigned_inputs).
+        self.sig_check_data = None
         self.tdestaddrs = [] if not tdestaddrs else tdestaddrs
         self.filter_orders_callback = callbacks[0]
         self.taker_info_callback = callbacks[1]
@@ -226,6 +231,46 @@ class Taker(object):
 
         return (True, self.cjamount, commitment, revelation, self.orderbook)
 
+    def early_fill_ready(self, orderbook, cached_counterparties=None):
+        """Used in early fill mode, before initialize(), to decide
+        whether the offers received so far are sufficient to proceed
+        with the next schedule entry without waiting for the rest of
+        the orderbook. Nothing is changed here; if a counterparty count
+        from the daemon's orderbook cache is available, we additionally
+        wait for a fraction of those counterparties to re-announce, so
+        that the order choice is not just made among the fastest bots.
+        """
+        if self.aborted or self.schedule_index + 1 >= len(self.schedule):
+            #nothing to wait for; let initialize() handle it.
+            return True
+        si = self.schedule[self.schedule_index + 1]
+        mixdepth, cjamount, n_counterparties = si[0], si[1], si[2]
+        if isinstance(cjamount, float) or cjamount == 0:
+            #fractional and sweep amounts are only fixed in initialize();
+            #the mixdepth balance is a good enough approximation here.
+            mixdepthbal = self.wallet.get_balance_by_mixdepth()[mixdepth]
+            if cjamount != 0:
+                cjamount = max(int(cjamount * mixdepthbal),
+                               jm_single().mincjamount)
+            else:
+                cjamount = mixdepthbal
+        if self.honest_only:
+            orderbook = [o for o in orderbook
+                         if o['counterparty'] in self.honest_makers]
+        allowed_types = ["reloffer", "absoffer"] if jm_single().config.get(
+            "POLICY", "segwit") == "false" else ["swreloffer", "swabsoffer"]
+        if count_suitable_counterparties(orderbook, cjamount,
+                self.ignored_makers, allowed_types=allowed_types,
+                max_cj_fee=self.max_cj_fee) < n_counterparties:
+            return False
+        if cached_counterparties:
+            fraction = float(jm_single().config.get("POLICY",
+                                                    "early_fill_fraction"))
+            seen = len(set(o['counterparty'] for o in orderbook))
+            if seen < fraction * cached_counterparties:
+                return False
+        return True
+
     def filter_orderbook(self, orderbook, sweep=False):
         #If honesty filter is set, we immediately filter to only the prescribed
         #honest makers before continuing. In this case, the number of
@@ -341,34 +386,22 @@ class Taker(object):
         if self.aborted:
             return (False, "User aborted")
 
-        #Temporary list used to aggregate all ioauth data that must be removed
-        rejected_counterparties = []
         #Need to authorize against the btc pubkey first.
-        for nick, nickdata in iteritems(ioauth_data):
-            utxo_list, auth_pub, cj_addr, change_addr, btc_sig, maker_pk = nickdata
-            if not self.auth_counterparty(btc_sig, auth_pub, maker_pk):
-                jlog.debug(
-                "Counterparty encryption verification failed, aborting: " + nick)
-                #This counterparty must be rejected
-                rejected_counterparties.append(nick)
-
-            if not validate_address(cj_addr)[0] or not validate_address(change_addr)[0]:
-                jlog.warn("Counterparty provided invalid address: {}".format(
-                    (cj_addr, change_addr)))
-                # Interpreted as malicious
-                self.add_ignored_makers([nick])
-                rejected_counterparties.append(nick)
-
+        rejected_counterparties = [
+            nick for nick, nickdata in iteritems(ioauth_data)
+            if not self.verify_counterparty(nick, nickdata)]
         for rc in rejected_counterparties:
             del ioauth_data[rc]
 
         self.maker_utxo_data = {}
+        #The utxos of all the counterparties are looked up at once;
+        #the results are then processed in the order of ioauth_data.
+        utxo_data_by_nick = self.query_counterparty_utxos(ioauth_data)
 
         for nick, nickdata in iteritems(ioauth_data):
             utxo_list, auth_pub, cj_addr, change_addr, btc_sig, maker_pk = nickdata
             self.utxos[nick] = utxo_list
-            utxo_data = jm_single().bc_interface.query_utxo_set(self.utxos[
-                nick])
+            utxo_data = utxo_data_by_nick[nick]
             if None in utxo_data:
                 jlog.warn(('ERROR outputs unconfirmed or already spent. '
                            'utxo_data={}').format(pprint.pformat(utxo_data)))
@@ -496,6 +529,7 @@ class Taker(object):
         tx = btc.mktx(self.utxo_tx, self.outputs)
         jlog.info('obtained tx\n' + pprint.pformat(btc.deserialize(tx)))
 
+        #a new object for each round (see get_unsigned_inputs)
         self.latest_tx = btc.deserialize(tx)
         for index, ins in enumerate(self.latest_tx['ins']):
             utxo = ins['outpoint']['hash'] + ':' + str(ins['outpoint']['index'])
@@ -506,6 +540,40 @@ class Taker(object):
         self.taker_info_callback("INFO", "Built tx, sending to counterparties.")
         return (True, list(self.maker_utxo_data.keys()), tx)
 
+    def verify_counterparty(self, nick, nickdata):
+        """Checks the counterparty's authorisation and addresses;
+        returns False if it must be rejected.
+        """
+        utxo_list, auth_pub, cj_addr, change_addr, btc_sig, maker_pk = nickdata
+        verified = True
+        if not self.auth_counterparty(btc_sig, auth_pub, maker_pk):
+            jlog.debug(
+            "Counterparty encryption verification failed, aborting: " + nick)
+            verified = False
+        if not validate_address(cj_addr)[0] or not validate_address(change_addr)[0]:
+            jlog.warn("Counterparty provided invalid address: {}".format(
+                (cj_addr, change_addr)))
+            # Interpreted as malicious
+            self.add_ignored_makers([nick])
+            verified = False
+        return verified
+
+    def query_counterparty_utxos(self, ioauth_data):
+        """Looks up the utxos of all the counterparties with a single
+        query_utxo_set call; returns {nick: utxo data list}.
+        """
+        nicks = list(ioauth_data.keys())
+        all_utxos = sum([ioauth_data[nick][0] for nick in nicks], [])
+        utxo_data = jm_single().bc_interface.query_utxo_set(
+            all_utxos) if all_utxos else []
+        utxo_data_by_nick = {}
+        start = 0
+        for nick in nicks:
+            end = start + len(ioauth_data[nick][0])
+            utxo_data_by_nick[nick] = utxo_data[start:end]
+            start = end
+        return utxo_data_by_nick
+
     def auth_counterparty(self, btc_sig, auth_pub, maker_pk):
         """Validate the counterpartys claim to own the btc
         address/pubkey that will be used for coinjoining
@@ -534,48 +602,43 @@ class Taker(object):
             return
         sig = hexlify(base64.b64decode(sigb64)).decode('ascii')
         inserted_sig = False
-        txhex = btc.serialize(self.latest_tx)
-
-        # batch retrieval of utxo data
-        utxo = {}
-        ctr = 0
-        for index, ins in enumerate(self.latest_tx['ins']):
-            utxo_for_checking = ins['outpoint']['hash'] + ':' + str(ins[
-                'outpoint']['index'])
-             #'deadbeef' markers mean our own input scripts are not ''
-            if (ins['script'] != ''):
-                continue
-            utxo[ctr] = [index, utxo_for_checking]
-            ctr += 1
-        utxo_data = jm_single().bc_interface.query_utxo_set([x[
-            1] for x in utxo.values()])
-
-        # insert signatures
-        for i, u in iteritems(utxo):
-            if utxo_data[i] is None:
-                continue
-            #Check if the sender serialize_scripted the scriptCode
-            #item into the sig message; if so, also pick up the amount
-            #from the utxo data retrieved from the blockchain to verify
-            #the segwit-style signature. Note that this allows a mixed
-            #SW/non-SW transaction as each utxo is interpreted separately.
-            sig_deserialized = btc.deserialize_script(sig)
-            #verify_tx_input will not even parse the script if it has integers or None,
-            #so abort in case we were given a junk sig:
-            if not all([not isinstance(x, int) and x for x in sig_deserialized]):
-                print("Junk signature: ", sig_deserialized, ", not attempting to verify")
-                break
-            if len(sig_deserialized) == 2:
-                ver_sig, ver_pub = sig_deserialized
-                scriptCode = None
-            elif len(sig_deserialized) == 3:
-                ver_sig, ver_pub, scriptCode =  sig_deserialized
-            else:
-                jlog.debug("Invalid signature message - more than 3 items")
-                break
-            ver_amt = utxo_data[i]['value'] if scriptCode else None
-            sig_good = btc.verify_tx_input(txhex, u[0], utxo_data[i]['script'],
-                            ver_sig, ver_pub, scriptCode=scriptCode, amount=ver_amt)
+        txhex, inputs = self.get_unsigned_inputs()
+
+        #Check if the sender serialize_scripted the scriptCode
+        #item into the sig message; if so, also pick up the amount
+        #from the utxo data retrieved from the blockchain to verify
+        #the segwit-style signature. Note that this allows a mixed
+        #SW/non-SW transaction as each utxo is interpreted separately.
+        sig_deserialized = btc.deserialize_script(sig)
+        #verify_tx_input will not even parse the script if it has integers or None,
+        #so abort in case we were given a junk sig:
+        if not all([not isinstance(x, int) and x for x in sig_deserialized]):
+            jlog.warn("Junk signature: " + str(sig_deserialized) +
+                      ", not attempting to verify")
+            ver_pub = None
+        elif len(sig_deserialized) == 2:
+            ver_sig, ver_pub = sig_deserialized
+            scriptCode = None
+        elif len(sig_deserialized) == 3:
+            ver_sig, ver_pub, scriptCode =  sig_deserialized
+        else:
+            jlog.debug("Invalid signature message - more than 3 items")
+            ver_pub = None
+
+        #The signature can only be for an input paying to its pubkey,
+        #so only those are tried.
+        candidates = sum([inputs.get(script, []) for script in
+                          self.pubkey_scripts(ver_pub)], []) if ver_pub else []
+        #The third item from legacy bots (see below) is the witness program,
+        #with which the signature can't verify, so it isn't tried.
+        legacy_sig = bool(candidates) and scriptCode is not None and \
+            scriptCode == hexlify(btc.pubkey_to_p2wpkh_script(
+                ver_pub)).decode('ascii')
+        for index, utxo, utxo_data in candidates:
+            ver_amt = utxo_data['value'] if scriptCode else None
+            sig_good = not legacy_sig and btc.verify_tx_input(
+                txhex, index, utxo_data['script'], ver_sig, ver_pub,
+                scriptCode=scriptCode, amount=ver_amt)
 
             if ver_amt is not None and not sig_good:
                 # Special case to deal with legacy bots 0.5.0 or lower:
@@ -586,34 +649,35 @@ class Taker(object):
                 # from the public key. For these cases, we can *assume* that
                 # the input is of type p2sh-p2wpkh; we call the jmbitcoin method
                 # directly, as we cannot assume that *our* wallet handles this.
-                scriptCode = hexlify(btc.pubkey_to_p2pkh_script(
+                legacy_scriptCode = hexlify(btc.pubkey_to_p2pkh_script(
                     ver_pub, True)).decode('ascii')
-                sig_good = btc.verify_tx_input(txhex, u[0], utxo_data[i]['script'],
-                        ver_sig, ver_pub, scriptCode=scriptCode, amount=ver_amt)
+                sig_good = btc.verify_tx_input(txhex, index, utxo_data['script'],
+                        ver_sig, ver_pub, scriptCode=legacy_scriptCode,
+                        amount=ver_amt)
 
             if sig_good:
-                jlog.debug('found good sig at index=%d' % (u[0]))
+                jlog.debug('found good sig at index=%d' % (index))
                 if ver_amt:
                     # Note that, due to the complexity of handling multisig or other
                     # arbitrary script (considering sending multiple signatures OTW),
                     # there is an assumption of p2sh-p2wpkh or p2wpkh, for the segwit
                     # case.
-                    self.latest_tx["ins"][u[0]]["txinwitness"] = [ver_sig, ver_pub]
-                    if btc.is_segwit_native_script(utxo_data[i]['script']):
+                    self.latest_tx["ins"][index]["txinwitness"] = [ver_sig, ver_pub]
+                    if btc.is_segwit_native_script(utxo_data['script']):
                         scriptSig = ""
                     else:
                         scriptSig = btc.serialize_script_unit(
                             btc.pubkey_to_p2wpkh_script(ver_pub))
-                    self.latest_tx["ins"][u[0]]["script"] = scriptSig
+                    self.latest_tx["ins"][index]["script"] = scriptSig
                 else:
                     # Non segwit (as per above comments) is limited only to single key,
                     # p2pkh case.
-                    self.latest_tx["ins"][u[0]]["script"] = sig
+                    self.latest_tx["ins"][index]["script"] = sig
                 inserted_sig = True
 
                 # check if maker has sent everything possible
                 try:
-                    self.utxos[nick].remove(u[1])
+                    self.utxos[nick].remove(utxo)
                 except ValueError:
                     pass
                 if len(self.utxos[nick]) == 0:
@@ -642,6 +706,58 @@ class Taker(object):
         jlog.debug("schedule item was: " + str(self.schedule[self.schedule_index]))
         return self.self_sign_and_push()
 
+    def get_unsigned_inputs(self):
+        """Returns the transaction of this round, serialized as it was
+        before the first signature was received (the signatures do not
+        change what is signed), and {script: [(index, utxo, utxo data)]}
+        for the inputs which are still to be signed by counterparties.
+        The utxo data is looked up once per round; inputs which could not
+        be found (e.g. on a connection failure) are looked up again on the
+        next call.
+        A round is identified by the latest_tx object itself, so each new
+        transaction must be assigned as a new object (as receive_utxos
+        does), never built by mutating latest_tx in place; only the input
+        scripts may be filled in, by on_sig, during the round.
+        """
+        if self.sig_check_data is None or \
+                self.sig_check_data['tx'] is not self.latest_tx:
+            self.sig_check_data = {'tx': self.latest_tx,
+                                   'txhex': btc.serialize(self.latest_tx),
+                                   'utxo_data': {}}
+        known = self.sig_check_data['utxo_data']
+        unsigned = []
+        for index, ins in enumerate(self.latest_tx['ins']):
+            #'deadbeef' markers mean our own input scripts are not ''
+            if ins['script'] != '':
+                continue
+            unsigned.append((index, ins['outpoint']['hash'] + ':' + str(
+                ins['outpoint']['index'])))
+        to_query = [utxo for index, utxo in unsigned if utxo not in known]
+        if to_query:
+            utxo_data = jm_single().bc_interface.query_utxo_set(to_query)
+            for utxo, data in zip(to_query, utxo_data):
+                if data is not None:
+                    known[utxo] = data
+        inputs = {}
+        for index, utxo in unsigned:
+            if utxo in known:
+                inputs.setdefault(known[utxo]['script'], []).append(
+                    (index, utxo, known[utxo]))
+        return self.sig_check_data['txhex'], inputs
+
+    @staticmethod
+    def pubkey_scripts(pub):
+        """Returns the output scripts (hex) of the types of input which a
+        counterparty may sign with pubkey pub: p2pkh, p2sh-p2wpkh and p2wpkh.
+        """
+        try:
+            return [hexlify(f(pub)).decode('ascii') for f in (
+                btc.pubkey_to_p2pkh_script, btc.pubkey_to_p2sh_p2wpkh_script,
+                btc.pubkey_to_p2wpkh_script)]
+        except (TypeError, ValueError):
+            #not hex
+            return []
+
     def make_commitment(self):
         """The Taker default commitment function, which uses PoDLE.
         Alternative commitment types should use a different commit type byte.
@@ -654,8 +770,9 @@ class Taker(object):
         """
 
         def filter_by_coin_age_amt(utxos, age, amt):
-            results = jm_single().bc_interface.query_utxo_set(utxos,
-                                                              includeconf=True)
+            #our own utxos are answered from the wallet where possible
+            results = jm_single().bc_interface.query_utxo_set_with_wallet(
+                utxos, self.wallet)
             newresults = []
             too_old = []
             too_small = []
@@ -835,9 +952,4 @@ class Taker(object):
                                   txdetails=(txd, txid))
 
     def import_new_addresses(self, addr_list):
-        # FIXME: same code as in maker.py
-        bci = jm_single().bc_interface
-        if not hasattr(bci, 'import_addresses'):
-            return
-        assert hasattr(bci, 'get_wallet_name')
-        bci.import_addresses(addr_list, bci.get_wallet_name(self.wallet))
+        import_new_addresses(self.wallet, addr_list)
@@ -13,6 +13,7 @@ from .configure import jm_single, validate_address
 from .schedule import human_readable_schedule_entry, tweak_tumble_schedule,\
     schedule_to_text
 from .wallet import BaseWallet, estimate_tx_fee
+from .address_pool import import_new_addresses
 from jmbitcoin import deserialize, mktx, serialize, txhash
 log = get_log()
 
@@ -115,14 +116,6 @@ def sign_tx(wallet, tx, utxos):
         our_inputs[index] = (script, amount)
     return wallet.sign_tx(deserialize(unhexlify(serialize(stx))), our_inputs)
 
-def import_new_addresses(wallet, addr_list):
-    # FIXME: same code as in maker.py and taker.py
-    bci = jm_single().bc_interface
-    if not hasattr(bci, 'import_addresses'):
-        return
-    assert hasattr(bci, 'get_wallet_name')
-    bci.import_addresses(addr_list, bci.get_wallet_name(wallet))
-
 
 def get_tumble_log(logsdir):
     tumble_log = logging.getLogger('tumbler')
@@ -0,0 +1,156 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import * # noqa: F401
+"""A local cache of information about the transactions of a wallet,
+kept in an sqlite database next to the wallet file, so that wallet
+display, history and (Electrum) sync don't have to fetch and classify
+the same transactions from the blockchain on every run.
+Only confirmed transactions are cached, and everything held about them
+is a function of the (immutable) transaction data or of the block
+they are in, so entries are not invalidated (a reorg deeper than
+the history checkpoint depth is not handled). The unspent outputs
+of an Electrum script hash are kept with the status hash they were
+fetched at, and must be fetched again when it changes.
+"""
+
+import json
+import sqlite3
+from binascii import hexlify, unhexlify
+
+from jmbase.support import get_log
+
+log = get_log()
+
+#appended to the wallet file name to give the cache file name
+TX_CACHE_SUFFIX = '.txcache'
+
+
+class TxCache(object):
+
+    def __init__(self, path=None):
+        """
+        args:
+            path: database file path, or None for an in-memory cache
+        """
+        self.path = path
+        self.con = sqlite3.connect(path if path else ":memory:")
+        self.con.execute("CREATE TABLE IF NOT EXISTS classification("
+                         "txid TEXT PRIMARY KEY, is_coinjoin INTEGER, "
+                         "cj_amount INTEGER, cj_n INTEGER);")
+        self.con.execute("CREATE TABLE IF NOT EXISTS transactions("
+                         "txid TEXT PRIMARY KEY, tx BLOB, blockhash TEXT, "
+                         "blockheight INTEGER, blocktime INTEGER);")
+        #single row, json encoded; see wallet_utils.wallet_fetch_history
+        self.con.execute("CREATE TABLE IF NOT EXISTS history_checkpoint("
+                         "id INTEGER PRIMARY KEY, data TEXT);")
+        #Electrum status hash and unspent outputs, by script hash
+        self.con.execute("CREATE TABLE IF NOT EXISTS scripthash_status("
+                         "scripthash TEXT PRIMARY KEY, status TEXT, "
+                         "unspent TEXT);")
+        self.changed = False
+
+    def get_tx(self, txid):
+        """
+        returns:
+            (txhex, blocktime) for confirmed transaction txid (hex),
+            or None if not cached
+        """
+        row = self.con.execute("SELECT tx, blocktime FROM transactions "
+                               "WHERE txid=?;", (txid,)).fetchone()
+        if row is None:
+            return None
+        return hexlify(row[0]).decode('ascii'), row[1]
+
+    def add_tx(self, txid, txhex, blockhash, blockheight, blocktime):
+        """
+        args:
+            txhex: serialized transaction (hex)
+            blockheight: int, or None if not known
+        """
+        self.con.execute("INSERT OR REPLACE INTO transactions "
+                         "VALUES(?, ?, ?, ?, ?);",
+                         (txid, sqlite3.Binary(unhexlify(txhex)), blockhash,
+                          blockheight, blocktime))
+        self.changed = True
+
+    def get_classification(self, txid):
+        """
+        returns:
+            (is_coinjoin, cj_amount, cj_n) for txid (hex), or None
+            if not cached
+        """
+        row = self.con.execute("SELECT is_coinjoin, cj_amount, cj_n FROM "
+                               "classification WHERE txid=?;",
+                               (txid,)).fetchone()
+        if row is None:
+            return None
+        return bool(row[0]), row[1], row[2]
+
+    def add_classification(self, txid, is_coinjoin, cj_amount, cj_n):
+        self.con.execute("INSERT OR REPLACE INTO classification "
+                         "VALUES(?, ?, ?, ?);",
+                         (txid, int(is_coinjoin), cj_amount, cj_n))
+        self.changed = True
+
+    def get_history_checkpoint(self):
+        """
+        returns:
+            the dict last passed to set_history_checkpoint, or None
+        """
+        row = self.con.execute("SELECT data FROM history_checkpoint "
+                               "WHERE id=0;").fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def set_history_checkpoint(self, checkpoint):
+        self.con.execute("INSERT OR REPLACE INTO history_checkpoint "
+                         "VALUES(0, ?);", (json.dumps(checkpoint),))
+        self.changed = True
+
+    def get_scripthash_status(self, scripthash):
+        """
+        returns:
+            (status, unspent) as last set for scripthash, or None
+        """
+        row = self.con.execute("SELECT status, unspent FROM scripthash_status "
+                               "WHERE scripthash=?;", (scripthash,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def set_scripthash_status(self, scripthash, status, unspent):
+        """
+        args:
+            status: the Electrum status hash of scripthash
+            unspent: json serializable list of its unspent outputs
+        """
+        self.con.execute("INSERT OR REPLACE INTO scripthash_status "
+                         "VALUES(?, ?, ?);",
+                         (scripthash, status, json.dumps(unspent)))
+        self.changed = True
+
+    def save(self):
+        if self.changed:
+            self.con.commit()
+            self.changed = False
+
+    def close(self):
+        self.save()
+        self.con.close()
+
+
+def get_tx_cache(wallet):
+    """Returns the TxCache of wallet: on disk next to the wallet file,
+    or in memory if the wallet has none (or the cache file can't be
+    opened).
+    """
+    location = wallet.get_storage_location()
+    if location is None:
+        return TxCache()
+    try:
+        return TxCache(location + TX_CACHE_SUFFIX)
+    except sqlite3.Error as e:
+        log.warn("Unable to open transaction cache, not persisting it: " +
+                 repr(e))
+        return TxCache()
@@ -5,6 +5,7 @@ from builtins import * # noqa: F401
 from configparser import NoOptionError
 import warnings
 import functools
+import time
 import collections
 import numbers
 from binascii import hexlify, unhexlify
@@ -111,6 +112,9 @@ class UTXOManager(object):
         self.selector = merge_func
         # {mixdexpth: {(txid, index): (path, value)}}
         self._utxo = None
+        # {(txid, index): height} of confirmed utxos, as found at sync;
+        # not persisted, since every run syncs the utxos again
+        self._heights = {}
         self._load_storage()
         assert self._utxo is not None
 
@@ -144,6 +148,7 @@ class UTXOManager(object):
 
     def reset(self):
         self._utxo = collections.defaultdict(dict)
+        self._heights = {}
 
     def have_utxo(self, txid, index):
         for md in self._utxo:
@@ -157,16 +162,34 @@ class UTXOManager(object):
         assert isinstance(index, numbers.Integral)
         assert isinstance(mixdepth, numbers.Integral)
 
+        self._heights.pop((txid, index), None)
         return self._utxo[mixdepth].pop((txid, index))
 
-    def add_utxo(self, txid, index, path, value, mixdepth):
+    def add_utxo(self, txid, index, path, value, mixdepth, height=None):
         assert isinstance(txid, bytes)
         assert len(txid) == self.TXID_LEN
         assert isinstance(index, numbers.Integral)
         assert isinstance(value, numbers.Integral)
         assert isinstance(mixdepth, numbers.Integral)
+        assert height is None or isinstance(height, numbers.Integral)
 
         self._utxo[mixdepth][(txid, index)] = (path, value)
+        if height is None:
+            self._heights.pop((txid, index), None)
+        else:
+            self._heights[(txid, index)] = height
+
+    def get_utxo(self, txid, index):
+        """
+        returns:
+            (path, value, height) of utxo (txid, index), height being
+            None if not known to be confirmed; or None if not a utxo
+        """
+        md = self.have_utxo(txid, index)
+        if md is False:
+            return None
+        path, value = self._utxo[md][(txid, index)]
+        return path, value, self._heights.get((txid, index))
 
     def select_utxos(self, mixdepth, amount, utxo_filter=()):
         assert isinstance(mixdepth, numbers.Integral)
@@ -209,6 +232,9 @@ class BaseWallet(object):
 
     _ENGINE = None
 
+    _STORAGE_SYNC_CHECKPOINT = b'sync_checkpoint'
+    _STORAGE_IMPORT_HORIZON = b'import_horizon'
+
     def __init__(self, storage, gap_limit=6, merge_algorithm_name=None,
                  mixdepth=None):
         # to be defined by inheriting classes
@@ -273,6 +299,82 @@ class BaseWallet(object):
         """
         self._storage.save()
 
+    def get_sync_checkpoint(self):
+        """
+        Get the checkpoint of the last complete address sync with
+        Bitcoin Core (see BitcoinCoreInterface.sync_addresses).
+
+        returns:
+            (blockhash, used_indices) or None: used_indices is
+            {mixdepth: [external, internal]}, the next index after the
+            last address of each branch used as of block blockhash (hex)
+        """
+        data = self._storage.data.get(self._STORAGE_SYNC_CHECKPOINT)
+        if not data:
+            return None
+        used_indices = dict([(int(md), list(indices))
+                             for md, indices in data[b'used'].items()])
+        return data[b'blockhash'].decode('ascii'), used_indices
+
+    def set_sync_checkpoint(self, blockhash, used_indices=None):
+        """
+        Set the address sync checkpoint, or remove it if blockhash is None.
+
+        args:
+            blockhash: str, hex
+            used_indices: dict, as returned by get_sync_checkpoint
+        """
+        if blockhash is None:
+            self._storage.data.pop(self._STORAGE_SYNC_CHECKPOINT, None)
+            return
+        self._storage.data[self._STORAGE_SYNC_CHECKPOINT] = {
+            b'blockhash': blockhash.encode('ascii'),
+            b'used': dict([(_int_to_bytestr(md), list(indices))
+                           for md, indices in used_indices.items()])}
+
+    def get_import_horizon(self, mixdepth, internal):
+        """
+        Get the index up to which the addresses of a branch are known to
+        be imported into Bitcoin Core (see AddressImportPool).
+
+        returns:
+            int, the index after the last imported address, or 0
+        """
+        data = self._storage.data.get(self._STORAGE_IMPORT_HORIZON, {})
+        indices = data.get(_int_to_bytestr(mixdepth))
+        if not indices:
+            return 0
+        return indices[1 if internal else 0]
+
+    def set_import_horizon(self, mixdepth, internal, index):
+        data = self._storage.data.setdefault(self._STORAGE_IMPORT_HORIZON, {})
+        indices = data.setdefault(_int_to_bytestr(mixdepth), [0, 0])
+        indices[1 if internal else 0] = index
+
+    def get_storage_location(self):
+        """
+        Get the file path of the wallet's storage.
+
+        returns:
+            str, or None for a wallet not stored on disk
+        """
+        return self._storage.get_location()
+
+    def get_creation_time(self):
+        """
+        Get the wallet's birthday: the time it was created, or for a
+        recovered wallet, the time given as that of its first use.
+
+        returns:
+            int, unix time, or None if not known
+        """
+        try:
+            return int(time.mktime(datetime.strptime(
+                self._storage.data[b'created'].decode('ascii'),
+                '%Y/%m/%d %H:%M:%S').timetuple()))
+        except (KeyError, ValueError):
+            return None
+
     @classmethod
     def initialize(cls, storage, network, max_mixdepth=2, timestamp=None,
                    write=True):
@@ -535,7 +637,12 @@ class BaseWallet(object):
                                           'value': outs['value']}
         return added_utxos
 
-    def add_utxo(self, txid, index, script, value):
+    def add_utxo(self, txid, index, script, value, height=None):
+        """
+        args:
+            height: height of the block the utxo was confirmed in,
+                if known (see get_utxo_)
+        """
         assert isinstance(txid, bytes)
         assert isinstance(index, Integral)
         assert isinstance(script, bytes)
@@ -546,7 +653,31 @@ class BaseWallet(object):
 
         path = self.script_to_path(script)
         mixdepth = self._get_mixdepth_from_path(path)
-        self._utxos.add_utxo(txid, index, path, value, mixdepth)
+        self._utxos.add_utxo(txid, index, path, value, mixdepth,
+                             height=height)
+
+    def get_utxo_(self, txid, index):
+        """
+        Get a utxo of this wallet, with the height of the block it was
+        confirmed in as recorded by the blockchain interface at sync, so
+        that its age can be found without querying the blockchain.
+
+        args:
+            txid: bytes
+            index: int
+        returns:
+            {'script': bytes, 'path': tuple, 'value': int, 'height': int}
+            (height None if unconfirmed or not known), or None if
+            (txid, index) is not a utxo of this wallet
+        """
+        utxo = self._utxos.get_utxo(txid, index)
+        if utxo is None:
+            return None
+        path, value, height = utxo
+        return {'script': self.get_script_path(path),
+                'path': path,
+                'value': value,
+                'height': height}
 
     @deprecated
     def select_utxos(self, mixdepth, amount, utxo_filter=None):
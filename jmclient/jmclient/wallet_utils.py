@@ -10,7 +10,7 @@ import binascii
 from datetime import datetime
 from optparse import OptionParser
 from numbers import Integral
-from collections import Counter
+from collections import Counter, defaultdict
 from itertools import islice
 from jmclient import (get_network, WALLET_IMPLEMENTATIONS, Storage, podle,
     jm_single, BitcoinCoreInterface, JsonRpcError, sync_wallet, WalletError,
@@ -18,12 +18,21 @@ from jmclient import (get_network, WALLET_IMPLEMENTATIONS, Storage, podle,
     is_segwit_mode, SegwitLegacyWallet, LegacyWallet)
 from jmbase.support import get_password
 from .cryptoengine import TYPE_P2PKH, TYPE_P2SH_P2WPKH
+from .tx_cache import get_tx_cache
 import jmbitcoin as btc
 
 
 # used for creating new wallets
 DEFAULT_MIXDEPTH = 4
 
+# the wallet history checkpoint only covers blocks with at least
+# this many confirmations
+HISTORY_CHECKPOINT_DEPTH = 6
+
+# creation time of recovered wallets whose birthday is not given:
+# the day of the genesis block
+RECOVERY_TIMESTAMP = '2009/01/03 00:00:00'
+
 
 def get_wallettool_parser():
     description = (
@@ -68,6 +77,14 @@ def get_wallettool_parser():
                       dest='csv',
                       default=False,
                       help=('When using the history method, output as csv'))
+    parser.add_option('--incremental',
+                      action='store_true',
+                      dest='incremental',
+                      default=False,
+                      help=('When using the history method, only process and '
+                            'show transactions since the last run (those '
+                            'less than {} blocks deep are shown again)'
+                            .format(HISTORY_CHECKPOINT_DEPTH)))
     parser.add_option('-v', '--verbosity',
                       action='store',
                       type='int',
@@ -75,12 +92,29 @@ def get_wallettool_parser():
                       default=1,
                       help=('History method verbosity, 0 (least) to 6 (most), '
                             '<=2 batches earnings, even values also list TXIDs'))
+    parser.add_option('--birthday',
+                      action='store',
+                      type='str',
+                      dest='birthday',
+                      default=None,
+                      help=('When using the recover method, the date '
+                            '(YYYY-MM-DD) from which the wallet may have been '
+                            'used; the blockchain is rescanned from then '
+                            '(default: from the first block)'))
     parser.add_option('--fast',
                       action='store_true',
                       dest='fastsync',
                       default=False,
                       help=('choose to do fast wallet sync, only for Core and '
                       'only for previously synced wallet'))
+    parser.add_option('--recoversync',
+                      action='store_true',
+                      dest='recoversync',
+                      default=False,
+                      help=('choose to sync a wallet recovered from its seed '
+                            'by scanning the UTXO set, only for Core (0.17 '
+                            'or later); addresses whose coins have all been '
+                            'spent are not found'))
     parser.add_option('-H',
                       '--hd',
                       action='store',
@@ -294,26 +328,18 @@ class WalletView(WalletViewBase):
                 x.serialize(entryseparator, summarize=False) for x in self.accounts] + [footer]))
 
 
-def get_tx_info(txid):
+def classify_tx(output_values):
     """
-    Retrieve some basic information about the given transaction.
+    Classify a transaction by the values of its outputs.
 
-    :param txid: txid as hex-str
+    :param output_values: list of output values, in satoshis
     :return: tuple
         is_coinjoin: bool
         cj_amount: int, only useful if is_coinjoin==True
         cj_n: int, number of cj participants, only useful if is_coinjoin==True
-        output_script_values: {script: value} dict including all outputs
-        blocktime: int, blocktime this tx was mined
-        txd: deserialized transaction object (hex-encoded data)
     """
-    rpctx = jm_single().bc_interface.rpc('gettransaction', [txid])
-    txhex = str(rpctx['hex'])
-    txd = btc.deserialize(txhex)
-    output_script_values = {binascii.unhexlify(sv['script']): sv['value']
-                            for sv in txd['outs']}
     value_freq_list = sorted(
-        Counter(output_script_values.values()).most_common(),
+        Counter(output_values).most_common(),
         key=lambda x: -x[1])
     non_cj_freq = (0 if len(value_freq_list) == 1 else
                    sum(next(islice(zip(*value_freq_list[1:]), 1, None))))
@@ -322,19 +348,83 @@ def get_tx_info(txid):
                    [non_cj_freq, non_cj_freq + 1])
     cj_amount = value_freq_list[0][0]
     cj_n = value_freq_list[0][1]
+    return is_coinjoin, cj_amount, cj_n
+
+
+def get_tx_info(txid, tx_cache=None):
+    """
+    Retrieve some basic information about the given transaction.
+
+    :param txid: txid as hex-str
+    :param tx_cache: TxCache or None, the classification of the transaction
+        is added to it
+    :return: tuple
+        is_coinjoin: bool
+        cj_amount: int, only useful if is_coinjoin==True
+        cj_n: int, number of cj participants, only useful if is_coinjoin==True
+        output_script_values: {script: value} dict including all outputs
+        blocktime: int, blocktime this tx was mined
+        txd: deserialized transaction object (hex-encoded data)
+    """
+    txhex, blocktime = get_tx_hex(txid, tx_cache)
+    txd = btc.deserialize(txhex)
+    output_script_values = {binascii.unhexlify(sv['script']): sv['value']
+                            for sv in txd['outs']}
+    is_coinjoin, cj_amount, cj_n = classify_tx(
+        list(output_script_values.values()))
+    if tx_cache is not None:
+        tx_cache.add_classification(txid, is_coinjoin, cj_amount, cj_n)
     return is_coinjoin, cj_amount, cj_n, output_script_values,\
-        rpctx.get('blocktime', 0), txd
+        blocktime, txd
+
+
+def get_tx_hex(txid, tx_cache=None):
+    """
+    Retrieve a wallet transaction, from tx_cache if there, else from the
+    blockchain interface (adding it to tx_cache if confirmed).
+    Raises JsonRpcError if the transaction is not in the wallet.
 
+    :param txid: txid as hex-str
+    :return: tuple (serialized transaction as hex-str, blocktime)
+    """
+    if tx_cache is not None:
+        cached = tx_cache.get_tx(txid)
+        if cached is not None:
+            return cached
+    rpctx = jm_single().bc_interface.rpc('gettransaction', [txid])
+    txhex = str(rpctx['hex'])
+    if tx_cache is not None and 'blockhash' in rpctx:
+        tx_cache.add_tx(txid, txhex, rpctx['blockhash'],
+                        rpctx.get('blockheight'), rpctx['blocktime'])
+    return txhex, rpctx.get('blocktime', 0)
+
+
+def get_tx_classification(txid, tx_cache):
+    """
+    As the first three items returned by get_tx_info, from tx_cache
+    if possible, else fetching the transaction and adding it to the cache.
+    """
+    classification = tx_cache.get_classification(txid)
+    if classification is None:
+        classification = get_tx_info(txid, tx_cache)[:3]
+    return classification
 
-def get_imported_privkey_branch(wallet, m, showprivkey):
+
+def get_imported_privkey_branch(wallet, m, showprivkey, utxos=None):
+    """
+    utxos: {utxo: data} of mixdepth m, as from
+        wallet.get_utxos_by_mixdepth_(), to avoid fetching them again
+    """
+    if utxos is None:
+        utxos = wallet.get_utxos_by_mixdepth_()[m]
+    script_balances = defaultdict(int)
+    for data in utxos.values():
+        script_balances[data['script']] += data['value']
     entries = []
     for path in wallet.yield_imported_paths(m):
         addr = wallet.get_addr_path(path)
         script = wallet.get_script_path(path)
-        balance = 0.0
-        for data in wallet.get_utxos_by_mixdepth_()[m].values():
-            if script == data['script']:
-                balance += data['value']
+        balance = script_balances.get(script, 0)
         used = ('used' if balance > 0.0 else 'empty')
         if showprivkey:
             wip_privkey = wallet.get_wif_path(path)
@@ -375,20 +465,20 @@ def wallet_showutxos(wallet, showprivkey):
 
 
 def wallet_display(wallet, gaplimit, showprivkey, displayall=False,
-        serialized=True, summarized=False):
+        serialized=True, summarized=False, tx_cache=None):
     """build the walletview object,
     then return its serialization directly if serialized,
     else return the WalletView object.
+    tx_cache: TxCache for the classification of utxos, by default
+    the wallet's own (see get_tx_cache).
     """
-    def get_addr_status(addr_path, utxos, is_new, is_internal):
+    def get_addr_status(addr_utxos, is_new, is_internal):
         addr_balance = 0
         status = []
-        for utxo, utxodata in iteritems(utxos):
-            if addr_path != utxodata['path']:
-                continue
+        for utxo, utxodata in addr_utxos:
             addr_balance += utxodata['value']
-            is_coinjoin, cj_amount, cj_n = \
-                get_tx_info(binascii.hexlify(utxo[0]).decode('ascii'))[:3]
+            is_coinjoin, cj_amount, cj_n = get_tx_classification(
+                binascii.hexlify(utxo[0]).decode('ascii'), tx_cache)
             if is_coinjoin and utxodata['value'] == cj_amount:
                 status.append('cj-out')
             elif is_coinjoin:
@@ -406,9 +496,15 @@ def wallet_display(wallet, gaplimit, showprivkey, displayall=False,
 
         return addr_balance, out_status
 
+    close_tx_cache = tx_cache is None
+    if close_tx_cache:
+        tx_cache = get_tx_cache(wallet)
     acctlist = []
     utxos = wallet.get_utxos_by_mixdepth_()
     for m in range(wallet.mixdepth + 1):
+        utxos_by_path = defaultdict(list)
+        for utxo, utxodata in iteritems(utxos[m]):
+            utxos_by_path[utxodata['path']].append((utxo, utxodata))
         branchlist = []
         for forchange in [0, 1]:
             entrylist = []
@@ -423,7 +519,7 @@ def wallet_display(wallet, gaplimit, showprivkey, displayall=False,
                 path = wallet.get_path(m, forchange, k)
                 addr = wallet.get_addr_path(path)
                 balance, used = get_addr_status(
-                    path, utxos[m], k >= unused_index, forchange)
+                    utxos_by_path.get(path, []), k >= unused_index, forchange)
                 if showprivkey:
                     privkey = wallet.get_wif_path(path)
                 else:
@@ -437,7 +533,7 @@ def wallet_display(wallet, gaplimit, showprivkey, displayall=False,
             path = wallet.get_path_repr(wallet.get_path(m, forchange))
             branchlist.append(WalletViewBranch(path, m, forchange, entrylist,
                                                xpub=xpub_key))
-        ipb = get_imported_privkey_branch(wallet, m, showprivkey)
+        ipb = get_imported_privkey_branch(wallet, m, showprivkey, utxos[m])
         if ipb:
             branchlist.append(ipb)
         #get the xpub key of the whole account
@@ -445,6 +541,10 @@ def wallet_display(wallet, gaplimit, showprivkey, displayall=False,
         path = wallet.get_path_repr(wallet.get_path(m))
         acctlist.append(WalletViewAccount(path, m, branchlist,
                                           xpub=xpub_account))
+    if close_tx_cache:
+        tx_cache.close()
+    else:
+        tx_cache.save()
     path = wallet.get_path_repr(wallet.get_path())
     walletview = WalletView(path, acctlist)
     if serialized:
@@ -492,7 +592,8 @@ def wallet_generate_recover_bip39(method, walletspath, default_wallet_name,
                                              cli_user_mnemonic_entry,
                                              cli_get_wallet_passphrase_check,
                                              cli_get_wallet_file_name,
-                                             cli_get_mnemonic_extension)):
+                                             cli_get_mnemonic_extension),
+                                  birthday=None):
     """Optionally provide callbacks:
     0 - display seed
     1 - enter seed (for recovery)
@@ -500,12 +601,16 @@ def wallet_generate_recover_bip39(method, walletspath, default_wallet_name,
     3 - enter wallet file name
     4 - enter mnemonic extension
     The defaults are for terminal entry.
+    birthday is the creation timestamp (see get_recovery_timestamp)
+    of a recovered wallet.
     """
     entropy = None
     mnemonic_extension = None
+    timestamp = None
     if method == "generate":
         mnemonic_extension = callbacks[4]()
     elif method == 'recover':
+        timestamp = get_recovery_timestamp(birthday)
         words, mnemonic_extension = callbacks[1]()
         mnemonic_extension = mnemonic_extension and mnemonic_extension.strip()
         if not words:
@@ -533,23 +638,39 @@ def wallet_generate_recover_bip39(method, walletspath, default_wallet_name,
 
     wallet = create_wallet(wallet_path, password, mixdepth,
                            entropy=entropy,
-                           entropy_extension=mnemonic_extension)
+                           entropy_extension=mnemonic_extension,
+                           timestamp=timestamp)
     mnemonic, mnext = wallet.get_mnemonic_words()
     callbacks[0] and callbacks[0](mnemonic, mnext or '')
     wallet.close()
     return True
 
 
+def get_recovery_timestamp(birthday=None):
+    """Returns the creation timestamp to store for a recovered wallet:
+    birthday (YYYY-MM-DD), the date from which it may have been used,
+    or if None, that of the first block (as the wallet's birthday is the
+    start of blockchain rescans, see BitcoinCoreInterface.rescan_from_time).
+    """
+    if birthday is None:
+        return RECOVERY_TIMESTAMP
+    return datetime.strptime(birthday, '%Y-%m-%d').strftime(
+        '%Y/%m/%d %H:%M:%S')
+
+
 def wallet_generate_recover(method, walletspath,
                             default_wallet_name='wallet.jmdat',
-                            mixdepth=DEFAULT_MIXDEPTH):
+                            mixdepth=DEFAULT_MIXDEPTH, birthday=None):
     if is_segwit_mode():
         #Here using default callbacks for scripts (not used in Qt)
         return wallet_generate_recover_bip39(
-            method, walletspath, default_wallet_name, mixdepth=mixdepth)
+            method, walletspath, default_wallet_name, mixdepth=mixdepth,
+            birthday=birthday)
 
     entropy = None
+    timestamp = None
     if method == 'recover':
+        timestamp = get_recovery_timestamp(birthday)
         seed = input("Input 12 word recovery seed: ")
         try:
             entropy = LegacyWallet.entropy_from_mnemonic(seed)
@@ -570,7 +691,8 @@ def wallet_generate_recover(method, walletspath,
     wallet_path = os.path.join(walletspath, wallet_name)
 
     wallet = create_wallet(wallet_path, password, mixdepth,
-                           wallet_cls=LegacyWallet, entropy=entropy)
+                           wallet_cls=LegacyWallet, entropy=entropy,
+                           timestamp=timestamp)
     print("Write down and safely store this wallet recovery seed\n\n{}\n"
           .format(wallet.get_mnemonic_words()[0]))
     wallet.close()
@@ -585,29 +707,54 @@ def dict_factory(cursor, row):
 
 
 def wallet_fetch_history(wallet, options):
+    """Print the history of the wallet's transactions, as rows in time
+    order followed by a summary.
+    Transactions are kept in the wallet's TxCache, along with a
+    checkpoint of the running totals (see HISTORY_CHECKPOINT_DEPTH);
+    with options.incremental, only transactions in blocks after the
+    checkpoint are fetched and printed.
+    """
+    tx_cache = get_tx_cache(wallet)
+    checkpoint = None
+    if options.incremental:
+        checkpoint = tx_cache.get_history_checkpoint()
     # sort txes in a db because python can be really bad with large lists
     con = sqlite3.connect(":memory:")
     con.row_factory = dict_factory
     tx_db = con.cursor()
     tx_db.execute("CREATE TABLE transactions(txid TEXT, "
-            "blockhash TEXT, blocktime INTEGER);")
+            "blockhash TEXT, blocktime INTEGER, confirmations INTEGER);")
     jm_single().debug_silence[0] = True
     wallet_name = jm_single().bc_interface.get_wallet_name(wallet)
-    buf = range(1000)
-    t = 0
-    while len(buf) == 1000:
-        buf = jm_single().bc_interface.rpc('listtransactions', ["*",
-            1000, t, True])
-        t += len(buf)
-        tx_data = ((tx['txid'], tx['blockhash'], tx['blocktime']) for tx
-                in buf if 'txid' in tx and 'blockhash' in tx and 'blocktime'
-                in tx)
-        tx_db.executemany('INSERT INTO transactions VALUES(?, ?, ?);',
+
+    def insert_txes(buf):
+        tx_data = ((tx['txid'], tx['blockhash'], tx['blocktime'],
+                    tx['confirmations']) for tx in buf
+                   if 'txid' in tx and 'blockhash' in tx and 'blocktime' in tx)
+        tx_db.executemany('INSERT INTO transactions VALUES(?, ?, ?, ?);',
                 tx_data)
 
+    if checkpoint:
+        try:
+            insert_txes(jm_single().bc_interface.rpc('listsinceblock',
+                [checkpoint['blockhash'], 1, True])['transactions'])
+        except JsonRpcError as e:
+            print('Unable to list transactions since checkpoint, showing '
+                  'full history: ' + repr(e))
+            checkpoint = None
+    if not checkpoint:
+        buf = range(1000)
+        t = 0
+        while len(buf) == 1000:
+            buf = jm_single().bc_interface.rpc('listtransactions', ["*",
+                1000, t, True])
+            t += len(buf)
+            insert_txes(buf)
+
+    # in chain order; transactions in the same block are adjacent
     txes = tx_db.execute(
-        'SELECT DISTINCT txid, blockhash, blocktime '
-        'FROM transactions ORDER BY blocktime').fetchall()
+        'SELECT DISTINCT txid, blockhash, blocktime, confirmations '
+        'FROM transactions ORDER BY confirmations DESC, blockhash').fetchall()
     wallet_script_set = set(wallet.get_script_path(p)
                             for p in wallet.yield_known_paths())
 
@@ -629,6 +776,8 @@ def wallet_fetch_history(wallet, options):
                 '% 3d' % utxo_count, skip_n1(mixdepth_src), skip_n1(mixdepth_dst)]
         if options.verbosity % 2 == 0: data += [txid]
         print(s().join(map('"{}"'.format, data)))
+        # rows are streamed as produced, also when piped
+        sys.stdout.flush()
 
 
     field_names = ['tx#', 'timestamp', 'type', 'amount/btc',
@@ -640,14 +789,22 @@ def wallet_fetch_history(wallet, options):
         options.verbosity = 4
     if options.verbosity > 0: print(s().join(field_names))
     if options.verbosity <= 2: cj_batch = [0]*8 + [[]]*2
-    balance = 0
-    utxo_count = 0
-    deposits = []
-    deposit_times = []
-    tx_number = 0
-    for tx in txes:
+    if checkpoint:
+        balance = checkpoint['balance']
+        utxo_count = checkpoint['utxo_count']
+        deposits = checkpoint['deposits']
+        deposit_times = checkpoint['deposit_times']
+        tx_number = checkpoint['tx_number']
+    else:
+        balance = 0
+        utxo_count = 0
+        deposits = []
+        deposit_times = []
+        tx_number = 0
+    new_checkpoint = None
+    for i, tx in enumerate(txes):
         is_coinjoin, cj_amount, cj_n, output_script_values, blocktime, txd =\
-            get_tx_info(tx['txid'])
+            get_tx_info(tx['txid'], tx_cache)
 
         our_output_scripts = wallet_script_set.intersection(
             output_script_values.keys())
@@ -655,11 +812,10 @@ def wallet_fetch_history(wallet, options):
         rpc_inputs = []
         for ins in txd['ins']:
             try:
-                wallet_tx = jm_single().bc_interface.rpc('gettransaction',
-                        [ins['outpoint']['hash']])
+                wallet_txhex = get_tx_hex(ins['outpoint']['hash'], tx_cache)[0]
             except JsonRpcError:
                 continue
-            input_dict = btc.deserialize(str(wallet_tx['hex']))['outs'][ins[
+            input_dict = btc.deserialize(wallet_txhex)['outs'][ins[
                 'outpoint']['index']]
             rpc_inputs.append(input_dict)
 
@@ -774,6 +930,23 @@ def wallet_fetch_history(wallet, options):
             deposits.append(delta_balance)
             deposit_times.append(blocktime)
 
+        # the state after the last deep enough block processed, to be
+        # resumed from with options.incremental
+        if tx['confirmations'] >= HISTORY_CHECKPOINT_DEPTH and (
+                i == len(txes) - 1 or
+                txes[i + 1]['blockhash'] != tx['blockhash']):
+            new_checkpoint = {'blockhash': tx['blockhash'],
+                              'balance': balance, 'utxo_count': utxo_count,
+                              'tx_number': tx_number,
+                              'n_deposits': len(deposits)}
+
+    if new_checkpoint:
+        n = new_checkpoint.pop('n_deposits')
+        new_checkpoint['deposits'] = deposits[:n]
+        new_checkpoint['deposit_times'] = deposit_times[:n]
+        tx_cache.set_history_checkpoint(new_checkpoint)
+    tx_cache.close()
+
     # we could have a leftover batch!
     if options.verbosity <= 2:
         n = cj_batch[0]
@@ -1070,7 +1243,8 @@ def wallet_tool_main(wallet_root_path):
             if 'listunspent_args' not in jm_single().config.options('POLICY'):
                 jm_single().config.set('POLICY','listunspent_args', '[0]')
             while not jm_single().bc_interface.wallet_synced:
-                sync_wallet(wallet, fast=options.fastsync)
+                sync_wallet(wallet, fast=options.fastsync,
+                            recover=options.recoversync)
     #Now the wallet/data is prepared, execute the script according to the method
     if method == "display":
         return wallet_display(wallet, options.gaplimit, options.showprivkey)
@@ -1091,8 +1265,14 @@ def wallet_tool_main(wallet_root_path):
                                          mixdepth=options.mixdepth)
         return retval if retval else "Failed"
     elif method == "recover":
+        try:
+            get_recovery_timestamp(options.birthday)
+        except ValueError:
+            parser.error("Invalid --birthday, use YYYY-MM-DD: " +
+                         str(options.birthday))
         retval = wallet_generate_recover("recover", wallet_root_path,
-                                         mixdepth=options.mixdepth)
+                                         mixdepth=options.mixdepth,
+                                         birthday=options.birthday)
         return retval if retval else "Failed"
     elif method == "showutxos":
         return wallet_showutxos(wallet, options.showprivkey)
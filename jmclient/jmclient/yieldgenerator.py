@@ -64,15 +64,7 @@ class YieldGeneratorBasic(YieldGenerator):
 
         # print mix_balance
         max_mix = max(mix_balance, key=mix_balance.get)
-        f = '0'
-        if self.ordertype in ('reloffer', 'swreloffer'):
-            f = self.cjfee_r
-            #minimum size bumped if necessary such that you always profit
-            #least 50% of the miner fee
-            self.minsize = max(int(1.5 * self.txfee / float(self.cjfee_r)),
-                self.minsize)
-        elif self.ordertype in ('absoffer', 'swabsoffer'):
-            f = str(self.txfee + self.cjfee_a)
+        f = self.get_offer_cjfee()
         order = {'oid': 0,
                  'ordertype': self.ordertype,
                  'minsize': self.minsize,
@@ -91,9 +83,26 @@ class YieldGeneratorBasic(YieldGenerator):
 
         return [order]
 
+    def get_offer_cjfee(self):
+        """Returns the cjfee to announce for our ordertype, bumping
+        self.minsize first for relative offers if necessary.
+        """
+        f = '0'
+        if self.ordertype in ('reloffer', 'swreloffer'):
+            f = self.cjfee_r
+            #minimum size bumped if necessary such that you always profit
+            #least 50% of the miner fee
+            self.minsize = max(int(1.5 * self.txfee / float(self.cjfee_r)),
+                self.minsize)
+        elif self.ordertype in ('absoffer', 'swabsoffer'):
+            f = str(self.txfee + self.cjfee_a)
+        return f
+
     def oid_to_order(self, offer, amount):
         total_amount = amount + offer["txfee"]
-        mix_balance = self.wallet.get_balance_by_mixdepth()
+        #utxos promised to other takers in the meantime are not available
+        mix_balance = self.get_available_balance_by_mixdepth()
+        reserved = self.reserved_utxos()
         max_mix = max(mix_balance, key=mix_balance.get)
 
         filtered_mix_balance = [m
@@ -104,6 +113,14 @@ class YieldGeneratorBasic(YieldGenerator):
         jlog.debug('mix depths that have enough = ' + str(filtered_mix_balance))
         filtered_mix_balance = sorted(filtered_mix_balance, key=lambda x: x[0])
         mixdepth = filtered_mix_balance[0][0]
+        return self.fill_from_mixdepth(offer, amount, mixdepth, reserved)
+
+    def fill_from_mixdepth(self, offer, amount, mixdepth, reserved):
+        """Returns the utxos (not among those reserved), coinjoin
+        and change addresses to fill offer for amount from mixdepth,
+        or (None, None, None) if not possible.
+        """
+        total_amount = amount + offer["txfee"]
         jlog.info('filling offer, mixdepth=' + str(mixdepth))
 
         # mixdepth is the chosen depth we'll be spending from
@@ -112,7 +129,8 @@ class YieldGeneratorBasic(YieldGenerator):
         change_addr = self.wallet.get_internal_addr(mixdepth)
         self.import_new_addresses([cj_addr, change_addr])
 
-        utxos = self.wallet.select_utxos(mixdepth, total_amount)
+        utxos = self.wallet.select_utxos(mixdepth, total_amount,
+                                         utxo_filter=reserved)
         my_total_in = sum([va['value'] for va in utxos.values()])
         real_cjfee = calc_cj_fee(offer["ordertype"], offer["cjfee"], amount)
         change_value = my_total_in - amount - offer["txfee"] + real_cjfee
@@ -121,7 +139,8 @@ class YieldGeneratorBasic(YieldGenerator):
                        'finding new utxos').format(change_value))
             try:
                 utxos = self.wallet.select_utxos(
-                    mixdepth, total_amount + jm_single().DUST_THRESHOLD)
+                    mixdepth, total_amount + jm_single().DUST_THRESHOLD,
+                    utxo_filter=reserved)
             except Exception:
                 jlog.info('dont have the required UTXOs to make a '
                           'output above the dust threshold, quitting')
@@ -158,6 +177,69 @@ class YieldGeneratorBasic(YieldGenerator):
                 confirm_time / 60.0, 2), ''])
         return self.on_tx_unconfirmed(offer, txid, None)
 
+
+class YieldGeneratorMultiOffer(YieldGeneratorBasic):
+    """Offers the coins of each mixdepth separately, as one offer per
+    mixdepth holding more than minsize, whose oid is that mixdepth.
+    A fill is served from the mixdepth of the offer taken, so that
+    takers of different offers can be served at the same time, and
+    coins outside the largest mixdepth are offered too.
+    After each transaction, only the offers which changed are
+    cancelled or reannounced.
+    """
+    #the fields of an offer that are announced
+    offer_keys = ('ordertype', 'minsize', 'maxsize', 'txfee', 'cjfee')
+
+    def create_my_orders(self):
+        f = self.get_offer_cjfee()
+        orders = []
+        #coins reserved for a coinjoin in progress are offered too: they are
+        #spent (and the offer updated) when it succeeds, else released
+        mix_balance = self.wallet.get_balance_by_mixdepth(verbose=False)
+        for mixdepth, balance in sorted(iteritems(mix_balance)):
+            maxsize = balance - max(jm_single().DUST_THRESHOLD, self.txfee)
+            if maxsize < self.minsize:
+                continue
+            orders.append({'oid': mixdepth,
+                           'ordertype': self.ordertype,
+                           'minsize': self.minsize,
+                           'maxsize': maxsize,
+                           'txfee': self.txfee,
+                           'cjfee': f})
+        if not orders:
+            jlog.error('no mixdepth has more than minsize (' + str(
+                self.minsize) + ') to offer')
+        return orders
+
+    def oid_to_order(self, offer, amount):
+        mixdepth = offer["oid"]
+        total_amount = amount + offer["txfee"]
+        mix_balance = self.get_available_balance_by_mixdepth()
+        if mix_balance.get(mixdepth, 0) < total_amount:
+            #the coins of the offer's mixdepth were promised to other
+            #takers since it was announced; fall back to another mixdepth
+            enough = sorted([m for m, b in iteritems(mix_balance)
+                             if b >= total_amount])
+            if not enough:
+                return None, None, None
+            jlog.info('not enough coins left in mixdepth {} for offer, '
+                      'using mixdepth {}'.format(mixdepth, enough[0]))
+            mixdepth = enough[0]
+        return self.fill_from_mixdepth(offer, amount, mixdepth,
+                                       self.reserved_utxos())
+
+    def on_tx_unconfirmed(self, offer, txid, removed_utxos):
+        self.tx_unconfirm_timestamp[offer["cjaddr"]] = int(time.time())
+        oldoffers = dict([(o['oid'], o) for o in self.offerlist])
+        newoffers = self.create_my_orders()
+        newoids = [o['oid'] for o in newoffers]
+        to_cancel = [oid for oid in oldoffers if oid not in newoids]
+        to_announce = [o for o in newoffers if o['oid'] not in oldoffers or
+                       any([oldoffers[o['oid']][k] != o[k]
+                            for k in self.offer_keys])]
+        return to_cancel, to_announce
+
+
 def ygmain(ygclass, txfee=1000, cjfee_a=200, cjfee_r=0.002, ordertype='swreloffer',
            nickserv_password='', minsize=100000, gaplimit=6):
     import sys
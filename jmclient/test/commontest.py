@@ -62,12 +62,12 @@ class DummyBlockchainInterface(BlockchainInterface):
     
     def query_utxo_set(self, txouts,includeconf=False):
         if self.qusfail:
-            #simulate failure to find the utxo
-            return [None]
+            #simulate failure to find the utxos
+            return [None] * len(txouts)
         if self.fake_query_results:
             result = []
-            for x in self.fake_query_results:
-                for y in txouts:
+            for y in txouts:
+                for x in self.fake_query_results:
                     if y == x['utxo']:
                         result.append(x)
             return result
@@ -91,14 +91,15 @@ class DummyBlockchainInterface(BlockchainInterface):
                 results.append({'value': wallet_outs[to][0],
                                 'confirms': wallet_outs[to][1]})
             return results
-        if txouts[0] in known_outs:
-            addr = btc.pubkey_to_p2sh_p2wpkh_address(
-                        known_outs[txouts[0]], get_p2sh_vbyte())
-            return [{'value': 200000000,
-                     'address': addr,
-                     'script': btc.address_to_script(addr),
-                     'confirms': 20}]
         for t in txouts:
+            if t in known_outs:
+                addr = btc.pubkey_to_p2sh_p2wpkh_address(
+                            known_outs[t], get_p2sh_vbyte())
+                result.append({'value': 200000000,
+                               'address': addr,
+                               'script': btc.address_to_script(addr),
+                               'confirms': 20})
+                continue
             result_dict = {'value': 10000000000,
                            'address': "mrcNu71ztWjAQA6ww9kHiW3zBWSQidHXTQ",
                            'script': '76a91479b000887626b294a914501a4cd226b58b23598388ac'}
@@ -107,7 +108,7 @@ class DummyBlockchainInterface(BlockchainInterface):
             result.append(result_dict)        
         return result
 
-    def estimate_fee_per_kb(self, N):
+    def fetch_fee_per_kb(self, N):
         return 30000
 
 
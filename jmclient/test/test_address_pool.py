@@ -0,0 +1,127 @@
+#! /usr/bin/env python
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import * # noqa: F401
+'''Tests of the pool of addresses imported ahead of use.'''
+
+import gc
+import weakref
+
+import pytest
+from twisted.internet import defer, task
+
+from commontest import DummyBlockchainInterface
+from jmclient import (load_program_config, jm_single, SegwitLegacyWallet,
+                      VolatileStorage, get_network, AddressImportPool,
+                      get_address_pool)
+from jmclient import address_pool
+
+
+class ImportRecorder(DummyBlockchainInterface):
+    def __init__(self):
+        super(ImportRecorder, self).__init__()
+        self.imports = []
+
+    def import_addresses(self, addr_list, wallet_name):
+        self.imports.append(list(addr_list))
+
+
+def test_address_pool(setup_pool):
+    bci = jm_single().bc_interface
+    storage = VolatileStorage()
+    SegwitLegacyWallet.initialize(storage, get_network(), max_mixdepth=1)
+    wallet = SegwitLegacyWallet(storage)
+    #derives the expected addresses, without moving the wallet's indices
+    twin = SegwitLegacyWallet(storage)
+    def internal(md, indices):
+        addrs = []
+        for i in indices:
+            twin.set_next_index(md, True, i, force=True)
+            addrs.append(twin.get_new_addr(md, True))
+        return addrs
+    pool = AddressImportPool(wallet, 3)
+    #nothing is in the pool yet, so the address is imported when used
+    addr = wallet.get_internal_addr(0)
+    pool.import_new_addresses([addr])
+    assert bci.imports == [[addr]]
+    #the pool is refilled later, up to 3 ahead in each mixdepth
+    setup_pool.advance(address_pool.REFILL_DELAY)
+    assert bci.imports[1] == internal(0, (1, 2, 3)) + internal(1, (0, 1, 2))
+    assert pool.refill() == 0
+    #addresses in the pool are not imported when used
+    addrs = [wallet.get_internal_addr(0), wallet.get_internal_addr(1)]
+    pool.import_new_addresses(addrs)
+    assert len(bci.imports) == 2
+    setup_pool.advance(address_pool.REFILL_DELAY)
+    assert bci.imports[2] == internal(0, (4,)) + internal(1, (3,))
+    #external addresses are not pooled
+    addr = wallet.get_external_addr(0)
+    pool.import_new_addresses([addr])
+    assert bci.imports[3] == [addr]
+    #the import horizon is kept in the wallet
+    wallet = SegwitLegacyWallet(storage)
+    assert [wallet.get_import_horizon(md, True) for md in (0, 1)] == [5, 4]
+    assert [wallet.get_next_unused_index(md, True) for md in (0, 1)] == \
+        [2, 1]
+    pool = get_address_pool(wallet)
+    assert [pool.is_imported(wallet.get_internal_addr(1))
+             for i in range(4)] == [True, True, True, False]
+
+
+class ThreadedImportRecorder(ImportRecorder):
+    def import_addresses_in_thread(self, addr_list, wallet_name):
+        self.imports.append(list(addr_list))
+        self.pending = defer.Deferred()
+        return self.pending
+
+
+def test_address_pool_in_thread(setup_pool, monkeypatch):
+    bci = ThreadedImportRecorder()
+    monkeypatch.setattr(jm_single(), 'bc_interface', bci)
+    storage = VolatileStorage()
+    SegwitLegacyWallet.initialize(storage, get_network(), max_mixdepth=0)
+    wallet = SegwitLegacyWallet(storage)
+    pool = AddressImportPool(wallet, 2)
+    assert pool.refill() == 2
+    #the addresses only count as imported when the import is done,
+    #and there is one import at a time
+    addr = wallet.get_internal_addr(0)
+    assert not pool.is_imported(addr)
+    assert pool.refill() == 0
+    bci.pending.callback(None)
+    assert pool.is_imported(addr)
+    assert wallet.get_import_horizon(0, True) == 2
+    #a failed import is retried on the next refill
+    wallet.get_internal_addr(0)
+    assert pool.refill() == 2
+    bci.pending.errback(Exception("connection refused"))
+    assert wallet.get_import_horizon(0, True) == 2
+    assert pool.refill() == 2
+    assert bci.imports[-1] == bci.imports[-2]
+
+
+def test_address_pool_per_wallet(setup_pool):
+    storage = VolatileStorage()
+    SegwitLegacyWallet.initialize(storage, get_network(), max_mixdepth=0)
+    wallet = SegwitLegacyWallet(storage)
+    pool = get_address_pool(wallet)
+    assert get_address_pool(wallet) is pool
+    assert get_address_pool(SegwitLegacyWallet(storage)) is not pool
+    #the pools don't keep closed wallets alive
+    wallet_ref = weakref.ref(wallet)
+    wallet = pool = None
+    gc.collect()
+    assert wallet_ref() is None
+
+
+@pytest.fixture(scope='module')
+def setup_pool():
+    load_program_config()
+    old_bci = jm_single().bc_interface
+    jm_single().bc_interface = ImportRecorder()
+    clock = task.Clock()
+    old_reactor = address_pool.reactor
+    address_pool.reactor = clock
+    yield clock
+    address_pool.reactor = old_reactor
+    jm_single().bc_interface = old_bci
@@ -5,11 +5,18 @@ from builtins import * # noqa: F401
 """Blockchaininterface functionality tests."""
 
 import binascii
+from decimal import Decimal
 from commontest import create_wallet_for_sync
 
 import pytest
+from twisted.internet import defer
+import jmbitcoin as btc
 from jmbase import get_log
-from jmclient import load_program_config, jm_single, sync_wallet
+from jmclient import load_program_config, jm_single, sync_wallet, \
+    BitcoinCoreInterface, SegwitLegacyWallet, VolatileStorage, get_network
+from jmclient import blockchaininterface
+from jmclient.jsonrpc import JsonRpc, JsonRpcError
+from jmclient.wallet_utils import get_recovery_timestamp
 
 log = get_log()
 
@@ -146,6 +153,343 @@ def test_imported_wallet_sync(setup_wallets, fast):
     assert wallet._utxos.have_utxo(txid, 0) == 0
 
 
+class FakeCoreRpc(object):
+    """Answers the calls used for importing and rescanning, on a
+    chain with a block every 10 minutes from block_times[0].
+    """
+    def __init__(self, block_times, importmulti=True):
+        self.block_times = block_times
+        self.importmulti = importmulti
+        #scantxoutset results, by output script
+        self.utxos = {}
+        #listunspent results, and gettxout results by txid:n
+        self.unspent = []
+        self.txouts = {}
+        #wallet transactions, as listed, with the height of their block
+        self.txs = []
+        self.imported = set()
+        #hashes of blocks reorganized out of the chain
+        self.orphaned = set()
+        self.calls = []
+        #methods of each batch request
+        self.batches = []
+
+    def new_connection(self):
+        return self
+
+    def call(self, method, params):
+        self.calls.append((method, params))
+        if method == 'getblockchaininfo':
+            return {'chain': 'regtest'}
+        elif method == 'importmulti':
+            if not self.importmulti:
+                raise JsonRpcError({'code': -32601,
+                                    'message': 'Method not found'})
+            self.imported.update([r['scriptPubKey']['address']
+                                  for r in params[0]])
+            return [{'success': True} for r in params[0]]
+        elif method == 'importaddress':
+            return None
+        elif method == 'getblockcount':
+            return len(self.block_times) - 1
+        elif method == 'getblockhash':
+            return str(params[0])
+        elif method == 'getblockheader':
+            return {'time': self.block_times[int(params[0])],
+                    'confirmations': -1 if params[0] in self.orphaned else
+                    len(self.block_times) - int(params[0])}
+        elif method == 'rescanblockchain':
+            return {'start_height': params[0],
+                    'stop_height': len(self.block_times) - 1}
+        elif method == 'getwalletinfo':
+            return {}
+        elif method == 'getaddressesbyaccount':
+            return list(self.imported)
+        elif method == 'listtransactions':
+            return self.txs[params[2]:params[2] + params[1]]
+        elif method == 'listsinceblock':
+            return {'transactions': [tx for tx in self.txs
+                                     if tx['height'] > int(params[0])],
+                    'lastblock': str(len(self.block_times) - params[1])}
+        elif method == 'listunspent':
+            return self.unspent
+        elif method == 'gettxout':
+            return self.txouts.get(params[0] + ':' + str(params[1]))
+        elif method == 'estimatesmartfee':
+            return {'feerate': Decimal('0.0002')}
+        elif method == 'scantxoutset':
+            scripts = set([btc.address_to_script(d[5:-1])
+                           for d in params[1]])
+            return {'success': True,
+                    'unspents': [u for u in self.utxos.values()
+                                 if u['scriptPubKey'] in scripts]}
+        raise JsonRpcError({'code': -32601, 'message': 'Method not found'})
+
+    def call_batch(self, calls):
+        self.batches.append([method for method, params in calls])
+        return [self.call(method, params) for method, params in calls]
+
+
+@pytest.mark.parametrize('importmulti', (True, False))
+def test_import_addresses(importmulti):
+    load_program_config()
+    rpc = FakeCoreRpc([], importmulti=importmulti)
+    bci = BitcoinCoreInterface(rpc, 'regtest')
+    addrs = ['addr' + str(i) for i in range(100)]
+    bci.import_addresses(addrs, 'label', timestamp=1500000000)
+    imports = [c for c in rpc.calls if c[0].startswith('import')]
+    if importmulti:
+        assert len(imports) == 1
+        assert [r['scriptPubKey']['address'] for r in imports[0][1][0]] == \
+            addrs
+        assert imports[0][1][0][0]['timestamp'] == 1500000000
+        assert imports[0][1][1] == {'rescan': False}
+    else:
+        assert [c[1] for c in imports[1:]] == [[a, 'label', False]
+                                               for a in addrs]
+
+
+def test_rescan_from_birthday(monkeypatch):
+    load_program_config()
+    genesis_time = 1500000000
+    rpc = FakeCoreRpc([genesis_time + 600 * i for i in range(10000)])
+    bci = BitcoinCoreInterface(rpc, 'regtest')
+    storage = VolatileStorage()
+    SegwitLegacyWallet.initialize(storage, get_network(),
+                                  timestamp=get_recovery_timestamp(
+                                      '2017-07-20'))
+    birthday = SegwitLegacyWallet(storage).get_creation_time()
+    height = bci.get_height_at_time(birthday)
+    #the first block at most 2 hours before the birthday
+    assert rpc.block_times[height] >= birthday - 7200
+    assert rpc.block_times[height - 1] < birthday - 7200
+    #found by bisection
+    assert len([c for c in rpc.calls if c[0] == 'getblockheader']) < 20
+    assert bci.rescan_from_time(birthday)
+    assert rpc.calls[-1] == ('rescanblockchain', [height])
+    #as in the GUI, off the reactor thread
+    monkeypatch.setattr(blockchaininterface.threads, 'deferToThread',
+                        defer.maybeDeferred)
+    rpc.calls = []
+    d = bci.rescan_from_time_in_thread(birthday)
+    assert d.result is True
+    assert rpc.calls[-1] == ('rescanblockchain', [height])
+
+
+def test_recovery_sync():
+    load_program_config()
+    rpc = FakeCoreRpc([1500000000 + 600 * i for i in range(1000)])
+    bci = BitcoinCoreInterface(rpc, 'regtest')
+    storage = VolatileStorage()
+    SegwitLegacyWallet.initialize(storage, get_network())
+    wallet = SegwitLegacyWallet(storage)
+    #coins on addresses beyond the gap limit, and the first scan range
+    funded = [(0, 0, 5), (0, 0, 998), (0, 0, 1005), (1, 1, 3), (2, 0, 20)]
+    for i, (md, internal, index) in enumerate(funded):
+        wallet.set_next_index(md, internal, index + 1, force=True)
+        script = binascii.hexlify(wallet.get_script(md, internal, index))
+        rpc.utxos[script] = {'txid': '%064x' % i, 'vout': 0,
+                             'scriptPubKey': script.decode('ascii'),
+                             'amount': Decimal('0.1'), 'height': 100 + i}
+    for md in range(wallet.max_mixdepth + 1):
+        for internal in (0, 1):
+            wallet.set_next_index(md, internal, 0, force=True)
+
+    bci.sync_wallet(wallet, recover=True)
+
+    assert bci.wallet_synced
+    assert [wallet.get_next_unused_index(md, internal)
+            for md in range(3) for internal in (0, 1)] == [1006, 0, 0, 4, 21, 0]
+    assert wallet.get_balance_by_mixdepth() == {0: 3 * 10**7, 1: 10**7,
+                                                2: 10**7}
+    #a second scan for the branch whose coins are at the end of the first
+    assert len([c for c in rpc.calls if c[0] == 'scantxoutset']) == 2
+    imports = [c for c in rpc.calls if c[0] == 'importmulti']
+    assert len(imports) == 1
+    assert len(imports[0][1][0]) == 1006 + 4 + 21 + 6 * wallet.gap_limit
+    assert rpc.calls[-1] == ('rescanblockchain', [100])
+
+
+def test_incremental_sync():
+    load_program_config()
+    rpc = FakeCoreRpc([1500000000 + 600 * i for i in range(100)])
+    bci = BitcoinCoreInterface(rpc, 'regtest')
+    storage = VolatileStorage()
+    SegwitLegacyWallet.initialize(storage, get_network())
+    wallet = SegwitLegacyWallet(storage)
+
+    def receive(md, internal, index):
+        wallet.set_next_index(md, internal, index, force=True)
+        rpc.txs.append({'address': wallet.get_new_addr(md, internal),
+                        'category': 'receive',
+                        'height': len(rpc.block_times) - 1})
+        wallet.set_next_index(md, internal, 0, force=True)
+
+    def sync():
+        rpc.calls = []
+        bci.wallet_synced = False
+        for i in range(5):
+            bci.sync_wallet(wallet)
+            if bci.wallet_synced:
+                break
+        assert bci.wallet_synced
+        return [c[0] for c in rpc.calls]
+
+    receive(0, 0, 2)
+    calls = sync()
+    assert 'listtransactions' in calls and 'listsinceblock' not in calls
+    assert wallet.get_next_unused_index(0, 0) == 3
+    assert wallet.get_sync_checkpoint() == (
+        '94', {0: [3, 0], 1: [0, 0], 2: [0, 0]})
+    #only newer transactions are listed
+    rpc.block_times.append(rpc.block_times[-1] + 600)
+    receive(1, 1, 4)
+    calls = sync()
+    assert 'listtransactions' not in calls
+    assert rpc.calls[calls.index('listsinceblock')][1] == ['94', 6, True]
+    assert [wallet.get_next_unused_index(md, internal) for md in range(3)
+            for internal in (0, 1)] == [3, 0, 0, 5, 0, 0]
+    assert wallet.get_sync_checkpoint()[0] == '95'
+    #the checkpoint block is reorganized out: full scan
+    rpc.orphaned.add('95')
+    calls = sync()
+    assert 'listtransactions' in calls and 'listsinceblock' not in calls
+    assert wallet.get_next_unused_index(1, 1) == 5
+
+
+def test_import_horizon_check():
+    load_program_config()
+    rpc = FakeCoreRpc([1500000000 + 600 * i for i in range(100)])
+    bci = BitcoinCoreInterface(rpc, 'regtest')
+    storage = VolatileStorage()
+    SegwitLegacyWallet.initialize(storage, get_network())
+    wallet = SegwitLegacyWallet(storage)
+    #as kept by the address pool, for another Core wallet
+    for md in range(3):
+        wallet.set_import_horizon(md, True, 10)
+    wallet.set_import_horizon(2, True, 3)
+    #only the addresses of mixdepth 1 are all imported into this one
+    for index in range(10):
+        wallet.set_next_index(1, True, index, force=True)
+        rpc.imported.add(wallet.get_new_addr(1, True))
+    wallet.set_next_index(1, True, 0, force=True)
+    while not bci.wallet_synced:
+        bci.sync_addresses(wallet)
+    #the synced addresses (up to the gap limit) are imported
+    assert [wallet.get_import_horizon(md, True) for md in range(3)] == [
+        wallet.gap_limit, 10, 3]
+    assert wallet.get_next_unused_index(0, True) == 0
+
+
+def test_fee_estimate_cache(monkeypatch):
+    load_program_config()
+    rpc = FakeCoreRpc([])
+    bci = BitcoinCoreInterface(rpc, 'regtest')
+    now = [1500000000.0]
+    monkeypatch.setattr(blockchaininterface.time, 'time', lambda: now[0])
+    ttl = jm_single().config.getint("POLICY", "fee_estimate_ttl_sec")
+    for i in range(10):
+        assert bci.estimate_fee_per_kb(3) == 20000
+    assert bci.estimate_fee_per_kb(6) == 20000
+    assert [c for c in rpc.calls if c[0] == 'estimatesmartfee'] == [
+        ('estimatesmartfee', [3]), ('estimatesmartfee', [6])]
+    #expired
+    now[0] += ttl
+    bci.estimate_fee_per_kb(3)
+    assert len([c for c in rpc.calls if c[0] == 'estimatesmartfee']) == 3
+    #refreshed in the background (off the reactor thread) before expiry
+    in_thread = []
+    def deferToThread(f, *args):
+        in_thread.append(args)
+        return defer.maybeDeferred(f, *args)
+    monkeypatch.setattr(blockchaininterface.threads, 'deferToThread',
+                        deferToThread)
+    now[0] += ttl - 1
+    bci.refresh_fee_estimates()
+    assert sorted(in_thread) == [(3,), (6,)]
+    now[0] += ttl - 1
+    rpc.calls = []
+    bci.estimate_fee_per_kb(3)
+    bci.estimate_fee_per_kb(6)
+    assert rpc.calls == []
+    #manually set fees are randomized, without any call
+    for i in range(10):
+        assert 24000 <= bci.estimate_fee_per_kb(30000) <= 36000
+    assert rpc.calls == []
+
+
+def test_utxo_heights():
+    load_program_config()
+    rpc = FakeCoreRpc([1500000000 + 600 * i for i in range(100)])
+    bci = BitcoinCoreInterface(rpc, 'regtest')
+    storage = VolatileStorage()
+    SegwitLegacyWallet.initialize(storage, get_network())
+    wallet = SegwitLegacyWallet(storage)
+    #a wallet utxo with 3 confirmations, an unconfirmed one,
+    #and a utxo of someone else
+    for i, confs in enumerate([3, 0]):
+        addr = wallet.get_new_addr(0, False)
+        rpc.unspent.append({'txid': '%064x' % i, 'vout': 0,
+                            'address': addr, 'amount': Decimal('0.1'),
+                            'confirmations': confs,
+                            'scriptPubKey': btc.address_to_script(addr)})
+    for i, confs in [(1, 0), (2, 10)]:
+        rpc.txouts['%064x:0' % i] = {'value': Decimal('0.2'),
+                                     'confirmations': confs,
+                                     'scriptPubKey': {'hex': '00'}}
+    bci.sync_unspent(wallet)
+    assert wallet.get_utxo_(binascii.unhexlify('%064x' % 0), 0)['height'] == \
+        len(rpc.block_times) - 3
+    txouts = ['%064x:0' % i for i in range(3)]
+    rpc.calls = []
+    results = bci.query_utxo_set_with_wallet(txouts, wallet)
+    assert [(r['value'], r['confirms']) for r in results] == [
+        (10**7, 3), (2 * 10**7, 0), (2 * 10**7, 10)]
+    assert results[0]['address'] == rpc.unspent[0]['address']
+    #only the unconfirmed and the foreign utxos are looked up
+    assert [c[1][0] for c in rpc.calls if c[0] == 'gettxout'] == [
+        '%064x' % 1, '%064x' % 2]
+    #the tip is fetched on each call until the block watcher runs
+    rpc.block_times.append(rpc.block_times[-1] + 600)
+    results = bci.query_utxo_set_with_wallet(txouts[:1], wallet)
+    assert results[0]['confirms'] == 4
+    assert [c[0] for c in rpc.calls].count('getblockcount') == 2
+
+
+def test_query_utxo_set_batch():
+    load_program_config()
+    rpc = FakeCoreRpc([1500000000])
+    bci = BitcoinCoreInterface(rpc, 'regtest')
+    rpc.txouts['%064x:1' % 1] = {'value': Decimal('0.5'),
+                                 'confirmations': 2,
+                                 'scriptPubKey': {'hex': '00'}}
+    txouts = ['%064x:1' % 1, 'bad', '%064x:0' % 2, '%064x:x' % 1]
+    rpc.calls = []
+    results = bci.query_utxo_set(txouts, includeconf=True)
+    assert results == [{'value': 5 * 10**7, 'address': None, 'script': '00',
+                        'confirms': 2}, None, None, None]
+    #one request for the well formed outpoints
+    assert rpc.batches == [['gettxout', 'gettxout']]
+
+
+def test_jsonrpc_call_batch(monkeypatch):
+    rpc = JsonRpc('localhost', 8332, 'user', 'password')
+    def queryHTTP(request):
+        #Bitcoin Core may answer a batch in any order
+        return [{'id': r['id'], 'error': None,
+                 'result': r['method'] + str(r['params'][0])}
+                for r in reversed(request)]
+    monkeypatch.setattr(rpc, 'queryHTTP', queryHTTP)
+    assert rpc.call_batch([('a', [1]), ('b', [2]), ('c', [3])]) == \
+        ['a1', 'b2', 'c3']
+    assert rpc.call_batch([]) == []
+    monkeypatch.setattr(rpc, 'queryHTTP', lambda request: [
+        {'id': r['id'], 'result': None,
+         'error': {'code': -8, 'message': 'bad'}} for r in request])
+    with pytest.raises(JsonRpcError):
+        rpc.call_batch([('a', [1])])
+
+
 @pytest.fixture(scope='module')
 def setup_wallets():
     load_program_config()
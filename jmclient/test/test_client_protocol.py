@@ -7,7 +7,10 @@ from builtins import *
 from jmbase import get_log
 from jmclient import load_program_config, Taker,\
     JMClientProtocolFactory, jm_single, Maker
-from jmclient.client_protocol import JMTakerClientProtocol
+from jmclient import client_protocol
+from jmclient.client_protocol import (JMTakerClientProtocol,
+                                     request_memory_report)
+from twisted.python.failure import Failure
 from twisted.python.log import msg as tmsg
 from twisted.internet import protocol, reactor, task
 from twisted.internet.defer import inlineCallbacks
@@ -190,10 +193,11 @@ class JMTestServerProtocol(JMBaseProtocol):
         return {'accepted': True}
 
     @JMRequestOffers.responder
-    def on_JM_REQUEST_OFFERS(self):
-        show_receipt("JMREQUESTOFFERS")
+    def on_JM_REQUEST_OFFERS(self, version):
+        show_receipt("JMREQUESTOFFERS", version)
         #build a huge orderbook to test BigString Argument
-        orderbook = ["aaaa" for _ in range(15)]
+        orderbook = [{"counterparty": "J5dummy" + str(i), "oid": 0}
+                     for i in range(15)]
         d = self.callRemote(JMOffers,
                         orderbook=json.dumps(orderbook))
         self.defaultCallbacks(d)
@@ -333,8 +337,9 @@ class TestMakerClientProtocol(unittest.TestCase):
 
     def setUp(self):
         load_program_config()
-        factory = JMClientProtocolFactory(DummyMaker(), proto_type='MAKER')
-        self.client = factory.buildProtocol(None)
+        self.factory = JMClientProtocolFactory(DummyMaker(),
+                                               proto_type='MAKER')
+        self.client = self.factory.buildProtocol(None)
         self.tr = proto_helpers.StringTransport()
         self.client.makeConnection(self.tr)
 
@@ -396,3 +401,43 @@ class TestMakerClientProtocol(unittest.TestCase):
         yield self.callClient(
             JMTXReceived, nick='testnick', txhex=t_raw_signed_tx,
             offer='{"cjaddr":"2MwfecDHsQTm4Gg3RekQdpqAMR15BJrjfRF"}')
+
+    def test_memory_report_disconnected(self):
+        assert self.factory.getClient() is self.client
+        self.client.connectionLost(Failure(ConnectionDone()))
+        assert self.factory.getClient() is None
+        # must only log, not raise, when there is no daemon connection
+        request_memory_report(self.factory)
+
+
+def test_start_metrics_once(monkeypatch):
+    load_program_config()
+    jm_single().config.set("LOGGING", "metrics_port", "27184")
+    jm_single().config.set("LOGGING", "metrics_summary_interval", "60")
+    started = []
+    monkeypatch.setattr(client_protocol.metrics, 'start_metrics_server',
+                        lambda *args: started.append('server'))
+    monkeypatch.setattr(client_protocol.metrics, 'start_metrics_summary',
+                        lambda *args: started.append('summary'))
+    monkeypatch.setattr(client_protocol, '_metrics_started', [False])
+    # as in the GUI, once per coinjoin
+    for i in range(3):
+        client_protocol.start_metrics()
+    assert started == ['server', 'summary']
+    jm_single().config.set("LOGGING", "metrics_port", "0")
+    jm_single().config.set("LOGGING", "metrics_summary_interval", "0")
+
+
+def test_start_profiling_control_once(monkeypatch):
+    load_program_config()
+    jm_single().config.set("LOGGING", "profile_control_socket", "jm.sock")
+    listening = []
+    monkeypatch.setattr(client_protocol.profiling, 'install_profiling_signal',
+                        lambda control: None)
+    monkeypatch.setattr(client_protocol.profiling, 'start_profiling_control',
+                        lambda control, path: listening.append(path))
+    monkeypatch.setattr(client_protocol, '_profiling_control', [None])
+    control = client_protocol.start_profiling_control()
+    assert client_protocol.start_profiling_control() is control
+    assert listening == ['jm.sock']
+    jm_single().config.set("LOGGING", "profile_control_socket", "")
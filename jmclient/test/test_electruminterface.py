@@ -0,0 +1,286 @@
+#! /usr/bin/env python
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import * # noqa: F401
+'''Test of Electrum wallet sync against a local fake Electrum server.'''
+
+import hashlib
+import json
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+
+import jmbitcoin as btc
+from jmclient import (load_program_config, SegwitLegacyWallet,
+                      VolatileStorage, get_network)
+from jmclient import electruminterface
+from jmclient.electruminterface import ElectrumInterface, \
+    address_to_scripthash
+
+#number of used addresses in the wallet to sync
+NUM_USED = 5000
+UTXO_VALUE = 10000
+HEIGHT = 100
+#number of outpoints to look up, and the simulated server round trip time
+NUM_QUERIED = 500
+LATENCY = 0.01
+
+
+class FakeElectrumHandler(socketserver.StreamRequestHandler):
+    """Answers newline delimited JSON-RPC requests and batches
+    of requests, from the script hash statuses, histories and
+    transactions of the server; notifications are sent with
+    FakeElectrumServer.notify.
+    """
+
+    def handle(self):
+        self.lock = threading.Lock()
+        self.server.handlers.append(self)
+        for line in self.rfile:
+            self.server.lines_received += 1
+            time.sleep(self.server.latency)
+            request = json.loads(line.decode())
+            if isinstance(request, list):
+                response = [self.respond(r) for r in request]
+            else:
+                response = self.respond(request)
+            self.send(response)
+
+    def send(self, message):
+        with self.lock:
+            self.wfile.write(json.dumps(message).encode() + b"\n")
+
+    def respond(self, request):
+        self.server.requests.append(request['method'])
+        method, params = request['method'], request['params']
+        if method == 'blockchain.scripthash.subscribe':
+            result = self.server.status.get(params[0])
+        elif method == 'blockchain.scripthash.get_history':
+            result = [{'tx_hash': txid, 'height': height} for txid, height in
+                      self.server.history.get(params[0], [])]
+        elif method == 'blockchain.scripthash.listunspent' and \
+             params[0] in self.server.unspent:
+            result = self.server.unspent[params[0]]
+        elif method == 'blockchain.scripthash.listunspent':
+            result = [{'tx_hash': txid, 'tx_pos': 0, 'height': height,
+                       'value': UTXO_VALUE} for txid, height in
+                      self.server.history.get(params[0], [])]
+        elif method == 'blockchain.transaction.get':
+            result = self.server.txs.get(params[0])
+        elif method == 'blockchain.headers.subscribe':
+            result = {'height': HEIGHT, 'hex': '00' * 80}
+        elif method == 'server.version':
+            result = ['FakeElectrum', '1.4']
+        else:
+            result = None
+        return {'id': request['id'], 'result': result}
+
+
+class FakeElectrumServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, used):
+        socketserver.TCPServer.__init__(self, ("localhost", 0),
+                                        FakeElectrumHandler)
+        #status hash and [(txid, height)] by script hash
+        self.status = {}
+        self.history = {}
+        self.txs = {}
+        #listunspent results, where not derived from the history
+        self.unspent = {}
+        self.latency = 0.0
+        for addr in used:
+            self.add_history(addr, fake_txid(addr), HEIGHT)
+        self.handlers = []
+        self.requests = []
+        self.lines_received = 0
+
+    def add_history(self, addr, txid, height):
+        scripthash = address_to_scripthash(addr)
+        history = [h for h in self.history.get(scripthash, [])
+                   if h[0] != txid] + [(txid, height)]
+        self.history[scripthash] = history
+        self.status[scripthash] = hashlib.sha256(
+            json.dumps(history).encode()).hexdigest()
+        return scripthash
+
+    def notify(self, scripthash):
+        for h in self.handlers:
+            h.send({'method': 'blockchain.scripthash.subscribe',
+                    'params': [scripthash, self.status[scripthash]]})
+
+
+def fake_txid(addr):
+    return hashlib.sha256(addr.encode('ascii')).hexdigest()
+
+
+class ElectrumSyncTests(unittest.TestCase):
+
+    def setUp(self):
+        load_program_config()
+        storage = VolatileStorage()
+        SegwitLegacyWallet.initialize(storage, get_network())
+        self.wallet = SegwitLegacyWallet(storage)
+        #used addresses spread over all branches, most in the first
+        self.branches = [(md, internal) for md in range(
+            self.wallet.max_mixdepth + 1) for internal in [False, True]]
+        self.first_used = NUM_USED - 10 * (len(self.branches) - 1)
+        used = []
+        for md, internal in self.branches:
+            n = self.first_used if (md, internal) == (0, False) else 10
+            used.extend([self.wallet.get_new_addr(md, internal)
+                         for i in range(n)])
+        #not served by the reactor, since the interface also makes
+        #blocking calls to the server from the reactor thread
+        self.server = FakeElectrumServer(set(used))
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.patch(electruminterface, "DEFAULT_PROTO", 't')
+        self.bci = ElectrumInterface(
+            electrum_server="localhost:" + str(self.server.server_address[1]))
+        self.bci.synctype = "with-script"
+        #persist the status hashes between syncs
+        self.tmpdir = tempfile.mkdtemp()
+        self.wallet.get_storage_location = lambda: os.path.join(
+            self.tmpdir, "wallet.jmdat")
+
+    def tearDown(self):
+        #the watchers' timeouts
+        for call in reactor.getDelayedCalls():
+            if call.func in (self.bci.tx_network_timeout,
+                             self.bci.tx_timeout):
+                call.cancel()
+        #no reconnection
+        self.bci.start_electrum_proto = lambda *args: None
+        self.bci.factory.client.transport.loseConnection()
+        self.bci.electrum_conn.s.close()
+        if self.bci.tx_cache:
+            self.bci.tx_cache.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    @defer.inlineCallbacks
+    def wait_for(self, condition):
+        while not condition():
+            yield task.deferLater(reactor, 0.1, lambda: None)
+
+    @defer.inlineCallbacks
+    def sync(self):
+        self.bci.sync_wallet(self.wallet)
+        self.bci.sync_addresses(self.wallet)
+        yield self.wait_for(lambda: self.bci.wallet_synced)
+
+    @defer.inlineCallbacks
+    def test_sync(self):
+        yield self.wait_for(lambda: getattr(self.bci.factory, 'client', None))
+        start = time.time()
+        yield self.sync()
+        print("Electrum sync of {} used addresses took {:.2f}s, in {} "
+              "requests and {} messages".format(
+                  NUM_USED, time.time() - start, len(self.server.requests),
+                  self.server.lines_received))
+        assert self.wallet.get_balance_by_mixdepth()[0] == \
+            (self.first_used + 10) * UTXO_VALUE
+        assert self.wallet.get_next_unused_index(0, False) == self.first_used
+        for md, internal in self.branches[1:]:
+            assert self.wallet.get_next_unused_index(md, internal) == 10
+        assert sum(self.wallet.get_balance_by_mixdepth().values()) == \
+            NUM_USED * UTXO_VALUE
+        #batched: far fewer messages than requests
+        assert self.server.lines_received < len(self.server.requests) / 20
+        #resync: unspent outputs are only fetched for changed statuses
+        changed = self.wallet.get_addr(1, False, 0)
+        self.server.add_history(changed, fake_txid(changed + "1"), HEIGHT)
+        self.server.requests = []
+        yield self.sync()
+        assert self.server.requests.count(
+            'blockchain.scripthash.listunspent') == 1
+        assert sum(self.wallet.get_balance_by_mixdepth().values()) == \
+            (NUM_USED + 1) * UTXO_VALUE
+
+    @defer.inlineCallbacks
+    def test_tx_notify(self):
+        yield self.wait_for(lambda: getattr(self.bci.factory, 'client', None))
+        addr = self.wallet.get_new_addr(0, False)
+        txd = {'version': 1, 'locktime': 0,
+               'ins': [{'outpoint': {'hash': '00' * 32, 'index': 0},
+                        'script': '', 'sequence': 4294967295}],
+               'outs': [{'script': btc.address_to_script(addr),
+                         'value': UTXO_VALUE}]}
+        txhex = btc.serialize(txd)
+        txid = btc.txhash(txhex)
+        self.server.txs[txid] = txhex
+        seen = []
+        self.bci.add_tx_notify(
+            txd, lambda txd, txid: seen.append("unconfirmed"),
+            lambda txd, txid, confs: seen.append("confirmed"), addr)
+        yield task.deferLater(reactor, 0.5, lambda: None)
+        assert seen == []
+        #watchers run on notifications only
+        self.server.notify(self.server.add_history(addr, txid, 0))
+        yield self.wait_for(lambda: len(seen) == 1)
+        assert seen == ["unconfirmed"]
+        self.server.notify(self.server.add_history(addr, txid, HEIGHT))
+        yield self.wait_for(lambda: len(seen) == 2)
+        assert seen == ["unconfirmed", "confirmed"]
+        assert 'blockchain.address.get_mempool' not in self.server.requests
+
+    @defer.inlineCallbacks
+    def test_query_utxo_set(self):
+        yield self.wait_for(lambda: getattr(self.bci.factory, 'client', None))
+        #transactions with two outputs each, to a few addresses;
+        #the second output of every other transaction is spent
+        addrs = [self.wallet.get_new_addr(0, False) for i in range(10)]
+        outpoints = []
+        expected = []
+        for i in range(NUM_QUERIED // 2):
+            addr = addrs[i % len(addrs)]
+            txd = {'version': 1, 'locktime': i,
+                   'ins': [{'outpoint': {'hash': '00' * 32, 'index': 0},
+                            'script': '', 'sequence': 4294967295}],
+                   'outs': [{'script': btc.address_to_script(addr),
+                             'value': UTXO_VALUE + n} for n in range(2)]}
+            txhex = btc.serialize(txd)
+            txid = btc.txhash(txhex)
+            self.server.txs[txid] = txhex
+            unspent = self.server.unspent.setdefault(
+                address_to_scripthash(addr), [])
+            for n in range(2):
+                outpoints.append(txid + ":" + str(n))
+                if n == 1 and i % 2:
+                    expected.append(None)
+                    continue
+                unspent.append({'tx_hash': txid, 'tx_pos': n,
+                                'height': HEIGHT - 1, 'value': UTXO_VALUE + n})
+                expected.append((UTXO_VALUE + n, addr, 2))
+        #an unknown transaction and a nonexistent output
+        outpoints += ["11" * 32 + ":0", outpoints[0][:64] + ":2"]
+        expected += [None, None]
+        self.server.latency = LATENCY
+        self.server.requests = []
+        lines_before = self.server.lines_received
+        start = time.time()
+        result = self.bci.query_utxo_set(outpoints, includeconf=True)
+        elapsed = time.time() - start
+        lines = self.server.lines_received - lines_before
+        print("query_utxo_set of {} outpoints took {:.2f}s, in {} requests "
+              "and {} messages, at {:.0f}ms latency".format(
+                  len(outpoints), elapsed, len(self.server.requests), lines,
+                  LATENCY * 1000))
+        assert [r and (r['value'], r['address'], r['confirms'])
+                for r in result] == expected
+        #each transaction and script hash fetched once, in batches
+        assert self.server.requests.count('blockchain.transaction.get') == \
+            NUM_QUERIED // 2 + 1
+        assert self.server.requests.count(
+            'blockchain.scripthash.listunspent') == len(addrs)
+        assert lines == 2
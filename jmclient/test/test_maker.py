@@ -6,10 +6,13 @@ from builtins import * # noqa: F401
 
 import jmbitcoin as btc
 from jmclient import Maker, get_p2sh_vbyte, get_p2pk_vbyte, \
-    load_program_config, jm_single
+    load_program_config, jm_single, YieldGeneratorBasic, \
+    SimulatedBlockchainInterface
 import jmclient
-from commontest import DummyBlockchainInterface
+from commontest import DummyBlockchainInterface, make_wallets
 from test_taker import DummyWallet
+from test_coinjoin import make_wallets_to_list, sync_wallets
+from twisted.internet import task
 
 import struct
 import binascii
@@ -175,8 +178,55 @@ def test_verify_unsigned_tx_nonsw_valid(setup_env_nodeps):
     assert maker.verify_unsigned_tx(tx, offerlist) == (True, None), "nonsw cj with only p2sh outputs"
 
 
+def test_maker_utxo_reservations(monkeypatch, setup_sim_wallets):
+    clock = task.Clock()
+    monkeypatch.setattr(jmclient.maker, 'reactor', clock)
+    wallets = make_wallets_to_list(make_wallets(
+        1, wallet_structures=[[4, 0, 0, 0, 0]], mean_amt=1))
+    sync_wallets(wallets)
+    maker = YieldGeneratorBasic(wallets[0],
+                                [0, 2000, 0, 'swabsoffer', 10**7])
+    offer = maker.offerlist[0]
+    #each fill needs two of the four utxos
+    amount = 15 * 10**7
+    fills = []
+    for i in range(2):
+        utxos = maker.oid_to_order(offer, amount)[0]
+        assert len(utxos) == 2
+        assert not set(utxos) & set(maker.reserved_utxos())
+        maker.reserve_utxos(utxos.keys(), 60)
+        fills.append(list(utxos.keys()))
+    assert maker.get_available_balance_by_mixdepth()[0] == 0
+    assert maker.oid_to_order(offer, amount) == (None, None, None)
+    maker.release_utxos(fills[0])
+    assert set(maker.oid_to_order(offer, amount)[0]) == set(fills[0])
+    #a reservation is extended by reserving again, and expires
+    clock.advance(30)
+    maker.reserve_utxos(fills[1], 60)
+    clock.advance(45)
+    assert set(maker.reserved_utxos()) == set(fills[1])
+    clock.advance(15)
+    assert maker.reserved_utxos() == []
+    #a stale expiry does not drop a newer reservation of the same utxo
+    maker.reserve_utxos(fills[1][:1], 60)
+    maker.expire_reservation(fills[1][0])
+    assert maker.reserved_utxos() == fills[1][:1]
+    maker.release_utxos(fills[1][:1])
+    assert maker.get_available_balance_by_mixdepth()[0] == 4 * 10**8
+
+
 @pytest.fixture
 def setup_env_nodeps(monkeypatch):
     monkeypatch.setattr(jmclient.configure, 'get_blockchain_interface_instance',
                         lambda x: DummyBlockchainInterface())
     load_program_config()
+
+
+@pytest.fixture
+def setup_sim_wallets():
+    load_program_config()
+    jm_single().config.set('POLICY', 'listunspent_args', '[0]')
+    old_bci = jm_single().bc_interface
+    jm_single().bc_interface = SimulatedBlockchainInterface()
+    yield None
+    jm_single().bc_interface = old_bci
@@ -0,0 +1,180 @@
+#! /usr/bin/env python
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import * # noqa: F401
+'''Test of full coinjoins on the in-memory simulated blockchain.'''
+
+import time
+
+import pytest
+from twisted.internet import task
+
+import jmbitcoin as btc
+import jmclient
+
+from jmbase import get_log
+from jmclient import (load_program_config, jm_single, YieldGeneratorBasic,
+                      YieldGeneratorMultiOffer, SimulatedBlockchainInterface)
+from jmclient.podle import set_commitment_file
+from commontest import make_wallets
+from test_coinjoin import (make_wallets_to_list, sync_wallets,
+                           create_orderbook, create_taker, init_coinjoin,
+                           do_tx_signing)
+
+log = get_log()
+
+MAKER_NUM = 3
+NUM_ROUNDS = 5
+
+
+def run_round(monkeypatch, wallets, cj_amount):
+    makers = [YieldGeneratorBasic(
+        wallets[i], [0, 2000, 0, 'swabsoffer', 10**7])
+        for i in range(MAKER_NUM)]
+    orderbook = create_orderbook(makers)
+    schedule = [(0, cj_amount, MAKER_NUM, 'INTERNAL', 0)]
+    taker = create_taker(wallets[-1], schedule, monkeypatch)
+    active_orders, maker_data = init_coinjoin(taker, makers, orderbook,
+                                              cj_amount)
+    txdata = taker.receive_utxos(maker_data)
+    assert txdata[0], "taker.receive_utxos error"
+    assert do_tx_signing(taker, makers, active_orders, txdata) is not False
+    return taker
+
+
+def test_simulated_coinjoins(monkeypatch, tmpdir, setup_sim):
+    bci = jm_single().bc_interface
+    set_commitment_file(str(tmpdir.join('commitments.json')))
+    wallets = make_wallets_to_list(make_wallets(
+        MAKER_NUM + 1, wallet_structures=[[4, 0, 0, 0, 0]] * (MAKER_NUM + 1),
+        mean_amt=1))
+    sync_wallets(wallets)
+    assert [w.get_balance_by_mixdepth()[0] for w in wallets] == \
+        [4 * 10**8] * (MAKER_NUM + 1)
+
+    cj_amount = 2 * 10**7
+    start = time.time()
+    for i in range(NUM_ROUNDS):
+        bci.calls.clear()
+        taker = run_round(monkeypatch, wallets, cj_amount)
+        assert taker.on_finished_callback.status is not False
+        #pushed, and seen by the watcher, but not yet confirmed
+        assert len(bci.mempool) == 1
+        txid = bci.mempool[0]
+        assert bci.get_confirmations(txid) == 0
+        bci.tick_forward_chain(1)
+        assert bci.get_confirmations(txid) == 1
+        log.debug("Simulated blockchain calls in round: " + str(bci.calls))
+        sync_wallets(wallets)
+    print("{} simulated coinjoin rounds took {:.2f}s".format(
+        NUM_ROUNDS, time.time() - start))
+    #the taker's coinjoin outputs went to its next mixdepth
+    assert wallets[-1].get_balance_by_mixdepth()[1] == NUM_ROUNDS * cj_amount
+    #no coins are created
+    assert sum([sum(w.get_balance_by_mixdepth().values())
+                for w in wallets]) < (MAKER_NUM + 1) * 4 * 10**8
+    #spent outputs are gone, and can't be spent again
+    spent = list(bci.spent_by.keys())[0]
+    assert bci.query_utxo_set(spent[0] + ':' + str(spent[1])) == [None]
+    txd = list(bci.txs.values())[-1]['txd']
+    txd['locktime'] += 1
+    assert not bci.pushtx(btc.serialize(txd))
+
+
+def test_taker_signature_checks(monkeypatch, tmpdir, setup_sim):
+    bci = jm_single().bc_interface
+    set_commitment_file(str(tmpdir.join('commitments.json')))
+    wallets = make_wallets_to_list(make_wallets(
+        MAKER_NUM + 1, wallet_structures=[[4, 0, 0, 0, 0]] * (MAKER_NUM + 1),
+        mean_amt=1))
+    sync_wallets(wallets)
+    makers = [YieldGeneratorBasic(
+        wallets[i], [0, 2000, 0, 'swabsoffer', 10**7])
+        for i in range(MAKER_NUM)]
+    orderbook = create_orderbook(makers)
+    #each maker signs two inputs
+    cj_amount = 15 * 10**7
+    taker = create_taker(wallets[-1], [(0, cj_amount, MAKER_NUM,
+                                        'INTERNAL', 0)], monkeypatch)
+    active_orders, maker_data = init_coinjoin(taker, makers, orderbook,
+                                              cj_amount)
+    txdata = taker.receive_utxos(maker_data)
+    assert txdata[0], "taker.receive_utxos error"
+    sigs = []
+    for mid in txdata[1]:
+        result = makers[int(mid)].on_tx_received('TAKER', txdata[2],
+                                                 active_orders[mid])
+        assert result[0], "maker.on_tx_received error"
+        sigs.extend([(mid, sig) for sig in result[1]])
+    assert len(sigs) == 2 * MAKER_NUM
+    bci.calls.clear()
+    assert taker.on_sig(sigs[0][0], 'junk') is False
+    unsigned = [ins for ins in taker.latest_tx['ins'] if ins['script'] == '']
+    assert len(unsigned) == len(sigs)
+    for mid, sig in reversed(sigs[1:]):
+        assert taker.on_sig(mid, sig) is False
+        #sent again, it is ignored
+        assert not taker.on_sig(mid, sig)
+    assert len([ins for ins in taker.latest_tx['ins']
+                if ins['script'] == '']) == 1
+    assert taker.on_sig(*sigs[0]) is not False
+    assert taker.on_finished_callback.status is not False
+    #the makers' inputs were looked up once for the round
+    assert bci.calls['gettxout'] == len(sigs)
+
+
+def test_multioffer_yield_generator(monkeypatch, setup_sim):
+    monkeypatch.setattr(jmclient.maker, 'reactor', task.Clock())
+    wallets = make_wallets_to_list(make_wallets(
+        1, wallet_structures=[[2, 1, 0, 3, 0]], mean_amt=1))
+    sync_wallets(wallets)
+    wallet = wallets[0]
+    maker = YieldGeneratorMultiOffer(wallet,
+                                     [0, 2000, 0, 'swabsoffer', 10**7])
+    dust = jm_single().DUST_THRESHOLD
+    assert [(o['oid'], o['maxsize']) for o in maker.offerlist] == \
+        [(0, 2 * 10**8 - dust), (1, 10**8 - dust), (3, 3 * 10**8 - dust)]
+    #a fill is served from the mixdepth of its offer
+    utxos = maker.oid_to_order(maker.offerlist[2], 15 * 10**7)[0]
+    assert set(utxos) <= set(wallet.get_utxos_by_mixdepth()[3])
+    maker.reserve_utxos(utxos.keys(), 60)
+    #or from another, if the offer's mixdepth has been promised meanwhile
+    other = maker.oid_to_order(maker.offerlist[2], 15 * 10**7)[0]
+    assert set(other) <= set(wallet.get_utxos_by_mixdepth()[0])
+    #only the offers which changed are updated
+    def spend(utxos):
+        txd = {'ins': [{'outpoint': {'hash': u[:64], 'index': int(u[65:])}}
+                       for u in utxos]}
+        wallet.remove_old_utxos(txd)
+        return maker.on_tx_unconfirmed({'cjaddr': 'dummy'}, 'dummy', None)
+    to_cancel, to_announce = spend(utxos)
+    assert to_cancel == []
+    assert [(o['oid'], o['maxsize']) for o in to_announce] == \
+        [(3, 10**8 - dust)]
+    maker.modify_orders(to_cancel, to_announce)
+    to_cancel, to_announce = spend(wallet.get_utxos_by_mixdepth()[1])
+    assert to_cancel == [1] and to_announce == []
+    maker.modify_orders(to_cancel, to_announce)
+    assert sorted([o['oid'] for o in maker.offerlist]) == [0, 3]
+
+
+def test_simulated_latency(setup_sim):
+    bci = SimulatedBlockchainInterface(latency=0.01)
+    wallet = make_wallets(1, wallet_structures=[[1, 0, 0, 0, 0]])[0]['wallet']
+    txid = jm_single().bc_interface.grab_coins(wallet.get_new_addr(0, False))
+    start = time.time()
+    assert bci.query_utxo_set([txid + ':0'] * 10) == [None] * 10
+    #the outpoints are looked up in one request
+    assert 0.01 <= time.time() - start < 0.1
+    assert bci.calls['gettxout'] == 10
+
+
+@pytest.fixture(scope='module')
+def setup_sim():
+    load_program_config()
+    jm_single().config.set('POLICY', 'tx_broadcast', 'self')
+    jm_single().config.set('POLICY', 'listunspent_args', '[0]')
+    old_bci = jm_single().bc_interface
+    jm_single().bc_interface = SimulatedBlockchainInterface()
+    yield None
+    jm_single().bc_interface = old_bci
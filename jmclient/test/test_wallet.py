@@ -14,7 +14,9 @@ from jmbase import get_log
 from jmclient import load_program_config, jm_single, \
     SegwitLegacyWallet,BIP32Wallet, BIP49Wallet, LegacyWallet,\
     VolatileStorage, get_network, cryptoengine, WalletError,\
-    SegwitWallet
+    SegwitWallet, TxCache, wallet_display, JsonRpcError
+from jmclient import wallet_utils
+from jmclient.wallet_utils import classify_tx, wallet_fetch_history
 from test_blockchaininterface import sync_test_wallet
 
 testdir = os.path.dirname(os.path.realpath(__file__))
@@ -645,6 +647,116 @@ def test_wallet_mixdepth_decrease(setup_wallet):
     assert utxo in new_wallet.select_utxos_(max_mixdepth, 10**7)
 
 
+def test_tx_cache(tmpdir):
+    assert classify_tx([10**8, 10**8, 10**8, 5000, 7000]) == (True, 10**8, 3)
+    assert classify_tx([10**8, 5000, 7000])[0] is False
+    path = str(tmpdir.join('wallet.jmdat.txcache'))
+    cache = TxCache(path)
+    assert cache.get_classification('aa'*32) is None
+    cache.add_classification('aa'*32, True, 10**8, 3)
+    cache.close()
+    assert TxCache(path).get_classification('aa'*32) == (True, 10**8, 3)
+
+
+def test_wallet_display_tx_cache(setup_wallet):
+    wallet = get_populated_wallet(num=0)
+    txids = [b'\x01'*32, b'\x02'*32]
+    # a coinjoin output and a deposit to the same address
+    script = wallet.get_script(0, 0, 0)
+    for txid in txids:
+        wallet.add_utxo(txid, 0, script, 10**8)
+    cache = TxCache()
+    cache.add_classification(hexlify(txids[0]).decode('ascii'), True,
+                             10**8, 3)
+    cache.add_classification(hexlify(txids[1]).decode('ascii'), False,
+                             10**8, 1)
+    # no blockchain access is needed, all are cached
+    walletview = wallet_display(wallet, 6, False, serialized=False,
+                                tx_cache=cache)
+    entries = walletview.children[0].children[0].children
+    assert entries[0].used == 'reused'
+    assert entries[0].unconfirmed_amount == 2 * 10**8
+    wallet.remove_old_utxos_({'ins': [{'outpoint': {
+        'hash': txids[1], 'index': 0}}]})
+    walletview = wallet_display(wallet, 6, False, serialized=False,
+                                tx_cache=cache)
+    assert walletview.children[0].children[0].children[0].used == 'cj-out'
+
+
+class DummyHistoryOptions(object):
+    csv = False
+    verbosity = 4
+    incremental = False
+
+
+def test_wallet_fetch_history_incremental(setup_wallet, tmpdir, capsys,
+                                          monkeypatch):
+    wallet = get_populated_wallet(num=0)
+    txes = []
+    for i, value in enumerate([10**8, 5 * 10**7, 2 * 10**7]):
+        script = wallet.get_script(0, 0, i)
+        txhex = btc.mktx(['{}:0'.format('ff' * 32)],
+                         ['{}:{}'.format(hexlify(script).decode('ascii'),
+                                         value)])
+        txes.append({'txid': btc.txhash(txhex), 'hex': txhex,
+                     'blockhash': '0{}'.format(i) * 32,
+                     'blocktime': 1500000000 + i * 600,
+                     'confirmations': 10 - i * 4})
+    # the transactions known to the node
+    chain = txes[:2]
+    calls = []
+
+    def rpc(method, args):
+        calls.append(method)
+        if method == 'listtransactions':
+            return chain[args[2]:]
+        elif method == 'listsinceblock':
+            return {'transactions': [tx for tx in chain
+                                     if tx['blockhash'] > args[0]]}
+        elif method == 'gettransaction':
+            for tx in chain:
+                if tx['txid'] == args[0]:
+                    return tx
+            raise JsonRpcError({'code': -5, 'message': 'not a wallet tx'})
+        elif method == 'getbestblockhash':
+            return '02' * 32
+        return {'time': 1500001200}
+    monkeypatch.setattr(jm_single().bc_interface, 'rpc', rpc, raising=False)
+    cache_path = str(tmpdir.join('wallet.txcache'))
+    monkeypatch.setattr(wallet_utils, 'get_tx_cache',
+                        lambda w: TxCache(cache_path))
+
+    def add_utxos(txes):
+        for tx in txes:
+            txd = btc.deserialize(tx['hex'])
+            binarize_tx(txd)
+            wallet.add_new_utxos_(txd, unhexlify(tx['txid']))
+    add_utxos(txes[:2])
+    options = DummyHistoryOptions()
+    wallet_fetch_history(wallet, options)
+    out = capsys.readouterr().out
+    assert len([l for l in out.splitlines() if 'deposit' in l]) == 2
+    assert 'BUG' not in out
+    assert calls.count('gettransaction') == 4
+    # the second run needs no transactions fetched, and only
+    # processes the new one
+    chain.append(txes[2])
+    add_utxos(txes[2:])
+    del calls[:]
+    options.incremental = True
+    wallet_fetch_history(wallet, options)
+    out = capsys.readouterr().out
+    rows = [l for l in out.splitlines() if 'deposit' in l]
+    assert len(rows) == 1
+    assert rows[0].startswith('"   2"') and txes[2]['txid'] in rows[0]
+    assert 'listtransactions' not in calls
+    assert calls.count('gettransaction') == 2
+    assert 'BUG' not in out
+    assert 'total profit = 0.00000000 BTC' in out
+    assert TxCache(cache_path).get_history_checkpoint()['blockhash'] == \
+        txes[1]['blockhash']
+
+
 @pytest.fixture(scope='module')
 def setup_wallet():
     load_program_config()
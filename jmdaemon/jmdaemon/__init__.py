@@ -7,9 +7,12 @@ from .protocol import *
 from .enc_wrapper import as_init_encryption, decode_decrypt, \
     encrypt_encode, init_keypair, init_pubkey, get_pubkey, NaclError
 from .irc import IRCMessageChannel
+from .hub import (HubMessageChannel, JMHubServerFactory, get_message_channel,
+                  start_hub)
 from jmbase.support import get_log
 from .message_channel import MessageChannel, MessageChannelCollection
 from .orderbookwatch import OrderbookWatch
+from .shared_mc import SharedMessageChannels
 from jmbase import commands
 from .daemon_protocol import (JMDaemonServerProtocolFactory, JMDaemonServerProtocol,
                               start_daemon)
@@ -5,17 +5,20 @@ from builtins import *
 from future.utils import iteritems
 
 from .message_channel import MessageChannelCollection
-from .orderbookwatch import OrderbookWatch
+from .orderbookwatch import OrderbookWatch, get_orderbook_delta
 from .enc_wrapper import (as_init_encryption, init_keypair, init_pubkey,
                           NaclError)
 from .protocol import (COMMAND_PREFIX, ORDER_KEYS, NICK_HASH_LENGTH,
                        NICK_MAX_ENCODED, JM_VERSION, JOINMARKET_NICK_HEADER,
                        COMMITMENT_PREFIXES)
-from .irc import IRCMessageChannel
+from .hub import get_message_channel
+from .shared_mc import SharedMessageChannels
 
 from jmbase.commands import *
+from jmbase.support import get_approx_size
+from jmbase import metrics
 from twisted.protocols import amp
-from twisted.internet import reactor, ssl
+from twisted.internet import reactor, ssl, task
 from twisted.internet.protocol import ServerFactory
 from twisted.internet.error import (ConnectionLost, ConnectionAborted,
                                     ConnectionClosed, ConnectionDone)
@@ -24,9 +27,14 @@ import json
 import threading
 import os
 import copy
+import time
 from functools import wraps
 from numbers import Integral
 
+FILL_TO_IOAUTH_SECONDS = metrics.histogram(
+    'jm_maker_fill_to_ioauth_seconds',
+    'Time from receipt of a !fill to sending the !ioauth, for makers')
+
 """Joinmarket application protocol control flow.
 For documentation on protocol (formats, message sequence) see
 https://github.com/JoinMarket-Org/JoinMarket-Docs/blob/master/
@@ -90,19 +98,45 @@ def check_utxo_blacklist(commitment, persist=False):
 class JMProtocolError(Exception):
     pass
 
+#Limits on the state the daemon keeps about counterparties (all times
+#in seconds), enforced every sweep_interval seconds; see
+#JMDaemonServerProtocol.sweep_expired_state.
+DEFAULT_EXPIRY = {"sweep_interval": 60,
+                  #nicks not heard from, and the maximum number remembered
+                  "nick_expiry": 86400,
+                  "max_nicks": 5000,
+                  #incomplete multi-part privmsgs
+                  "partial_message_expiry": 60,
+                  #coinjoin state (keys, utxos) for a counterparty
+                  "active_order_expiry": 3600,
+                  #offers not re-announced
+                  "offer_expiry": 86400}
+
 class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
 
     def __init__(self, factory):
         self.factory = factory
+        self.orderbook_cache_loop = None
+        self.orderbook_cache_trigger = None
+        #version and content (keyed by (counterparty, oid)) of
+        #the last orderbook sent to the taker, for deltas
+        self.offers_version = 0
+        self.offers_sent = None
         self.jm_state = 0
         self.restart_mc_required = False
         self.irc_configs = None
         self.mcc = None
+        #set if the message channels are shared with other clients
+        self.shared_mc = None
         #Default role is TAKER; must be overriden to MAKER in JMSetup message.
         self.role = "TAKER"
         self.crypto_boxes = {}
         self.sig_lock = threading.Lock()
         self.active_orders = {}
+        #time of the last message in the transaction with each
+        #counterparty in active_orders/crypto_boxes, for expiry
+        self.active_orders_time = {}
+        self.sweep_loop = None
 
     def checkClientResponse(self, response):
         """A generic check of client acceptance; any failure
@@ -135,7 +169,14 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
         irc_configs = json.loads(irc_configs)
         #(bitcoin) network only referenced in channel name construction
         self.network = network
-        if irc_configs == self.irc_configs:
+        if self.factory.shared and irc_configs != self.irc_configs:
+            if self.shared_mc:
+                self.mc_shutdown()
+            self.irc_configs = irc_configs
+            self.shared_mc = self.factory.get_shared_mc(irc_configs, bcsource)
+            self.mcc = self.shared_mc.attach(self)
+            self.restart_mc_required = True
+        elif irc_configs == self.irc_configs:
             self.restart_mc_required = False
             log.msg("New init received did not require a new message channel"
                     " setup.")
@@ -145,9 +186,9 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
                 self.mc_shutdown()
             self.irc_configs = irc_configs
             self.restart_mc_required = True
-            mcs = [IRCMessageChannel(c,
-                                     daemon=self,
-                                     realname='btcint=' + bcsource)
+            mcs = [get_message_channel(c,
+                                       daemon=self,
+                                       realname='btcint=' + bcsource)
                    for c in self.irc_configs]
             self.mcc = MessageChannelCollection(mcs)
             OrderbookWatch.set_msgchan(self, self.mcc)
@@ -162,6 +203,11 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
                                               self.on_commitment_seen,
                                               self.on_commitment_transferred)
             self.mcc.set_daemon(self)
+            self.start_orderbook_cache()
+        if not self.sweep_loop:
+            self.sweep_loop = task.LoopingCall(self.sweep_expired_state)
+            self.sweep_loop.start(self.factory.expiry["sweep_interval"],
+                                  now=False)
         d = self.callRemote(JMInitProto,
                             nick_hash_length=NICK_HASH_LENGTH,
                             nick_max_encoded=NICK_MAX_ENCODED,
@@ -212,19 +258,47 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
             self.mcc.on_verified_privmsg(nick, fullmsg, hostid)
         return {'accepted': True}
 
+    @JMRequestMemoryReport.responder
+    def on_JM_REQUEST_MEMORY_REPORT(self):
+        d = self.callRemote(JMMemoryReport,
+                            report=json.dumps(self.get_memory_report()))
+        self.defaultCallbacks(d)
+        return {'accepted': True}
+
     """Taker specific responders
     """
 
     @JMRequestOffers.responder
-    def on_JM_REQUEST_OFFERS(self):
+    def on_JM_REQUEST_OFFERS(self, version):
         """Reports the current state of the orderbook.
-        This call is stateless."""
+        If the client already holds the last version we sent,
+        only the changes since then are sent; otherwise
+        the full orderbook.
+        """
         rows = self.db.execute('SELECT * FROM orderbook;').fetchall()
         self.orderbook = [dict([(k, o[k]) for k in ORDER_KEYS]) for o in rows]
-        log.msg("About to send orderbook of size: " + str(len(self.orderbook)))
-        string_orderbook = json.dumps(self.orderbook)
-        d = self.callRemote(JMOffers,
-                        orderbook=string_orderbook)
+        current = dict([((o['counterparty'], o['oid']), o)
+                        for o in self.orderbook])
+        base_version = self.offers_version
+        self.offers_version += 1
+        if self.offers_sent is not None and version == base_version:
+            updated, removed = get_orderbook_delta(self.offers_sent, current)
+            log.msg("About to send orderbook changes: {} updated, {} "
+                    "removed".format(len(updated), len(removed)))
+            d = self.callRemote(JMOffersDelta,
+                        base_version=base_version,
+                        version=self.offers_version,
+                        updated=json.dumps(updated),
+                        removed=json.dumps(removed),
+                        cached_counterparties=len(self.cached_counterparties))
+        else:
+            log.msg("About to send orderbook of size: " + str(len(self.orderbook)))
+            string_orderbook = json.dumps(self.orderbook)
+            d = self.callRemote(JMOffers,
+                        orderbook=string_orderbook,
+                        cached_counterparties=len(self.cached_counterparties),
+                        version=self.offers_version)
+        self.offers_sent = current
         self.defaultCallbacks(d)
         return {'accepted': True}
 
@@ -243,6 +317,7 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
         self.ioauth_data = {}
         self.active_orders = json.loads(filled_offers)
         for nick, offer_dict in iteritems(self.active_orders):
+            self.active_orders_time[nick] = time.time()
             offer_fill_msg = " ".join([str(offer_dict["oid"]), str(amount),
                 self.kp.hex_pk().decode('ascii'), str(commitment)])
             self.mcc.prepare_privmsg(nick, "fill", offer_fill_msg)
@@ -298,6 +373,9 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
         if not nick in self.active_orders:
             return
         utxos= json.loads(utxolist)
+        fill_time = self.active_orders[nick].pop("fill_time", None)
+        if fill_time is not None:
+            FILL_TO_IOAUTH_SECONDS.observe(time.time() - fill_time)
         #completed population of order/offer object
         self.active_orders[nick]["cjaddr"] = cjaddr
         self.active_orders[nick]["changeaddr"] = changeaddr
@@ -392,7 +470,9 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
                                         "kp": kp,
                                         "offer": offer,
                                         "amount": amount,
-                                        "commit": scommit}
+                                        "commit": scommit,
+                                        "fill_time": time.time()}
+        self.active_orders_time[nick] = time.time()
         self.mcc.prepare_privmsg(nick, "pubkey", kp.hex_pk().decode('ascii'))
 
     @maker_only
@@ -404,6 +484,7 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
 	"""
         if not nick in self.active_orders:
             return
+        self.active_orders_time[nick] = time.time()
         ao =self.active_orders[nick]
         #ask the client to validate the commitment and prepare the utxo data
         d = self.callRemote(JMAuthReceived,
@@ -457,6 +538,7 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
 	"""
         if nick not in self.active_orders:
             return
+        self.active_orders_time[nick] = time.time()
         #we send a copy of the entire "active_orders" entry except the cryptobox,
         #so make a temporary copy
         ao = copy.deepcopy(self.active_orders[nick])
@@ -642,15 +724,145 @@ class JMDaemonServerProtocol(amp.AMP, OrderbookWatch):
                       ', message will be dropped')
             return None
 
+    def start_orderbook_cache(self):
+        """If the factory was configured with an orderbook cache
+        file, load the offers seen in previous sessions, and persist
+        the (incrementally updated) cache periodically and on shutdown.
+        """
+        if not self.factory.orderbook_cache:
+            return
+        OrderbookWatch.start_orderbook_cache(self,
+            self.factory.orderbook_cache, self.factory.orderbook_cache_max_age,
+            self.factory.orderbook_cache_interval)
+
+    def expire_active_orders(self, max_age):
+        """Drop the transaction state for counterparties which
+        have not messaged for max_age seconds (abandoned transactions).
+        Returns the number dropped.
+        """
+        oldest = time.time() - max_age
+        expired = [n for n, t in iteritems(self.active_orders_time)
+                   if t < oldest]
+        for nick in expired:
+            del self.active_orders_time[nick]
+            self.active_orders.pop(nick, None)
+            self.crypto_boxes.pop(nick, None)
+        return len(expired)
+
+    def sweep_expired_state(self):
+        """Forget the state kept about counterparties which have gone
+        quiet (see DEFAULT_EXPIRY), so that the memory used by long
+        running daemons stays bounded.
+        """
+        if not self.mcc:
+            return
+        expiry = self.factory.expiry
+        ob = self.shared_mc if self.shared_mc else self
+        keep = set(self.active_orders.keys())
+        if self.shared_mc:
+            for s in self.shared_mc.sessions:
+                keep.update(s.active_orders.keys())
+        expired = [("offers", ob.expire_offers(expiry["offer_expiry"])),
+                   ("active orders", self.expire_active_orders(
+                       expiry["active_order_expiry"])),
+                   ("nicks", self.mcc.expire_nicks(expiry["nick_expiry"],
+                                                   expiry["max_nicks"], keep)),
+                   ("partial messages", sum([mc.expire_partial_messages(
+                       expiry["partial_message_expiry"])
+                                             for mc in self.mcc.mchannels]))]
+        if any([n > 0 for _, n in expired]):
+            log.msg("Expired: " + ", ".join(
+                ["{} {}".format(n, name) for name, n in expired]))
+
+    def get_memory_report(self):
+        """Returns, for each structure holding state about
+        counterparties, the number of entries and their approximate
+        size in bytes.
+        """
+        ob = self.shared_mc if self.shared_mc else self
+        report = {}
+        def add(name, count, obj):
+            report[name] = {"count": count, "bytes": get_approx_size(obj)}
+        if self.mcc:
+            add("nicks_seen", sum([len(x) for x in
+                                   self.mcc.nicks_seen.values()]),
+                self.mcc.nicks_seen)
+            add("nick_last_seen", len(self.mcc.nick_last_seen),
+                self.mcc.nick_last_seen)
+            add("active_channels", len(self.mcc.active_channels),
+                self.mcc.active_channels)
+            partial = [mc.get_partial_messages() for mc in self.mcc.mchannels]
+            add("partial_messages", sum([len(x) for x in partial]), partial)
+        with ob.dblock:
+            rows = ob.db.execute('SELECT * FROM orderbook;').fetchall()
+        add("orderbook", len(rows), rows)
+        add("offer_cache", len(ob.offer_cache), ob.offer_cache)
+        add("active_orders", len(self.active_orders), self.active_orders)
+        add("crypto_boxes", len(self.crypto_boxes), self.crypto_boxes)
+        return report
+
+    def connectionLost(self, reason):
+        if self.sweep_loop and self.sweep_loop.running:
+            self.sweep_loop.stop()
+        if self.shared_mc:
+            self.mc_shutdown()
+        else:
+            self.stop_orderbook_cache()
+        amp.AMP.connectionLost(self, reason)
+
     def mc_shutdown(self):
+        if self.shared_mc:
+            #the connections are closed when the last client detaches
+            self.shared_mc.detach(self)
+            self.shared_mc = None
+            return
         log.msg("Message channels being shutdown by daemon")
         if self.mcc:
+            self.stop_orderbook_cache()
             self.mcc.shutdown()
 
 
 class JMDaemonServerProtocolFactory(ServerFactory):
     protocol = JMDaemonServerProtocol
 
+    def __init__(self, orderbook_cache=None, orderbook_cache_max_age=3600,
+                 orderbook_cache_interval=30, shared=False, expiry=None):
+        """If orderbook_cache is set, it is the name of the file
+        in which offers seen by the daemon are persisted between runs,
+        so that a restarted taker knows which counterparties to expect.
+        If shared is True, all clients with the same message channel
+        configuration share one orderbook, parsed from the public
+        messages on one client's channels, and one connection to each
+        hub, carrying all their nicks; each client still has its own
+        connection to each IRC server (which carries a single nick).
+        See shared_mc.py.
+        expiry overrides any of the limits in DEFAULT_EXPIRY.
+        """
+        self.orderbook_cache = orderbook_cache
+        self.orderbook_cache_max_age = orderbook_cache_max_age
+        self.orderbook_cache_interval = orderbook_cache_interval
+        self.shared = shared
+        self.shared_mcs = []
+        self.expiry = copy.copy(DEFAULT_EXPIRY)
+        if expiry:
+            self.expiry.update(expiry)
+
+    def get_shared_mc(self, irc_configs, bcsource):
+        """Returns the SharedMessageChannels object for this
+        message channel configuration, creating it if necessary.
+        """
+        self.shared_mcs = [x for x in self.shared_mcs if not x.closed]
+        for smc in self.shared_mcs:
+            if smc.irc_configs == irc_configs:
+                return smc
+        smc = SharedMessageChannels(irc_configs, bcsource)
+        if self.orderbook_cache:
+            smc.start_orderbook_cache(self.orderbook_cache,
+                                      self.orderbook_cache_max_age,
+                                      self.orderbook_cache_interval)
+        self.shared_mcs.append(smc)
+        return smc
+
     def buildProtocol(self, addr):
         return JMDaemonServerProtocol(self)
 
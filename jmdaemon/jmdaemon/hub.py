@@ -0,0 +1,475 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import * # noqa: F401
+"""A message channel over a joinmarket hub: a minimal relay server
+(see JMHubServerFactory and scripts/joinmarket-hub.py) reached over TCP
+or a unix socket, for private or test deployments where the throttling
+and message size limits of IRC servers are not wanted.
+
+Frames are json lists preceded by a 4 byte length (Int32StringReceiver):
+client to hub:
+  ["nick", nick, channel]  register (or change) the connection's nick
+  ["join", nick, channel]  register one more nick on the connection
+  ["part", nick]           unregister one of the connection's nicks
+  ["pubmsg", message, from_nick]
+                           to all other nicks in the channel
+  ["privmsg", nick, message, from_nick]
+hub to client:
+  ["welcome", hostid, topic, nick]
+  ["nickinuse", nick]
+  ["pubmsg", from_nick, message]
+  ["privmsg", from_nick, message, to_nick]
+  ["leave", nick]
+from_nick may be left out by a connection with a single nick. A public
+message is sent once to each connection with another nick in the
+channel, however many nicks it carries; so a joinmarketd serving many
+clients (see shared_mc.py) shares one connection (see HubConnection),
+and receives the pit once, rather than once per client.
+Messages are not chunked; the joinmarket protocol (commands, signatures,
+encryption) is unchanged, so hub and IRC channels can be used together
+in one MessageChannelCollection.
+"""
+
+import json
+
+from twisted.internet import reactor, protocol
+from twisted.protocols.basic import Int32StringReceiver
+from jmdaemon.message_channel import MessageChannel
+from jmdaemon.irc import IRCMessageChannel, get_config_irc_channel
+from jmbase.support import get_log
+from jmdaemon.protocol import *
+
+log = get_log()
+
+#maximum frame size, in bytes, accepted by client and hub
+MAX_FRAME_LEN = 2**20
+
+
+def send_frame(proto, *args):
+    proto.sendString(json.dumps(list(args)).encode('utf-8'))
+
+
+def read_frame(data):
+    """Returns the decoded frame as a list with a
+    string command first, or None if invalid.
+    """
+    try:
+        frame = json.loads(data.decode('utf-8'))
+    except (UnicodeDecodeError, ValueError):
+        return None
+    if not isinstance(frame, list) or len(frame) == 0 or \
+       not isinstance(frame[0], str):
+        return None
+    return frame
+
+
+def get_message_channel(configdata, daemon=None, realname='realname',
+                        hub_connection=None):
+    """Returns the message channel for one messaging configuration
+    section, as returned by jmclient.get_irc_mchannels: a hub if
+    its type is 'hub' (over hub_connection, if given), else IRC.
+    """
+    if configdata.get("type") == "hub":
+        return HubMessageChannel(configdata, daemon=daemon,
+                                 hub_connection=hub_connection)
+    return IRCMessageChannel(configdata, daemon=daemon, realname=realname)
+
+
+def get_hub_address(configdata):
+    """Returns (socket, serverport, hostid) for a hub configuration
+    section; socket is None for a hub reached over TCP.
+    """
+    socket = configdata.get("socket")
+    if socket:
+        return socket, socket, socket
+    return (None, (configdata['host'], int(configdata['port'])),
+            configdata['host'] + str(configdata['port']))
+
+
+def connect_to_hub(wrapper):
+    """Connects wrapper (a HubMessageChannel or HubConnection) to
+    its hub, reconnecting until wrapper.give_up is set.
+    """
+    wrapper.give_up = False
+    wrapper.factory = HubClientFactory(wrapper)
+    if wrapper.socket:
+        reactor.connectUNIX(wrapper.socket, wrapper.factory)
+    else:
+        reactor.connectTCP(wrapper.serverport[0], wrapper.serverport[1],
+                           wrapper.factory)
+
+
+class HubClientFactory(protocol.ReconnectingClientFactory):
+    maxDelay = 60
+
+    def __init__(self, wrapper):
+        self.wrapper = wrapper
+
+    def buildProtocol(self, addr):
+        p = HubClientProtocol(self.wrapper)
+        p.factory = self
+        self.resetDelay()
+        return p
+
+    def clientConnectionLost(self, connector, reason):
+        log.debug('Hub connection lost: ' + str(reason))
+        if not self.wrapper.give_up and reactor.running:
+            log.info('Attempting to reconnect...')
+            protocol.ReconnectingClientFactory.clientConnectionLost(
+                self, connector, reason)
+
+    def clientConnectionFailed(self, connector, reason):
+        log.info('Hub connection failed')
+        if not self.wrapper.give_up and reactor.running:
+            log.info('Attempting to reconnect...')
+            protocol.ReconnectingClientFactory.clientConnectionFailed(
+                self, connector, reason)
+
+
+class HubClientProtocol(Int32StringReceiver):
+    MAX_LENGTH = MAX_FRAME_LEN
+
+    def __init__(self, wrapper):
+        self.wrapper = wrapper
+
+    def connectionMade(self):
+        self.wrapper.on_hub_connected(self)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.wrapper.on_hub_disconnected(self)
+
+    def stringReceived(self, data):
+        frame = read_frame(data)
+        if frame is None:
+            log.debug("Invalid frame from hub, ignoring")
+            return
+        try:
+            self.wrapper.on_frame(frame[0], frame[1:])
+        except IndexError:
+            log.debug("Malformed frame from hub: " + str(frame))
+
+
+class HubMessageChannel(MessageChannel):
+
+    def __init__(self,
+                 configdata,
+                 username='username',
+                 realname='realname',
+                 password=None,
+                 daemon=None,
+                 hub_connection=None):
+        """If hub_connection (a HubConnection) is given, the nick
+        is registered on it, rather than on a connection of its own.
+        """
+        MessageChannel.__init__(self, daemon=daemon)
+        self.give_up = True
+        self.socket, self.serverport, self.hostid = get_hub_address(
+            configdata)
+        self.channel = get_config_irc_channel(configdata["channel"],
+                                              configdata["btcnet"])
+        self.hub_client = None
+        self.hub_connection = hub_connection
+        self.nick = None
+
+    def run(self):
+        if self.hub_connection:
+            self.hub_connection.attach(self)
+        else:
+            connect_to_hub(self)
+
+    def shutdown(self):
+        if self.hub_connection:
+            self.hub_connection.detach(self)
+            return
+        self.give_up = True
+        if self.hub_client:
+            self.hub_client.transport.loseConnection()
+
+    def set_nick(self, nick):
+        old_nick = self.nick
+        MessageChannel.set_nick(self, nick)
+        if self.hub_connection and nick != old_nick:
+            self.hub_connection.change_nick(self, old_nick)
+
+    def register_nick(self):
+        if self.hub_connection:
+            self.hub_connection.join(self)
+        else:
+            self.send("nick", self.nick, self.channel)
+
+    def send(self, *args):
+        if self.hub_connection:
+            self.hub_connection.send_from(self, *args)
+            return
+        if not self.hub_client:
+            log.info("Not connected to hub, dropping message to: " +
+                     str(self.serverport))
+            return
+        send_frame(self.hub_client, *args)
+
+    def _pubmsg(self, msg):
+        self.send("pubmsg", msg)
+
+    def _privmsg(self, nick, cmd, message):
+        self.send("privmsg", nick, COMMAND_PREFIX + cmd + ' ' + message)
+
+    def change_nick(self, new_nick):
+        if self.hub_connection:
+            self.set_nick(new_nick)
+        else:
+            self.send("nick", new_nick, self.channel)
+
+    def _announce_orders(self, offerlist):
+        #no line length limit, so all in one message
+        self._pubmsg(''.join(offerlist))
+
+    def on_hub_connected(self, proto):
+        self.hub_client = proto
+        self.register_nick()
+
+    def on_hub_disconnected(self, proto):
+        if self.hub_client == proto:
+            self.hub_client = None
+        if self.on_disconnect:
+            reactor.callLater(0.0, self.on_disconnect, self)
+
+    def on_frame(self, cmd, args):
+        """Handles a frame from the hub (for our nick).
+        """
+        if cmd == "pubmsg":
+            self.on_pubmsg(args[0], args[1])
+        elif cmd == "privmsg":
+            self.on_privmsg(args[0], args[1])
+        elif cmd == "leave":
+            if self.on_nick_leave:
+                self.on_nick_leave(args[0], self)
+        elif cmd == "welcome":
+            self.hostid = args[0]
+            if args[1] and self.on_set_topic:
+                self.on_set_topic(args[1])
+            if self.on_welcome:
+                self.on_welcome(self)
+        elif cmd == "nickinuse":
+            log.warn("Your nickname is in use on the hub; retrying "
+                     "in 10 seconds.")
+            reactor.callLater(10.0, self.register_nick)
+
+
+class HubConnection(object):
+    """One connection to a hub carrying the nicks of several
+    HubMessageChannels (those of the clients of a shared joinmarketd,
+    see shared_mc.py). Frames for a nick (welcome, nickinuse, private
+    messages) go to its channel; public messages, received once, and
+    leaves, to all the channels but the sender's.
+    """
+
+    def __init__(self, configdata):
+        self.give_up = True
+        self.socket, self.serverport, self.hostid = get_hub_address(
+            configdata)
+        self.channel = get_config_irc_channel(configdata["channel"],
+                                              configdata["btcnet"])
+        self.hub_client = None
+        #the HubMessageChannels using the connection
+        self.channels = []
+
+    def attach(self, mc):
+        """Registers mc's nick (now, or once set) on the connection,
+        connecting first if needed.
+        """
+        if mc not in self.channels:
+            self.channels.append(mc)
+        if self.give_up:
+            connect_to_hub(self)
+        else:
+            self.join(mc)
+
+    def detach(self, mc):
+        """Unregisters mc's nick; the connection is closed with
+        the last one.
+        """
+        if mc not in self.channels:
+            return
+        self.channels.remove(mc)
+        if mc.nick:
+            self.send("part", mc.nick)
+        if len(self.channels) == 0:
+            self.shutdown()
+
+    def shutdown(self):
+        self.give_up = True
+        if self.hub_client:
+            self.hub_client.transport.loseConnection()
+
+    def join(self, mc):
+        if mc.nick and mc in self.channels:
+            self.send("join", mc.nick, self.channel)
+
+    def change_nick(self, mc, old_nick):
+        if mc not in self.channels:
+            return
+        if old_nick:
+            self.send("part", old_nick)
+        self.join(mc)
+
+    def get_channel(self, nick):
+        for mc in self.channels:
+            if mc.nick == nick:
+                return mc
+        return None
+
+    def send(self, *args):
+        if not self.hub_client:
+            log.info("Not connected to hub, dropping message to: " +
+                     str(self.serverport))
+            return
+        send_frame(self.hub_client, *args)
+
+    def send_from(self, mc, *args):
+        """Sends a pubmsg or privmsg frame from mc's nick.
+        """
+        self.send(*(args + (mc.nick,)))
+
+    def on_hub_connected(self, proto):
+        self.hub_client = proto
+        for mc in self.channels:
+            self.join(mc)
+
+    def on_hub_disconnected(self, proto):
+        if self.hub_client == proto:
+            self.hub_client = None
+        for mc in self.channels:
+            if mc.on_disconnect:
+                reactor.callLater(0.0, mc.on_disconnect, mc)
+
+    def on_frame(self, cmd, args):
+        if cmd in ("pubmsg", "leave"):
+            for mc in list(self.channels):
+                if mc.nick != args[0]:
+                    mc.on_frame(cmd, args)
+        elif cmd in ("privmsg", "welcome", "nickinuse"):
+            #the nick the frame is for comes last
+            mc = self.get_channel(args[-1])
+            if mc:
+                mc.on_frame(cmd, args)
+
+
+class JMHubServerProtocol(Int32StringReceiver):
+    MAX_LENGTH = MAX_FRAME_LEN
+
+    def __init__(self, factory):
+        self.factory = factory
+        #channel, by nick registered on this connection
+        self.nicks = {}
+
+    def stringReceived(self, data):
+        frame = read_frame(data)
+        if frame is None:
+            self.transport.loseConnection()
+            return
+        cmd, args = frame[0], frame[1:]
+        try:
+            if cmd == "nick":
+                self.factory.register(self, args[0], args[1])
+            elif cmd == "join":
+                self.factory.register(self, args[0], args[1], replace=False)
+            elif cmd == "part":
+                self.factory.unregister(self, args[0])
+            elif cmd == "pubmsg":
+                self.factory.pubmsg(self, args[0], self.get_sender(args[1:]))
+            elif cmd == "privmsg":
+                self.factory.privmsg(self, args[0], args[1],
+                                     self.get_sender(args[2:]))
+        except IndexError:
+            self.transport.loseConnection()
+
+    def get_sender(self, args):
+        """The nick a message is sent from: given last in its frame,
+        or, if not, the connection's only nick (or None).
+        """
+        if args:
+            return args[0] if args[0] in self.nicks else None
+        if len(self.nicks) == 1:
+            return list(self.nicks.keys())[0]
+        return None
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        for nick in list(self.nicks.keys()):
+            self.factory.unregister(self, nick)
+
+
+class JMHubServerFactory(protocol.ServerFactory):
+    """A relay for joinmarket message channels: nicks join
+    a channel, public messages go to all other nicks in it,
+    private messages to the named nick only.
+    hostid identifies the hub for message signatures (as the IRC
+    network name does); topic is sent to clients on joining.
+    """
+
+    def __init__(self, hostid="joinmarket-hub", topic=None):
+        self.hostid = hostid
+        self.topic = topic
+        #nick: protocol, by channel name
+        self.channels = {}
+
+    def buildProtocol(self, addr):
+        return JMHubServerProtocol(self)
+
+    def register(self, proto, nick, channel, replace=True):
+        """Registers nick in channel on the connection proto; if
+        replace, instead of the connection's other nicks.
+        """
+        if not nick or " " in nick:
+            proto.transport.loseConnection()
+            return
+        members = self.channels.setdefault(channel, {})
+        if nick in members and members[nick] != proto:
+            send_frame(proto, "nickinuse", nick)
+            return
+        for n in list(proto.nicks.keys()):
+            if (replace and n != nick) or (n == nick and
+                                           proto.nicks[n] != channel):
+                self.unregister(proto, n)
+        proto.nicks[nick] = channel
+        members[nick] = proto
+        send_frame(proto, "welcome", self.hostid, self.topic, nick)
+
+    def unregister(self, proto, nick):
+        channel = proto.nicks.pop(nick, None)
+        if channel is None:
+            return
+        members = self.channels[channel]
+        if members.get(nick) == proto:
+            del members[nick]
+            for p in self.get_connections(channel, nick):
+                send_frame(p, "leave", nick)
+
+    def get_connections(self, channel, nick):
+        """The connections with a nick other than nick in channel,
+        each once.
+        """
+        return set([p for n, p in self.channels[channel].items()
+                    if n != nick])
+
+    def pubmsg(self, proto, message, nick):
+        if nick is None:
+            return
+        for p in self.get_connections(proto.nicks[nick], nick):
+            send_frame(p, "pubmsg", nick, message)
+
+    def privmsg(self, proto, to_nick, message, nick):
+        if nick is None:
+            return
+        p = self.channels[proto.nicks[nick]].get(to_nick)
+        if p:
+            send_frame(p, "privmsg", nick, message, to_nick)
+
+
+def start_hub(port=None, socket=None, hostid="joinmarket-hub", topic=None,
+              interface="localhost"):
+    """Serve a hub on TCP port, or on unix socket path socket.
+    """
+    factory = JMHubServerFactory(hostid, topic)
+    if socket:
+        return reactor.listenUNIX(socket, factory)
+    return reactor.listenTCP(port, factory, interface=interface)
@@ -3,6 +3,7 @@ from __future__ import (absolute_import, division,
 from builtins import *
 
 #TODO: SSL support (can it be done without back-end openssl?)
+import time
 from twisted.internet import reactor, protocol
 from twisted.internet.endpoints import TCP4ClientEndpoint
 from twisted.application.internet import ClientService
@@ -10,12 +11,22 @@ from twisted.internet.ssl import ClientContextFactory
 from twisted.words.protocols import irc
 from jmdaemon.message_channel import MessageChannel
 from jmbase.support import get_log, chunks
+from jmbase import metrics
 from txtorcon.socks import TorSocksEndpoint
 from jmdaemon.protocol import *
 MAX_PRIVMSG_LEN = 450
+#limits on the multi-line privmsgs being assembled (see handle_privmsg):
+#how many (from different nicks), and the length of each
+MAX_PARTIAL_MESSAGES = 1000
+MAX_PARTIAL_LEN = 2**20
 
 log = get_log()
 
+SEND_QUEUE_LINES = metrics.gauge(
+    'jm_irc_send_queue_lines',
+    'Lines waiting to be sent to the IRC server (see lineRate)',
+    labelnames=('host',))
+
 def wlog(*x):
     """Simplifier to add lists to the debug log
     """
@@ -128,6 +139,16 @@ class IRCMessageChannel(MessageChannel):
         self.tx_irc_client._announce_orders(offerlist)
     #end ABC impl.
 
+    def expire_partial_messages(self, max_age):
+        if not self.tx_irc_client:
+            return 0
+        return self.tx_irc_client.expire_partial_messages(max_age)
+
+    def get_partial_messages(self):
+        if not self.tx_irc_client:
+            return {}
+        return self.tx_irc_client.built_privmsg
+
     def set_tx_irc_client(self, txircclt):
         self.tx_irc_client = txircclt
 
@@ -197,9 +218,14 @@ class txIRC_Client(irc.IRCClient, object):
         pass
 
     def connectionMade(self):
+        #(the hostid may be changed by the server)
+        self.metrics_host = self.wrapper.hostid
+        SEND_QUEUE_LINES.set_function(lambda: len(self._queue),
+                                      host=self.metrics_host)
         return irc.IRCClient.connectionMade(self)
 
     def connectionLost(self, reason=protocol.connectionDone):
+        SEND_QUEUE_LINES.remove(host=self.metrics_host)
         if self.wrapper.on_disconnect:
             reactor.callLater(0.0, self.wrapper.on_disconnect, self.wrapper)
         return irc.IRCClient.connectionLost(self, reason)
@@ -289,10 +315,18 @@ class txIRC_Client(irc.IRCClient, object):
                         return
     
                     # new message starting
+                    if len(self.built_privmsg) >= MAX_PARTIAL_MESSAGES:
+                        # make room by dropping only the oldest one
+                        self.expire_partial_messages(float('inf'), 1)
                     cmd_string = message[1:].split(' ')[0]
-                    self.built_privmsg[nick] = [cmd_string, message[:-2]]
+                    self.built_privmsg[nick] = [cmd_string, message[:-2],
+                                                time.time()]
                 else:
                     self.built_privmsg[nick][1] += message[:-2]
+                    if len(self.built_privmsg[nick][1]) > MAX_PARTIAL_LEN:
+                        wlog('message too long, dropping, from: ', nick)
+                        del self.built_privmsg[nick]
+                        return
                 if message[-1] == ';':
                     pass
                 elif message[-1] == '~':
@@ -310,6 +344,19 @@ class txIRC_Client(irc.IRCClient, object):
         except:
             wlog('unable to parse privmsg, msg: ', message)
 
+    def expire_partial_messages(self, max_age, min_count=0):
+        """Drop the incomplete messages started more than max_age
+        seconds ago; if fewer than min_count, also drop the oldest
+        others until min_count have been dropped.
+        """
+        by_age = sorted(self.built_privmsg.items(), key=lambda x: x[1][2])
+        oldest = time.time() - max_age
+        expired = [nick for i, (nick, m) in enumerate(by_age)
+                   if m[2] < oldest or i < min_count]
+        for nick in expired:
+            del self.built_privmsg[nick]
+        return len(expired)
+
     def action(self, user, channel, msg):
         pass
         #wlog('unhandled action: ', user, channel, msg)
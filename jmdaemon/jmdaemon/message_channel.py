@@ -7,6 +7,7 @@ import abc
 import base64
 import binascii
 import threading
+import time
 from jmdaemon import encrypt_encode, decode_decrypt, COMMAND_PREFIX,\
     NICK_HASH_LENGTH, NICK_MAX_ENCODED, plaintext_commands,\
     encrypted_commands, commitment_broadcast_list, offername_list
@@ -61,31 +62,14 @@ class MessageChannelCollection(object):
         @wraps(func)
         def func_wrapper(inst, *args, **kwargs):
             cp = args[0]
-            if cp in inst.active_channels:
+            if inst.find_channel(cp) is not None:
                 return func(inst, *args, **kwargs)
-            else:
-                for mc in inst.available_channels():
-                    #nicks_seen[mc] guaranteed to exist
-                    #from constructor
-                    if cp in inst.nicks_seen[mc]:
-                        log.debug("Dynamic switch nick: " + cp)
-                        inst.active_channels[cp] = mc
-                        #early return on first success;
-                        #means that we assume that if we have
-                        #ever seen a message from this counterparty
-                        #on one messagechannel which is currently active,
-                        #we assume it's still
-                        #available. Of course, this is optimistic,
-                        #but still much better to do this than to
-                        #immediately give up when any one connection
-                        #is broken.
-                        return func(inst, *args, **kwargs)
-                #Failure to send is a critical error for a transaction,
-                #but should not kill the bot. So, we don't raise an
-                #exception, but rather allow sending to continue, which
-                #should usually result in tx completion just timing out.
-                log.warn("Couldn't find a route to send privmsg")
-                log.warn("For counterparty: " + str(cp))
+            #Failure to send is a critical error for a transaction,
+            #but should not kill the bot. So, we don't raise an
+            #exception, but rather allow sending to continue, which
+            #should usually result in tx completion just timing out.
+            log.warn("Couldn't find a route to send privmsg")
+            log.warn("For counterparty: " + str(cp))
 
         return func_wrapper
 
@@ -100,6 +84,8 @@ class MessageChannelCollection(object):
         #To keep track of counterparties having at least once
         #made their presence known on a channel
         self.nicks_seen = {}
+        #time each nick was last seen (on any channel), for expiry
+        self.nick_last_seen = {}
         for mc in self.mchannels:
             self.nicks_seen[mc] = set()
             #callback to mark nicks as seen when they privmsg
@@ -113,6 +99,31 @@ class MessageChannelCollection(object):
         self.mc_lock = threading.Lock()
         self.nick=None
 
+    def find_channel(self, cp):
+        """Returns the message channel on which to privmsg
+        counterparty cp (setting it as active for cp), or None
+        if there is no route to cp.
+        """
+        if cp in self.active_channels:
+            return self.active_channels[cp]
+        for mc in self.available_channels():
+            #nicks_seen[mc] guaranteed to exist
+            #from constructor
+            if cp in self.nicks_seen[mc]:
+                log.debug("Dynamic switch nick: " + cp)
+                self.active_channels[cp] = mc
+                #return on first success;
+                #means that we assume that if we have
+                #ever seen a message from this counterparty
+                #on one messagechannel which is currently active,
+                #we assume it's still
+                #available. Of course, this is optimistic,
+                #but still much better to do this than to
+                #immediately give up when any one connection
+                #is broken.
+                return mc
+        return None
+
     def set_nick(self, nick):
         if nick != self.nick:
             self.nick = nick
@@ -166,11 +177,34 @@ class MessageChannelCollection(object):
     def see_nick(self, nick, mc):
         with self.mc_lock:
             self.nicks_seen[mc].add(nick)
+            self.nick_last_seen[nick] = time.time()
 
     def unsee_nick(self, nick, mc):
         with self.mc_lock:
             self.nicks_seen[mc] = self.nicks_seen[mc].difference(set([nick]))
 
+    def expire_nicks(self, max_age, max_nicks, keep=()):
+        """Forget the nicks not seen for max_age seconds, and the
+        least recently seen ones beyond a total of max_nicks, except
+        those in keep (counterparties in a transaction in progress).
+        Returns the number of nicks forgotten.
+        """
+        with self.mc_lock:
+            by_age = sorted(self.nick_last_seen.items(), key=lambda x: x[1])
+            oldest = time.time() - max_age
+            excess = len(by_age) - max_nicks
+            expired = set()
+            for i, (nick, last_seen) in enumerate(by_age):
+                if nick not in keep and (last_seen < oldest or i < excess):
+                    expired.add(nick)
+            for nick in expired:
+                del self.nick_last_seen[nick]
+            for mc in self.mchannels:
+                self.nicks_seen[mc] = self.nicks_seen[mc].difference(expired)
+            self.active_channels = dict([(k, v) for k, v in iteritems(
+                self.active_channels) if k not in expired])
+        return len(expired)
+
     def run(self, failures=None):
         for mc in self.mchannels:
             mc.run()
@@ -525,6 +559,7 @@ class MessageChannelCollection(object):
         #message channel where it has published an order (priv or pub),
         #so that we can hope to contact it at any one of those mcs.
         self.nicks_seen[mc].add(counterparty)
+        self.nick_last_seen[counterparty] = time.time()
 
         self.active_channels[counterparty] = mc
         if self.on_order_seen:
@@ -629,6 +664,13 @@ class MessageChannel(object):
         self.on_seen_auth = None
         self.on_seen_tx = None
         self.on_push_tx = None
+        #public messages are parsed unless another connection
+        #does it for us (see shared_mc.py); they still mark
+        #the sending nick as seen.
+        self.parse_pubmsgs = True
+        #if set, called with (our nick, message) for each public
+        #message we send (see shared_mc.py)
+        self.on_own_pubmsg = None
 
         self.daemon = None
 
@@ -677,6 +719,19 @@ class MessageChannel(object):
 
     """END OF SUBCLASS IMPLEMENTATION SECTION"""
 
+    def expire_partial_messages(self, max_age):
+        """Implementations which assemble messages from several parts
+        must drop those left incomplete for max_age seconds, returning
+        the number dropped.
+        """
+        return 0
+
+    def get_partial_messages(self):
+        """The incomplete messages held by the implementation, if any,
+        as a dict (for memory usage reporting).
+        """
+        return {}
+
     def set_nick(self, nick):
         self.given_nick = nick
         self.nick = self.given_nick
@@ -735,6 +790,8 @@ class MessageChannel(object):
 
     def announce_orders(self, orderlines):
         self._announce_orders(orderlines)
+        if self.on_own_pubmsg:
+            self.on_own_pubmsg(self.nick, ''.join(orderlines))
 
     def check_for_orders(self, nick, _chunks):
         if _chunks[0] in offername_list:
@@ -814,6 +871,8 @@ class MessageChannel(object):
         #Currently there is no joinmarket protocol logic here;
         #just pass-through.
         self._pubmsg(message)
+        if self.on_own_pubmsg:
+            self.on_own_pubmsg(self.nick, message)
 
     def privmsg(self, nick, cmd, message):
         log.debug('>>privmsg on %s: ' % (self.hostid) + 'nick=' + nick + ' cmd='
@@ -825,7 +884,7 @@ class MessageChannel(object):
         #Even illegal messages mark a nick as "seen"
         if self.on_pubmsg_trigger:
             self.on_pubmsg_trigger(nick, self)
-        if message[0] != COMMAND_PREFIX:
+        if not self.parse_pubmsgs or message[0] != COMMAND_PREFIX:
             return
         commands = message[1:].split(COMMAND_PREFIX)
         #DOS vector: repeated !orderbook requests, see #298.
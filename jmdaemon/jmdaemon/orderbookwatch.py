@@ -3,13 +3,18 @@ from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 from builtins import * # noqa: F401
 
+import json
+import os
 import sqlite3
 import sys
 import threading
+import time
 from decimal import InvalidOperation, Decimal
 from numbers import Integral
 
-from jmdaemon.protocol import JM_VERSION
+from twisted.internet import reactor, task
+
+from jmdaemon.protocol import JM_VERSION, ORDER_KEYS
 from jmbase.support import get_log, joinmarket_alert, DUST_THRESHOLD
 log = get_log()
 
@@ -21,6 +26,17 @@ def dict_factory(cursor, row):
     return d
 
 
+def get_orderbook_delta(old, new):
+    """Given two orderbooks as dicts keyed by (counterparty, oid),
+    returns (updated, removed): the list of offers in new which are
+    absent or different in old, and the list of [counterparty, oid]
+    keys in old which are absent in new.
+    """
+    updated = [o for k, o in new.items() if old.get(k) != o]
+    removed = [list(k) for k in old if k not in new]
+    return updated, removed
+
+
 class JMTakerError(Exception):
     pass
 
@@ -34,7 +50,11 @@ class OrderbookWatch(object):
         self.msgchan.register_channel_callbacks(
             self.on_welcome, self.on_set_topic, None, self.on_disconnect,
             self.on_nick_leave, None)
+        self.init_orderbook()
 
+    def init_orderbook(self):
+        """Create the (empty) orderbook table and offer cache.
+        """
         self.dblock = threading.Lock()
         con = sqlite3.connect(":memory:", check_same_thread=False)
         con.row_factory = dict_factory
@@ -46,6 +66,109 @@ class OrderbookWatch(object):
                             "maxsize INTEGER, txfee INTEGER, cjfee TEXT);")
         finally:
             self.dblock.release()
+        #Offers seen in this or previous sessions, keyed by
+        #(counterparty, oid), with the time they were last seen; this is
+        #independent of the orderbook table, which only holds offers
+        #announced (and therefore routable) in the current session.
+        self.offer_cache = {}
+        self.offer_cache_changed = False
+        self.cached_counterparties = set()
+
+    def load_orderbook_cache(self, fname, max_age):
+        """Read the offers persisted by a previous session from
+        the json file fname, dropping those not seen for max_age
+        seconds. Note that these offers are *not* inserted into the
+        orderbook table, since they cannot be filled until the
+        counterparty re-announces them; they only record which
+        counterparties can be expected to do so.
+        """
+        if not os.path.isfile(fname):
+            return
+        try:
+            with open(fname, "rb") as f:
+                cached = json.loads(f.read().decode('utf-8'))
+        except (IOError, ValueError) as e:
+            log.debug("Failed to read orderbook cache, ignoring: " + repr(e))
+            return
+        oldest = time.time() - max_age
+        for o in cached:
+            try:
+                if o['last_seen'] < oldest:
+                    continue
+                key = (o['counterparty'], int(o['oid']))
+            except (KeyError, TypeError, ValueError):
+                continue
+            if key not in self.offer_cache:
+                self.offer_cache[key] = o
+        self.cached_counterparties = set(
+            k[0] for k in self.offer_cache.keys())
+        log.debug("Loaded {} cached offers from {} counterparties".format(
+            len(self.offer_cache), len(self.cached_counterparties)))
+
+    def save_orderbook_cache(self, fname):
+        """Persist the offer cache to the json file fname, if it
+        has changed since the last save.
+        """
+        if not self.offer_cache_changed:
+            return
+        tmpname = fname + ".tmp"
+        with open(tmpname, "wb") as f:
+            f.write(json.dumps(list(self.offer_cache.values())).encode('utf-8'))
+        #atomic on POSIX; a half-written cache is never read back
+        if os.path.exists(fname) and os.name == 'nt': #pragma: no cover
+            os.remove(fname)
+        os.rename(tmpname, fname)
+        self.offer_cache_changed = False
+
+    def start_orderbook_cache(self, fname, max_age, interval):
+        """Load the offers seen in previous sessions from fname,
+        and persist the (incrementally updated) cache every interval
+        seconds and on shutdown.
+        """
+        self.stop_orderbook_cache()
+        self.orderbook_cache_file = fname
+        self.load_orderbook_cache(fname, max_age)
+        self.orderbook_cache_loop = task.LoopingCall(
+            self.save_orderbook_cache, fname)
+        self.orderbook_cache_loop.start(interval, now=False)
+        #only one trigger per running cache; it is removed again in
+        #stop_orderbook_cache, so it does not keep this object alive
+        self.orderbook_cache_trigger = reactor.addSystemEventTrigger(
+            "before", "shutdown", self.save_orderbook_cache, fname)
+
+    def stop_orderbook_cache(self):
+        """Stop persisting the offer cache started with
+        start_orderbook_cache, saving it one last time. Does nothing
+        if no cache is running.
+        """
+        loop = getattr(self, "orderbook_cache_loop", None)
+        if loop and loop.running:
+            loop.stop()
+        self.orderbook_cache_loop = None
+        trigger = getattr(self, "orderbook_cache_trigger", None)
+        if trigger is not None:
+            reactor.removeSystemEventTrigger(trigger)
+            self.orderbook_cache_trigger = None
+            self.save_orderbook_cache(self.orderbook_cache_file)
+
+    def expire_offers(self, max_age):
+        """Drop the offers not (re-)announced for max_age seconds
+        from the orderbook and the offer cache, e.g. from makers whose
+        departure we missed. Returns the number dropped.
+        """
+        oldest = time.time() - max_age
+        expired = [k for k, o in self.offer_cache.items()
+                   if o['last_seen'] < oldest]
+        with self.dblock:
+            for counterparty, oid in expired:
+                self.db.execute(
+                    ("DELETE FROM orderbook WHERE counterparty=? "
+                     "AND oid=?;"), (counterparty, oid))
+        for k in expired:
+            del self.offer_cache[k]
+        if len(expired) > 0:
+            self.offer_cache_changed = True
+        return len(expired)
 
     @staticmethod
     def on_set_topic(newtopic):
@@ -120,6 +243,11 @@ class OrderbookWatch(object):
                 'INSERT INTO orderbook VALUES(?, ?, ?, ?, ?, ?, ?);',
                 (counterparty, oid, ordertype, minsize, maxsize, txfee,
                  str(Decimal(cjfee))))  # any parseable Decimal is a valid cjfee
+            cached = dict(zip(ORDER_KEYS, (counterparty, int(oid), ordertype,
+                int(minsize), int(maxsize), int(txfee), str(Decimal(cjfee)))))
+            cached['last_seen'] = time.time()
+            self.offer_cache[(counterparty, int(oid))] = cached
+            self.offer_cache_changed = True
         except InvalidOperation:
             log.debug("Got invalid cjfee: " + cjfee + " from " + counterparty)
         except Exception as e:
@@ -134,6 +262,10 @@ class OrderbookWatch(object):
             self.db.execute(
                 ("DELETE FROM orderbook WHERE "
                  "counterparty=? AND oid=?;"), (counterparty, oid))
+            #an explicit cancel means the offer is gone for good; a
+            #counterparty leaving or our disconnection does not.
+            if self.offer_cache.pop((counterparty, int(oid)), None):
+                self.offer_cache_changed = True
         finally:
             self.dblock.release()
 
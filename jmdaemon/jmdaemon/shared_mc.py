@@ -0,0 +1,193 @@
+#! /usr/bin/env python
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import * # noqa: F401
+"""Support for a joinmarketd serving many clients (e.g. a fleet of
+makers with different wallets, and takers) with shared message channel
+connections and a single parsed orderbook.
+
+Each client (session) keeps its own nick, its own encryption boxes,
+and its messages signed by its own client. How its nick reaches a
+server depends on the kind of server:
+* a hub (see hub.py) carries any number of nicks on a connection: all
+  the sessions' nicks share one connection per hub (a HubConnection),
+  on which private messages are routed to the session by nick, and
+  the pit is received once;
+* an IRC connection carries a single nick, so each session has its own
+  connection to each IRC server (N clients use N connections, as they
+  would without sharing).
+In either case the parsing of the pit is shared: the public messages
+are parsed into one orderbook by one session's channels only (the
+reader, by default the first client to attach), which also passes
+orderbook requests and commitment broadcasts on to the maker sessions.
+The other sessions' channels only note which nicks are present from
+public messages.
+"""
+
+from .message_channel import MessageChannelCollection
+from .orderbookwatch import OrderbookWatch
+from .hub import HubConnection, get_message_channel
+from twisted.python import log
+
+
+class SessionMessageChannelCollection(MessageChannelCollection):
+    """The message channel connections of one daemon protocol
+    instance (session) attached to a SharedMessageChannels instance,
+    under the session's own nick. Public messages are only parsed
+    if the session is the reader (see SharedMessageChannels.set_reader).
+    """
+
+    def __init__(self, mchannels, shared):
+        for mc in mchannels:
+            mc.parse_pubmsgs = False
+        MessageChannelCollection.__init__(self, mchannels)
+        self.shared = shared
+
+    def own_channel(self, mc):
+        """Our available channel to the server of mc (a channel
+        of the reader's connections), or None.
+        """
+        if mc is None:
+            return None
+        for x in self.available_channels():
+            if x.hostid == mc.hostid:
+                return x
+        return None
+
+    def announce_orders(self, orderlist, nick=None, new_mc=None):
+        #orderbook requests are seen on the reader's connections
+        if new_mc is not None and new_mc not in self.mchannels:
+            new_mc = self.own_channel(new_mc)
+        MessageChannelCollection.announce_orders(self, orderlist, nick,
+                                                 new_mc)
+
+
+class SharedMessageChannels(OrderbookWatch):
+    """Owns the orderbook, and the hub connections, for all the daemon
+    protocol instances (sessions) attached to it; each session gets its
+    own message channel collection, which takes offers it receives
+    privately into the shared orderbook, and, for the reader session,
+    the offers announced in public.
+    """
+
+    def __init__(self, irc_configs, bcsource):
+        self.irc_configs = irc_configs
+        self.bcsource = bcsource
+        #the connection to each hub, shared by the sessions' channels;
+        #None for IRC servers
+        self.hub_connections = [HubConnection(c) if c.get("type") == "hub"
+                                else None for c in irc_configs]
+        #attached sessions, in order of attachment
+        self.sessions = []
+        #the session whose connections parse the public messages
+        self.reader = None
+        self.closed = False
+        self.init_orderbook()
+
+    """Session management
+    """
+
+    def attach(self, session):
+        """Attach a daemon protocol instance; it shares the
+        orderbook, and gets its own message channel collection
+        (over the shared hub connections), which is returned.
+        """
+        mcs = [get_message_channel(c,
+                                   daemon=session,
+                                   realname='btcint=' + self.bcsource,
+                                   hub_connection=hc)
+               for c, hc in zip(self.irc_configs, self.hub_connections)]
+        mcc = SessionMessageChannelCollection(mcs, self)
+        mcc.register_orderbookwatch_callbacks(self.on_order_seen,
+                                              self.on_order_cancel)
+        mcc.register_channel_callbacks(
+            session.on_welcome, self.on_set_topic, None,
+            lambda: self.on_session_disconnect(session),
+            lambda nick: self.on_session_nick_leave(session, nick), None)
+        mcc.register_taker_callbacks(session.on_error, session.on_pubkey,
+                                     session.on_ioauth, session.on_sig)
+        #orderbook requests and commitment broadcasts are public, so
+        #only come from the reader's connections
+        mcc.register_maker_callbacks(self.on_orderbook_requested,
+                                     session.on_order_fill,
+                                     session.on_seen_auth,
+                                     session.on_seen_tx,
+                                     session.on_push_tx,
+                                     self.on_commitment_seen,
+                                     session.on_commitment_transferred)
+        mcc.set_daemon(session)
+        self.sessions.append(session)
+        session.db = self.db
+        session.dblock = self.dblock
+        session.cached_counterparties = self.cached_counterparties
+        if self.reader is None:
+            self.set_reader(session, mcc)
+        log.msg("Client attached to shared orderbook, now serving: "
+                + str(len(self.sessions)))
+        return mcc
+
+    def detach(self, session):
+        """Detach a daemon protocol instance (on shutdown or
+        disconnection of its client), closing its connections, and
+        unregistering its nick from the hub connections (which are
+        closed with the last session). If it was the reader, the next
+        session takes over.
+        """
+        if session not in self.sessions:
+            return
+        self.sessions.remove(session)
+        if session.mcc:
+            session.mcc.shutdown()
+            #(including the channels which are not up)
+            for mc, hc in zip(session.mcc.mchannels, self.hub_connections):
+                if hc:
+                    hc.detach(mc)
+        log.msg("Client detached from shared orderbook, now serving: "
+                + str(len(self.sessions)))
+        if session is self.reader:
+            self.reader = None
+            if len(self.sessions) > 0:
+                self.set_reader(self.sessions[0], self.sessions[0].mcc)
+        if len(self.sessions) == 0:
+            self.stop_orderbook_cache()
+            self.closed = True
+
+    def set_reader(self, session, mcc):
+        """Make session's connections (mcc) the ones on which
+        public messages are parsed. Since a server does not echo
+        a nick's own public messages, the reader's are parsed as
+        they are sent, as the other sessions' are when received.
+        """
+        self.reader = session
+        for mc in mcc.mchannels:
+            mc.parse_pubmsgs = True
+            mc.on_own_pubmsg = mc.on_pubmsg
+        log.msg("Public messages now read by the connections of: " +
+                str(mcc.nick))
+
+    def get_maker_sessions(self):
+        return [s for s in self.sessions
+                if s.role == "MAKER" and hasattr(s, "offerlist")]
+
+    """Callbacks from the message channels
+    """
+
+    def on_session_disconnect(self, session):
+        if session is self.reader:
+            self.on_disconnect()
+
+    def on_session_nick_leave(self, session, nick):
+        if session is self.reader:
+            self.on_nick_leave(nick)
+
+    def on_orderbook_requested(self, nick, mc=None):
+        #(the request may be from one of our own takers)
+        for s in self.get_maker_sessions():
+            if s.mcc.nick != nick:
+                s.on_orderbook_requested(nick, mc)
+
+    def on_commitment_seen(self, nick, commitment):
+        #the blacklist is common to all makers
+        sessions = self.get_maker_sessions()
+        if len(sessions) > 0:
+            sessions[0].on_commitment_seen(nick, commitment)
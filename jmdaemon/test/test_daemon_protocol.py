@@ -7,7 +7,8 @@ from future.utils import iteritems
 
 from jmdaemon import MessageChannelCollection
 from jmdaemon.orderbookwatch import OrderbookWatch
-from jmdaemon.daemon_protocol import JMDaemonServerProtocol
+from jmdaemon.daemon_protocol import (JMDaemonServerProtocol,
+                                      JMDaemonServerProtocolFactory)
 from jmdaemon.protocol import NICK_HASH_LENGTH, NICK_MAX_ENCODED, JM_VERSION,\
     JOINMARKET_NICK_HEADER
 from jmbase import get_log
@@ -15,7 +16,6 @@ from jmclient import (load_program_config, jm_single, get_irc_mchannels)
 from twisted.python.log import msg as tmsg
 from twisted.python.log import startLogging
 from twisted.internet import protocol, reactor, task
-from twisted.internet.protocol import ServerFactory
 from twisted.internet.error import (ConnectionLost, ConnectionAborted,
                                     ConnectionClosed, ConnectionDone)
 from twisted.protocols.amp import UnknownRemoteError
@@ -114,7 +114,7 @@ class JMTestClientProtocol(JMBaseProtocol):
         self.defaultCallbacks(d)
 
     @JMOffers.responder
-    def on_JM_OFFERS(self, orderbook):
+    def on_JM_OFFERS(self, orderbook, cached_counterparties, version):
         if end_early:
             return {'accepted': True}
         jlog.debug("JMOFFERS" + str(orderbook))
@@ -208,13 +208,14 @@ class JMDaemonTestServerProtocol(JMDaemonServerProtocol):
         self.on_error("dummy error")
 
     @JMRequestOffers.responder
-    def on_JM_REQUEST_OFFERS(self):
+    def on_JM_REQUEST_OFFERS(self, version):
         for o in t_orderbook:
             #counterparty, oid, ordertype, minsize, maxsize,txfee, cjfee):
             self.on_order_seen(o["counterparty"], o["oid"], o["ordertype"],
                                  o["minsize"], o["maxsize"],
                                  o["txfee"], o["cjfee"])
-        return super(JMDaemonTestServerProtocol, self).on_JM_REQUEST_OFFERS()
+        return super(JMDaemonTestServerProtocol, self).on_JM_REQUEST_OFFERS(
+            version)
         
     @JMInit.responder
     def on_JM_INIT(self, bcsource, network, irc_configs, minmakers,
@@ -273,7 +274,7 @@ class JMDaemonTestServerProtocol(JMDaemonServerProtocol):
 
 
 
-class JMDaemonTestServerProtocolFactory(ServerFactory):
+class JMDaemonTestServerProtocolFactory(JMDaemonServerProtocolFactory):
     protocol = JMDaemonTestServerProtocol
     
     def buildProtocol(self, addr):
@@ -285,7 +286,7 @@ class JMDaemonTest2ServerProtocol(JMDaemonServerProtocol):
     def init_connections(self, nick):
         self.mc_shutdown()
 
-class JMDaemonTest2ServerProtocolFactory(ServerFactory):
+class JMDaemonTest2ServerProtocolFactory(JMDaemonServerProtocolFactory):
     protocol = JMDaemonTest2ServerProtocol
     def buildProtocol(self, addr):
         return JMDaemonTest2ServerProtocol(self)
@@ -0,0 +1,145 @@
+#! /usr/bin/env python
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import * # noqa: F401
+'''test the joinmarket hub message channel with many simulated bots.'''
+
+from jmdaemon import HubMessageChannel, start_hub, COMMAND_PREFIX
+from jmdaemon.hub import HubConnection
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+
+NUM_BOTS = 100
+
+
+def get_config(port):
+    return {"host": "localhost", "port": port, "channel": "joinmarket-pit",
+            "btcnet": "testnet"}
+
+
+def announce(bot):
+    bot.mc.announce_orders([COMMAND_PREFIX + "swreloffer " + str(oid) +
+                            " 27300 100000000 1000 0.0002"
+                            for oid in range(2)])
+
+
+class SimBot(object):
+    """Records what a bot's HubMessageChannel passes up."""
+    def __init__(self, port, i, hub_connection=None):
+        self.nick = "J5bot" + str(i)
+        self.welcomed = defer.Deferred()
+        self.orders_seen = set()
+        self.privmsgs = []
+        self.left = []
+        self.mc = HubMessageChannel(get_config(port),
+                                    hub_connection=hub_connection)
+        self.mc.set_nick(self.nick)
+        self.mc.on_welcome = lambda mc: self.welcomed.callback(None)
+        self.mc.on_order_seen = self.on_order_seen
+        self.mc.on_nick_leave = lambda nick, mc: self.left.append(nick)
+        #privmsgs are normally signature checked by the daemon first
+        self.mc.on_privmsg = lambda nick, msg: self.privmsgs.append(
+            (nick, msg))
+
+    def on_order_seen(self, mc, counterparty, oid, ordertype, minsize,
+                      maxsize, txfee, cjfee):
+        self.orders_seen.add((counterparty, int(oid)))
+
+
+class HubTests(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = start_hub(port=0, hostid="testhub")
+        port = self.listener.getHost().port
+        self.bots = [SimBot(port, i) for i in range(NUM_BOTS)]
+        for b in self.bots:
+            b.mc.run()
+        return defer.gatherResults([b.welcomed for b in self.bots])
+
+    def tearDown(self):
+        for b in self.bots:
+            b.mc.shutdown()
+        return self.listener.stopListening()
+
+    @defer.inlineCallbacks
+    def test_hub_messaging(self):
+        assert all([b.mc.hostid == "testhub" for b in self.bots])
+        #every bot announces two offers in one (unchunked) pubmsg
+        for b in self.bots:
+            announce(b)
+        #a private message much larger than an IRC line
+        big = "x" * 100000
+        self.bots[0].mc.privmsg(self.bots[1].nick, "tx", big)
+        yield task.deferLater(reactor, 1.0, lambda: None)
+        for b in self.bots:
+            assert len(b.orders_seen) == 2 * (NUM_BOTS - 1)
+            assert (b.nick, 0) not in b.orders_seen
+        assert self.bots[1].privmsgs == [(self.bots[0].nick,
+                                          COMMAND_PREFIX + "tx " + big)]
+        assert all([len(b.privmsgs) == 0 for b in self.bots[2:]])
+        #leaving is seen by the others
+        self.bots[-1].mc.shutdown()
+        yield task.deferLater(reactor, 0.5, lambda: None)
+        assert self.bots[0].left == [self.bots[-1].nick]
+
+
+class SharedConnectionTests(unittest.TestCase):
+    """Several nicks over one HubConnection, as for the clients
+    of a shared joinmarketd, and a bot with its own connection.
+    """
+
+    def setUp(self):
+        self.listener = start_hub(port=0, hostid="testhub")
+        port = self.listener.getHost().port
+        self.connection = HubConnection(get_config(port))
+        self.shared = [SimBot(port, i, self.connection) for i in range(3)]
+        self.other = SimBot(port, 3)
+        for b in self.shared + [self.other]:
+            b.mc.run()
+        return defer.gatherResults([b.welcomed for b in
+                                    self.shared + [self.other]])
+
+    def tearDown(self):
+        for b in self.shared + [self.other]:
+            b.mc.shutdown()
+        return self.listener.stopListening()
+
+    def get_members(self):
+        return self.listener.factory.channels[self.connection.channel]
+
+    @defer.inlineCallbacks
+    def test_shared_connection(self):
+        #four nicks, over two connections
+        assert len(self.get_members()) == 4
+        assert len(set(self.get_members().values())) == 2
+        assert all([b.mc.hostid == "testhub" for b in self.shared])
+        #public messages reach all the other nicks, on either connection
+        announce(self.other)
+        announce(self.shared[0])
+        #private messages are routed by nick
+        self.other.mc.privmsg(self.shared[1].nick, "tx", "x")
+        self.shared[2].mc.privmsg(self.shared[0].nick, "tx", "y")
+        yield task.deferLater(reactor, 0.5, lambda: None)
+        assert self.other.orders_seen == set([(self.shared[0].nick, 0),
+                                              (self.shared[0].nick, 1)])
+        assert self.shared[0].orders_seen == set([(self.other.nick, 0),
+                                                  (self.other.nick, 1)])
+        for b in self.shared[1:]:
+            assert len(b.orders_seen) == 4
+        assert self.shared[1].privmsgs == [(self.other.nick,
+                                            COMMAND_PREFIX + "tx x")]
+        assert self.shared[0].privmsgs == [(self.shared[2].nick,
+                                            COMMAND_PREFIX + "tx y")]
+        assert self.shared[2].privmsgs == [] and self.other.privmsgs == []
+        #a nick leaving the shared connection is seen by all the others
+        self.shared[2].mc.shutdown()
+        yield task.deferLater(reactor, 0.5, lambda: None)
+        for b in self.shared[:2] + [self.other]:
+            assert b.left == [self.shared[2].nick]
+        assert len(self.get_members()) == 3
+        #the connection is closed with its last nick
+        for b in self.shared[:2]:
+            b.mc.shutdown()
+        yield task.deferLater(reactor, 0.5, lambda: None)
+        assert list(self.get_members().keys()) == [self.other.nick]
+        assert self.connection.hub_client is None
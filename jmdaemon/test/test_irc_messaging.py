@@ -8,6 +8,7 @@ import time
 from twisted.trial import unittest
 from twisted.internet import reactor, task
 from jmdaemon import IRCMessageChannel, MessageChannelCollection
+from jmdaemon.irc import txIRC_Client, MAX_PARTIAL_MESSAGES
 #needed for test framework
 from jmclient import (load_program_config, get_irc_mchannels, jm_single)
 
@@ -135,6 +136,20 @@ class TrialIRC(unittest.TestCase):
         pass
 
 
-
-
-
+class DummyIRCWrapper(object):
+    channel = "#joinmarket-pit"
+    nick = "irc_receiver"
+    password = None
+    serverport = ("localhost", 6667)
+
+def test_partial_messages_cap():
+    client = txIRC_Client(DummyIRCWrapper())
+    for i in range(MAX_PARTIAL_MESSAGES):
+        client.built_privmsg["nick" + str(i)] = ["fill", "!fill 0", i]
+    client.handle_privmsg("newnick!user@host", "irc_receiver",
+                          "!fill 0 ;")
+    # only the oldest in-progress message makes way for the new one
+    assert len(client.built_privmsg) == MAX_PARTIAL_MESSAGES
+    assert "nick0" not in client.built_privmsg
+    assert "nick1" in client.built_privmsg
+    assert "newnick" in client.built_privmsg
@@ -353,3 +353,23 @@ def test_mc_run(failuretype, mcindex, wait):
     fi = FIThread(mcc)
     fi.start()
     time.sleep(wait+0.5)
+
+def test_expire_nicks():
+    dmcs = [DummyMessageChannel(None, hostid="hostid"+str(x)) for x in range(2)]
+    mcc = MessageChannelCollection(dmcs)
+    for i in range(5):
+        mcc.see_nick("nick" + str(i), dmcs[i % 2])
+        mcc.active_channels["nick" + str(i)] = dmcs[i % 2]
+    mcc.nick_last_seen["nick0"] -= 1000
+    mcc.nick_last_seen["nick1"] -= 1000
+    #nick1 is too old but kept, as it is in a transaction
+    assert mcc.expire_nicks(100, 10, keep=["nick1"]) == 1
+    assert "nick0" not in mcc.nicks_seen[dmcs[0]]
+    assert "nick0" not in mcc.active_channels
+    assert "nick1" in mcc.nicks_seen[dmcs[1]]
+    #cap on number of nicks removes the least recently seen
+    mcc.nick_last_seen["nick4"] -= 10
+    assert mcc.expire_nicks(100, 2) == 2
+    assert sorted(mcc.nick_last_seen.keys()) == ["nick2", "nick3"]
+    assert mcc.nicks_seen[dmcs[0]] == set(["nick2"])
+    assert mcc.nicks_seen[dmcs[1]] == set(["nick3"])
@@ -5,7 +5,9 @@ from builtins import * # noqa: F401
 
 import pytest
 
-from jmdaemon.orderbookwatch import OrderbookWatch
+import json
+
+from jmdaemon.orderbookwatch import OrderbookWatch, get_orderbook_delta
 from jmdaemon import IRCMessageChannel
 from jmclient import get_irc_mchannels, load_program_config
 from jmdaemon.protocol import JM_VERSION, ORDER_KEYS
@@ -129,3 +131,90 @@ def test_disconnect_leave():
     
 
     
+
+def test_orderbook_cache(tmpdir):
+    fname = str(tmpdir.join("orderbookcache.json"))
+    ob = get_ob()
+    #nothing to load yet
+    ob.load_orderbook_cache(fname, 3600)
+    assert len(ob.cached_counterparties) == 0
+    ob.on_order_seen("J5one", "0", "swreloffer", "3000", "4000", "2", "0.3")
+    ob.on_order_seen("J5two", "0", "swabsoffer", "3000", "4000", "2", "300")
+    ob.on_order_seen("J5two", "1", "swreloffer", "3000", "4000", "2", "0.3")
+    ob.on_order_cancel("J5two", 1)
+    #leaving or disconnecting does not remove offers from the cache
+    ob.on_nick_leave("J5one")
+    ob.save_orderbook_cache(fname)
+    ob2 = get_ob()
+    ob2.load_orderbook_cache(fname, 3600)
+    assert ob2.cached_counterparties == set(["J5one", "J5two"])
+    assert sorted(ob2.offer_cache.keys()) == [("J5one", 0), ("J5two", 0)]
+    #cached offers are not fillable until re-announced
+    rows = ob2.db.execute('SELECT * FROM orderbook;').fetchall()
+    assert len(rows) == 0
+    #too old
+    ob3 = get_ob()
+    ob3.load_orderbook_cache(fname, -1)
+    assert len(ob3.offer_cache) == 0
+
+def test_orderbook_cache_restart(tmpdir):
+    from twisted.internet import reactor
+    fname = str(tmpdir.join("orderbookcache.json"))
+    ob = get_ob()
+    triggers = len(reactor._eventTriggers['shutdown'].before)
+    #restarting (e.g. on a new JM_INIT) must not pile up triggers
+    ob.start_orderbook_cache(fname, 3600, 30)
+    ob.start_orderbook_cache(fname, 3600, 30)
+    assert len(reactor._eventTriggers['shutdown'].before) == triggers + 1
+    ob.on_order_seen("J5one", "0", "swreloffer", "3000", "4000", "2", "0.3")
+    ob.stop_orderbook_cache()
+    assert ob.orderbook_cache_loop is None
+    assert len(reactor._eventTriggers['shutdown'].before) == triggers
+    #saved on stop
+    ob2 = get_ob()
+    ob2.load_orderbook_cache(fname, 3600)
+    assert ob2.cached_counterparties == set(["J5one"])
+    #stopping again is harmless
+    ob.stop_orderbook_cache()
+
+def test_orderbook_delta():
+    def make_offer(i, cjfee="0.0002"):
+        return {'counterparty': 'J5cp' + str(i // 2), 'oid': i % 2,
+                'ordertype': 'swreloffer', 'minsize': 27300,
+                'maxsize': 599972700, 'txfee': 1000, 'cjfee': cjfee}
+    def keyed(offers):
+        return dict([((o['counterparty'], o['oid']), o) for o in offers])
+    old = keyed([make_offer(i) for i in range(2000)])
+    #10 offers cancelled, 10 re-announced with a new fee, 10 new ones
+    new_offers = [make_offer(i) for i in range(10, 2010)]
+    new_offers[:10] = [make_offer(i, "0.0003") for i in range(10, 20)]
+    new = keyed(new_offers)
+    updated, removed = get_orderbook_delta(old, new)
+    assert len(updated) == 20
+    assert sorted(map(tuple, removed)) == sorted(
+        [(o['counterparty'], o['oid']) for o in
+         [make_offer(i) for i in range(10)]])
+    #applying the delta to a copy of the old book gives the new one
+    mirror = dict(old)
+    for o in json.loads(json.dumps(updated)):
+        mirror[(o['counterparty'], o['oid'])] = o
+    for cp, oid in json.loads(json.dumps(removed)):
+        del mirror[(cp, oid)]
+    assert mirror == new
+    #a small fraction of the full orderbook is sent
+    assert len(json.dumps([updated, removed])) * 50 < len(
+        json.dumps(list(new.values())))
+    assert get_orderbook_delta(new, new) == ([], [])
+
+def test_expire_offers():
+    ob = get_ob()
+    ob.on_order_seen("J5one", "0", "swreloffer", "3000", "4000", "2", "0.3")
+    ob.on_order_seen("J5two", "0", "swabsoffer", "3000", "4000", "2", "300")
+    ob.offer_cache[("J5one", 0)]['last_seen'] -= 1000
+    ob.offer_cache_changed = False
+    assert ob.expire_offers(100) == 1
+    rows = ob.db.execute('SELECT * FROM orderbook;').fetchall()
+    assert [r['counterparty'] for r in rows] == ["J5two"]
+    assert list(ob.offer_cache.keys()) == [("J5two", 0)]
+    assert ob.offer_cache_changed
+    assert ob.expire_offers(100) == 0
@@ -0,0 +1,157 @@
+#! /usr/bin/env python
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import * # noqa: F401
+'''test sharing of the orderbook between daemon clients.'''
+
+from jmdaemon import shared_mc
+from jmdaemon.shared_mc import SharedMessageChannels
+from jmclient import get_irc_mchannels, load_program_config
+from dummy_mc import DummyMessageChannel
+
+
+class DummySession(object):
+    """Stands in for a JMDaemonServerProtocol; records the
+    callbacks made to it.
+    """
+    def __init__(self, role="TAKER"):
+        self.role = role
+        self.jm_state = 0
+        self.active_orders = {}
+        self.calls = []
+        self.mcc = None
+
+    def __getattr__(self, name):
+        if not name.startswith("on_") and not name.startswith("request_"):
+            raise AttributeError(name)
+        def record(*args):
+            self.calls.append((name,) + args)
+        return record
+
+
+def get_shared(monkeypatch):
+    load_program_config()
+    monkeypatch.setattr(shared_mc, "get_message_channel",
+        lambda c, daemon=None, realname=None, hub_connection=None:
+        DummyMessageChannel(c, daemon=daemon,
+                            hostid=c['host'] + str(c['port'])))
+    return SharedMessageChannels(get_irc_mchannels(), "regtest")
+
+
+def welcome(mcc):
+    for mc in mcc.mchannels:
+        mcc.on_welcome_trigger(mc)
+
+
+def rows(smc):
+    return smc.db.execute('SELECT * FROM orderbook;').fetchall()
+
+
+def test_shared_sessions(monkeypatch):
+    smc = get_shared(monkeypatch)
+    taker, maker1, maker2 = (DummySession(), DummySession("MAKER"),
+                             DummySession("MAKER"))
+    for i, s in enumerate((taker, maker1, maker2)):
+        s.mcc = smc.attach(s)
+        s.mcc.set_nick("J5nick" + str(i))
+    #each session has its own nick and connections, for its own daemon,
+    #and no others are opened
+    assert maker1.mcc.mchannels[0] not in maker2.mcc.mchannels
+    assert maker1.mcc.mchannels[0].daemon is maker1
+    assert taker.mcc.mchannels[0].nick == "J5nick0"
+    assert not hasattr(smc, "mcc")
+    #the first session to attach reads the pit for all
+    assert smc.reader is taker
+    pit = taker.mcc.mchannels[0]
+    assert pit.parse_pubmsgs
+    assert not maker1.mcc.mchannels[0].parse_pubmsgs
+    #JMUp as soon as the session's own connections are up
+    for s in (taker, maker1, maker2):
+        welcome(s.mcc)
+        assert s.calls == [("on_welcome",)]
+    #one orderbook for all, read on the reader's connections only
+    assert maker1.db is smc.db and taker.db is smc.db
+    maker1.mcc.mchannels[0].on_pubmsg(
+        "J5maker", "!swreloffer 0 27300 10000000 0 0.0002")
+    assert len(rows(smc)) == 0
+    pit.on_pubmsg("J5maker", "!swreloffer 0 27300 10000000 0 0.0002")
+    assert len(rows(smc)) == 1
+    #but the nick is known to be present
+    assert "J5maker" in maker1.mcc.nicks_seen[maker1.mcc.mchannels[0]]
+    #the reader's own public messages are not echoed by the server, so
+    #they are parsed as they are sent: the orderbook request of our own
+    #taker is passed on to the maker sessions
+    maker1.offerlist = [{'oid': 0, 'ordertype': 'swreloffer',
+                         'minsize': 27300, 'maxsize': 10000000, 'txfee': 0,
+                         'cjfee': '0.0002'}]
+    taker.mcc.request_orderbook()
+    #(once for each of the reader's channels)
+    assert ("on_orderbook_requested", "J5nick0", pit) in maker1.calls
+    assert len(maker2.calls) == 1 and len(taker.calls) == 1
+    #the server also relays the request to the makers' own connections,
+    #where the taker's nick is seen
+    for mc in maker1.mcc.mchannels:
+        mc.on_pubmsg("J5nick0", "!orderbook")
+    #which answer over their own connection, signed by their own client
+    maker1.mcc.announce_orders(maker1.offerlist, "J5nick0", pit)
+    assert maker1.calls[-1][0] == "request_signed_message"
+    assert maker1.calls[-1][1:3] == ("J5nick0", "swreloffer")
+    #when the reader leaves, the next session takes over
+    shut = []
+    pit.shutdown = lambda: shut.append("taker")
+    smc.detach(taker)
+    assert shut == ["taker"] and not smc.closed
+    assert smc.reader is maker1
+    assert maker1.mcc.mchannels[0].parse_pubmsgs
+    maker1.mcc.mchannels[0].on_pubmsg("J5maker", "!cancel 0")
+    assert len(rows(smc)) == 0
+    #including for the offers it announces itself
+    maker1.mcc.announce_orders(maker1.offerlist)
+    assert [r['counterparty'] for r in rows(smc)] == ["J5nick1"]
+    smc.detach(maker1)
+    smc.detach(maker2)
+    assert smc.reader is None and smc.closed
+
+
+def test_shared_hub_connection():
+    smc = SharedMessageChannels([{"type": "hub", "host": "localhost",
+                                  "port": 27184, "channel": "joinmarket-pit",
+                                  "btcnet": "testnet"}], "regtest")
+    hc = smc.hub_connections[0]
+    #as if connected
+    sent = []
+    hc.send = lambda *args: sent.append(args)
+    hc.give_up = False
+    sessions = [DummySession("MAKER") for i in range(3)]
+    for i, s in enumerate(sessions):
+        s.mcc = smc.attach(s)
+        s.mcc.run()
+        s.mcc.set_nick("J5nick" + str(i))
+    #the nicks of all the sessions are registered on one connection
+    mcs = [s.mcc.mchannels[0] for s in sessions]
+    assert hc.channels == mcs
+    assert all([mc.hub_connection is hc for mc in mcs])
+    assert sent == [("join", "J5nick" + str(i), hc.channel)
+                    for i in range(3)]
+    #the pit, received once, is passed to each session's channel,
+    #and parsed by the reader's only
+    hc.on_frame("pubmsg", ["J5maker", "!swreloffer 0 27300 10000000 0 0.0002"])
+    assert len(rows(smc)) == 1
+    assert all(["J5maker" in s.mcc.nicks_seen[s.mcc.mchannels[0]]
+                for s in sessions])
+    #but a session's public messages are not passed back to it
+    hc.on_frame("pubmsg", ["J5nick1", "!cancel 0"])
+    assert "J5nick1" in sessions[0].mcc.nicks_seen[mcs[0]]
+    assert "J5nick1" not in sessions[1].mcc.nicks_seen[mcs[1]]
+    #a session sends from its own nick
+    sent[:] = []
+    mcs[2].pubmsg("!orderbook")
+    assert sent == [("pubmsg", "!orderbook", "J5nick2")]
+    #detaching unregisters the nick; the last closes the connection
+    smc.detach(sessions[1])
+    assert hc.channels == [mcs[0], mcs[2]]
+    assert sent[-1] == ("part", "J5nick1")
+    assert not hc.give_up
+    smc.detach(sessions[0])
+    smc.detach(sessions[2])
+    assert hc.channels == [] and hc.give_up and smc.closed
@@ -0,0 +1,35 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import * # noqa: F401
+import sys
+from twisted.internet import reactor
+from twisted.python.log import startLogging
+import jmdaemon
+
+def startup_hub(port=None, socket=None, hostid="joinmarket-hub", topic=None):
+    """Start a joinmarket hub, a message relay for private
+    or test deployments (see jmdaemon/hub.py), serving either
+    on a local TCP port or on a unix socket.
+    Args:
+    port : TCP port on localhost to serve on
+    socket : path of the unix socket to serve on, instead of port
+    hostid : identifier of the hub used in message signatures
+    topic : sent to bots joining, as for an IRC channel topic
+    """
+    startLogging(sys.stdout)
+    jmdaemon.start_hub(port=port, socket=socket, hostid=hostid, topic=topic)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    port = 27184
+    socket = None
+    if len(sys.argv) > 1:
+        try:
+            port = int(sys.argv[1])
+        except ValueError:
+            socket = sys.argv[1]
+    hostid = "joinmarket-hub"
+    if len(sys.argv) > 2:
+        hostid = sys.argv[2]
+    startup_hub(port=port, socket=socket, hostid=hostid)
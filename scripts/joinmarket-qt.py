@@ -1408,8 +1408,8 @@ class JMMainWindow(QMainWindow):
         if iselectrum:
             jm_single().bc_interface.synctype = "with-script"
 
-        jm_single().bc_interface.sync_wallet(self.wallet, fast=fast,
-                                             restart_cb=restart_cb)
+        bci = jm_single().bc_interface
+        bci.sync_wallet(self.wallet, fast=fast, restart_cb=restart_cb)
 
         if iselectrum:
             #sync_wallet only initialises, we must manually call its entry
@@ -1417,9 +1417,37 @@ class JMMainWindow(QMainWindow):
             jm_single().bc_interface.sync_addresses(self.wallet)
             self.wait_for_sync_loop = task.LoopingCall(self.updateWalletInfo)
             self.wait_for_sync_loop.start(0.2)
+        elif not bci.wallet_synced:
+            #addresses were imported, and a rescan may have been started
+            #(in a thread); sync again once it has finished
+            d, bci.rescan_deferred = bci.rescan_deferred, None
+            if d is None:
+                reactor.callLater(0, self.syncWalletUpdate, fast, restart_cb)
+            else:
+                self.statusBar().showMessage("Rescanning blockchain ...")
+                d.addErrback(self.rescanFailed)
+                d.addCallback(self.rescanFinished, fast, restart_cb)
         else:
             self.updateWalletInfo()
 
+    def rescanFailed(self, failure):
+        log.warn("Rescan failed: " + failure.getErrorMessage())
+        return False
+
+    def rescanFinished(self, rescanned, fast, restart_cb=None):
+        if rescanned:
+            self.syncWalletUpdate(fast, restart_cb)
+            return
+        restart_msg = ("Unable to rescan the blockchain: restart Bitcoin "
+                       "Core with -rescan, then restart this application.")
+        if restart_cb:
+            restart_cb(restart_msg)
+        else:
+            JMQtMessageBox(self, restart_msg, mbtype='warn',
+                           title="Error")
+            self.statusBar().showMessage(
+                "Unable to sync wallet - see error in console.")
+
     def updateWalletInfo(self):
         if jm_single().config.get("BLOCKCHAIN",
                             "blockchain_source") == "electrum-server":
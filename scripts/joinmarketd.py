@@ -5,16 +5,35 @@ import sys
 from twisted.internet import reactor
 from twisted.python.log import startLogging
 import jmdaemon
+from jmbase import metrics, profiling
 
-def startup_joinmarketd(host, port, usessl, finalizer=None, finalizer_args=None):
+def startup_joinmarketd(host, port, usessl, finalizer=None, finalizer_args=None,
+                        orderbook_cache=None, shared=False, metrics_port=None,
+                        control_socket=None):
     """Start event loop for joinmarket daemon here.
     Args:
     port : port over which to serve the daemon
     finalizer: a function which is called after the reactor has shut down.
     finalizer_args : arguments to finalizer function.
+    orderbook_cache : file in which to persist seen offers between runs.
+    shared : if True, clients share one parsed orderbook, and one
+    connection to each hub, carrying all their nicks; each client still
+    has its own connection to each IRC server.
+    metrics_port : if set, local port on which to serve the daemon's
+    metrics in Prometheus text format.
+    control_socket : if set, unix socket path on which to accept
+    profiling commands (see jmbase/profiling.py); SIGUSR2 toggles
+    profiling in any case. Profiles are written to the current directory.
     """
     startLogging(sys.stdout)
-    factory = jmdaemon.JMDaemonServerProtocolFactory()
+    if metrics_port:
+        metrics.start_metrics_server(metrics_port)
+    profiling_control = profiling.ProfilingControl()
+    profiling.install_profiling_signal(profiling_control)
+    if control_socket:
+        profiling.start_profiling_control(profiling_control, control_socket)
+    factory = jmdaemon.JMDaemonServerProtocolFactory(
+        orderbook_cache=orderbook_cache, shared=shared)
     jmdaemon.start_daemon(host, port, factory, usessl,
                           './ssl/key.pem', './ssl/cert.pem')
     if finalizer:
@@ -36,4 +55,19 @@ if __name__ == "__main__":
         host = sys.argv[3]
     else:
         host = 'localhost'
-    startup_joinmarketd(host, port, usessl)
+    orderbook_cache = None
+    if len(sys.argv) > 4 and sys.argv[4] != "":
+        orderbook_cache = sys.argv[4]
+    shared = False
+    if len(sys.argv) > 5:
+        if int(sys.argv[5]) != 0:
+            shared = True
+    metrics_port = None
+    if len(sys.argv) > 6 and int(sys.argv[6]) != 0:
+        metrics_port = int(sys.argv[6])
+    control_socket = None
+    if len(sys.argv) > 7 and sys.argv[7] != "":
+        control_socket = sys.argv[7]
+    startup_joinmarketd(host, port, usessl, orderbook_cache=orderbook_cache,
+                        shared=shared, metrics_port=metrics_port,
+                        control_socket=control_socket)
@@ -0,0 +1,448 @@
+#! /usr/bin/env python
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import * # noqa: F401
+'''Benchmarks full coinjoin rounds: a Taker and several
+YieldGeneratorBasic makers, each a client of one in-process
+JMDaemonServerProtocol instance, over an in-memory message channel
+(built on jmdaemon/test/dummy_mc.py) and the simulated blockchain
+interface; no IRC servers, bitcoind or network access are needed.
+Every round uses fresh wallets; each maker contributes the same number
+of inputs. The wall clock and process CPU time of each phase of the
+round are recorded, and their percentiles reported per configuration.
+This is NOT part of the test-suite. Run it like:
+   PYTHONPATH=.:$PYTHONPATH python test/bench_coinjoin.py \
+   --makers=2,5,10,20 --inputs=1,10,50 --rounds=5 --output=bench.json
+   '''
+
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from twisted.internet import defer, reactor, task
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'jmdaemon', 'test'))
+from dummy_mc import DummyMessageChannel
+
+import jmbitcoin as btc
+from jmbase import get_log, set_logging_level
+from jmclient import (load_program_config, jm_single, YieldGeneratorBasic,
+                      Taker, JMClientProtocolFactory, SegwitLegacyWallet,
+                      VolatileStorage, get_network)
+from jmclient.client_protocol import JMTakerClientProtocol
+from jmclient.configure import defaultconfig
+from jmdaemon import JMDaemonServerProtocolFactory, COMMAND_PREFIX
+from jmdaemon import daemon_protocol
+from jmdaemon.daemon_protocol import JMDaemonServerProtocol
+
+log = get_log()
+
+#value of each maker input, in satoshis; makers are asked for
+#half an input less than they hold, so that they must use all of them
+UTXO_VALUE = 10**6
+#txfee, cjfee_a, cjfee_r, ordertype, minsize
+OFFER_CONFIG = [0, 200, 0, 'swabsoffer', 100000]
+#seconds after the push at which the simulated chain mines a block
+BLOCK_INTERVAL = 0.01
+#seconds to wait for the makers' offers
+SETUP_TIMEOUT = 60
+
+#the ends of the phases of a round, in order; the round starts when
+#the taker connects to the daemon
+PHASES = [
+    #daemon setup, orderbook request and collection
+    ('orderbook', 'Taker.initialize called'),
+    #order choice and commitment (PoDLE) generation
+    ('initialize', 'Taker.initialize returned'),
+    #!fill, !pubkey, !auth and !ioauth, including the makers' checks
+    ('stage1', 'JMDaemonServerProtocol.respondToIoauths called'),
+    #taker checks of the makers' utxos and transaction construction
+    ('tx_build', 'JMTakerClientProtocol.make_tx called'),
+    #!tx, maker signing, !sig and taker signature verification
+    ('signing', 'Taker.push called'),
+    #broadcast, until the taker sees it on the network
+    ('broadcast', 'Taker.unconfirm_callback called'),
+    #until the taker sees it confirmed
+    ('confirmation', 'Taker.confirm_callback called'),
+]
+
+try:
+    process_time = time.process_time
+except AttributeError:
+    #Python 2; clock is CPU time on Unix
+    process_time = time.clock
+
+
+class InMemoryMessageChannel(DummyMessageChannel):
+    """A message channel on which all instances created with the
+    same bus (a dict) and host id can talk to each other: public
+    messages go to all the others, private messages to the named
+    nick, all delivered on the next reactor iteration (as if from
+    a server).
+    """
+
+    def __init__(self, bus, configdata, daemon=None):
+        hostid = configdata['host'] + str(configdata['port'])
+        DummyMessageChannel.__init__(self, configdata, daemon=daemon,
+                                     hostid=hostid)
+        #{nick: channel} of this host
+        self.members = bus.setdefault(hostid, {})
+        self.nick = None
+        self.announced = False
+
+    def run(self):
+        self.give_up = False
+        reactor.callLater(0.0, self.welcome)
+
+    def welcome(self):
+        if not self.give_up and self.on_welcome:
+            self.on_welcome(self)
+
+    def shutdown(self):
+        self.give_up = True
+        if self.members.get(self.nick) == self:
+            del self.members[self.nick]
+            for mc in self.members.values():
+                self.deliver(mc, 'on_nick_leave', self.nick, mc)
+
+    def set_nick(self, nick):
+        DummyMessageChannel.set_nick(self, nick)
+        self.change_nick(nick)
+
+    def change_nick(self, new_nick):
+        if self.members.get(self.nick) == self:
+            del self.members[self.nick]
+        self.nick = new_nick
+        self.members[new_nick] = self
+
+    def deliver(self, mc, callback, *args):
+        def f():
+            if not mc.give_up and getattr(mc, callback):
+                getattr(mc, callback)(*args)
+        reactor.callLater(0.0, f)
+
+    def _pubmsg(self, msg):
+        for nick, mc in self.members.items():
+            if mc != self:
+                self.deliver(mc, 'on_pubmsg', self.nick, msg)
+
+    def _privmsg(self, nick, cmd, message):
+        mc = self.members.get(nick)
+        if mc:
+            self.deliver(mc, 'on_privmsg', self.nick,
+                         COMMAND_PREFIX + cmd + ' ' + message)
+
+    def _announce_orders(self, offerlist):
+        self.announced = True
+        self._pubmsg(''.join(offerlist))
+
+
+class PhaseRecorder(object):
+    """Records the wall clock and CPU time at the phase ends of the
+    round in progress, by wrapping the methods named in PHASES.
+    """
+
+    def __init__(self):
+        self.marks = None
+        self.originals = []
+
+    def start(self):
+        self.marks = {'start': (time.time(), process_time())}
+
+    def mark(self, name):
+        if self.marks is not None and name not in self.marks:
+            self.marks[name] = (time.time(), process_time())
+
+    def wrap(self, obj, attr, before=None, after=None):
+        orig = getattr(obj, attr)
+        def wrapper(*args, **kwargs):
+            if before:
+                self.mark(before)
+            retval = orig(*args, **kwargs)
+            if after:
+                self.mark(after)
+            return retval
+        if isinstance(obj, type):
+            #unbound methods are wrapped on the class, and restored later
+            self.originals.append((obj, attr, obj.__dict__[attr]))
+            def method(inst, *args, **kwargs):
+                return wrapper(inst, *args, **kwargs)
+            setattr(obj, attr, method)
+        else:
+            setattr(obj, attr, wrapper)
+
+    def install(self):
+        self.wrap(JMDaemonServerProtocol, 'respondToIoauths', before='stage1')
+        self.wrap(JMTakerClientProtocol, 'make_tx', before='tx_build')
+
+    def install_taker(self, taker):
+        self.wrap(taker, 'initialize', before='orderbook', after='initialize')
+        self.wrap(taker, 'push', before='signing')
+        self.wrap(taker, 'unconfirm_callback', before='broadcast')
+        self.wrap(taker, 'confirm_callback', before='confirmation')
+
+    def uninstall(self):
+        for cls, attr, orig in self.originals:
+            setattr(cls, attr, orig)
+        self.originals = []
+
+    def phase_times(self):
+        """Returns {phase: (wall seconds, cpu seconds)} for the phases
+        of the last round, or None if it did not complete them all.
+        """
+        names = ['start'] + [p for p, desc in PHASES]
+        if any([n not in self.marks for n in names]):
+            return None
+        return dict([(names[i], (
+            self.marks[names[i]][0] - self.marks[names[i - 1]][0],
+            self.marks[names[i]][1] - self.marks[names[i - 1]][1]))
+                     for i in range(1, len(names))])
+
+
+def make_funded_wallet(bci, values):
+    """Returns a new wallet with outputs of the given values at
+    mixdepth 0, paid in one (unconfirmed) transaction.
+    """
+    storage = VolatileStorage()
+    SegwitLegacyWallet.initialize(storage, get_network())
+    wallet = SegwitLegacyWallet(storage)
+    bci.coinbase_count += 1
+    txd = {'version': 1, 'locktime': 0,
+           'ins': [{'outpoint': {'hash': '00' * 32,
+                                 'index': bci.coinbase_count},
+                    'script': '', 'sequence': 4294967295}],
+           'outs': [{'script': btc.address_to_script(
+                        wallet.get_new_addr(0, False)), 'value': v}
+                    for v in values]}
+    bci.add_tx(txd, check_inputs=False)
+    return wallet
+
+
+def sync(bci, wallet):
+    bci.wallet_synced = False
+    bci.sync_wallet(wallet)
+    assert bci.wallet_synced, "failed to sync wallet"
+
+
+@defer.inlineCallbacks
+def wait_for(condition, timeout):
+    start = time.time()
+    while not condition():
+        if time.time() - start > timeout:
+            raise Exception("Timed out")
+        yield task.deferLater(reactor, 0.01, lambda: None)
+
+
+@defer.inlineCallbacks
+def run_round(port, bus, recorder, n_makers, n_inputs, round_timeout):
+    """Runs one coinjoin of a new taker with n_makers new makers
+    each spending n_inputs outputs; returns the phase times,
+    or None if the round failed.
+    """
+    bci = jm_single().bc_interface
+    cj_amount = int((n_inputs - 0.5) * UTXO_VALUE)
+    maker_wallets = [make_funded_wallet(bci, [UTXO_VALUE] * n_inputs)
+                     for i in range(n_makers)]
+    taker_wallet = make_funded_wallet(bci, [2 * cj_amount + 10**8])
+    bci.tick_forward_chain(jm_single().config.getint(
+        "POLICY", "taker_utxo_age") + 1)
+    for w in maker_wallets + [taker_wallet]:
+        sync(bci, w)
+    factories = []
+    for w in maker_wallets:
+        f = JMClientProtocolFactory(YieldGeneratorBasic(w, OFFER_CONFIG),
+                                    proto_type="MAKER")
+        reactor.connectTCP("localhost", port, f)
+        factories.append(f)
+    #all makers have announced their offers on all channels
+    yield wait_for(lambda: len([mc for members in bus.values()
+                                for mc in members.values()
+                                if mc.announced]) ==
+                   n_makers * len(bus), SETUP_TIMEOUT)
+
+    finished = defer.Deferred()
+    def on_finished_callback(res, fromtx=False, waittime=0.0,
+                             txdetails=None):
+        if fromtx == "unconfirmed" and res:
+            return
+        if not finished.called:
+            finished.callback(res)
+    taker = Taker(taker_wallet, [(0, cj_amount, n_makers, 'INTERNAL', 0)],
+                  callbacks=(lambda *args: True, None, on_finished_callback))
+    #no stall monitoring
+    taker.testflag = True
+    recorder.install_taker(taker)
+    recorder.start()
+    f = JMClientProtocolFactory(taker)
+    #e.g. on a message too large for the daemon protocol
+    f.clientConnectionLost = lambda connector, reason: \
+        on_finished_callback(False)
+    reactor.connectTCP("localhost", port, f)
+    factories.append(f)
+    timeout = reactor.callLater(round_timeout, on_finished_callback, False)
+    res = yield finished
+    if timeout.active():
+        timeout.cancel()
+
+    for f in factories:
+        if f.getClient() and f.getClient().transport:
+            f.getClient().transport.loseConnection()
+    for members in bus.values():
+        for mc in list(members.values()):
+            mc.shutdown()
+    if not res:
+        defer.returnValue(None)
+    defer.returnValue(recorder.phase_times())
+
+
+def percentile(values, p):
+    """The p-th percentile of values, by linear interpolation
+    between the closest ranks.
+    """
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def summarize(times):
+    wall = [t[0] for t in times]
+    cpu = [t[1] for t in times]
+    summary = dict([('p' + str(p), percentile(wall, p))
+                    for p in (50, 90, 99)])
+    summary['mean'] = sum(wall) / len(wall)
+    summary['cpu_mean'] = sum(cpu) / len(cpu)
+    summary['cpu_p90'] = percentile(cpu, 90)
+    return summary
+
+
+@defer.inlineCallbacks
+def run_benchmark(options, results):
+    bus = {}
+    daemon_protocol.get_message_channel = lambda c, daemon=None, \
+        realname=None: InMemoryMessageChannel(bus, c, daemon=daemon)
+    listener = reactor.listenTCP(0, JMDaemonServerProtocolFactory(),
+                                 interface="localhost")
+    port = listener.getHost().port
+    recorder = PhaseRecorder()
+    recorder.install()
+    try:
+        for n_makers in options.makers:
+            for n_inputs in options.inputs:
+                rounds = []
+                failures = 0
+                for i in range(options.rounds):
+                    times = yield run_round(port, bus, recorder, n_makers,
+                                            n_inputs, options.timeout)
+                    if times is None:
+                        failures += 1
+                        log.error("Round failed: {} makers, {} inputs".format(
+                            n_makers, n_inputs))
+                    else:
+                        rounds.append(times)
+                result = {'makers': n_makers, 'inputs': n_inputs,
+                          'rounds': len(rounds), 'failures': failures,
+                          'phases': {}}
+                if rounds:
+                    for phase, desc in PHASES:
+                        result['phases'][phase] = summarize(
+                            [r[phase] for r in rounds])
+                    result['phases']['total'] = summarize(
+                        [(sum([r[p][0] for p, d in PHASES]),
+                          sum([r[p][1] for p, d in PHASES]))
+                         for r in rounds])
+                results.append(result)
+                print_result(result)
+    except Exception as e:
+        log.error("Benchmark failed: " + repr(e))
+    finally:
+        recorder.uninstall()
+        listener.stopListening()
+        reactor.stop()
+
+
+def print_result(result):
+    print("\n{} makers, {} inputs each: {} rounds, {} failed".format(
+        result['makers'], result['inputs'], result['rounds'],
+        result['failures']))
+    if not result['phases']:
+        return
+    print("{:<14}{:>10}{:>10}{:>10}{:>10}{:>10}".format(
+        "phase (ms)", "p50", "p90", "p99", "mean", "cpu"))
+    for phase in [p for p, d in PHASES] + ['total']:
+        s = result['phases'][phase]
+        print("{:<14}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+            phase, *[1000 * s[k] for k in ('p50', 'p90', 'p99', 'mean',
+                                           'cpu_mean')]))
+
+
+def main():
+    parser = OptionParser(
+        usage='usage: %prog [options]',
+        description='Benchmarks coinjoin rounds between in-process '
+        'takers and makers, over an in-memory message channel and '
+        'a simulated blockchain. Phases are: ' + ', '.join(
+            ['{} (ends at: {})'.format(p, d) for p, d in PHASES]))
+    parser.add_option('--makers', default='2,5,10,20',
+                      help='comma separated numbers of makers to run '
+                      'rounds with, default 2,5,10,20')
+    parser.add_option('--inputs', default='1,10,50',
+                      help='comma separated numbers of inputs per maker '
+                      'to run rounds with, default 1,10,50')
+    parser.add_option('--rounds', type='int', default=5,
+                      help='rounds per configuration, default 5')
+    parser.add_option('--timeout', type='float', default=300,
+                      help='seconds after which a round is counted as '
+                      'failed, default 300')
+    parser.add_option('--output', default=None,
+                      help='file to write the results to, as JSON')
+    (options, args) = parser.parse_args()
+    options.makers = [int(x) for x in options.makers.split(',')]
+    options.inputs = [int(x) for x in options.inputs.split(',')]
+
+    #the config and the commitment files are kept out of the way
+    datadir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(datadir)
+    #for the makers' income statements, and the taker's commitments
+    os.mkdir('logs')
+    os.mkdir('cmtdata')
+    with open('joinmarket.cfg', 'w') as f:
+        f.write(defaultconfig)
+    load_program_config(bs='simulated')
+    for section, option, value in [('BLOCKCHAIN', 'network', 'testnet'),
+                                   ('DAEMON', 'use_ssl', 'false'),
+                                   ('POLICY', 'tx_broadcast', 'self'),
+                                   ('POLICY', 'listunspent_args', '[0]'),
+                                   ('POLICY', 'early_fill', 'true')]:
+        jm_single().config.set(section, option, value)
+    set_logging_level('ERROR')
+    jm_single().bc_interface.tick_forward_chain_interval = BLOCK_INTERVAL
+    results = []
+    start = time.time()
+    reactor.callWhenRunning(run_benchmark, options, results)
+    reactor.run()
+    os.chdir(cwd)
+    shutil.rmtree(datadir)
+
+    output = {'python': platform.python_version(),
+              'platform': platform.platform(),
+              'duration': time.time() - start,
+              'block_interval': BLOCK_INTERVAL,
+              'utxo_value': UTXO_VALUE,
+              'results': results}
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(output, f, indent=4, sort_keys=True)
+        print("\nResults written to: " + options.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+#! /usr/bin/env python
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import * # noqa: F401
+'''Benchmarks one orderbook refresh between daemon and taker, sent
+either as a full JMOffers snapshot or as a JMOffersDelta, for a book
+of a given number of offers of which a given number are cancelled,
+re-priced and newly announced between refreshes. Each refresh is a
+JMRequestOffers from a JMTakerClientProtocol to a
+JMDaemonServerProtocol, connected in memory, so that it runs the
+daemon's on_JM_REQUEST_OFFERS and the client's on_JM_OFFERS or
+on_JM_OFFERS_DELTA responders, with the AMP encoding and decoding of
+the commands; the bytes sent by the daemon and the process CPU time
+per refresh are reported.
+This is NOT part of the test-suite. Run it like:
+   PYTHONPATH=.:$PYTHONPATH python test/bench_orderbook_delta.py \
+   --offers=2000 --changed=10 --refreshes=200
+   '''
+
+import json
+import platform
+import time
+from optparse import OptionParser
+
+from twisted.test import proto_helpers
+
+from jmclient.client_protocol import JMTakerClientProtocol
+from jmdaemon import MessageChannelCollection
+from jmdaemon.daemon_protocol import JMDaemonServerProtocol
+from jmdaemon.orderbookwatch import OrderbookWatch
+
+try:
+    process_time = time.process_time
+except AttributeError:
+    #Python 2; clock is CPU time on Unix
+    process_time = time.clock
+
+
+def percentile(values, p):
+    """The p-th percentile of values, by linear interpolation
+    between the closest ranks.
+    """
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def make_offer(i, cjfee="0.0002"):
+    return {'counterparty': 'J5cp' + str(i // 2), 'oid': i % 2,
+            'ordertype': 'swreloffer', 'minsize': 27300,
+            'maxsize': 599972700, 'txfee': 1000, 'cjfee': cjfee}
+
+
+def make_books(n_offers, n_changed, n_refreshes):
+    """Returns the successive orderbooks (as lists of offers, in the
+    daemon's format) seen at each refresh: between two of them,
+    n_changed offers are cancelled, n_changed re-priced and n_changed
+    newly announced.
+    """
+    books = []
+    first = 0
+    for r in range(n_refreshes + 1):
+        book = [make_offer(i) for i in range(first, first + n_offers)]
+        #alternate the fee, so the re-priced offers differ every time
+        cjfee = "0.0003" if r % 2 else "0.0004"
+        for j in range(n_changed, 2 * n_changed):
+            book[j] = make_offer(first + j, cjfee)
+        books.append(book)
+        first += n_changed
+    return books
+
+
+def by_key(book):
+    return dict([((o['counterparty'], o['oid']), o) for o in book])
+
+
+class BenchDaemonProtocol(JMDaemonServerProtocol):
+
+    def __init__(self):
+        JMDaemonServerProtocol.__init__(self, None)
+        #no message channels: the offers are fed in by set_book
+        OrderbookWatch.set_msgchan(self, MessageChannelCollection([]))
+        self.book = {}
+
+    def set_book(self, book):
+        """Updates the daemon's orderbook to book, as the message
+        channel callbacks would on the offers announced and cancelled.
+        """
+        book = by_key(book)
+        for cp, oid in self.book:
+            if (cp, oid) not in book:
+                self.on_order_cancel(cp, oid)
+        for k, o in book.items():
+            if self.book.get(k) != o:
+                self.on_order_seen(o['counterparty'], o['oid'],
+                                   o['ordertype'], o['minsize'],
+                                   o['maxsize'], o['txfee'], o['cjfee'])
+        self.book = book
+
+
+class BenchTakerClientProtocol(JMTakerClientProtocol):
+
+    def __init__(self, delta):
+        JMTakerClientProtocol.__init__(self, None, None)
+        self.delta = delta
+
+    def connectionMade(self):
+        #no JMInit; only the orderbook commands are exchanged
+        pass
+
+    def get_offers(self):
+        if not self.delta:
+            #always ask for a full snapshot
+            self.offers_version = None
+        JMTakerClientProtocol.get_offers(self)
+
+    def process_offers(self, orderbook, cached_counterparties):
+        self.orderbook = orderbook
+
+
+def connect(daemon, client):
+    """Connects the two protocols with in-memory transports; returns a
+    function which delivers all the pending data both ways, and returns
+    the number of bytes the daemon sent.
+    """
+    daemon.makeConnection(proto_helpers.StringTransport())
+    client.makeConnection(proto_helpers.StringTransport())
+
+    def pump():
+        sent = 0
+        while True:
+            from_daemon = daemon.transport.value()
+            from_client = client.transport.value()
+            if not from_daemon and not from_client:
+                return sent
+            daemon.transport.clear()
+            client.transport.clear()
+            sent += len(from_daemon)
+            client.dataReceived(from_daemon)
+            daemon.dataReceived(from_client)
+    return pump
+
+
+def run(books, delta):
+    """Returns the bytes sent by the daemon and CPU time of each
+    refresh after the first (which is always a full snapshot).
+    """
+    daemon = BenchDaemonProtocol()
+    client = BenchTakerClientProtocol(delta)
+    pump = connect(daemon, client)
+    daemon.set_book(books[0])
+    client.get_offers()
+    pump()
+    sizes, cpu = [], []
+    for book in books[1:]:
+        daemon.set_book(book)
+        start = process_time()
+        client.get_offers()
+        sizes.append(pump())
+        cpu.append(process_time() - start)
+        #both ways must give the taker the same orderbook
+        assert by_key(client.orderbook) == by_key(book)
+    return sizes, cpu
+
+
+def main():
+    parser = OptionParser(
+        usage='usage: %prog [options]',
+        description='Benchmarks a full orderbook snapshot against a delta '
+        'per taker refresh.')
+    parser.add_option('--offers', type='int', default=2000,
+                      help='number of offers in the orderbook')
+    parser.add_option('--changed', type='int', default=10,
+                      help='number of offers cancelled, and of offers '
+                      're-priced, and of new offers, between refreshes')
+    parser.add_option('--refreshes', type='int', default=200,
+                      help='number of refreshes measured')
+    parser.add_option('--output', default=None,
+                      help='file to write the results to, as JSON')
+    (options, args) = parser.parse_args()
+
+    books = make_books(options.offers, options.changed, options.refreshes)
+    results = []
+    print("{} offers, {} cancelled, {} re-priced and {} new per "
+          "refresh".format(options.offers, options.changed,
+                           options.changed, options.changed))
+    print("{:>10}{:>12}{:>14}{:>14}".format(
+        "mode", "bytes", "p50 CPU (ms)", "p90 CPU (ms)"))
+    for mode, delta in [('full', False), ('delta', True)]:
+        sizes, cpu = run(books, delta)
+        result = {'mode': mode, 'bytes': sum(sizes) // len(sizes),
+                  'p50': percentile(cpu, 50), 'p90': percentile(cpu, 90),
+                  'mean': sum(cpu) / len(cpu)}
+        results.append(result)
+        print("{:>10}{:>12}{:>14.2f}{:>14.2f}".format(
+            mode, result['bytes'], 1000 * result['p50'],
+            1000 * result['p90']))
+
+    if options.output:
+        output = {'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'offers': options.offers,
+                  'changed': options.changed,
+                  'refreshes': options.refreshes,
+                  'results': results}
+        with open(options.output, 'w') as f:
+            json.dump(output, f, indent=4, sort_keys=True)
+        print("\nResults written to: " + options.output)
+
+
+if __name__ == "__main__":
+    main()
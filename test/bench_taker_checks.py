@@ -0,0 +1,251 @@
+#! /usr/bin/env python
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import * # noqa: F401
+'''Benchmarks the Taker's checks of the makers' data in a coinjoin
+round, for a number of makers each contributing a number of inputs,
+on the simulated blockchain interface with a given latency per request
+(a round trip to the node):
+* receive_utxos: checks of the !ioauth messages, and the lookup of
+  the makers' utxos, done in one of these ways:
+    combined: one query for the utxos of all makers (as the Taker does),
+    per_maker: one query per maker,
+    per_utxo: one query per utxo (as with one gettxout RPC per utxo).
+* on_sig: verification of all the makers' signatures, received one
+  by one, until the Taker signs.
+This is NOT part of the test-suite. Run it like:
+   PYTHONPATH=.:$PYTHONPATH python test/bench_taker_checks.py \
+   --makers=2,5,10,20 --inputs=1,5,10 --latency=0.001
+   '''
+
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from future.utils import iteritems
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_coinjoin import (make_funded_wallet, sync, percentile,
+                            OFFER_CONFIG, UTXO_VALUE)
+
+from jmbase import get_log, set_logging_level
+from jmclient import (load_program_config, jm_single, YieldGeneratorBasic,
+                      Taker)
+from jmclient.configure import defaultconfig
+
+log = get_log()
+
+MODES = ['combined', 'per_maker', 'per_utxo']
+#stands for the maker's encryption pubkey, which the maker signs
+#with its authorising utxo's key (set up by jmdaemon)
+KPHEX = '00'
+
+
+def query_per_maker(ioauth_data):
+    bci = jm_single().bc_interface
+    return dict([(nick, bci.query_utxo_set(nickdata[0]))
+                 for nick, nickdata in iteritems(ioauth_data)])
+
+
+def query_per_utxo(ioauth_data):
+    bci = jm_single().bc_interface
+    return dict([(nick, [bci.query_utxo_set([u])[0] for u in nickdata[0]])
+                 for nick, nickdata in iteritems(ioauth_data)])
+
+
+def setup_round(n_makers, n_inputs):
+    """Returns a new taker, initialized for a coinjoin with n_makers
+    new makers each spending n_inputs outputs, the makers, and their
+    ioauth data and offer information (as kept by the daemon), by nick.
+    """
+    bci = jm_single().bc_interface
+    cj_amount = int((n_inputs - 0.5) * UTXO_VALUE)
+    maker_wallets = [make_funded_wallet(bci, [UTXO_VALUE] * n_inputs)
+                     for i in range(n_makers)]
+    taker_wallet = make_funded_wallet(bci, [2 * cj_amount + 10**8])
+    bci.tick_forward_chain(jm_single().config.getint(
+        "POLICY", "taker_utxo_age") + 1)
+    for w in maker_wallets + [taker_wallet]:
+        sync(bci, w)
+    makers = [YieldGeneratorBasic(w, OFFER_CONFIG) for w in maker_wallets]
+    orderbook = []
+    for i, m in enumerate(makers):
+        m.offerlist[0]['counterparty'] = str(i)
+        orderbook.extend(m.offerlist)
+    taker = Taker(taker_wallet, [(0, cj_amount, n_makers, 'INTERNAL', 0)],
+                  callbacks=(lambda *args: True, None, lambda *args: None))
+    taker.testflag = True
+    init_data = taker.initialize(orderbook)
+    assert init_data[0], "taker.initialize failed"
+    ioauth_data = {}
+    offerinfos = {}
+    for nick, order in iteritems(init_data[4]):
+        response = makers[int(nick)].on_auth_received(
+            'TAKER', order, init_data[2][1:], init_data[3], init_data[1],
+            KPHEX)
+        assert response[0], "maker.on_auth_received failed"
+        ioauth_data[nick] = [list(response[1].keys())] + \
+            list(response[2:]) + [KPHEX]
+        offerinfos[nick] = {'utxos': response[1], 'cjaddr': response[3],
+                            'changeaddr': response[4], 'offer': order,
+                            'amount': cj_amount}
+    return taker, makers, ioauth_data, offerinfos
+
+
+def count_requests(bci, requests):
+    """Counts the calls of bci.query_utxo_set into requests
+    (until deleted).
+    """
+    def query_utxo_set(txout, *args, **kwargs):
+        requests.append(txout)
+        return type(bci).query_utxo_set(bci, txout, *args, **kwargs)
+    bci.query_utxo_set = query_utxo_set
+
+
+def run_receive_utxos(n_makers, n_inputs, mode, latency):
+    """Returns the wall clock seconds taken by receive_utxos, and the
+    number of utxo lookup requests it made.
+    """
+    bci = jm_single().bc_interface
+    taker, makers, ioauth_data, offerinfos = setup_round(n_makers, n_inputs)
+    if mode == 'per_maker':
+        taker.query_counterparty_utxos = query_per_maker
+    elif mode == 'per_utxo':
+        taker.query_counterparty_utxos = query_per_utxo
+    requests = []
+    count_requests(bci, requests)
+    bci.latency = latency
+    start = time.time()
+    try:
+        res = taker.receive_utxos(ioauth_data)
+    finally:
+        bci.latency = 0.0
+        del bci.query_utxo_set
+    elapsed = time.time() - start
+    assert res[0], "receive_utxos failed: " + str(res[1])
+    assert len(res[1]) == n_makers
+    return elapsed, len(requests)
+
+
+def run_on_sig(n_makers, n_inputs, mode, latency):
+    """Returns the wall clock seconds taken by on_sig for all the
+    makers' signatures, and the number of utxo lookup requests made.
+    """
+    bci = jm_single().bc_interface
+    taker, makers, ioauth_data, offerinfos = setup_round(n_makers, n_inputs)
+    res = taker.receive_utxos(ioauth_data)
+    assert res[0], "receive_utxos failed: " + str(res[1])
+    sigs = []
+    for nick in res[1]:
+        signed = makers[int(nick)].on_tx_received('TAKER', res[2],
+                                                  offerinfos[nick])
+        assert signed[0], "maker.on_tx_received failed"
+        sigs.extend([(nick, sig) for sig in signed[1]])
+    #our own signing is not measured
+    signing = []
+    taker.self_sign_and_push = lambda: signing.append(time.time())
+    requests = []
+    count_requests(bci, requests)
+    bci.latency = latency
+    start = time.time()
+    try:
+        for nick, sig in sigs:
+            taker.on_sig(nick, sig)
+    finally:
+        bci.latency = 0.0
+        del bci.query_utxo_set
+    assert len(signing) == 1, "not all signatures were accepted"
+    return signing[0] - start, len(requests)
+
+
+CHECKS = {'receive_utxos': (run_receive_utxos, MODES),
+          'on_sig': (run_on_sig, ['taker'])}
+
+
+def main():
+    parser = OptionParser(
+        usage='usage: %prog [options]',
+        description='Benchmarks the Taker\'s checks of the makers\' '
+        'utxos and authorisation (Taker.receive_utxos), with the makers\' '
+        'utxos looked up in each of these ways: ' + ', '.join(MODES))
+    parser.add_option('--checks', default='receive_utxos,on_sig',
+                      help='comma separated checks to benchmark, '
+                      'default receive_utxos,on_sig')
+    parser.add_option('--makers', default='2,5,10,20',
+                      help='comma separated numbers of makers, '
+                      'default 2,5,10,20')
+    parser.add_option('--inputs', default='1,5,10',
+                      help='comma separated numbers of inputs per maker, '
+                      'default 1,5,10')
+    parser.add_option('--latency', type='float', default=0.001,
+                      help='seconds each request to the blockchain '
+                      'interface takes, default 0.001')
+    parser.add_option('--rounds', type='int', default=5,
+                      help='rounds per configuration, default 5')
+    parser.add_option('--output', default=None,
+                      help='file to write the results to, as JSON')
+    (options, args) = parser.parse_args()
+    options.makers = [int(x) for x in options.makers.split(',')]
+    options.inputs = [int(x) for x in options.inputs.split(',')]
+    options.checks = options.checks.split(',')
+
+    datadir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(datadir)
+    os.mkdir('logs')
+    os.mkdir('cmtdata')
+    with open('joinmarket.cfg', 'w') as f:
+        f.write(defaultconfig)
+    load_program_config(bs='simulated')
+    for section, option, value in [('BLOCKCHAIN', 'network', 'testnet'),
+                                   ('POLICY', 'listunspent_args', '[0]')]:
+        jm_single().config.set(section, option, value)
+    set_logging_level('ERROR')
+
+    results = []
+    print("{:>14}{:>7}{:>7}{:>11}{:>10}{:>10}{:>10}".format(
+        "check", "makers", "inputs", "mode", "p50 (ms)", "p90 (ms)",
+        "requests"))
+    try:
+        for check in options.checks:
+            run_round, modes = CHECKS[check]
+            for n_makers, n_inputs, mode in [(m, i, mode)
+                                             for m in options.makers
+                                             for i in options.inputs
+                                             for mode in modes]:
+                rounds = [run_round(n_makers, n_inputs, mode,
+                                    options.latency)
+                          for i in range(options.rounds)]
+                times = [r[0] for r in rounds]
+                result = {'check': check, 'makers': n_makers,
+                          'inputs': n_inputs, 'mode': mode,
+                          'p50': percentile(times, 50),
+                          'p90': percentile(times, 90),
+                          'mean': sum(times) / len(times),
+                          'requests': rounds[0][1]}
+                results.append(result)
+                print("{:>14}{:>7}{:>7}{:>11}{:>10.1f}{:>10.1f}"
+                      "{:>10}".format(
+                    check, n_makers, n_inputs, mode, 1000 * result['p50'],
+                    1000 * result['p90'], result['requests']))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(datadir)
+
+    if options.output:
+        output = {'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'latency': options.latency,
+                  'results': results}
+        with open(options.output, 'w') as f:
+            json.dump(output, f, indent=4, sort_keys=True)
+        print("\nResults written to: " + options.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,453 @@
+#! /usr/bin/env python
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import * # noqa: F401
+'''Simulates tumbler runs offline, many times over, to estimate the
+fees, the failures and the wall time of tumbler schedules for given
+tumbler options, before running them with real coins.
+Each run generates a schedule with get_tumble_schedule (or reads one
+with --schedule) and plays it against an orderbook, which is either
+synthetic or recorded (the /orderbook.json page of ob-watcher). The
+Taker's own functions choose the offers (choose_orders and
+choose_sweep_orders, with the --order-choose-algorithm and the -x/-r
+fee limits), the tumbler's filter decides whether to accept them, and
+failed transactions are handled as tumbler_taker_finished_update does:
+non-responding makers are ignored from then on, a transaction is
+retried with the honest makers if enough of them signed, and otherwise
+the schedule is tweaked with tweak_tumble_schedule.
+Each maker fails to respond in each phase of a coinjoin with
+probability --failure-rate. Time is simulated: a successful transaction
+takes the wait for offers, the makers' responses, the wait for its
+first confirmation and then the schedule entry's wait; a failed one
+takes until the stall monitor restarts the Taker (20 times
+maker_timeout_sec).
+Runs are independent, and are spread over --processes processes; run
+number i uses the random seed --seed + i, so that the results do not
+depend on the number of processes.
+This is NOT part of the test-suite. Run it like:
+   PYTHONPATH=.:$PYTHONPATH python test/sim_tumbler_schedule.py \
+   --runs=2000 --amount=100000000 -N 6 1 -x 5000 -r 0.001
+   '''
+
+import copy
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'scripts'))
+from bench_coinjoin import percentile
+from cli_options import get_tumbler_parser, get_max_cj_fee_values
+
+import jmbitcoin as btc
+from jmbase import get_log, set_logging_level
+from jmclient import (load_program_config, jm_single, get_schedule,
+                      get_tumble_schedule, tweak_tumble_schedule,
+                      tumbler_filter_orders_callback, choose_orders,
+                      choose_sweep_orders, calc_cj_fee)
+from jmclient.configure import defaultconfig
+
+log = get_log()
+
+#as Taker.txfee_default, the tx fee contribution asked of each maker
+TXFEE_DEFAULT = 5000
+#inputs assumed for each maker, as in the Taker's sweep fee estimate
+MAKER_INS = 3
+FAILURE_REASONS = ['liquidity', 'fee_limit', 'funds', 'phase1', 'phase2']
+COLUMNS = ['fees', 'cjfees', 'txfees', 'fee_percent', 'transactions',
+           'failures', 'restarts', 'tweaks', 'hours']
+
+
+def make_orderbook(rng, n_makers):
+    """Returns a synthetic orderbook of one offer for each of n_makers
+    makers, with sizes and fees spread over the ranges usually seen.
+    """
+    orderbook = []
+    for i in range(n_makers):
+        minsize = int(10**rng.uniform(5, 7))
+        offer = {'counterparty': 'M{}'.format(i), 'oid': 0,
+                 'minsize': minsize,
+                 'maxsize': max(int(10**rng.uniform(6, 10)), 2 * minsize),
+                 'txfee': rng.choice([0, 0, 0, 500, 1000])}
+        if rng.random() < 0.7:
+            offer['ordertype'] = 'swreloffer'
+            offer['cjfee'] = '{:.6f}'.format(10**rng.uniform(-5.5, -3))
+        else:
+            offer['ordertype'] = 'swabsoffer'
+            offer['cjfee'] = int(10**rng.uniform(2, 4))
+        orderbook.append(offer)
+    return orderbook
+
+
+def load_orderbook(filename):
+    """Reads an orderbook as served by ob-watcher at /orderbook.json;
+    relative fees are turned back into the strings the Taker receives.
+    """
+    with open(filename, 'r') as f:
+        orderbook = json.load(f)
+    for o in orderbook:
+        if o['ordertype'] in ['swreloffer', 'reloffer']:
+            o['cjfee'] = str(o['cjfee'])
+    return orderbook
+
+
+def estimate_fee(ins, outs, fee_per_kb):
+    """Miner fee of a p2sh-p2wpkh transaction, as estimate_tx_fee
+    calculates it, for a given fee rate.
+    """
+    witness_estimate, non_witness_estimate = btc.estimate_tx_size(
+        ins, outs, 'p2sh-p2wpkh')
+    return int((non_witness_estimate + 0.25 * witness_estimate) *
+               fee_per_kb / 1000)
+
+
+class Simulation(object):
+    """One run of a tumbler schedule. The attributes read by
+    tumbler_filter_orders_callback are those of the Taker.
+    """
+
+    def __init__(self, options, orderbook, schedule, destaddrs):
+        self.options = options
+        self.orderbook = orderbook
+        self.schedule = copy.deepcopy(schedule)
+        self.destaddrs = destaddrs
+        self.max_cj_fee = options['max_cj_fee']
+        self.n_mixdepths = max([s[0] for s in schedule] + [
+            options['mixdepthsrc'] + options['mixdepthcount']]) + 1
+        self.balances = dict([(m, 0) for m in range(self.n_mixdepths)])
+        #the coins start in the mixdepth of the first entry
+        self.balances[schedule[0][0]] = options['amount']
+        self.utxos = dict([(m, 0) for m in range(self.n_mixdepths)])
+        self.utxos[schedule[0][0]] = options['utxos']
+        self.schedule_index = 0
+        self.ignored_makers = []
+        self.honest_makers = []
+        self.honest_only = False
+        self.nonrespondants = []
+        self.minimum_makers = jm_single().config.getint("POLICY",
+                                                         "minimum_makers")
+        self.timeout = jm_single().maker_timeout_sec
+        self.stats = dict([(k, 0) for k in COLUMNS + FAILURE_REASONS])
+        self.stats['abandoned'] = 0
+
+    def run(self):
+        seconds = 0.0
+        attempts = 0
+        while self.schedule_index < len(self.schedule):
+            if attempts == self.options['max_attempts']:
+                #the tumbler itself never gives up
+                self.stats['abandoned'] = 1
+                break
+            attempts += 1
+            res, duration = self.attempt()
+            seconds += duration
+            if res is True:
+                #first confirmation, then the schedule's wait (in minutes)
+                seconds += random.expovariate(
+                    1.0 / self.options['block_interval'])
+                seconds += 60 * self.schedule[self.schedule_index][4]
+                self.stats['transactions'] += 1
+                self.schedule_index += 1
+                self.honest_only = False
+                self.honest_makers = []
+                attempts = 0
+            else:
+                self.stats[res] += 1
+                self.stats['failures'] += 1
+                self.on_failure(res == 'phase2')
+        self.stats['fees'] = self.stats['cjfees'] + self.stats['txfees']
+        self.stats['fee_percent'] = (100.0 * self.stats['fees'] /
+                                     self.options['amount'])
+        self.stats['hours'] = seconds / 3600
+        return self.stats
+
+    def on_failure(self, in_phase2):
+        """As tumbler_taker_finished_update, after the stall monitor
+        has flagged the failure.
+        """
+        self.ignored_makers = list(set(self.ignored_makers +
+                                       self.nonrespondants))
+        if in_phase2:
+            self.honest_makers = list(set(self.maker_utxo_data).difference(
+                self.nonrespondants))
+            if len(self.honest_makers) >= self.minimum_makers:
+                self.schedule[self.schedule_index][2] = len(
+                    self.honest_makers)
+                self.honest_only = True
+                self.stats['restarts'] += 1
+                return
+        self.schedule = tweak_tumble_schedule(
+            self.options, self.schedule, self.schedule_index - 1,
+            self.destaddrs)
+        self.stats['tweaks'] += 1
+
+    def attempt(self):
+        """Tries the current schedule entry once; returns True or
+        the reason of the failure, and the seconds it took.
+        """
+        stalled = 20 * self.timeout
+        si = self.schedule[self.schedule_index]
+        mixdepth, amount, self.n_counterparties, destination = si[:4]
+        balance = self.balances[mixdepth]
+        orderbook = self.orderbook
+        if self.honest_only:
+            orderbook = [o for o in orderbook
+                         if o['counterparty'] in self.honest_makers]
+        self.maker_utxo_data = {}
+        if amount != 0:
+            #Taker.initialize re-reads the mixdepth balance for
+            #each entry
+            self.cjamount = amount
+            if isinstance(amount, float):
+                self.cjamount = max(int(amount * balance),
+                                    self.options['mincjamount'])
+            orders, total_cj_fee = choose_orders(
+                orderbook, self.cjamount, self.n_counterparties,
+                self.options['order_choose_fn'], self.ignored_makers,
+                max_cj_fee=self.max_cj_fee)
+            if orders is None:
+                return 'liquidity', stalled
+            accepted = tumbler_filter_orders_callback(
+                [orders, total_cj_fee], self.cjamount, self, self.options)
+            if not accepted or accepted == "retry":
+                return 'fee_limit', stalled
+            total_txfee = 2 * TXFEE_DEFAULT * self.n_counterparties
+            if self.cjamount + total_cj_fee + total_txfee > balance:
+                return 'funds', stalled
+            my_ins = 1
+        else:
+            my_ins = self.utxos[mixdepth]
+            if not balance:
+                return 'funds', stalled
+            total_txfee = max(estimate_fee(
+                my_ins + MAKER_INS * self.n_counterparties,
+                2 * self.n_counterparties + 1, self.options['fee_per_kb']),
+                self.n_counterparties * TXFEE_DEFAULT)
+            orders, self.cjamount, total_cj_fee = choose_sweep_orders(
+                orderbook, balance, total_txfee, self.n_counterparties,
+                self.options['order_choose_fn'], self.ignored_makers,
+                max_cj_fee=self.max_cj_fee)
+            if not orders:
+                return 'liquidity', stalled
+            if not tumbler_filter_orders_callback(
+                    (orders, total_cj_fee), self.cjamount, self,
+                    self.options):
+                return 'fee_limit', stalled
+        duration = self.timeout
+        #phase 1: the makers who send their utxos; with too few of
+        #them, the daemon ignores the others and the Taker stalls
+        self.nonrespondants = [nick for nick in orders
+                               if random.random() < self.options['failure_rate']]
+        responded = [nick for nick in orders
+                     if nick not in self.nonrespondants]
+        if len(responded) < self.minimum_makers:
+            return 'phase1', stalled
+        duration += self.timeout if self.nonrespondants else \
+            self.options['response_time']
+        #phase 2: the makers who sign
+        self.maker_utxo_data = dict([(nick, orders[nick])
+                                     for nick in responded])
+        self.nonrespondants = [nick for nick in responded
+                               if random.random() < self.options['failure_rate']]
+        if self.nonrespondants:
+            return 'phase2', stalled
+        duration += self.options['response_time']
+
+        cjfee = sum([calc_cj_fee(orders[nick]['ordertype'],
+                                 orders[nick]['cjfee'], self.cjamount)
+                     for nick in responded])
+        maker_txfees = sum([orders[nick]['txfee'] for nick in responded])
+        txfee = max(estimate_fee(my_ins + MAKER_INS * len(responded),
+                                 2 * len(responded) + 1 + (amount != 0),
+                                 self.options['fee_per_kb']) - maker_txfees,
+                    0)
+        if amount == 0:
+            received = balance - cjfee - txfee
+            self.balances[mixdepth] = 0
+            self.utxos[mixdepth] = 0
+        else:
+            received = self.cjamount
+            self.balances[mixdepth] -= self.cjamount + cjfee + txfee
+        if destination == "INTERNAL":
+            next_mixdepth = (mixdepth + 1) % self.n_mixdepths
+            self.balances[next_mixdepth] += received
+            self.utxos[next_mixdepth] += 1
+        self.stats['cjfees'] += cjfee
+        self.stats['txfees'] += txfee
+        return True, duration
+
+
+def init_worker(datadir, overrides, loglevel):
+    os.chdir(datadir)
+    load_program_config(bs='simulated')
+    for section, option, value in overrides:
+        jm_single().config.set(section, option, value)
+    jm_single().maker_timeout_sec = jm_single().config.getint(
+        'TIMEOUT', 'maker_timeout_sec')
+    set_logging_level(loglevel)
+
+
+def simulate(args):
+    """Worker function: returns the stats of the run with the given
+    seed.
+    """
+    seed, options, orderbook, schedule = args
+    random.seed(seed)
+    if schedule is None:
+        destaddrs = ['EXTERNAL{}'.format(i)
+                     for i in range(options['addrcount'])]
+        schedule = get_tumble_schedule(options, destaddrs)
+    else:
+        destaddrs = [s[3] for s in schedule if s[3] != "INTERNAL"]
+    return Simulation(options, orderbook, schedule, destaddrs).run()
+
+
+def summarize(results):
+    summary = {}
+    for c in COLUMNS:
+        values = [r[c] for r in results]
+        summary[c] = {'mean': sum(values) / float(len(values)),
+                      'p10': percentile(values, 10),
+                      'p50': percentile(values, 50),
+                      'p90': percentile(values, 90),
+                      'max': max(values)}
+    for c in FAILURE_REASONS + ['abandoned']:
+        summary[c] = sum([r[c] for r in results])
+    return summary
+
+
+def print_summary(summary, runs):
+    print("{:<14}".format("") + "".join(
+        ["{:>14}".format(s) for s in ['mean', 'p10', 'p50', 'p90', 'max']]))
+    for c in COLUMNS:
+        print("{:<14}".format(c) + "".join(
+            ["{:>14.2f}".format(summary[c][s])
+             for s in ['mean', 'p10', 'p50', 'p90', 'max']]))
+    print("failures by reason over {} runs: ".format(runs) + ", ".join(
+        ["{} {}".format(c, summary[c]) for c in FAILURE_REASONS]))
+    print("abandoned runs: {}".format(summary['abandoned']))
+
+
+def main():
+    parser = get_tumbler_parser()
+    parser.set_usage('usage: %prog [options]')
+    parser.description = ('Simulates runs of the tumbler with the given '
+                          'tumbler options against an orderbook, and '
+                          'prints the distributions of their fees, '
+                          'failures and wall time.')
+    parser.set_defaults(max_cj_fee_abs=5000, max_cj_fee_rel=0.001)
+    parser.add_option('--runs', type='int', default=1000,
+                      help='number of simulated runs, default 1000')
+    parser.add_option('--processes', type='int',
+                      default=multiprocessing.cpu_count(),
+                      help='number of processes to run them in, default '
+                      'the number of cpus')
+    parser.add_option('--amount', type='int', default=10**8,
+                      help='satoshis in the mixdepth of the first schedule '
+                      'entry at the start, default 100000000')
+    parser.add_option('--utxos', type='int', default=1,
+                      help='utxos in that mixdepth at the start, '
+                      'default 1')
+    parser.add_option('--schedule', default=None,
+                      help='schedule file to run, instead of generating '
+                      'a schedule for each run')
+    parser.add_option('--orderbook', default=None,
+                      help='orderbook to use, as JSON from ob-watcher\'s '
+                      '/orderbook.json, instead of a synthetic one')
+    parser.add_option('--makers', type='int', default=100,
+                      help='number of makers in the synthetic orderbook, '
+                      'default 100')
+    parser.add_option('--failure-rate', type='float', default=0.05,
+                      dest='failure_rate',
+                      help='probability that a maker does not respond, in '
+                      'each phase of a coinjoin, default 0.05')
+    parser.add_option('--response-time', type='float', default=10,
+                      dest='response_time',
+                      help='seconds the makers take to respond in each '
+                      'phase, default 10')
+    parser.add_option('--block-interval', type='float', default=600,
+                      dest='block_interval',
+                      help='mean seconds between blocks, default 600')
+    parser.add_option('--fee-per-kb', type='int', default=10000,
+                      dest='fee_per_kb',
+                      help='miner fee rate in satoshis per kB, '
+                      'default 10000')
+    parser.add_option('--minimum-makers', type='int', default=None,
+                      dest='minimum_makers',
+                      help='POLICY minimum_makers, default as in '
+                      'joinmarket.cfg')
+    parser.add_option('--max-attempts', type='int', default=100,
+                      dest='max_attempts',
+                      help='attempts at one schedule entry after which a '
+                      'run is abandoned, default 100')
+    parser.add_option('--seed', type='int', default=0,
+                      help='random seed of the orderbook and the first '
+                      'run, default 0')
+    parser.add_option('--output', default=None,
+                      help='file to write the summary and the results of '
+                      'all runs to, as JSON')
+    (options_org, args) = parser.parse_args()
+
+    #the config is kept out of the way
+    datadir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    overrides = [('BLOCKCHAIN', 'network', 'testnet')]
+    if options_org.minimum_makers is not None:
+        overrides.append(('POLICY', 'minimum_makers',
+                          str(options_org.minimum_makers)))
+    loglevel = os.environ.get('SIMLOG', 'ERROR')
+    try:
+        with open(os.path.join(datadir, 'joinmarket.cfg'), 'w') as f:
+            f.write(defaultconfig)
+        init_worker(datadir, overrides, loglevel)
+        options = vars(options_org)
+        options['max_cj_fee'] = get_max_cj_fee_values(jm_single().config,
+                                                      options_org)
+        schedule = None
+        if options['schedule']:
+            res, schedule = get_schedule(os.path.join(cwd,
+                                                      options['schedule']))
+            if not res:
+                parser.error("Failed to load schedule: " + schedule)
+        if options['orderbook']:
+            orderbook = load_orderbook(os.path.join(cwd,
+                                                    options['orderbook']))
+        else:
+            orderbook = make_orderbook(random.Random(options['seed']),
+                                       options['makers'])
+
+        start = time.time()
+        work = [(options['seed'] + i, options, orderbook, schedule)
+                for i in range(options['runs'])]
+        pool = multiprocessing.Pool(options['processes'], init_worker,
+                                    (datadir, overrides, loglevel))
+        try:
+            results = pool.map(simulate, work, chunksize=max(
+                1, options['runs'] // (4 * options['processes'])))
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = time.time() - start
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(datadir)
+
+    summary = summarize(results)
+    print("{} runs in {:.1f} seconds, {} processes, {} offers".format(
+        len(results), elapsed, options['processes'], len(orderbook)))
+    print_summary(summary, len(results))
+    if options['output']:
+        del options['order_choose_fn']
+        with open(options['output'], 'w') as f:
+            json.dump({'options': options, 'summary': summary,
+                       'results': results}, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
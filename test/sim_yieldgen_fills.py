@@ -0,0 +1,305 @@
+#! /usr/bin/env python
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+from builtins import * # noqa: F401
+'''Simulates a yield generator serving a synthetic stream of takers,
+to compare the fills per hour of the yield generator classes.
+Takers arrive at random (a Poisson process), each wanting a coinjoin of
+a random amount; a taker fills an offer of the maker which the amount
+fits, if any, and its coinjoin is broadcast round_time seconds later,
+so coinjoins overlap when takers arrive faster than that; the maker
+signs half way through. The maker's
+coins are spent when the coinjoin is broadcast, and its new coins
+(coinjoin output and change) are available once the coinjoin is
+confirmed, in the next block.
+The maker's own code decides the offers, the utxos of each fill and
+the offers to reannounce after each transaction; the wallet is a real
+(in-memory) wallet, and the time is simulated, so that many hours run
+in seconds. Every class is run against the same takers and blocks.
+This is NOT part of the test-suite. Run it like:
+   PYTHONPATH=.:$PYTHONPATH python test/sim_yieldgen_fills.py \
+   --hours=24 --rate=10 --output=fills.json
+   '''
+
+import json
+import os
+import random
+import shutil
+import tempfile
+from optparse import OptionParser
+
+from twisted.internet import task
+
+import jmbitcoin as btc
+import jmclient
+from jmbase import get_log, set_logging_level
+from jmclient import (load_program_config, jm_single, YieldGeneratorBasic,
+                      YieldGeneratorMultiOffer, SegwitLegacyWallet,
+                      VolatileStorage, get_network, calc_cj_fee)
+from jmclient.configure import defaultconfig
+
+log = get_log()
+
+
+class UnreservedYieldGenerator(YieldGeneratorBasic):
+    """YieldGeneratorBasic as it was before utxo reservations: concurrent
+    fills can choose the same utxos, and then all but one fail.
+    """
+    def reserve_utxos(self, utxos, seconds):
+        pass
+
+
+YG_CLASSES = {'basic': YieldGeneratorBasic,
+              'multioffer': YieldGeneratorMultiOffer,
+              'unreserved': UnreservedYieldGenerator}
+#txfee, cjfee_a, cjfee_r, ordertype, minsize
+OFFER_CONFIG = [0, 0, '0.0002', 'swreloffer', 100000]
+
+
+def make_takers(rng, hours, rate, min_amount, max_amount):
+    """Returns the (arrival time, amount) of the takers of a simulation;
+    amounts are uniform on a log scale.
+    """
+    takers = []
+    t = rng.expovariate(rate / 3600.0)
+    while t < hours * 3600:
+        amount = int(min_amount * (max_amount / float(min_amount)) **
+                     rng.random())
+        takers.append((t, amount))
+        t += rng.expovariate(rate / 3600.0)
+    return takers
+
+
+def make_blocks(rng, hours, block_interval):
+    """Returns the times of the blocks of a simulation (and one after).
+    """
+    blocks = [rng.expovariate(1.0 / block_interval)]
+    while blocks[-1] < hours * 3600:
+        blocks.append(blocks[-1] + rng.expovariate(1.0 / block_interval))
+    return blocks
+
+
+def foreign_script(i):
+    return btc.address_to_script(btc.privkey_to_address(
+        btc.sha256(str(i)), magicbyte=jmclient.get_p2pk_vbyte()))
+
+
+def make_funded_wallet(mixdepths, utxos_per_mixdepth, utxo_value):
+    storage = VolatileStorage()
+    SegwitLegacyWallet.initialize(storage, get_network(),
+                                  max_mixdepth=mixdepths - 1)
+    wallet = SegwitLegacyWallet(storage)
+    txd = {'version': 1, 'locktime': 0,
+           'ins': [{'outpoint': {'hash': '00' * 32, 'index': 0},
+                    'script': '', 'sequence': 4294967295}],
+           'outs': [{'script': btc.address_to_script(
+                        wallet.get_new_addr(md, False)), 'value': utxo_value}
+                    for md in range(mixdepths)
+                    for i in range(utxos_per_mixdepth)]}
+    wallet.add_new_utxos(txd, btc.txhash(btc.serialize(txd)))
+    return wallet
+
+
+class Simulation(object):
+
+    def __init__(self, ygclass, wallet, takers, blocks, round_time):
+        self.clock = task.Clock()
+        #the maker's utxo reservations expire in simulated time
+        jmclient.maker.reactor = self.clock
+        self.maker = ygclass(wallet, OFFER_CONFIG)
+        self.takers = takers
+        self.blocks = blocks
+        self.round_time = round_time
+        self.stats = {'takers': len(takers), 'no_offer': 0, 'refused': 0,
+                      'fills': 0, 'conflicts': 0, 'confirmed': 0,
+                      'volume': 0, 'earned': 0, 'offers_max': 0,
+                      'reannounced': 0, 'cancelled': 0}
+        self.txcount = 0
+        self.spent = set()
+
+    def run(self, seconds):
+        for t, amount in self.takers:
+            self.clock.callLater(t, self.on_taker, amount)
+        while self.clock.getDelayedCalls():
+            t = min([c.getTime() for c in self.clock.getDelayedCalls()])
+            if t > seconds:
+                break
+            self.clock.advance(t - self.clock.seconds())
+        self.stats['hours'] = seconds / 3600.0
+        self.stats['fills_per_hour'] = self.stats['fills'] / (seconds / 3600.0)
+        return self.stats
+
+    def on_taker(self, amount):
+        offers = [o for o in self.maker.offerlist
+                  if o['minsize'] <= amount <= o['maxsize']]
+        if not offers:
+            self.stats['no_offer'] += 1
+            return
+        #takers choose the cheapest offer (they are all the same here)
+        offer = offers[0]
+        utxos, cj_addr, change_addr = self.maker.oid_to_order(offer, amount)
+        if not utxos:
+            self.stats['refused'] += 1
+            return
+        #as in Maker.on_auth_received
+        self.maker.reserve_utxos(utxos.keys(),
+                                 2 * jm_single().maker_timeout_sec)
+        offerinfo = {'utxos': utxos, 'cjaddr': cj_addr,
+                     'changeaddr': change_addr, 'amount': amount,
+                     'offer': offer}
+        #the maker signs half way through the round
+        self.clock.callLater(self.round_time / 2, self.on_signed, offerinfo)
+        self.clock.callLater(self.round_time, self.on_broadcast, offerinfo)
+
+    def on_signed(self, offerinfo):
+        #as in Maker.on_tx_received
+        self.maker.reserve_utxos(offerinfo['utxos'].keys(), float(
+            jm_single().config.get("TIMEOUT", "unconfirm_timeout_sec")))
+
+    def on_broadcast(self, offerinfo):
+        if self.spent.intersection(offerinfo['utxos']):
+            #a double spend of an earlier coinjoin; it fails
+            self.stats['conflicts'] += 1
+            self.maker.release_utxos(offerinfo['utxos'].keys())
+            return
+        self.spent.update(offerinfo['utxos'])
+        self.txcount += 1
+        amount = offerinfo['amount']
+        offer = offerinfo['offer']
+        my_total_in = sum([u['value'] for u in offerinfo['utxos'].values()])
+        cjfee = calc_cj_fee(offer['ordertype'], offer['cjfee'], amount)
+        txd = {'version': 1, 'locktime': 0,
+               'ins': [{'outpoint': {'hash': u[:64], 'index': int(u[65:])},
+                        'script': '', 'sequence': 4294967295}
+                       for u in offerinfo['utxos']],
+               'outs': [{'script': btc.address_to_script(
+                             offerinfo['cjaddr']), 'value': amount},
+                        {'script': btc.address_to_script(
+                            offerinfo['changeaddr']),
+                         'value': my_total_in - amount - offer['txfee'] +
+                         cjfee},
+                        {'script': foreign_script(self.txcount),
+                         'value': amount}]}
+        txid = btc.txhash(btc.serialize(txd))
+        self.stats['fills'] += 1
+        self.stats['volume'] += amount
+        self.stats['earned'] += cjfee - offer['txfee']
+        #as in JMMakerClientProtocol.unconfirm_callback
+        self.maker.release_utxos(offerinfo['utxos'].keys())
+        self.maker.wallet.remove_old_utxos(txd)
+        self.modify_orders(*self.maker.on_tx_unconfirmed(offerinfo, txid,
+                                                         None))
+        block = [b for b in self.blocks if b > self.clock.seconds()][0]
+        self.clock.callLater(block - self.clock.seconds(), self.on_confirm,
+                             offerinfo, txd, txid)
+
+    def on_confirm(self, offerinfo, txd, txid):
+        self.stats['confirmed'] += 1
+        self.maker.wallet.add_new_utxos(txd, txid)
+        self.modify_orders(*self.maker.on_tx_confirmed(offerinfo, 1, txid))
+
+    def modify_orders(self, to_cancel, to_announce):
+        self.stats['cancelled'] += len(to_cancel)
+        self.stats['reannounced'] += len(to_announce)
+        self.maker.modify_orders(to_cancel, to_announce)
+        self.stats['offers_max'] = max(self.stats['offers_max'],
+                                       len(self.maker.offerlist))
+
+
+def print_results(results):
+    columns = ['fills_per_hour', 'fills', 'no_offer', 'refused', 'conflicts',
+               'offers_max', 'reannounced', 'earned']
+    print("{:<12}".format("class") + "".join(
+        ["{:>15}".format(c) for c in columns]))
+    for name, stats in results:
+        print("{:<12}".format(name) + "".join(
+            ["{:>15.2f}".format(stats[c]) if isinstance(stats[c], float)
+             else "{:>15}".format(stats[c]) for c in columns]))
+
+
+def main():
+    parser = OptionParser(
+        usage='usage: %prog [options]',
+        description='Simulates the fills of yield generators against '
+        'synthetic taker demand, in simulated time.')
+    parser.add_option('--classes', default='unreserved,basic,multioffer',
+                      help='comma separated yield generators to simulate, '
+                      'of: ' + ', '.join(sorted(YG_CLASSES.keys())) +
+                      '; default unreserved,basic,multioffer')
+    parser.add_option('--hours', type='float', default=24,
+                      help='simulated hours, default 24')
+    parser.add_option('--rate', type='float', default=10,
+                      help='mean number of takers arriving per hour, '
+                      'default 10')
+    parser.add_option('--min-amount', type='int', default=10**6,
+                      dest='min_amount',
+                      help='smallest coinjoin amount wanted by a taker, '
+                      'in satoshis, default 1000000')
+    parser.add_option('--max-amount', type='int', default=10**8,
+                      dest='max_amount',
+                      help='largest coinjoin amount wanted by a taker, '
+                      'in satoshis, default 100000000')
+    parser.add_option('--round-time', type='float', default=120,
+                      dest='round_time',
+                      help='seconds from a fill to the broadcast of its '
+                      'coinjoin, default 120')
+    parser.add_option('--block-interval', type='float', default=600,
+                      dest='block_interval',
+                      help='mean seconds between blocks, default 600')
+    parser.add_option('--mixdepths', type='int', default=5,
+                      help='mixdepths of the maker wallet, default 5')
+    parser.add_option('--utxos', type='int', default=3,
+                      help='utxos in each mixdepth at the start, default 3')
+    parser.add_option('--utxo-value', type='int', default=5 * 10**7,
+                      dest='utxo_value',
+                      help='value of each utxo at the start, in satoshis, '
+                      'default 50000000')
+    parser.add_option('--seed', type='int', default=0,
+                      help='random seed of the takers and blocks, default 0')
+    parser.add_option('--output', default=None,
+                      help='file to write the results to, as JSON')
+    (options, args) = parser.parse_args()
+    classes = options.classes.split(',')
+    for c in classes:
+        if c not in YG_CLASSES:
+            parser.error('Unknown yield generator: ' + c)
+
+    #the config and the makers' income statements are kept out of the way
+    datadir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(datadir)
+    os.mkdir('logs')
+    with open('joinmarket.cfg', 'w') as f:
+        f.write(defaultconfig)
+    load_program_config(bs='simulated')
+    jm_single().config.set('BLOCKCHAIN', 'network', 'testnet')
+    set_logging_level(os.environ.get('SIMLOG', 'ERROR'))
+    #the maker creates its offers once the wallet is synced
+    jm_single().bc_interface.wallet_synced = True
+
+    rng = random.Random(options.seed)
+    takers = make_takers(rng, options.hours, options.rate,
+                         options.min_amount, options.max_amount)
+    blocks = make_blocks(rng, options.hours, options.block_interval)
+    results = []
+    try:
+        for name in classes:
+            wallet = make_funded_wallet(options.mixdepths, options.utxos,
+                                        options.utxo_value)
+            sim = Simulation(YG_CLASSES[name], wallet, takers, blocks,
+                             options.round_time)
+            results.append((name, sim.run(options.hours * 3600)))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(datadir)
+    print("{} takers in {} hours, amounts {} to {} satoshis".format(
+        len(takers), options.hours, options.min_amount, options.max_amount))
+    print_results(results)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'options': vars(options), 'results': dict(results)},
+                      f, indent=4)
+
+
+if __name__ == "__main__":
+    main()